@@ -0,0 +1,106 @@
+"""
+Compares write time and file size of the ODM2 SQLite output against the columnar export formats using the
+WaterML fixtures bundled in static_data/refts_test_files.
+
+Usage:          python benchmarks/bench_export_formats.py [--repeat 3] [--output results.json]
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tethysapp.hydroshare_resource_creator.utilities import parse_wml_series, write_odm2_series
+from tethysapp.hydroshare_resource_creator.exports import write_exports, EXPORT_FORMATS
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tethysapp", "hydroshare_resource_creator")
+FIXTURE_PATH = os.path.join(APP_PATH, "static_data", "refts_test_files")
+ODM_MASTER = os.path.join(APP_PATH, "static_data", "ODM2_master.sqlite")
+
+
+def load_fixture_series(wml_filepath):
+    with open(wml_filepath, "rb") as wml_file:
+        values_result = wml_file.read()
+    values_result = values_result[values_result.find(b"<"):]
+    wml_tree = etree.fromstring(values_result)
+    for wml_version in ("1.1", "1.0"):
+        ns = "{http://www.cuahsi.org/waterML/" + wml_version + "/}"
+        if list(wml_tree.iter(ns + "value")):
+            return parse_wml_series(wml_tree, ns)
+    return None
+
+
+def write_sqlite(series, output_path):
+    res_filepath = os.path.join(output_path, "benchmark.odm2.sqlite")
+    shutil.copy(ODM_MASTER, res_filepath)
+    sql_connect = sqlite3.connect(res_filepath, isolation_level=None)
+    curs = sql_connect.cursor()
+    curs.execute("BEGIN TRANSACTION;")
+    write_odm2_series(curs, series, ("benchmark", "singleTimeSeries", 1, "benchmark", "benchmark"))
+    sql_connect.commit()
+    sql_connect.close()
+    return [res_filepath]
+
+
+def run_benchmark(output_format, series, repeat):
+    timings = []
+    file_size = 0
+    for _ in range(repeat):
+        output_path = tempfile.mkdtemp()
+        try:
+            start_time = time.time()
+            if output_format == "odm2":
+                filepaths = write_sqlite(series, output_path)
+            else:
+                filepaths = write_exports([series], [output_format], os.path.join(output_path, "benchmark"))
+            timings.append(time.time() - start_time)
+            file_size = sum(os.path.getsize(filepath) for filepath in filepaths)
+        finally:
+            shutil.rmtree(output_path, ignore_errors=True)
+    return {"write_seconds": min(timings), "file_bytes": file_size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per fixture and format. The fastest is kept.")
+    parser.add_argument("--output", help="Optional path of a JSON file to write the results to.")
+    args = parser.parse_args()
+
+    output_formats = ["odm2"] + sorted(output_format for output_format in EXPORT_FORMATS
+                                       if EXPORT_FORMATS[output_format][1])
+    results = []
+    print("%-28s %8s %-8s %12s %14s" % ("fixture", "values", "format", "write (ms)", "size (bytes)"))
+    for wml_filename in sorted(os.listdir(FIXTURE_PATH)):
+        if not wml_filename.endswith("_resource.wml"):
+            continue
+        try:
+            series = load_fixture_series(os.path.join(FIXTURE_PATH, wml_filename))
+        except etree.XMLSyntaxError:
+            series = None
+        if series is None or not len(series["values"]["date_time"]):
+            continue
+        value_count = len(series["values"]["date_time"])
+        for output_format in output_formats:
+            try:
+                result = run_benchmark(output_format, series, args.repeat)
+            except sqlite3.IntegrityError:
+                continue
+            result.update({"fixture": wml_filename, "format": output_format, "value_count": value_count})
+            results.append(result)
+            print("%-28s %8d %-8s %12.1f %14d" % (wml_filename, value_count, output_format,
+                                                  result["write_seconds"] * 1000, result["file_bytes"]))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Measures the cost of loading the app the way a Tethys worker does at app registration: the time and peak RSS
+added by importing the controller modules once Django is set up, and which heavy dependencies they pull in.
+Each run uses a fresh interpreter.
+
+Run it inside the Tethys environment, where DJANGO_SETTINGS_MODULE defaults to tethys_portal.settings.
+
+Usage:          python benchmarks/bench_import.py [--repeat 5] [--importtime] [--output results.json]
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+REPO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Dependencies that should only be loaded by the requests that need them.
+HEAVY_MODULES = ("numpy", "pandas", "lxml.etree", "hs_restclient", "pyarrow", "netCDF4", "xmltodict", "requests")
+
+IMPORT_SCRIPT = """
+import os, sys, json, time, resource
+sys.path.insert(0, %(repo_path)r)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tethys_portal.settings")
+import django
+django.setup()
+import django.shortcuts, django.http, django.views.decorators.csrf
+scale = 1 if sys.platform == "darwin" else 1024
+start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+start_time = time.time()
+import tethysapp.hydroshare_resource_creator.controllers
+import tethysapp.hydroshare_resource_creator.controllers_ajax
+seconds = time.time() - start_time
+peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+print(json.dumps({"seconds": seconds, "rss_bytes": peak_rss - start_rss, "peak_rss_bytes": peak_rss,
+                  "heavy_modules": [name for name in %(heavy_modules)r if name in sys.modules]}))
+"""
+
+
+def run_import(importtime=False):
+    """
+    Imports the controllers in a fresh interpreter and returns its measurements, along with the slowest
+    modules reported by -X importtime when requested.
+    """
+
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + [
+        "-c", IMPORT_SCRIPT % {"repo_path": REPO_PATH, "heavy_modules": HEAVY_MODULES}]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(stderr.strip().splitlines()[-1] if stderr.strip() else "Import failed")
+    result = json.loads(stdout.strip().splitlines()[-1])
+
+    if importtime:
+        module_times = []
+        for line in stderr.splitlines():
+            parts = line.split("|")
+            if line.startswith("import time:") and len(parts) == 3 and parts[1].strip().isdigit():
+                module_times.append((int(parts[1]), parts[2].rstrip()))
+        result["slowest_modules"] = [{"module": module.strip(), "cumulative_us": cumulative}
+                                     for cumulative, module in sorted(module_times, reverse=True)[:20]]
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters to measure. The median is kept.")
+    parser.add_argument("--importtime", action="store_true", help="List the slowest modules of one more run.")
+    parser.add_argument("--output", help="Optional path of a JSON file to write the results to.")
+    args = parser.parse_args()
+
+    runs = sorted((run_import() for _ in range(args.repeat)), key=lambda run: run["seconds"])
+    median_run = runs[len(runs) // 2]
+    print("import time:     %.3f s (min %.3f s, max %.3f s)" % (median_run["seconds"], runs[0]["seconds"],
+                                                              runs[-1]["seconds"]))
+    print("RSS added:       %.1f MB" % (median_run["rss_bytes"] / 1048576.0))
+    print("heavy modules:   " + (", ".join(median_run["heavy_modules"]) or "none"))
+
+    slowest_modules = None
+    if args.importtime:
+        slowest_modules = run_import(importtime=True)["slowest_modules"]
+        for module_time in slowest_modules:
+            print("%10.1f ms  %s" % (module_time["cumulative_us"] / 1000.0, module_time["module"]))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "runs": runs,
+                "slowest_modules": slowest_modules
+            }, output_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
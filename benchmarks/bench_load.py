@@ -0,0 +1,331 @@
+"""
+Load test of the login_test and ajax_create_resource views of a single Tethys worker process.
+
+Simulated users run in threads against the real Django views: each user has its own session holding a refts
+served by the local WaterOneFlow stub, and repeatedly checks its login and builds a resource. HydroShare is
+replaced by a fake client that records createResource, addResourceFile, and setAccessRules calls after a
+configurable latency. Each concurrency level reports throughput, p50/p95/p99 latency per view, CPU use, and
+the mean number of requests in flight, and the first level where throughput stops growing is reported as
+the saturation point of the worker. With --heavy-users, that many more users per level build a synthetic
+series of --heavy-values values, so that the latency of the small builds can be measured under mixed load;
+builds turned away by admission control are counted as rejected.
+
+Run it inside the Tethys environment, where DJANGO_SETTINGS_MODULE defaults to tethys_portal.settings.
+
+Usage:          python benchmarks/bench_load.py [--users 1,2,4,8,16] [--requests 4] [--fixture gulf]
+                    [--hs-latency 0.2] [--wof-latency 0.1] [--access public] [--heavy-users 2]
+                    [--heavy-values 300000] [--output results.json]
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import platform
+import threading
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_pipeline import start_stub_process, load_case_refts
+
+# Data URL posted by the page when it is served from apps.hydroshare.org, which login_test pairs with the
+# www HydroShare host returned by get_o_auth_hs.
+DATA_URL = "https://apps.hydroshare.org/apps/hydroshare-resource-creator/"
+
+# Throughput gain below which adding users is considered to have saturated the worker.
+SATURATION_GAIN = 1.1
+
+hs_calls = []
+hs_calls_lock = threading.Lock()
+
+
+class FakeHydroShare(object):
+    """
+    Stands in for hs_restclient.HydroShare. Every call sleeps for the configured latency, plus the upload
+    time of any file at the configured bandwidth, and is recorded in hs_calls.
+    """
+
+    latency = 0.0
+    bandwidth = None
+
+    def __init__(self, auth=None, hostname="www.hydroshare.org", **kwargs):
+        self.hostname = hostname
+        self.resource_titles = {}
+
+    def record_call(self, method, byte_count=0):
+        seconds = self.latency + (byte_count / float(self.bandwidth) if self.bandwidth else 0.0)
+        time.sleep(seconds)
+        with hs_calls_lock:
+            hs_calls.append({"method": method, "seconds": seconds, "bytes": byte_count})
+
+    def createResource(self, resource_type, title, abstract=None, keywords=None, **kwargs):
+        self.record_call("createResource")
+        resource_id = uuid.uuid4().hex
+        self.resource_titles[resource_id] = title
+        return resource_id
+
+    def addResourceFile(self, pid, resource_file, resource_filename=None, progress_callback=None):
+        self.record_call("addResourceFile", os.path.getsize(resource_file) if os.path.isfile(resource_file) else 0)
+        return pid
+
+    def deleteResourceFile(self, pid, filename):
+        self.record_call("deleteResourceFile")
+        return pid
+
+    def setAccessRules(self, pid, public=False):
+        self.record_call("setAccessRules")
+        return pid
+
+    def getSystemMetadata(self, pid):
+        self.record_call("getSystemMetadata")
+        return {"resource_id": pid, "resource_title": self.resource_titles.get(pid, "Untitled resource")}
+
+    def deleteResource(self, pid):
+        self.record_call("deleteResource")
+        return pid
+
+
+class SimulatedUser(object):
+    """
+    Signed-in HydroShare user with the social auth token that get_o_auth_hs reads.
+    """
+
+    is_staff = False
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, username):
+        self.username = username
+        self.extra_data = {"token_dict": {"access_token": "load-test", "token_type": "Bearer"}}
+        self.social_auth = self
+
+    def get(self, provider=None):
+        return self
+
+    def is_authenticated(self):
+        return True
+
+    def __str__(self):
+        return self.username
+
+
+class SimulatedSession(dict):
+
+    def __init__(self, session_key):
+        dict.__init__(self)
+        self.session_key = session_key
+
+    def save(self):
+        pass
+
+
+def setup_views(args):
+    """
+    Configures Django and replaces the HydroShare client used by the views with the fake client.
+    """
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tethys_portal.settings")
+    import django
+    django.setup()
+    import hs_restclient
+    from tethysapp.hydroshare_resource_creator import utilities
+
+    FakeHydroShare.latency = args.hs_latency
+    FakeHydroShare.bandwidth = args.hs_bandwidth
+    hs_restclient.HydroShare = FakeHydroShare
+    utilities.use_hs_client_helper = False
+
+
+def make_request(user, session, data):
+    from django.test import RequestFactory
+
+    request = RequestFactory().post("/apps/hydroshare-resource-creator/", data, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+    request.user = user
+    request.session = session
+    return request
+
+
+def run_user(user_index, level_id, args, service_url_format, samples, samples_lock, heavy=False):
+    """
+    Loads a refts into the session of a simulated user, then sends its login checks and builds, recording
+    the latency and outcome of each request. Heavy users load a single synthetic series instead.
+    """
+
+    from tethysapp.hydroshare_resource_creator.utilities import process_form_data
+    from tethysapp.hydroshare_resource_creator.session_store import save_session_refts
+    from tethysapp.hydroshare_resource_creator.controllers_ajax import login_test, ajax_create_resource
+
+    user = SimulatedUser("loadtest%d" % user_index)
+    session = SimulatedSession("loadtest%s%d" % (level_id, user_index))
+    if heavy:
+        refts = load_case_refts({"fixture": "gulf", "kind": "synthetic"},
+                                service_url_format % ("synthetic/%d" % args.heavy_values))
+        refts["timeSeriesReferenceFile"]["referencedTimeSeries"][0]["valueCount"] = args.heavy_values
+    else:
+        refts = load_case_refts({"fixture": args.fixture, "kind": "fixture"}, service_url_format % args.fixture)
+    form_body = process_form_data(refts)
+    save_session_refts(make_request(user, session, {}), form_body)
+
+    login_data = {"dataUrl": DATA_URL, "actionRequest": args.action}
+    create_data = {"actionRequest": args.action, "resTitle": "Load test %d" % user_index,
+                   "resAbstract": "Load test", "resKeywords": "load,test", "resAccess": args.access,
+                   "outputFormats": args.formats}
+    for _ in range(args.requests):
+        for view_name, view, data in (("login_test", login_test, login_data),
+                                      ("ajax_create_resource", ajax_create_resource, create_data)):
+            start_time = time.time()
+            status_code = None
+            try:
+                response = view(make_request(user, session, data))
+                status_code = response.status_code
+                success = str(json.loads(response.content.decode("utf-8")).get("success")) == "True"
+            except Exception:
+                success = False
+            seconds = time.time() - start_time
+            with samples_lock:
+                samples.append({"view": view_name, "start": start_time, "seconds": seconds, "success": success,
+                                "rejected": status_code == 429, "heavy": heavy})
+        if args.think_time:
+            time.sleep(args.think_time)
+
+
+def get_latency_summary(samples):
+    seconds = np.array([sample["seconds"] for sample in samples], dtype=float)
+    if not len(seconds):
+        return {"requests": 0}
+    p50, p95, p99 = np.percentile(seconds, [50, 95, 99])
+    return {
+        "requests": len(seconds),
+        "errors": sum(1 for sample in samples if not sample["success"] and not sample["rejected"]),
+        "rejected": sum(1 for sample in samples if sample["rejected"]),
+        "mean": float(seconds.mean()),
+        "p50": float(p50),
+        "p95": float(p95),
+        "p99": float(p99),
+        "max": float(seconds.max())
+    }
+
+
+def run_level(user_count, args, service_url_format):
+    """
+    Runs one concurrency level and summarizes its throughput, latency, and worker use.
+    """
+
+    samples = []
+    samples_lock = threading.Lock()
+    del hs_calls[:]
+    level_id = uuid.uuid4().hex[:8]
+    threads = [threading.Thread(target=run_user, args=(user_index, level_id, args, service_url_format, samples,
+                                                       samples_lock, user_index >= user_count))
+               for user_index in range(user_count + args.heavy_users)]
+
+    start_times = os.times()
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.time() - start_time
+    end_times = os.times()
+    cpu_seconds = (end_times[0] - start_times[0]) + (end_times[1] - start_times[1])
+
+    build_samples = [sample for sample in samples if sample["view"] == "ajax_create_resource" and not sample["heavy"]]
+    heavy_samples = [sample for sample in samples if sample["view"] == "ajax_create_resource" and sample["heavy"]]
+    with hs_calls_lock:
+        call_counts = {}
+        for call in hs_calls:
+            call_counts[call["method"]] = call_counts.get(call["method"], 0) + 1
+
+    return {
+        "users": user_count,
+        "seconds": wall_seconds,
+        "requests": len(samples),
+        "throughput": len(samples) / wall_seconds if wall_seconds else None,
+        "builds_per_second": sum(1 for sample in build_samples if sample["success"]) / wall_seconds
+        if wall_seconds else None,
+        "cpu_utilization": cpu_seconds / wall_seconds if wall_seconds else None,
+        "in_flight": sum(sample["seconds"] for sample in samples) / wall_seconds if wall_seconds else None,
+        "views": {
+            "login_test": get_latency_summary([sample for sample in samples if sample["view"] == "login_test"]),
+            "ajax_create_resource": get_latency_summary(build_samples),
+            "heavy_create_resource": get_latency_summary(heavy_samples)
+        },
+        "hydroshare_calls": call_counts
+    }
+
+
+def get_saturation_point(levels):
+    """
+    Gets the first user count whose builds per second grew by less than SATURATION_GAIN over the previous
+    level, or None if throughput kept growing.
+    """
+
+    for previous_level, level in zip(levels, levels[1:]):
+        if level["builds_per_second"] < previous_level["builds_per_second"] * SATURATION_GAIN:
+            return level["users"]
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="1,2,4,8,16", help="Comma-separated simulated user counts.")
+    parser.add_argument("--requests", type=int, default=4, help="Login checks and builds per user.")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Seconds each user waits between builds.")
+    parser.add_argument("--fixture", default="gulf", help="Refts fixture loaded by every user.")
+    parser.add_argument("--action", default="ts", choices=["ts", "refts"], help="Resource type to build.")
+    parser.add_argument("--formats", default="odm2", help="Comma-separated output formats.")
+    parser.add_argument("--access", default="public", choices=["public", "private"])
+    parser.add_argument("--hs-latency", type=float, default=0.2, help="Fake HydroShare latency in seconds.")
+    parser.add_argument("--hs-bandwidth", type=float, help="Fake HydroShare upload bytes per second.")
+    parser.add_argument("--wof-latency", type=float, default=0.1, help="WaterOneFlow stub latency in seconds.")
+    parser.add_argument("--wof-bandwidth", type=float, help="WaterOneFlow stub bytes per second.")
+    parser.add_argument("--heavy-users", type=int, default=0,
+                        help="Users added to every level that build one large synthetic series.")
+    parser.add_argument("--heavy-values", type=int, default=300000, help="Values of the heavy users' series.")
+    parser.add_argument("--output", help="Optional path of a JSON file to write the results to.")
+    args = parser.parse_args()
+
+    stub_process, service_url_format = start_stub_process(args.wof_latency, args.wof_bandwidth)
+    setup_views(args)
+
+    levels = []
+    print("%6s %9s %10s %9s %9s %8s %8s %8s %8s %6s %9s" % ("users", "requests", "builds/s", "errors", "rejected",
+                                                            "p50 (s)", "p95 (s)", "p99 (s)", "login p95", "CPU",
+                                                            "in flight"))
+    for user_count in [int(count) for count in args.users.split(",") if count]:
+        level = run_level(user_count, args, service_url_format)
+        levels.append(level)
+        build_latency = level["views"]["ajax_create_resource"]
+        heavy_latency = level["views"]["heavy_create_resource"]
+        print("%6d %9d %10.2f %9d %9d %8.2f %8.2f %8.2f %8.3f %5.0f%% %9.1f" % (
+            user_count, level["requests"], level["builds_per_second"],
+            build_latency["errors"] + level["views"]["login_test"]["errors"] + heavy_latency.get("errors", 0),
+            build_latency["rejected"] + heavy_latency.get("rejected", 0), build_latency["p50"],
+            build_latency["p95"], build_latency["p99"], level["views"]["login_test"]["p95"],
+            100 * level["cpu_utilization"], level["in_flight"]))
+    stub_process.terminate()
+
+    saturation_point = get_saturation_point(levels)
+    if saturation_point is None:
+        print("Build throughput kept growing up to %d users." % levels[-1]["users"])
+    else:
+        print("Build throughput stopped growing at %d users." % saturation_point)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "settings": vars(args),
+                "saturation_users": saturation_point,
+                "levels": levels
+            }, output_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
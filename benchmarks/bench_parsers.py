@@ -0,0 +1,91 @@
+"""
+Compares the payload size and parse throughput of each registered return type parser on synthetic series
+built by the WaterOneFlow stub, and estimates the transfer time of each payload at a given bandwidth. The
+results are what the registry costs in parsers.py are ranked by.
+
+Usage:          python benchmarks/bench_parsers.py [--synthetic 10000,100000] [--repeat 3]
+                [--bandwidth 1000000] [--output results.json]
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from wof_stub import build_synthetic_wml, build_nwis_response
+from tethysapp.hydroshare_resource_creator.parsers import PARSERS
+
+# Format names of the registered parsers, and the NWIS format parameter their payload is built with.
+BENCHMARK_FORMATS = (
+    ("wml11", None),
+    ("wml2", "waterml,2.0"),
+    ("nwis_json", "json"),
+    ("nwis_rdb", "rdb"),
+)
+
+
+def get_benchmark_ts(format_name):
+    parser_key = next(key for key in PARSERS if PARSERS[key]["format"] == format_name)
+    return {
+        "site": {"siteCode": "NWISUV:10109000", "siteName": "synthetic"},
+        "variable": {"variableCode": "NWISUV:00060", "variableName": "Discharge"},
+        "requestInfo": {"serviceType": parser_key[0], "returnType": parser_key[1],
+                        "url": "http://127.0.0.1/nwis/iv/"},
+        "beginDate": "", "endDate": ""
+    }, PARSERS[parser_key]
+
+
+def run_benchmark(format_name, payload, repeat):
+    ts, parser = get_benchmark_ts(format_name)
+    timings = []
+    value_count = 0
+    for _ in range(repeat):
+        start_time = time.time()
+        series = parser["parse"](payload, ts)
+        timings.append(time.time() - start_time)
+        value_count = len(series["values"]["data_value"]) if series is not None else 0
+    return {"parse_seconds": min(timings), "value_count": value_count}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--synthetic", default="10000,100000",
+                        help="Comma separated value counts of the synthetic series to parse.")
+    parser.add_argument("--repeat", type=int, default=3, help="Parses per series and format. The fastest is kept.")
+    parser.add_argument("--bandwidth", type=float, default=1000000.0,
+                        help="Bytes per second the transfer time of each payload is estimated at.")
+    parser.add_argument("--output", help="Optional path of a JSON file to write the results to.")
+    args = parser.parse_args()
+
+    results = []
+    print("%-8s %-10s %12s %10s %11s %14s %13s %12s" % (
+        "values", "format", "size (bytes)", "bytes/val", "parse (ms)", "values/s", "transfer (ms)", "total (ms)"))
+    for value_count in [int(count) for count in args.synthetic.split(",") if count.strip()]:
+        wml = build_synthetic_wml(value_count)
+        for format_name, format_code in BENCHMARK_FORMATS:
+            payload = wml if format_code is None else build_nwis_response(wml, "iv", format_code)
+            result = run_benchmark(format_name, payload, args.repeat)
+            result.update({
+                "synthetic_values": value_count,
+                "format": format_name,
+                "payload_bytes": len(payload),
+                "transfer_seconds": len(payload) / args.bandwidth
+            })
+            results.append(result)
+            print("%-8d %-10s %12d %10.1f %11.1f %14.0f %13.1f %12.1f" % (
+                value_count, format_name, result["payload_bytes"],
+                result["payload_bytes"] / float(max(result["value_count"], 1)),
+                result["parse_seconds"] * 1000, result["value_count"] / max(result["parse_seconds"], 1e-9),
+                result["transfer_seconds"] * 1000, (result["parse_seconds"] + result["transfer_seconds"]) * 1000))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""
+Measures end-to-end create_ts_resource builds against the local WaterOneFlow stub: the bundled fixtures are
+replayed through real SOAP requests, and synthetic series are scaled to the requested value counts.
+
+Each case runs in its own process on an empty series store, and reports wall time, values per second, time
+per build stage, peak RSS, and output size. Results are written as JSON for comparing runs.
+
+The USGS water services used for alternate formats are also answered by the stub, so no case leaves the
+machine.
+
+Usage:          python benchmarks/bench_pipeline.py [--latency 0.1] [--bandwidth 5000000]
+                    [--synthetic 10000,100000] [--formats odm2] [--alternate-formats] [--repeat 1]
+                    [--output results.json]
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import socket
+import platform
+import tempfile
+import requests
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from lxml import etree
+from wof_stub import WaterOneFlowStub, FIXTURE_PATH, load_fixture_wml
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def get_peak_rss():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def serve_stub(port, latency, bandwidth):
+    WaterOneFlowStub(port, latency, bandwidth).serve_forever()
+
+
+def start_stub_process(latency, bandwidth):
+    """
+    Starts the WaterOneFlow stub in its own process, so its memory and CPU are not counted against the
+    measured builds, and waits until it accepts connections.
+    """
+
+    free_socket = socket.socket()
+    free_socket.bind(("127.0.0.1", 0))
+    port = free_socket.getsockname()[1]
+    free_socket.close()
+    stub_process = multiprocessing.Process(target=serve_stub, args=(port, latency, bandwidth))
+    stub_process.daemon = True
+    stub_process.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except socket.error:
+            time.sleep(0.05)
+
+    return stub_process, "http://127.0.0.1:%d/%%s/cuahsi_1_1.asmx?WSDL" % port
+
+
+def load_case_refts(case, service_url):
+    """
+    Loads the refts of a benchmark case and points every series at the stub service. Synthetic cases use the
+    first series of the template fixture with an unbounded time window.
+    """
+
+    refts_name = case["fixture"] + "_refts.json"
+    with open(os.path.join(FIXTURE_PATH, refts_name), "r") as refts_file:
+        form_body = json.load(refts_file)
+    ts_list = form_body["timeSeriesReferenceFile"]["referencedTimeSeries"]
+    if case["kind"] == "synthetic":
+        del ts_list[1:]
+        ts_list[0]["beginDate"] = "1900-01-01T00:00:00"
+        ts_list[0]["endDate"] = "2100-01-01T00:00:00"
+    for ts in ts_list:
+        ts["requestInfo"]["url"] = service_url
+
+    return form_body
+
+
+def configure_settings(nwis_url, alternate_formats):
+    """
+    Configures default Django settings when none are configured, and points the USGS water services at the
+    stub.
+    """
+
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure()
+    settings.HS_RESOURCE_CREATOR_NWIS_URL = nwis_url
+    settings.HS_RESOURCE_CREATOR_ALTERNATE_FORMATS = alternate_formats
+
+
+def run_case(case, service_url, nwis_url, options, result_queue):
+    """
+    Builds one case in a fresh process and puts its measurements on the result queue.
+    """
+
+    work_path = tempfile.mkdtemp()
+    os.environ["HS_RESOURCE_CREATOR_SERIES_STORE"] = os.path.join(work_path, "series_store")
+    os.environ["HS_RESOURCE_CREATOR_SERVICE_REGISTRY"] = os.path.join(work_path, "service_registry")
+    try:
+        configure_settings(nwis_url, options["alternate_formats"])
+        from tethysapp.hydroshare_resource_creator.utilities import process_form_data, create_ts_resource
+        from tethysapp.hydroshare_resource_creator.metrics import get_metrics
+
+        form_body = process_form_data(load_case_refts(case, service_url))
+        series_count = len(form_body["timeSeriesReferenceFile"]["referencedTimeSeries"])
+        res_data = {
+            "workspace": work_path,
+            "form_body": form_body,
+            "res_title": "Benchmark " + case["name"],
+            "res_abstract": "Benchmark",
+            "res_keywords": ["benchmark"],
+            "res_filename": "benchmark",
+            "selected_resources": list(range(series_count)),
+            "output_formats": options["formats"],
+            "finalize": options["finalize"],
+            "shards": options["shards"]
+        }
+
+        start_time = time.time()
+        res_results = create_ts_resource(res_data)
+        seconds = time.time() - start_time
+
+        stage_seconds = {}
+        value_count = 0
+        for histogram in get_metrics()["histograms"]:
+            stage = histogram["labels"].get("stage")
+            stage_seconds[stage] = stage_seconds.get(stage, 0.0) + histogram["sum"]
+        for counter in get_metrics()["counters"]:
+            if counter["name"] == "build_rows_total" and counter["labels"].get("stage") == "parse":
+                value_count += counter["value"]
+        output_filepaths = [res_results["res_filepath"]] + res_results.get("export_filepaths", [])
+
+        result_queue.put({
+            "case": case["name"],
+            "kind": case["kind"],
+            "series_count": res_results["series_count"],
+            "value_count": value_count,
+            "seconds": seconds,
+            "values_per_second": value_count / seconds if seconds else None,
+            "stage_seconds": stage_seconds,
+            "peak_rss_bytes": get_peak_rss(),
+            "output_bytes": sum(os.path.getsize(filepath) for filepath in output_filepaths
+                                if os.path.isfile(filepath))
+        })
+    except Exception as ex:
+        result_queue.put({"case": case["name"], "kind": case["kind"], "error": str(ex) or type(ex).__name__})
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+
+def get_cases(args):
+    cases = []
+    if not args.no_fixtures:
+        for file_name in sorted(os.listdir(FIXTURE_PATH)):
+            if file_name.endswith("_resource.wml"):
+                fixture = file_name[:-len("_resource.wml")]
+                if not os.path.isfile(os.path.join(FIXTURE_PATH, fixture + "_refts.json")):
+                    continue
+                # Some fixtures are text dumps of parsed responses rather than WaterML, so the stub cannot
+                # replay them.
+                try:
+                    etree.fromstring(load_fixture_wml(fixture))
+                except etree.XMLSyntaxError:
+                    print("Skipping fixture %s: %s is not a WaterML document" % (fixture, file_name))
+                    continue
+                cases.append({"name": fixture, "kind": "fixture", "fixture": fixture})
+    for value_count in [int(count) for count in args.synthetic.split(",") if count]:
+        cases.append({"name": "synthetic_" + str(value_count), "kind": "synthetic", "fixture": "gulf",
+                      "value_count": value_count})
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.0, help="Stub response latency in seconds.")
+    parser.add_argument("--bandwidth", type=float, help="Stub bandwidth in bytes per second.")
+    parser.add_argument("--synthetic", default="10000,100000", help="Comma-separated synthetic value counts.")
+    parser.add_argument("--no-fixtures", action="store_true", help="Only run the synthetic cases.")
+    parser.add_argument("--formats", default="odm2", help="Comma-separated output formats.")
+    parser.add_argument("--finalize", action="store_true", help="Finalize ODM2 databases.")
+    parser.add_argument("--shards", default="1", help="Writer processes per ODM2 database, or auto.")
+    parser.add_argument("--alternate-formats", dest="alternate_formats", action="store_true",
+                        help="Fetch NWIS series from the stub's USGS water services in cheaper formats.")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per case. The fastest is kept.")
+    parser.add_argument("--output", help="Optional path of a JSON file to write the results to.")
+    args = parser.parse_args()
+
+    stub_process, service_url_format = start_stub_process(args.latency, args.bandwidth)
+    nwis_url_format = service_url_format.replace("/%s/cuahsi_1_1.asmx?WSDL", "/nwis/%s/")
+    options = {"formats": [output_format for output_format in args.formats.split(",") if output_format],
+               "finalize": args.finalize, "shards": args.shards, "alternate_formats": args.alternate_formats}
+
+    results = []
+    print("%-20s %7s %9s %9s %12s %10s %12s" % ("case", "series", "values", "time (s)", "values/s", "RSS (MB)",
+                                                 "output (KB)"))
+    for case in get_cases(args):
+        if case["kind"] == "synthetic":
+            service_url = service_url_format % ("synthetic/" + str(case["value_count"]))
+            nwis_url = nwis_url_format % ("synthetic/" + str(case["value_count"]))
+            # Builds the synthetic document in the stub before the timed runs.
+            requests.post(service_url, data="")
+        else:
+            service_url = service_url_format % case["fixture"]
+            nwis_url = nwis_url_format % case["fixture"]
+        runs = []
+        for _ in range(args.repeat):
+            result_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_case,
+                                              args=(case, service_url, nwis_url, options, result_queue))
+            process.start()
+            runs.append(result_queue.get())
+            process.join()
+        successful_runs = [run for run in runs if "error" not in run]
+        result = min(successful_runs, key=lambda run: run["seconds"]) if successful_runs else runs[0]
+        results.append(result)
+        if "error" in result:
+            print("%-20s failed: %s" % (case["name"], result["error"]))
+            continue
+        print("%-20s %7d %9d %9.2f %12.0f %10.1f %12.1f" % (
+            case["name"], result["series_count"], result["value_count"], result["seconds"],
+            result["values_per_second"] or 0, (result["peak_rss_bytes"] or 0) / 1048576.0,
+            result["output_bytes"] / 1024.0))
+
+    stub_process.terminate()
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "settings": vars(args),
+                "results": results
+            }, output_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
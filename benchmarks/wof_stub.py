@@ -0,0 +1,359 @@
+"""
+Local WaterOneFlow stub server replaying the WaterML fixtures bundled in static_data/refts_test_files.
+
+GetValuesObject requests posted to /<fixture>/cuahsi_1_1.asmx are answered with <fixture>_resource.wml, and
+requests posted to /synthetic/<value count>/cuahsi_1_1.asmx with a synthetic series of that many values,
+built from the gulf fixture. GetSiteInfoObject and GetVariableInfoObject requests are answered with the site,
+series catalog, or variable of the same document. GET requests to /nwis/<fixture>/dv/ or /nwis/<fixture>/iv/
+(or /nwis/synthetic/<value count>/...) answer like the USGS water services, with the same document rebuilt as
+RDB, JSON, or WaterML 2.0 according to the format parameter. GET requests for ?WSDL are answered with a
+WaterOneFlow 1.1 WSDL listing the methods the stub serves. Latency delays every response, and bandwidth
+throttles the response body.
+
+Usage:          python benchmarks/wof_stub.py [--port 8089] [--latency 0.2] [--bandwidth 1000000]
+"""
+from __future__ import print_function
+import os
+import re
+import copy
+import json
+import time
+import hashlib
+import argparse
+import threading
+import datetime
+from lxml import etree
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tethysapp", "hydroshare_resource_creator")
+FIXTURE_PATH = os.path.join(APP_PATH, "static_data", "refts_test_files")
+SYNTHETIC_TEMPLATE = "gulf"
+WML_NAMESPACES = ("{http://www.cuahsi.org/waterML/1.1/}", "{http://www.cuahsi.org/waterML/1.0/}")
+
+WSDL_RESPONSE = ('<?xml version="1.0" encoding="utf-8"?>'
+                 '<wsdl:definitions xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" '
+                 'targetNamespace="http://www.cuahsi.org/his/1.1/ws/"><wsdl:portType name="WaterOneFlow">' +
+                 ''.join('<wsdl:operation name="' + method + '"/>' for method in (
+                     "GetSiteInfoObject", "GetValuesObject", "GetVariableInfoObject")) +
+                 '</wsdl:portType></wsdl:definitions>').encode("utf-8")
+
+fixture_cache = {}
+fixture_cache_lock = threading.Lock()
+
+
+def load_fixture_wml(fixture_name):
+    """
+    Loads a WaterML fixture, dropping any bytes in front of the XML document.
+    """
+
+    with fixture_cache_lock:
+        if fixture_name not in fixture_cache:
+            with open(os.path.join(FIXTURE_PATH, fixture_name + "_resource.wml"), "rb") as wml_file:
+                wml = wml_file.read()
+            fixture_cache[fixture_name] = wml[max(wml.find(b"<"), 0):]
+        return fixture_cache[fixture_name]
+
+
+def build_synthetic_wml(value_count, step_minutes=15):
+    """
+    Builds a WaterML document with value_count values at a fixed time step, using the site, variable, and
+    method metadata of the synthetic template fixture.
+    """
+
+    cache_key = "synthetic_" + str(value_count)
+    with fixture_cache_lock:
+        if cache_key in fixture_cache:
+            return fixture_cache[cache_key]
+
+    wml_tree = etree.fromstring(load_fixture_wml(SYNTHETIC_TEMPLATE))
+    for ns in WML_NAMESPACES:
+        values_element = next(wml_tree.iter(ns + "values"), None)
+        if values_element is not None:
+            break
+    value_attributes = dict(next(values_element.iter(ns + "value")).attrib)
+    other_elements = [element for element in values_element if element.tag != ns + "value"]
+    for element in list(values_element):
+        values_element.remove(element)
+
+    start_date = datetime.datetime(2000, 1, 1)
+    for index in range(value_count):
+        value_element = etree.SubElement(values_element, ns + "value", dict(value_attributes))
+        value_element.set("dateTime", (start_date + datetime.timedelta(minutes=step_minutes * index)).isoformat())
+        value_element.text = "%.3f" % (10 + 5 * ((index * 7919) % 1000) / 1000.0)
+    values_element.extend(other_elements)
+    wml = etree.tostring(wml_tree)
+
+    with fixture_cache_lock:
+        fixture_cache[cache_key] = wml
+    return wml
+
+
+def build_info_response(wml, method):
+    """
+    Builds the GetSiteInfoObject or GetVariableInfoObject response matching a WaterML document: the site
+    with a one-series catalog holding the value count and period of the document, or its variable.
+    """
+
+    cache_key = (hashlib.sha1(wml).hexdigest(), method)
+    with fixture_cache_lock:
+        if cache_key in fixture_cache:
+            return fixture_cache[cache_key]
+
+    wml_tree = etree.fromstring(wml)
+    ns = next(namespace for namespace in WML_NAMESPACES
+              if next(wml_tree.iter(namespace + "values"), None) is not None)
+    wof_version = "1.1" if "1.1" in ns else "1.0"
+    variable_element = next(wml_tree.iter(ns + "variable"))
+    envelope = etree.Element("{http://schemas.xmlsoap.org/soap/envelope/}Envelope")
+    body = etree.SubElement(envelope, "{http://schemas.xmlsoap.org/soap/envelope/}Body")
+    method_response = etree.SubElement(body, "{http://www.cuahsi.org/his/%s/ws/}%sResponse" % (wof_version, method))
+
+    if method == "GetVariableInfoObject":
+        variables = etree.SubElement(etree.SubElement(method_response, ns + "variablesResponse"), ns + "variables")
+        variables.append(copy.deepcopy(variable_element))
+    else:
+        site = etree.SubElement(etree.SubElement(method_response, ns + "sitesResponse"), ns + "site")
+        site_info = etree.SubElement(site, ns + "siteInfo")
+        site_info.extend(copy.deepcopy(list(next(wml_tree.iter(ns + "sourceInfo")))))
+        series = etree.SubElement(etree.SubElement(site, ns + "seriesCatalog"), ns + "series")
+        series.append(copy.deepcopy(variable_element))
+        date_times = [value.get("dateTime") for value in wml_tree.iter(ns + "value")]
+        etree.SubElement(series, ns + "valueCount").text = str(len(date_times))
+        time_interval = etree.SubElement(series, ns + "variableTimeInterval")
+        etree.SubElement(time_interval, ns + "beginDateTime").text = min(date_times) if date_times else ""
+        etree.SubElement(time_interval, ns + "endDateTime").text = max(date_times) if date_times else ""
+    info_response = etree.tostring(envelope)
+
+    with fixture_cache_lock:
+        fixture_cache[cache_key] = info_response
+    return info_response
+
+
+def read_wml_series(wml):
+    """
+    Reads the site, variable, and values of a WaterML 1.x document, for rebuilding it in the REST formats.
+    """
+
+    wml_tree = etree.fromstring(wml)
+    ns = next(namespace for namespace in WML_NAMESPACES
+              if next(wml_tree.iter(namespace + "values"), None) is not None)
+    variable_code = (wml_tree.findtext(".//" + ns + "variable/" + ns + "variableCode") or "").split("/")[0]
+    option = wml_tree.find(".//" + ns + "variable//" + ns + "option")
+    return {
+        "site_code": (wml_tree.findtext(".//" + ns + "siteCode") or "").split(":")[-1],
+        "site_name": wml_tree.findtext(".//" + ns + "siteName") or "",
+        "latitude": wml_tree.findtext(".//" + ns + "latitude") or "0",
+        "longitude": wml_tree.findtext(".//" + ns + "longitude") or "0",
+        "parameter_code": variable_code if re.match(r"^\d{5}$", variable_code) else "00060",
+        "statistic_code": option.get("optionCode") if option is not None else None,
+        "variable_name": wml_tree.findtext(".//" + ns + "variableName") or "",
+        "unit": wml_tree.findtext(".//" + ns + "variable/" + ns + "unit/" + ns + "unitAbbreviation") or
+        wml_tree.findtext(".//" + ns + "variable/" + ns + "unit/" + ns + "unitsAbbreviation") or "",
+        "values": [(value.get("dateTime")[:19], value.get("timeOffset") or "+00:00",
+                    value.get("qualityControlLevelCode") or "A", value.text)
+                   for value in wml_tree.iter(ns + "value")]
+    }
+
+
+def build_nwis_response(wml, service, format_code):
+    """
+    Rebuilds a WaterML 1.x document as a USGS water services response: RDB, JSON, or WaterML 2.0. Daily
+    values (dv) are dated by day, and instantaneous values (iv) keep their time and offset.
+    """
+
+    cache_key = (hashlib.sha1(wml).hexdigest(), service, format_code)
+    with fixture_cache_lock:
+        if cache_key in fixture_cache:
+            return fixture_cache[cache_key]
+
+    series = read_wml_series(wml)
+    ts_id = "153851"
+    column_name = ts_id + "_" + series["parameter_code"] + (
+        "_" + series["statistic_code"] if service == "dv" and series["statistic_code"] else "")
+    time_zones = dict((offset, zone) for zone, offset in (("UTC", "+00:00"), ("EST", "-05:00"), ("CST", "-06:00"),
+                                                         ("MST", "-07:00"), ("PST", "-08:00"), ("EDT", "-04:00"),
+                                                         ("CDT", "-05:00"), ("MDT", "-06:00"), ("PDT", "-07:00")))
+
+    if format_code == "rdb":
+        lines = [
+            "# Data for the following 1 site(s) are contained in this file",
+            "#    USGS " + series["site_code"] + " " + series["site_name"],
+            "#",
+            "#            TS   parameter     statistic     Description",
+            "#        " + ts_id + "       " + series["parameter_code"] + "     " +
+            (series["statistic_code"] + "     " if service == "dv" and series["statistic_code"] else "") +
+            series["variable_name"],
+            "#",
+            "agency_cd\tsite_no\tdatetime\t" + ("tz_cd\t" if service != "dv" else "") + column_name + "\t" +
+            column_name + "_cd",
+            "5s\t15s\t20d\t" + ("6s\t" if service != "dv" else "") + "14n\t10s",
+        ]
+        for date_time, utc_offset, qualifier, value in series["values"]:
+            if service == "dv":
+                lines.append("USGS\t%s\t%s\t%s\t%s" % (series["site_code"], date_time[:10], value, qualifier))
+            else:
+                lines.append("USGS\t%s\t%s\t%s\t%s\t%s" % (series["site_code"], date_time[:16].replace("T", " "),
+                                                            time_zones.get(utc_offset, "UTC"), value, qualifier))
+        response = ("\n".join(lines) + "\n").encode("utf-8")
+    elif format_code == "json":
+        response = json.dumps({"value": {"timeSeries": [{
+            "sourceInfo": {
+                "siteName": series["site_name"],
+                "siteCode": [{"value": series["site_code"], "network": "NWIS", "agencyCode": "USGS"}],
+                "geoLocation": {"geogLocation": {"srs": "EPSG:4326", "latitude": float(series["latitude"]),
+                                                 "longitude": float(series["longitude"])}}
+            },
+            "variable": {
+                "variableCode": [{"value": series["parameter_code"], "network": "NWIS"}],
+                "variableName": series["variable_name"],
+                "variableDescription": series["variable_name"],
+                "unit": {"unitCode": series["unit"]},
+                "noDataValue": -999999.0
+            },
+            "values": [{
+                "value": [{"value": value, "qualifiers": [qualifier],
+                           "dateTime": (date_time[:10] + "T00:00:00.000" if service == "dv" else
+                                        date_time + ".000" + utc_offset)}
+                          for date_time, utc_offset, qualifier, value in series["values"]],
+                "method": [{"methodDescription": "", "methodID": 69928}]
+            }],
+            "name": "USGS:" + series["site_code"] + ":" + series["parameter_code"]
+        }]}}).encode("utf-8")
+    else:
+        points = "".join(
+            "<wml2:point><wml2:MeasurementTVP><wml2:time>%s</wml2:time><wml2:value>%s</wml2:value>"
+            "</wml2:MeasurementTVP></wml2:point>" % (date_time[:10] if service == "dv" else date_time + utc_offset,
+                                                     value)
+            for date_time, utc_offset, qualifier, value in series["values"])
+        response = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<wml2:Collection xmlns:wml2="http://www.opengis.net/waterml/2.0" '
+            'xmlns:gml="http://www.opengis.net/gml/3.2" xmlns:om="http://www.opengis.net/om/2.0" '
+            'xmlns:xlink="http://www.w3.org/1999/xlink" gml:id="C.USGS.' + series["site_code"] + '">'
+            '<wml2:observationMember><om:OM_Observation gml:id="obs.1">'
+            '<om:observedProperty xlink:title="' + series["variable_name"] + '"/>'
+            '<om:featureOfInterest xlink:title="' + series["site_name"] + '">'
+            '<wml2:MonitoringPoint gml:id="site.1"><gml:identifier>USGS.' + series["site_code"] +
+            '</gml:identifier><gml:pos>' + series["latitude"] + ' ' + series["longitude"] + '</gml:pos>'
+            '</wml2:MonitoringPoint></om:featureOfInterest>'
+            '<om:result><wml2:MeasurementTimeseries gml:id="ts.1"><wml2:defaultPointMetadata>'
+            '<wml2:DefaultTVPMeasurementMetadata><wml2:uom code="' + series["unit"] + '"/>'
+            '</wml2:DefaultTVPMeasurementMetadata></wml2:defaultPointMetadata>' + points +
+            '</wml2:MeasurementTimeseries></om:result></om:OM_Observation></wml2:observationMember>'
+            '</wml2:Collection>').encode("utf-8")
+
+    with fixture_cache_lock:
+        fixture_cache[cache_key] = response
+    return response
+
+
+class WaterOneFlowHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def get_path_wml(self, path_parts):
+        if path_parts[0] == "synthetic":
+            return build_synthetic_wml(int(path_parts[1]))
+        return load_fixture_wml(re.sub(r"[^A-Za-z0-9_]", "", path_parts[0]))
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        path_parts = [part for part in self.path.split("?")[0].split("/") if part]
+        try:
+            wml = self.get_path_wml(path_parts)
+            method = self.headers.get("SOAPAction", "").strip('"').split("/")[-1]
+            if method in ("GetSiteInfoObject", "GetVariableInfoObject"):
+                wml = build_info_response(wml, method)
+        except (IndexError, ValueError, IOError, OSError, StopIteration, etree.XMLSyntaxError):
+            self.send_body(None)
+            return
+
+        self.send_body(wml)
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        path_parts = [part for part in path.split("/") if part]
+        params = parse_qs(query)
+        if query.upper() == "WSDL":
+            self.send_body(WSDL_RESPONSE)
+            return
+        try:
+            if path_parts[0] != "nwis":
+                raise ValueError(path)
+            wml = self.get_path_wml(path_parts[1:])
+            service = path_parts[-1]
+            format_code = params.get("format", ["rdb"])[0]
+            if service not in ("dv", "iv") or format_code not in ("rdb", "json", "waterml,2.0"):
+                raise ValueError(format_code)
+            body = build_nwis_response(wml, service, format_code)
+        except (IndexError, ValueError, IOError, OSError, StopIteration, etree.XMLSyntaxError):
+            self.send_body(None)
+            return
+
+        self.send_body(body, "text/plain" if format_code == "rdb" else "application/json" if format_code == "json"
+                       else "text/xml")
+
+    def send_body(self, body, content_type="text/xml"):
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        chunk_size = 65536
+        for start in range(0, len(body), chunk_size):
+            chunk = body[start:start + chunk_size]
+            self.wfile.write(chunk)
+            if self.server.bandwidth:
+                time.sleep(len(chunk) / float(self.server.bandwidth))
+
+
+class WaterOneFlowStub(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, bandwidth=None):
+        HTTPServer.__init__(self, ("127.0.0.1", port), WaterOneFlowHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def get_service_url(self, fixture_name):
+        return "http://127.0.0.1:%d/%s/cuahsi_1_1.asmx?WSDL" % (self.server_port, fixture_name)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before each response.")
+    parser.add_argument("--bandwidth", type=float, help="Response bytes per second. Unlimited by default.")
+    args = parser.parse_args()
+
+    stub = WaterOneFlowStub(args.port, args.latency, args.bandwidth)
+    print("Serving WaterOneFlow fixtures on " + stub.get_service_url("<fixture>"))
+    stub.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,7 @@ app_class = 'hydroshare_resource_creator.app:HydroshareResourceCreator'
 app_package_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tethysapp', app_package)
 
 ### Python Dependencies ###
-dependencies = ['simplejson','xmltodict','pandas','lxml']
+dependencies = ['simplejson','xmltodict','pandas','lxml','numpy','ijson']
 
 setup(
     name=release_package,
@@ -27,6 +27,11 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=dependencies,
+    entry_points={
+        'console_scripts': [
+            'hs-resource-creator = tethysapp.hydroshare_resource_creator.cli:main'
+        ]
+    },
     cmdclass={
         'install': custom_install_command(app_package, app_package_dir, dependencies),
         'develop': custom_develop_command(app_package, app_package_dir, dependencies)
@@ -0,0 +1,258 @@
+import math
+import time
+import threading
+from logging import getLogger
+from django.conf import settings
+from .metrics import increment, observe
+
+logger = getLogger('django')
+
+# Cost of a build in value-equivalents: the values of its selected series, plus a fixed cost per series for
+# the requests and writes it takes however few values it has. Series with no usable value count are
+# charged the default. Refts builds download nothing, and are charged per series only.
+SERIES_BASE_COST = 1000
+DEFAULT_SERIES_COST = 10000
+REFTS_SERIES_COST = 10
+
+# Defaults of the HS_RESOURCE_CREATOR_BUILD_BUDGET, HS_RESOURCE_CREATOR_USER_BUILDS, and
+# HS_RESOURCE_CREATOR_ADMISSION_WAIT settings: the in-flight cost allowed across all users, the builds one
+# user may run at a time, and the seconds a build may wait for admission before it is rejected.
+BUILD_BUDGET = 1000000
+USER_BUILDS = 1
+ADMISSION_WAIT = 30
+
+# Builds one user may have waiting, beyond those running, before more are rejected without waiting.
+USER_QUEUE = 1
+
+# Value-equivalents per second that builds are assumed to finish at until some have been timed, the weight
+# of each newly timed build in the running rate, and the bounds of the Retry-After given to rejected builds.
+COST_RATE = 5000.0
+COST_RATE_WEIGHT = 0.2
+RETRY_AFTER_MIN = 1
+RETRY_AFTER_MAX = 300
+
+# Admission state of this process. Each server process admits its own builds.
+admission_condition = threading.Condition()
+admission_queue = []
+admission_state = {"virtual_time": 0.0, "in_flight_cost": 0, "sequence": 0, "cost_rate": COST_RATE}
+user_running = {}
+user_finish = {}
+
+
+def get_admission_limits():
+    """
+    Gets the global cost budget, per-user concurrency, and admission wait from the settings.
+
+    Arguments:      []
+    Returns:        [build_budget, user_builds, admission_wait]
+    Referenced By:  [acquire_build]
+    References:     []
+    Libraries:      []
+    """
+
+    return (
+        max(int(getattr(settings, "HS_RESOURCE_CREATOR_BUILD_BUDGET", BUILD_BUDGET)), 1),
+        max(int(getattr(settings, "HS_RESOURCE_CREATOR_USER_BUILDS", USER_BUILDS)), 1),
+        max(float(getattr(settings, "HS_RESOURCE_CREATOR_ADMISSION_WAIT", ADMISSION_WAIT)), 0.0),
+    )
+
+
+def estimate_build_cost(action_request, form_body, selected_ids):
+    """
+    Estimates the cost of a build from the value counts of its selected series.
+
+    Arguments:      [action_request, form_body, selected_ids]
+    Returns:        [build_cost]
+    Referenced By:  [controllers_ajax.ajax_create_resource]
+    References:     []
+    Libraries:      []
+    """
+
+    try:
+        ts_list = form_body["timeSeriesReferenceFile"]["referencedTimeSeries"]
+        selected_ts = [ts_list[int(selected_id)] for selected_id in selected_ids or []]
+    except (TypeError, KeyError, IndexError, ValueError):
+        return DEFAULT_SERIES_COST
+
+    if action_request == "refts":
+        return max(REFTS_SERIES_COST * len(selected_ts), 1)
+
+    build_cost = 0
+    for ts in selected_ts:
+        try:
+            build_cost += SERIES_BASE_COST + max(int(ts.get("valueCount")), 0)
+        except (TypeError, ValueError):
+            build_cost += DEFAULT_SERIES_COST
+
+    return max(build_cost, 1)
+
+
+def get_admissible_ticket(build_budget, user_builds):
+    """
+    Gets the waiting build that may be admitted next. Waiting builds are served in weighted fair queuing order,
+    by finish tag, among those whose user is below the concurrency limit. The first of them is admitted only
+    when its cost fits in the budget, or when nothing is running, so that a large build is never passed over
+    indefinitely by smaller ones. Called with the admission lock held.
+
+    Arguments:      [build_budget, user_builds]
+    Returns:        [ticket]
+    Referenced By:  [acquire_build]
+    References:     []
+    Libraries:      []
+    """
+
+    eligible_tickets = [ticket for ticket in admission_queue if user_running.get(ticket["user"], 0) < user_builds]
+    if not eligible_tickets:
+        return None
+    ticket = min(eligible_tickets, key=lambda queued_ticket: (queued_ticket["finish"], queued_ticket["sequence"]))
+    if admission_state["in_flight_cost"] and admission_state["in_flight_cost"] + ticket["cost"] > build_budget:
+        return None
+
+    return ticket
+
+
+def get_retry_after(ticket, build_budget):
+    """
+    Estimates the seconds until a rejected build could be admitted: the time for the running builds and the
+    builds ahead of it to free enough of the budget, at the measured rate. Called with the admission lock held.
+
+    Arguments:      [ticket, build_budget]
+    Returns:        [retry_after]
+    Referenced By:  [acquire_build]
+    References:     []
+    Libraries:      [math]
+    """
+
+    queued_cost = sum(queued_ticket["cost"] for queued_ticket in admission_queue
+                      if queued_ticket["finish"] < ticket["finish"])
+    excess_cost = admission_state["in_flight_cost"] + queued_cost + ticket["cost"] - build_budget
+    retry_after = math.ceil(max(excess_cost, 0) / admission_state["cost_rate"])
+    if user_running.get(ticket["user"]):
+        retry_after = max(retry_after, math.ceil(ticket["cost"] / admission_state["cost_rate"]))
+
+    return int(min(max(retry_after, RETRY_AFTER_MIN), RETRY_AFTER_MAX))
+
+
+def acquire_build(user, build_cost, weight=1.0):
+    """
+    Waits for a build to be admitted under the global cost budget and the per-user concurrency limit. Each
+    build is given a weighted fair queuing finish tag, its start tag plus its cost over the user's weight,
+    where its start tag is the later of the current virtual time and the finish tag of the user's previous
+    build. Small builds therefore finish ahead of a large one submitted before them, and a user submitting
+    many builds is served no more than their share. A build that is not admitted within the admission wait,
+    or whose user already has too many waiting, is rejected.
+
+    Arguments:      [user, build_cost, weight]
+    Returns:        [ticket, retry_after]
+    Referenced By:  [controllers_ajax.ajax_create_resource]
+    References:     [get_admission_limits, get_admissible_ticket, get_retry_after]
+    Libraries:      [threading, time]
+    """
+
+    build_budget, user_builds, admission_wait = get_admission_limits()
+    wait_start = time.time()
+
+    with admission_condition:
+        admission_state["sequence"] += 1
+        start_tag = max(admission_state["virtual_time"], user_finish.get(user, 0.0))
+        ticket = {
+            "user": user,
+            "cost": build_cost,
+            "start": start_tag,
+            "finish": start_tag + build_cost / float(weight),
+            "sequence": admission_state["sequence"],
+            "admitted_at": None
+        }
+
+        user_waiting = len([queued_ticket for queued_ticket in admission_queue if queued_ticket["user"] == user])
+        if user_running.get(user, 0) >= user_builds and user_waiting >= USER_QUEUE:
+            retry_after = get_retry_after(ticket, build_budget)
+            increment("admission_total", status="rejected", reason="user_limit")
+            return None, retry_after
+
+        previous_finish = user_finish.get(user)
+        user_finish[user] = ticket["finish"]
+        admission_queue.append(ticket)
+
+        def withdraw_ticket():
+            admission_queue.remove(ticket)
+            if user_finish.get(user) == ticket["finish"]:
+                if previous_finish is None:
+                    del user_finish[user]
+                else:
+                    user_finish[user] = previous_finish
+            admission_condition.notify_all()
+
+        try:
+            deadline = wait_start + admission_wait
+            while get_admissible_ticket(build_budget, user_builds) is not ticket:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    withdraw_ticket()
+                    retry_after = get_retry_after(ticket, build_budget)
+                    increment("admission_total", status="rejected", reason="timeout")
+                    observe("admission_wait_seconds", time.time() - wait_start, status="rejected")
+                    return None, retry_after
+                admission_condition.wait(remaining)
+        except BaseException:
+            if ticket in admission_queue:
+                withdraw_ticket()
+            raise
+
+        admission_queue.remove(ticket)
+        admission_state["virtual_time"] = max(admission_state["virtual_time"], ticket["start"])
+        admission_state["in_flight_cost"] += ticket["cost"]
+        user_running[user] = user_running.get(user, 0) + 1
+        ticket["admitted_at"] = time.time()
+        admission_condition.notify_all()
+
+    increment("admission_total", status="admitted")
+    observe("admission_wait_seconds", ticket["admitted_at"] - wait_start, status="admitted")
+
+    return ticket, 0
+
+
+def release_build(ticket):
+    """
+    Returns the budget of a finished build, updates the measured build rate, and wakes the waiting builds.
+
+    Arguments:      [ticket]
+    Returns:        []
+    Referenced By:  [controllers_ajax.ajax_create_resource]
+    References:     []
+    Libraries:      [threading, time]
+    """
+
+    build_seconds = max(time.time() - ticket["admitted_at"], 0.001)
+
+    with admission_condition:
+        admission_state["in_flight_cost"] -= ticket["cost"]
+        user_running[ticket["user"]] -= 1
+        if not user_running[ticket["user"]]:
+            del user_running[ticket["user"]]
+        admission_state["cost_rate"] = ((1 - COST_RATE_WEIGHT) * admission_state["cost_rate"] +
+                                        COST_RATE_WEIGHT * max(ticket["cost"] / build_seconds, 1.0))
+        for user in [user for user in user_finish if user_finish[user] <= admission_state["virtual_time"] and
+                     user not in user_running]:
+            del user_finish[user]
+        admission_condition.notify_all()
+
+
+def get_admission_status():
+    """
+    Gets the in-flight cost, running and waiting builds, and measured build rate of this process.
+
+    Arguments:      []
+    Returns:        [admission_status]
+    Referenced By:  [controllers_ajax.ajax_metrics, prefetch.run_prefetch]
+    References:     []
+    Libraries:      []
+    """
+
+    with admission_condition:
+        return {
+            "in_flight_cost": admission_state["in_flight_cost"],
+            "running_builds": sum(user_running.values()),
+            "waiting_builds": len(admission_queue),
+            "cost_rate": admission_state["cost_rate"]
+        }
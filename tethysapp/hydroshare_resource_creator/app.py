@@ -32,6 +32,27 @@ class HydroshareResourceCreator(TethysAppBase):
                     url_map(name='login_callback',
                             url='hydroshare-resource-creator/login-callback',
                             controller='hydroshare_resource_creator.controllers.login_callback'),
+                    url_map(name='preview_series',
+                            url='hydroshare-resource-creator/preview-series',
+                            controller='hydroshare_resource_creator.controllers_ajax.ajax_preview_series'),
+                    url_map(name='list_series',
+                            url='hydroshare-resource-creator/list-series',
+                            controller='hydroshare_resource_creator.controllers_ajax.ajax_list_series'),
+                    url_map(name='select_series',
+                            url='hydroshare-resource-creator/select-series',
+                            controller='hydroshare_resource_creator.controllers_ajax.ajax_select_series'),
+                    url_map(name='prefetch',
+                            url='hydroshare-resource-creator/prefetch',
+                            controller='hydroshare_resource_creator.controllers_ajax.ajax_prefetch'),
+                    url_map(name='build_status',
+                            url='hydroshare-resource-creator/build-status',
+                            controller='hydroshare_resource_creator.controllers_ajax.ajax_build_status'),
+                    url_map(name='metrics',
+                            url='hydroshare-resource-creator/metrics',
+                            controller='hydroshare_resource_creator.controllers_ajax.ajax_metrics'),
+                    url_map(name='profiles',
+                            url='hydroshare-resource-creator/profiles',
+                            controller='hydroshare_resource_creator.controllers.profiles'),
                     url_map(name='login_test',
                             url='hydroshare-resource-creator/login-test',
                             controller='hydroshare_resource_creator.controllers_ajax.login_test'),
@@ -0,0 +1,237 @@
+"""
+Builds timeseries and refts resource files from refts JSON files without going through the web app.
+
+Usage:          hs-resource-creator [--action ts] [--output-dir out] [--workers 4] [--cache DIR] FILE_OR_DIR [...]
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+from multiprocessing import Pool, cpu_count
+
+# Directory of the series store and service registry of builds run from the command line, used unless
+# --cache or --service-registry is given, since there is no Tethys app workspace outside the app.
+CLI_DATA_PATH = os.path.join(os.path.expanduser("~"), ".hs_resource_creator")
+
+
+def configure_settings():
+    """
+    Configures Django settings with their defaults when the command line runs outside a Django project, so that
+    the HS_RESOURCE_CREATOR settings read by the build fall back to their defaults.
+
+    Arguments:      []
+    Returns:        []
+    Referenced By:  [build_refts_file, main]
+    References:     []
+    Libraries:      [django]
+    """
+
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure()
+
+
+def get_refts_filepaths(paths):
+    """
+    Expands the given files and directories into the list of refts JSON files to build.
+
+    Arguments:      [paths]
+    Returns:        [refts_filepaths]
+    Referenced By:  [main]
+    References:     []
+    Libraries:      [os]
+    """
+
+    refts_filepaths = []
+    for path in paths:
+        if os.path.isdir(path):
+            refts_filepaths += sorted(os.path.join(path, file_name) for file_name in os.listdir(path)
+                                      if file_name.endswith("refts.json"))
+        else:
+            refts_filepaths.append(path)
+
+    return refts_filepaths
+
+
+def get_res_filename(refts_filepath):
+    file_name = os.path.basename(refts_filepath)
+    for suffix in (".refts.json", "_refts.json", ".json"):
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+    return file_name
+
+
+def build_refts_file(build_options):
+    """
+    Builds the resource files of one refts JSON file. Runs in a worker process, so all errors are caught and
+    reported in the returned summary.
+
+    Arguments:      [build_options]
+    Returns:        [summary]
+    Referenced By:  [main]
+    References:     [configure_settings, utilities.process_form_data, utilities.create_ts_resource,
+                     utilities.create_refts_resource]
+    Libraries:      [json, time]
+    """
+
+    configure_settings()
+    from .utilities import process_form_data, create_ts_resource, create_refts_resource
+
+    refts_filepath = build_options["refts_filepath"]
+    summary = {
+        "refts_filepath": refts_filepath,
+        "success": False,
+        "series_count": 0,
+        "rows_removed": 0,
+        "output_filepaths": [],
+        "seconds": 0.0,
+        "message": None
+    }
+    start_time = time.time()
+
+    try:
+        with open(refts_filepath, "r") as refts_file:
+            form_body = process_form_data(json.load(refts_file))
+        if form_body == "Data Processing Error":
+            raise ValueError("File processing error")
+        refts = form_body["timeSeriesReferenceFile"]
+        res_filename = get_res_filename(refts_filepath)
+        res_data = {
+            "workspace": build_options["output_dir"],
+            "form_body": form_body,
+            "res_title": refts.get("title") or res_filename,
+            "res_abstract": refts.get("abstract") or "",
+            "res_keywords": refts.get("keyWords") or [],
+            "res_filename": res_filename,
+            "selected_resources": list(range(len(refts["referencedTimeSeries"]))),
+            "output_formats": build_options["output_formats"],
+            "finalize": build_options["finalize"],
+            "shards": build_options["shards"],
+            "compact_refts": build_options["compact_refts"],
+            "reconcile": build_options["reconcile"],
+            "partition": build_options["partition"],
+            "epoch_index": build_options["epoch_index"]
+        }
+
+        if build_options["action"] == "ts":
+            res_results = create_ts_resource(res_data)
+            output_filepaths = [res_results["res_filepath"]] + res_results.get("export_filepaths", [])
+        else:
+            res_results = create_refts_resource(res_data)
+            output_filepaths = [res_results["res_filepath"]]
+
+        summary["series_count"] = res_results["series_count"]
+        summary["rows_removed"] = sum(record["rows_removed"] for record in res_results.get("reconciled_series", []))
+        summary["output_filepaths"] = output_filepaths
+        summary["success"] = True
+    except Exception as ex:
+        summary["message"] = str(ex) or type(ex).__name__
+        if build_options["verbose"]:
+            traceback.print_exc()
+
+    summary["seconds"] = time.time() - start_time
+
+    return summary
+
+
+def main(argv=None):
+    """
+    Command line entry point. Builds every given refts file with a process pool and prints a timing summary.
+
+    Arguments:      [argv]
+    Returns:        [exit_code]
+    Referenced By:  [setup.py console_scripts]
+    References:     [configure_settings, get_refts_filepaths, build_refts_file, series_store.SERIES_STORE_PATH_VARIABLE,
+                     service_registry.SERVICE_REGISTRY_PATH_VARIABLE]
+    Libraries:      [argparse, multiprocessing]
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="Refts JSON files, or directories of *refts.json files.")
+    parser.add_argument("--action", choices=("ts", "refts"), default="ts",
+                        help="Build timeseries resource files (ts) or refts files only (refts).")
+    parser.add_argument("--output-dir", default=".", help="Directory the resource files are written to.")
+    parser.add_argument("--workers", type=int, default=cpu_count(),
+                        help="Number of worker processes.")
+    parser.add_argument("--cache", default=os.path.join(CLI_DATA_PATH, "series_store"),
+                        help="Series store directory shared by the workers and later runs.")
+    parser.add_argument("--service-registry", dest="service_registry",
+                        default=os.path.join(CLI_DATA_PATH, "service_registry"),
+                        help="Service registry directory shared by the workers and later runs.")
+    parser.add_argument("--formats", default="odm2",
+                        help="Comma-separated output formats: odm2, parquet, csv.gz, netcdf.")
+    parser.add_argument("--finalize", action="store_true", help="Index, summarize, and vacuum ODM2 databases.")
+    parser.add_argument("--shards", default="1",
+                        help="Writer processes per ODM2 database, or auto for one per CPU. Used with --workers 1.")
+    parser.add_argument("--partition", choices=("site", "network", "size"),
+                        help="Write several ODM2 files, split by site, network, or size, with a manifest.")
+    parser.add_argument("--epoch-index", dest="epoch_index", action="store_true", default=None,
+                        help="Store the UTC epoch seconds of each value in ODM2 databases, indexed per result.")
+    parser.add_argument("--compact-refts", action="store_true", help="Write refts files without indentation.")
+    parser.add_argument("--no-reconcile", dest="reconcile", action="store_false", default=None,
+                        help="Write overlapping series of the same site and variable as separate results.")
+    parser.add_argument("--json", dest="json_output", help="Optional path of a JSON file to write the summary to.")
+    parser.add_argument("--verbose", action="store_true", help="Print tracebacks of failed builds.")
+    args = parser.parse_args(argv)
+
+    output_dir = os.path.abspath(args.output_dir)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    configure_settings()
+    from .series_store import SERIES_STORE_PATH_VARIABLE
+    from .service_registry import SERVICE_REGISTRY_PATH_VARIABLE
+    os.environ[SERIES_STORE_PATH_VARIABLE] = os.path.abspath(args.cache)
+    os.environ[SERVICE_REGISTRY_PATH_VARIABLE] = os.path.abspath(args.service_registry)
+
+    build_options = [{
+        "refts_filepath": refts_filepath,
+        "action": args.action,
+        "output_dir": output_dir,
+        "output_formats": [output_format for output_format in args.formats.split(",") if output_format],
+        "finalize": args.finalize,
+        "shards": args.shards,
+        "compact_refts": args.compact_refts,
+        "reconcile": args.reconcile,
+        "partition": args.partition,
+        "epoch_index": args.epoch_index,
+        "verbose": args.verbose
+    } for refts_filepath in get_refts_filepaths(args.paths)]
+    if not build_options:
+        parser.error("No refts files found.")
+
+    start_time = time.time()
+    workers = max(min(args.workers or 1, len(build_options)), 1)
+    if workers == 1:
+        summaries = [build_refts_file(options) for options in build_options]
+    else:
+        pool = Pool(workers)
+        try:
+            summaries = pool.map(build_refts_file, build_options, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    total_seconds = time.time() - start_time
+
+    print("")
+    print("%-40s %-7s %7s %9s %10s  %s" % ("refts file", "status", "series", "deduped", "time (s)", "message"))
+    for summary in summaries:
+        print("%-40s %-7s %7d %9d %10.2f  %s" % (os.path.basename(summary["refts_filepath"])[:40],
+                                                 "ok" if summary["success"] else "failed", summary["series_count"],
+                                                 summary["rows_removed"], summary["seconds"],
+                                                 summary["message"] or ""))
+    failed_count = len([summary for summary in summaries if not summary["success"]])
+    print("%d files, %d failed, %.2f s total with %d workers" % (len(summaries), failed_count, total_seconds,
+                                                                  workers))
+
+    if args.json_output:
+        with open(args.json_output, "w") as json_file:
+            json.dump({"total_seconds": total_seconds, "workers": workers, "files": summaries}, json_file, indent=4)
+
+    return 1 if failed_count else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
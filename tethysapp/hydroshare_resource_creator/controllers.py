@@ -1,12 +1,23 @@
 from django.shortcuts import render
+from django.http import FileResponse, Http404, HttpResponseForbidden
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import ensure_csrf_cookie
 from tethys_apps.base import TethysWorkspace
+import io
+import os
 import json
 import uuid
-import requests
-from .utilities import get_user_workspace, process_form_data
+from logging import getLogger
+from .utilities import get_user_workspace, process_form_data, normalize_ts
+from .session_store import save_session_refts, save_session_refts_stream, get_refts_summary
+from .refts_cache import open_hs_refts_file
+from .refts_stream import iter_referenced_series, REFTS_KEY
+from .profiling import list_profiles, load_profile_summary, get_profile_file
+from .service_registry import schedule_service_refresh, track_service_urls
+from .prefetch import should_prefetch, start_prefetch
+
+logger = getLogger('django')
 
 
 @csrf_exempt
@@ -17,13 +28,20 @@ def home(request):
     Arguments:      [request]
     Returns:        [render_obj]
     Referenced By:  [app.HydroshareResourceCreator]
-    References:     [utilities.get_app_workspace]
+    References:     [utilities.process_form_data, utilities.normalize_ts, refts_cache.open_hs_refts_file,
+                     refts_stream.iter_referenced_series, session_store.save_session_refts,
+                     session_store.save_session_refts_stream, session_store.get_refts_summary,
+                     service_registry.schedule_service_refresh, service_registry.track_service_urls,
+                     prefetch.should_prefetch, prefetch.start_prefetch]
     Libraries:      [json]
     """
 
     # FORM DATA FOR LOCAL TESTING
     #test_file_name = 'stroud_refts.json'  # Comment out before uploading to GitHub
 
+    # Refts from HydroShare or the data client are read one series at a time from refts_file.
+    refts_file = None
+    refts_key = REFTS_KEY
     try:  # LOCAL TESTING USE ONLY
         local_path = "/Users/klippold/Documents/Tethys/tethysdev/HS_TimeseriesCreator/tethysapp/hydroshare_resource_creator/static_data/refts_test_files/"
         local_file = local_path + test_file_name
@@ -34,30 +52,43 @@ def home(request):
     except:  # PRODUCTION USE ONLY
         if request.GET:
             res_id = request.GET["res_id"]
-            rest_url = "https://beta.hydroshare.org/hsapi/resource/" + res_id + "/files/"
-            response = requests.get(rest_url)
-            for refts in json.loads(response.content)["results"]:
-                if ".refts.json" in refts["url"]:
-                    file_path = str(refts["url"]).replace("www", "beta")
-                    break
-            rest_url = file_path
-            response = requests.get(rest_url)
-            form_body = json.loads(response.content)
+            refts_file = open_hs_refts_file(res_id)
+            form_body = "Streamed"
         else:
             try:
                 form_body = request.POST
                 if bool(form_body) is False:
                     form_body = "No data"
+                else:
+                    refts_file = io.BytesIO(form_body.get("timeSeriesReferenceFile", "").encode("utf-8"))
+                    refts_key = None
+                    form_body = "Streamed"
             except:
                 form_body = "No data"
 
     body = request.body
+    res_id = request.GET.get("res_id", "")
     if form_body == "No data":
         context = {"source": body,
-                   "form_body": "No data",
-                   "method": request
+                   "form_body": json.dumps("No data"),
+                   "method": request,
+                   "res_id": res_id
                    }
 
+    elif refts_file is not None:
+        original_data = body
+        try:
+            header = {}
+            service_ts_list = []
+            ts_iter = (normalize_ts(ts) for ts in iter_referenced_series(refts_file, header, refts_key))
+            save_session_refts_stream(request, track_service_urls(ts_iter, service_ts_list), header)
+            schedule_service_refresh(service_ts_list)
+        except Exception as ex:
+            logger.error("Unable to process refts: " + (str(ex) or type(ex).__name__))
+            form_body = "Data Processing Error"
+        finally:
+            refts_file.close()
+
     else:
         original_data = json.dumps(form_body)
         form_body = process_form_data(form_body)
@@ -66,11 +97,18 @@ def home(request):
         context = {"source": original_data,
                    "form_body": "File processing error",
                    "method": request,
+                   "res_id": res_id
                    }
-    else:
+    elif form_body != "No data":
+        if refts_file is None:
+            save_session_refts(request, form_body)
+            schedule_service_refresh(form_body["timeSeriesReferenceFile"]["referencedTimeSeries"])
+        if should_prefetch():
+            start_prefetch(request)
         context = {"source": body,
-                   "form_body": json.dumps(form_body),
-                   "method": request
+                   "form_body": json.dumps(get_refts_summary(request)),
+                   "method": request,
+                   "res_id": res_id
                    }
 
     render_obj = render(request, "hydroshare_resource_creator/home.html", context)
@@ -101,3 +139,39 @@ def login_callback(request):
     render_obj = render(request, "hydroshare_resource_creator/login_callback.html", context)
 
     return render_obj
+
+
+@never_cache
+def profiles(request):
+    """
+    Controller for the build profiles page. Lists saved profiles, shows the summary of one profile, or
+    downloads its raw stats or payload. Available to staff users only.
+
+    Arguments:      [request]
+    Returns:        [render_obj]
+    Referenced By:  [app.HydroshareResourceCreator]
+    References:     [profiling.list_profiles, profiling.load_profile_summary, profiling.get_profile_file]
+    Libraries:      []
+    """
+
+    if not (request.user.is_authenticated() and request.user.is_staff):
+        return HttpResponseForbidden("Build profiles are only available to administrators.")
+
+    profile_id = request.GET.get("profile_id")
+    if profile_id and request.GET.get("file"):
+        file_path = get_profile_file(profile_id, request.GET.get("file"))
+        if file_path is None:
+            raise Http404("Profile file not found.")
+        file_response = FileResponse(open(file_path, "rb"), content_type="application/octet-stream")
+        file_response["Content-Disposition"] = 'attachment; filename="' + profile_id + "_" + \
+                                               os.path.basename(file_path) + '"'
+
+        return file_response
+
+    context = {"profiles": list_profiles(),
+               "profile": load_profile_summary(profile_id) if profile_id else None
+               }
+
+    render_obj = render(request, "hydroshare_resource_creator/profiles.html", context)
+
+    return render_obj
@@ -1,4 +1,4 @@
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.csrf import ensure_csrf_cookie
 from tethys_apps.base import TethysWorkspace
@@ -8,7 +8,16 @@ import shutil
 import os
 import time
 from logging import getLogger
-from .utilities import get_user_workspace, create_ts_resource, create_refts_resource, get_o_auth_hs
+from .utilities import get_user_workspace, create_ts_resource, update_ts_resource, create_refts_resource, get_o_auth_hs, \
+    get_referenced_series, get_series_preview, get_request_form_body, get_request_checked_ids
+from .profiling import should_profile, profile_call
+from .metrics import stage_timer, record_error, increment, get_metrics, render_metrics
+from .session_store import list_session_series, select_session_series, parse_spatial_query, query_session_series
+from .preflight import should_preflight, preflight_series, PRUNED_STATUSES
+from .admission import estimate_build_cost, acquire_build, release_build, get_admission_status
+from .prefetch import cancel_prefetch, get_prefetch_status, PREFETCH_CANCEL_WAIT
+from .partitions import upload_resource_file, upload_resource_files, replace_resource_file
+from .deferred import start_deferred_build, get_deferred_status
 
 logger = getLogger('django')
 
@@ -36,18 +45,32 @@ def login_test(request):
         hs = get_o_auth_hs(request)
         hs_version = hs.hostname
         value_count = 0
-        checked_ids = request.POST.get('checkedIds').split(',')
-        form_body = json.loads(request.POST.get('formBody'))
-        if checked_ids != [u'']:
-            try:
-                for chk_id in checked_ids:
-                    value_count += int(form_body['timeSeriesReferenceFile']['referencedTimeSeries'][int(chk_id)]['valueCount'])
-            except:
-                form_body = json.loads(form_body)
-                for chk_id in checked_ids:
-                    value_count += int(form_body['timeSeriesReferenceFile']['referencedTimeSeries'][int(chk_id)]['valueCount'])
+        try:
+            checked_ids = get_request_checked_ids(request)
+            form_body = get_request_form_body(request)
+        except:
+            return_obj['message'] = "We encountered a problem while loading your resource data."
+
+            return JsonResponse(return_obj)
+        pruned_count = 0
+        if checked_ids:
+            selected_ts = [form_body['timeSeriesReferenceFile']['referencedTimeSeries'][int(chk_id)]
+                           for chk_id in checked_ids]
+            if action_request == 'ts' and should_preflight({}):
+                preflight_results = preflight_series(selected_ts)
+            else:
+                preflight_results = [None] * len(selected_ts)
+            for ts, preflight_result in zip(selected_ts, preflight_results):
+                if preflight_result is not None and preflight_result['status'] in PRUNED_STATUSES:
+                    pruned_count += 1
+                elif preflight_result is not None and preflight_result['value_count'] is not None:
+                    value_count += preflight_result['value_count']
+                else:
+                    value_count += int(ts['valueCount'])
             if value_count > 300000 and request.POST.get('actionRequest') == 'ts':
                 return_obj['message'] = "TooManyValues"
+        return_obj['results'] = {'selected_count': len(checked_ids), 'value_count': value_count,
+                                 'pruned_count': pruned_count}
         if "appsdev.hydroshare.org" in str(data_url) and "beta" in str(hs_version):
             return_obj['success'] = "True"
         elif "apps.hydroshare.org" in str(data_url) and "www" in str(hs_version):
@@ -66,15 +89,246 @@ def login_test(request):
     return JsonResponse(return_obj)
 
 
+@csrf_exempt
+def ajax_preview_series(request):
+    """
+    Ajax controller for preview_series. Returns a downsampled preview of one referenced timeseries.
+
+    Arguments:      [request]
+    Returns:        [JsonResponse(return_obj)]
+    Referenced By:  [app.HydroshareResourceCreator]
+    References:     [utilities.get_referenced_series, utilities.get_series_preview]
+    Libraries:      []
+    """
+
+    return_obj = {
+        "success": False,
+        "message": None,
+        "results": {}
+    }
+
+    if request.method != "POST":
+        return_obj["message"] = "Unable to communicate with server."
+
+        return JsonResponse(return_obj)
+
+    try:
+        series_id = int(request.POST.get("seriesId"))
+        max_points = min(max(int(request.POST.get("maxPoints", 1000)), 3), 10000)
+        method = str(request.POST.get("method", "lttb"))
+        ts = get_referenced_series(get_request_form_body(request), series_id)
+    except:
+        return_obj["message"] = "We encountered a problem while loading your resource data."
+
+        return JsonResponse(return_obj)
+
+    try:
+        preview = get_series_preview(ts, max_points=max_points, method=method)
+    except:
+        logger.exception("Unable to create preview of series " + str(series_id))
+        return_obj["message"] = "We were unable to load data for this timeseries."
+
+        return JsonResponse(return_obj)
+
+    if preview is None:
+        return_obj["message"] = "No timeseries data found."
+
+        return JsonResponse(return_obj)
+
+    return_obj["success"] = True
+    return_obj["message"] = "Preview created successfully"
+    return_obj["results"] = preview
+
+    return JsonResponse(return_obj)
+
+
+@csrf_exempt
+def ajax_list_series(request):
+    """
+    Ajax controller for list_series. Returns one sorted and filtered page of the series loaded in the
+    session, following the DataTables server-side processing protocol.
+
+    Arguments:      [request]
+    Returns:        [JsonResponse(return_obj)]
+    Referenced By:  [app.HydroshareResourceCreator]
+    References:     [session_store.list_session_series]
+    Libraries:      []
+    """
+
+    params = request.POST if request.method == "POST" else request.GET
+    try:
+        draw = int(params.get("draw", 0))
+        start = max(int(params.get("start", 0)), 0)
+        length = min(int(params.get("length", 25)), 1000)
+        order_column = int(params.get("order[0][column]", 2)) - 2
+        descending = params.get("order[0][dir]", "asc") == "desc"
+        search = params.get("search[value]", "")
+        filters = {
+            "site": params.get("siteFilter", ""),
+            "variable": params.get("variableFilter", ""),
+            "network": params.get("networkFilter", "")
+        }
+    except ValueError:
+        return JsonResponse({"error": "Invalid listing request."})
+
+    listing = list_session_series(request, start=start, length=length, order_column=order_column,
+                                  descending=descending, search=search, filters=filters)
+    if listing is None:
+        return JsonResponse({"error": "No data"})
+
+    return_obj = {
+        "draw": draw,
+        "recordsTotal": listing["records_total"],
+        "recordsFiltered": listing["records_filtered"],
+        "selectedCount": listing["selected_count"],
+        "data": [[series["series_id"], series["selected"]] + series["row"] for series in listing["series"]]
+    }
+
+    return JsonResponse(return_obj)
+
+
+@csrf_exempt
+def ajax_select_series(request):
+    """
+    Ajax controller for select_series. Selects or deselects series ids, the series matching a spatial
+    query, or every series matching the current filters, and keeps the selection in the session.
+
+    Arguments:      [request]
+    Returns:        [JsonResponse(return_obj)]
+    Referenced By:  [app.HydroshareResourceCreator]
+    References:     [session_store.select_session_series, session_store.parse_spatial_query,
+                     session_store.query_session_series]
+    Libraries:      []
+    """
+
+    return_obj = {
+        "success": False,
+        "message": None,
+        "results": {}
+    }
+
+    action = request.POST.get("action")
+    if action not in ("select", "deselect", "replace"):
+        return_obj["message"] = "Invalid selection request."
+
+        return JsonResponse(return_obj)
+
+    series_ids = request.POST.get("seriesIds")
+    if series_ids is not None:
+        series_ids = [int(series_id) for series_id in series_ids.split(",") if series_id != ""]
+    else:
+        try:
+            spatial_query = parse_spatial_query(request.POST)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return_obj["message"] = "Invalid spatial query."
+
+            return JsonResponse(return_obj)
+        if spatial_query is not None:
+            series_ids = query_session_series(request, spatial_query)
+    filters = {
+        "site": request.POST.get("siteFilter", ""),
+        "variable": request.POST.get("variableFilter", ""),
+        "network": request.POST.get("networkFilter", "")
+    }
+    selected_count = select_session_series(request, action, series_ids=series_ids,
+                                           search=request.POST.get("search", ""), filters=filters)
+
+    return_obj["success"] = True
+    return_obj["results"] = {"selected_count": selected_count}
+
+    return JsonResponse(return_obj)
+
+
+@csrf_exempt
+def ajax_prefetch(request):
+    """
+    Ajax controller for prefetch. Cancels the prefetch of the session, which the home page requests when it
+    is left.
+
+    Arguments:      [request]
+    Returns:        [JsonResponse(return_obj)]
+    Referenced By:  [app.HydroshareResourceCreator]
+    References:     [prefetch.cancel_prefetch]
+    Libraries:      []
+    """
+
+    return_obj = {
+        "success": False,
+        "message": None,
+        "results": {}
+    }
+
+    if request.method != "POST" or request.POST.get("action") != "cancel":
+        return_obj["message"] = "Invalid prefetch request."
+
+        return JsonResponse(return_obj)
+
+    return_obj["success"] = True
+    return_obj["results"] = {"cancelled": cancel_prefetch(request.session.session_key)}
+
+    return JsonResponse(return_obj)
+
+
 @csrf_exempt
 def ajax_create_resource(request):
     """
-    Ajax controller for create_layer.
+    Ajax controller for create_layer. Builds are admitted in fair-share order under a global cost budget and
+    a per-user concurrency limit, and a build that cannot be admitted in time is answered with 429 and a
+    Retry-After header. An admitted build stops the prefetch of its session.
 
-    Arguments:      []
-    Returns:        []
-    Referenced By:  []
-    References:     []
+    Arguments:      [request]
+    Returns:        [JsonResponse(return_obj)]
+    Referenced By:  [app.HydroshareResourceCreator]
+    References:     [build_resource, admission.estimate_build_cost, admission.acquire_build,
+                     admission.release_build, prefetch.cancel_prefetch]
+    Libraries:      []
+    """
+
+    if not (request.is_ajax() and request.method == "POST"):
+        return build_resource(request)
+
+    # ------------------------------- #
+    #   ADMITS BUILD BY FAIR SHARE    #
+    # ------------------------------- #
+
+    action_request = str(request.POST.get("actionRequest"))
+    try:
+        build_cost = estimate_build_cost(action_request, get_request_form_body(request),
+                                         get_request_checked_ids(request))
+    except Exception:
+        build_cost = estimate_build_cost(action_request, None, None)
+    ticket, retry_after = acquire_build(str(request.user), build_cost)
+
+    if ticket is None:
+        increment("build_requests_total", action=action_request, status="rejected")
+        response = JsonResponse({
+            "success": False,
+            "message": "The server is busy with other builds. Please try again in %d seconds." % retry_after,
+            "results": {"retry_after": retry_after}
+        }, status=429)
+        response["Retry-After"] = str(retry_after)
+
+        return response
+
+    try:
+        cancel_prefetch(request.session.session_key, PREFETCH_CANCEL_WAIT)
+        return build_resource(request)
+    finally:
+        release_build(ticket)
+
+
+def build_resource(request):
+    """
+    Builds and uploads the resource of an admitted create_layer request. Resource files are uploaded in
+    parallel and retried one by one, and the main file, which is the manifest of a partitioned build, last.
+    Series left pending by a build deadline are appended to the uploaded resource by a deferred build.
+
+    Arguments:      [request]
+    Returns:        [JsonResponse(return_obj)]
+    Referenced By:  [ajax_create_resource]
+    References:     [utilities.create_ts_resource, utilities.update_ts_resource, utilities.create_refts_resource,
+                     partitions.upload_resource_files, partitions.upload_resource_file,
+                     partitions.replace_resource_file, deferred.start_deferred_build]
     Libraries:      []
     """
 
@@ -101,13 +355,18 @@ def ajax_create_resource(request):
 
     try:
         action_request = str(request.POST.get("actionRequest"))
-        data_body = request.POST.get("formBody")
+        data_body = get_request_form_body(request)
         res_title = request.POST.get("resTitle")
         res_abstract = request.POST.get("resAbstract")
         res_keywords = request.POST.get("resKeywords").split(",")
         res_access = str(request.POST.get("resAccess"))
         res_filename = res_title.replace(" ", "")[:10]
-        selected_resources = map(int, (request.POST.get("checkedIds")).split(','))
+        res_id = request.POST.get("resId")
+        output_formats = str(request.POST.get("outputFormats", "odm2")).split(",")
+        finalize = request.POST.get("finalize") == "true"
+        partition = request.POST.get("partition") or None
+        deadline = request.POST.get("deadline") or None
+        selected_resources = get_request_checked_ids(request)
         res_data = {
             "request": request,
             "form_body": data_body,
@@ -116,7 +375,12 @@ def ajax_create_resource(request):
             "res_keywords": res_keywords,
             "res_access": res_access,
             "res_filename": res_filename,
-            "selected_resources": selected_resources
+            "selected_resources": selected_resources,
+            "res_id": res_id,
+            "output_formats": output_formats,
+            "finalize": finalize,
+            "partition": partition,
+            "deadline": deadline
         }
 
     except:
@@ -133,6 +397,7 @@ def ajax_create_resource(request):
     try:
         hs_api = get_o_auth_hs(request)
         hs_version = hs_api.hostname
+        res_data["hs_api"] = hs_api
 
     except:
         return_obj["success"] = False
@@ -147,23 +412,32 @@ def ajax_create_resource(request):
 
     if True:
         actions = {"ts": create_ts_resource,
-                   "update": None,
+                   "update": update_ts_resource,
                    "refts": create_refts_resource}
 
-        processed_data = actions[action_request](res_data)
+        with stage_timer("build", action=action_request):
+            if should_profile(request):
+                payload = dict((key, value) for key, value in res_data.items() if key not in ("request", "hs_api"))
+                processed_data = profile_call("create_resource", actions[action_request], args=(res_data,),
+                                              payload=payload, labels={"action": action_request,
+                                                                       "user": str(request.user)})
+            else:
+                processed_data = actions[action_request](res_data)
 
         res_type = processed_data["res_type"]
         res_filepath = processed_data["res_filepath"]
         res_filename = res_filename + processed_data["file_extension"]
         res_status = processed_data["parse_status"]
         series_count = processed_data["series_count"]
+        pending_ids = [selected_resources[n] for n in processed_data.get("pending_ids", [])]
 
         return_status = []
-        if action_request == "ts":
+        if action_request in ("ts", "update"):
             for status in res_status:
                 if status["res_status"] != "Success":
                     return_status.append(status["res_name"].capitalize())
             if return_status:
+                increment("build_requests_total", action=action_request, status="parse_error")
                 open(res_filepath, "w").close()
                 return_obj["success"] = False
                 return_obj["message"] = "PARSE_ERROR"
@@ -171,7 +445,8 @@ def ajax_create_resource(request):
 
                 return JsonResponse(return_obj)
 
-            if series_count < 1:
+            if series_count < 1 and not pending_ids:
+                increment("build_requests_total", action=action_request, status="empty")
                 return_obj['success'] = False
                 return_obj['message'] = "We were unable to create your resource."
                 return_obj['results'] = ""
@@ -179,16 +454,37 @@ def ajax_create_resource(request):
                 return JsonResponse(return_obj)
 
 
-        resource_id = hs_api.createResource(res_type, res_title, abstract=res_abstract, keywords=res_keywords)
-        try:
-            hs_api.addResourceFile(resource_id, resource_file=res_filepath)
-            if hs_api.getSystemMetadata(resource_id)["resource_title"] == "Untitled resource":
-                hs_api.deleteResource(resource_id)
-                raise Exception
-        except:
-            logger.error("Unable to upload resource to HydroShare")
-            hs_api.deleteResource(resource_id)
-            raise Exception
+        upload_filepaths = processed_data.get("export_filepaths", []) + [res_filepath]
+        with stage_timer("upload", action=action_request) as stage_record:
+            stage_record["bytes"] = sum(os.path.getsize(filepath) for filepath in upload_filepaths
+                                        if os.path.isfile(filepath))
+            if action_request == "update":
+                resource_id = res_id
+                upload_error = replace_resource_file(hs_api, resource_id, processed_data["res_filename"],
+                                                     res_filepath, processed_data["backup_filepath"])
+                if upload_error is not None:
+                    logger.error("Unable to update resource on HydroShare")
+                    increment("build_requests_total", action=action_request, status="upload_error")
+                    return_obj['success'] = False
+                    return_obj['message'] = "We were unable to upload the updated resource to HydroShare."
+                    return_obj['results'] = str(upload_error)
+
+                    return JsonResponse(return_obj)
+            else:
+                resource_id = hs_api.createResource(res_type, res_title, abstract=res_abstract, keywords=res_keywords)
+                try:
+                    upload_resource_files(hs_api, resource_id, upload_filepaths[:-1])
+                    upload_error = upload_resource_file(hs_api, resource_id, res_filepath)
+                    if upload_error is not None:
+                        raise upload_error
+                    if hs_api.getSystemMetadata(resource_id)["resource_title"] == "Untitled resource":
+                        hs_api.deleteResource(resource_id)
+                        raise Exception
+                except Exception as ex:
+                    logger.error("Unable to upload resource to HydroShare")
+                    record_error("upload", "https://" + str(hs_version), ex)
+                    hs_api.deleteResource(resource_id)
+                    raise Exception
 
     else:
         return_obj['success'] = False
@@ -204,7 +500,7 @@ def ajax_create_resource(request):
     if res_access == 'public':
         public = False
         timeout = time.time() + 20
-        while public is False or time.time() < timeout:
+        while public is False and time.time() < timeout:
             try:
                 hs_api.setAccessRules(resource_id, public=True)
                 public = True
@@ -218,14 +514,82 @@ def ajax_create_resource(request):
 
             return JsonResponse(return_obj)
 
+    # -------------------------------------- #
+    #   APPENDS PENDING SERIES IN BACKGROUND   #
+    # -------------------------------------- #
+
+    deferred_job = None
+    if pending_ids and action_request == "ts":
+        deferred_job = start_deferred_build(res_data, resource_id, pending_ids, processed_data["fetch_state"])
+
     # --------------------------------- #
     #   RESOURCE CREATED SUCCESSFULLY   #
     # --------------------------------- #
 
+    increment("build_requests_total", action=action_request, status="success")
     return_obj['success'] = True
     return_obj['message'] = 'Resource created successfully'
-    return_obj['results'] = {'resource_id': resource_id, 'hs_version': hs_version}
+    return_obj['results'] = {'resource_id': resource_id, 'hs_version': hs_version,
+                             'pruned_series': processed_data.get('pruned_series', []),
+                             'reconciled_series': processed_data.get('reconciled_series', []),
+                             'partitions': processed_data.get('partitions', []),
+                             'pending_series': processed_data.get('pending_series', []),
+                             'deferred_job': deferred_job}
 
     TethysWorkspace(get_user_workspace(request)).clear()
 
     return JsonResponse(return_obj)
+
+
+@csrf_exempt
+def ajax_build_status(request):
+    """
+    Ajax controller for build_status. Returns the status of a deferred build of the user, which appends the
+    series a build deadline left pending to the created resource.
+
+    Arguments:      [request]
+    Returns:        [JsonResponse(return_obj)]
+    Referenced By:  [app.HydroshareResourceCreator]
+    References:     [deferred.get_deferred_status]
+    Libraries:      []
+    """
+
+    return_obj = {
+        "success": False,
+        "message": None,
+        "results": {}
+    }
+
+    params = request.POST if request.method == "POST" else request.GET
+    deferred_status = get_deferred_status(str(params.get("jobId")), str(request.user))
+    if deferred_status is None:
+        return_obj["message"] = "No deferred build found."
+
+        return JsonResponse(return_obj)
+
+    return_obj["success"] = True
+    return_obj["results"] = deferred_status
+
+    return JsonResponse(return_obj)
+
+
+def ajax_metrics(request):
+    """
+    Controller for metrics. Returns the build counters and histograms of this process in the Prometheus text
+    format, or as JSON with ?format=json.
+
+    Arguments:      [request]
+    Returns:        [HttpResponse(metrics_text)]
+    Referenced By:  [app.HydroshareResourceCreator]
+    References:     [metrics.get_metrics, metrics.render_metrics, admission.get_admission_status,
+                     prefetch.get_prefetch_status]
+    Libraries:      []
+    """
+
+    if request.GET.get("format") == "json":
+        snapshot = get_metrics()
+        snapshot["admission"] = get_admission_status()
+        snapshot["prefetch"] = get_prefetch_status()
+        return JsonResponse(snapshot)
+
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
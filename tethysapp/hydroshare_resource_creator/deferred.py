@@ -0,0 +1,226 @@
+import os
+import time
+import uuid
+import shutil
+import threading
+import traceback
+from logging import getLogger
+from django.conf import settings
+from .app import HydroshareResourceCreator
+from .metrics import increment
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = getLogger('django')
+
+# Fetched series groups held for the build while it writes earlier ones, and seconds the fetch thread waits
+# to hand over a group before checking whether the build stopped waiting.
+FETCH_AHEAD_GROUPS = 2
+FETCH_PUT_WAIT = 0.5
+
+# Seconds the status of a finished deferred build is kept for the page to poll.
+DEFERRED_STATUS_SECONDS = 86400
+
+deferred_jobs = {}
+deferred_lock = threading.Lock()
+
+
+def get_build_deadline(res_data):
+    """
+    Gets the seconds a build may spend fetching and writing series before it returns with the series it has,
+    as res_data asks, or otherwise as the HS_RESOURCE_CREATOR_BUILD_DEADLINE setting, off by default, asks.
+
+    Arguments:      [res_data]
+    Returns:        [deadline]
+    Referenced By:  [utilities.create_ts_resource]
+    References:     []
+    Libraries:      []
+    """
+
+    deadline = res_data.get("deadline")
+    if deadline is None:
+        deadline = getattr(settings, "HS_RESOURCE_CREATOR_BUILD_DEADLINE", None)
+    try:
+        deadline = float(deadline)
+    except (TypeError, ValueError):
+        return None
+
+    return deadline if deadline > 0 else None
+
+
+def fetch_groups_until(ts_list, series_groups, deadline_at, fetch_state):
+    """
+    Fetches series groups in a background thread, ahead of the build writing them, and yields each group
+    with its reconciled series until deadline_at. The groups not yielded by then are left in
+    fetch_state["pending_groups"], and the thread keeps fetching them into the series store, so that the
+    deferred build finds them stored. fetch_state["thread"] is the fetch thread.
+
+    Arguments:      [ts_list, series_groups, deadline_at, fetch_state]
+    Returns:        [fetched_groups]
+    Referenced By:  [utilities.create_ts_resource]
+    References:     [reconcile.fetch_series_group]
+    Libraries:      [threading, queue, time]
+    """
+
+    from .reconcile import fetch_series_group
+
+    fetched_queue = queue.Queue(FETCH_AHEAD_GROUPS)
+    fetch_state["abandoned"] = False
+    fetch_state["pending_groups"] = list(series_groups)
+
+    def fetch_groups():
+        for series_group in series_groups:
+            try:
+                fetched_group = fetch_series_group([ts_list[n] for n in series_group], series_group)
+            except Exception:
+                logger.error("Unable to fetch series group: " + traceback.format_exc())
+                fetched_group = ([], [])
+            while not fetch_state["abandoned"]:
+                try:
+                    fetched_queue.put((series_group,) + fetched_group, timeout=FETCH_PUT_WAIT)
+                    break
+                except queue.Full:
+                    continue
+
+    fetch_state["thread"] = threading.Thread(target=fetch_groups, name="deadline_fetch")
+    fetch_state["thread"].daemon = True
+    fetch_state["thread"].start()
+
+    try:
+        while fetch_state["pending_groups"]:
+            remaining = deadline_at - time.time()
+            if remaining <= 0:
+                break
+            try:
+                fetched_group = fetched_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            fetch_state["pending_groups"].pop(0)
+            yield fetched_group
+    finally:
+        fetch_state["abandoned"] = True
+
+
+def start_deferred_build(res_data, resource_id, pending_ids, fetch_state):
+    """
+    Starts a background thread that appends the series a deadline build left pending to its resource.
+
+    Arguments:      [res_data, resource_id, pending_ids, fetch_state]
+    Returns:        [job_id]
+    Referenced By:  [controllers_ajax.build_resource]
+    References:     [finish_deferred_build]
+    Libraries:      [threading, uuid]
+    """
+
+    job = {
+        "job_id": uuid.uuid4().hex,
+        "user": str(res_data["request"].user) if res_data.get("request") is not None else "",
+        "resource_id": resource_id,
+        "pending_ids": list(pending_ids),
+        "status": "pending",
+        "series_count": 0,
+        "failed_series": [],
+        "message": None,
+        "started_at": time.time(),
+        "finished_at": None
+    }
+    with deferred_lock:
+        for job_id in [job_id for job_id, old_job in deferred_jobs.items() if old_job["finished_at"] and
+                       time.time() - old_job["finished_at"] > DEFERRED_STATUS_SECONDS]:
+            del deferred_jobs[job_id]
+        deferred_jobs[job["job_id"]] = job
+
+    update_data = dict((key, value) for key, value in res_data.items() if key != "request")
+    deferred_thread = threading.Thread(target=finish_deferred_build, args=(job, update_data, fetch_state),
+                                       name="deferred_build")
+    deferred_thread.daemon = True
+    deferred_thread.start()
+
+    return job["job_id"]
+
+
+def finish_deferred_build(job, update_data, fetch_state):
+    """
+    Waits for the fetch thread of a deadline build, is admitted like any build, and appends the pending
+    series to the ODM2 database of the resource as new Results with utilities.update_ts_resource, then
+    replaces the database on HydroShare, restoring the original if the upload fails. Runs in a daemon
+    thread, in its own workspace.
+
+    Arguments:      [job, update_data, fetch_state]
+    Returns:        []
+    Referenced By:  [start_deferred_build]
+    References:     [utilities.update_ts_resource, admission.estimate_build_cost, admission.acquire_build,
+                     admission.release_build, partitions.replace_resource_file]
+    Libraries:      [shutil, time]
+    """
+
+    from .utilities import update_ts_resource
+    from .admission import estimate_build_cost, acquire_build, release_build
+    from .partitions import replace_resource_file
+
+    workspace = os.path.join(HydroshareResourceCreator.get_app_workspace().path, "deferred", job["job_id"])
+    os.makedirs(workspace)
+    ticket = None
+    try:
+        if fetch_state.get("thread") is not None:
+            fetch_state["thread"].join()
+
+        build_cost = estimate_build_cost("ts", update_data["form_body"], job["pending_ids"])
+        ticket, retry_after = acquire_build(job["user"], build_cost)
+        while ticket is None:
+            time.sleep(retry_after)
+            ticket, retry_after = acquire_build(job["user"], build_cost)
+
+        update_data.update({
+            "workspace": workspace,
+            "res_id": job["resource_id"],
+            "selected_resources": job["pending_ids"],
+            "new_series": True
+        })
+        processed_data = update_ts_resource(update_data)
+
+        upload_error = replace_resource_file(update_data["hs_api"], job["resource_id"], processed_data["res_filename"],
+                                             processed_data["res_filepath"], processed_data["backup_filepath"])
+        if upload_error is not None:
+            raise upload_error
+
+        job["series_count"] = processed_data["series_count"]
+        job["failed_series"] = [status["res_name"] for status in processed_data["parse_status"]
+                                if status["res_status"] != "Success"]
+        job["status"] = "done"
+    except Exception as ex:
+        logger.error("Unable to finish deferred build: " + traceback.format_exc())
+        job["status"] = "failed"
+        job["message"] = str(ex) or type(ex).__name__
+    finally:
+        if ticket is not None:
+            release_build(ticket)
+        shutil.rmtree(workspace, ignore_errors=True)
+        job["finished_at"] = time.time()
+
+    increment("deferred_builds_total", status=job["status"])
+    logger.info("Deferred build of resource %s %s: %d of %d series appended" % (
+        job["resource_id"], job["status"], job["series_count"], len(job["pending_ids"])))
+
+
+def get_deferred_status(job_id, user):
+    """
+    Gets the status of a deferred build of a user: pending, done, or failed, with the series it appended and
+    those that failed.
+
+    Arguments:      [job_id, user]
+    Returns:        [deferred_status]
+    Referenced By:  [controllers_ajax.ajax_build_status]
+    References:     []
+    Libraries:      []
+    """
+
+    with deferred_lock:
+        job = deferred_jobs.get(job_id)
+        if job is None or job["user"] != user:
+            return None
+        return dict((key, job[key]) for key in ("job_id", "resource_id", "status", "pending_ids", "series_count",
+                                                "failed_series", "message"))
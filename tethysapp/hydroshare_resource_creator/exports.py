@@ -0,0 +1,242 @@
+import json
+import gzip
+import numpy
+from logging import getLogger
+from .timeseries import get_utc_epochs
+
+logger = getLogger('django')
+use_pyarrow = True
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    use_pyarrow = False
+use_netcdf = True
+try:
+    import netCDF4
+except ImportError:
+    use_netcdf = False
+
+
+def get_series_metadata(series_list):
+    """
+    Builds one metadata row per series for the metadata tables of columnar exports.
+
+    Arguments:      [series_list]
+    Returns:        [metadata_rows]
+    Referenced By:  [write_parquet_export, write_csv_export, write_netcdf_export]
+    References:     []
+    Libraries:      []
+    """
+
+    metadata_rows = []
+    for series_id, series in enumerate(series_list):
+        date_times = series["values"]["date_time"]
+        metadata_rows.append({
+            "series_id": series_id,
+            "site_code": series["site"]["site_code"],
+            "site_name": series["site"]["site_name"],
+            "latitude": series["site"]["latitude"],
+            "longitude": series["site"]["longitude"],
+            "srs_code": series["site"]["srs_code"],
+            "variable_code": series["variable"]["variable_code"],
+            "variable_name": series["variable"]["variable_name"],
+            "sample_medium": series["variable"]["sample_medium"],
+            "no_data_value": series["variable"]["no_data_value"],
+            "unit_name": series["unit"]["unit_name"],
+            "unit_abbreviation": series["unit"]["unit_abbreviation"],
+            "organization": series["source"]["organization"],
+            "method_codes": ",".join(str(method["method_code"]) for method in series["methods"]),
+            "processing_level_codes": ",".join(str(processing_level["processing_level_code"])
+                                               for processing_level in series["processing_levels"]),
+            "value_count": len(date_times),
+            "begin_date": min(numpy.asarray(date_times).tolist()) if len(date_times) else None,
+            "end_date": max(numpy.asarray(date_times).tolist()) if len(date_times) else None,
+        })
+
+    return metadata_rows
+
+
+def get_float_values(values):
+    """
+    Converts metadata values to floats. Missing values and placeholders such as "UNKNOWN" become NaN.
+
+    Arguments:      [values]
+    Returns:        [float_values]
+    Referenced By:  [write_netcdf_export]
+    References:     []
+    Libraries:      [numpy]
+    """
+
+    float_values = []
+    for value in values:
+        try:
+            float_values.append(float(value))
+        except (TypeError, ValueError):
+            float_values.append(numpy.nan)
+
+    return float_values
+
+
+def write_parquet_export(series_list, base_path):
+    """
+    Writes each series to its own Parquet table, plus a metadata table describing every series.
+
+    Arguments:      [series_list, base_path]
+    Returns:        [export_filepaths]
+    Referenced By:  [write_exports]
+    References:     [get_series_metadata, timeseries.get_utc_epochs]
+    Libraries:      [pyarrow]
+    """
+
+    export_filepaths = []
+    for series_id, series in enumerate(series_list):
+        values = series["values"]
+        table = pyarrow.table({
+            "date_time_utc": pyarrow.array(get_utc_epochs(values["date_time"], values["utc_offset"]),
+                                           type=pyarrow.timestamp("s", tz="UTC")),
+            "date_time": pyarrow.array(numpy.asarray(values["date_time"]).tolist(), type=pyarrow.string()),
+            "utc_offset": pyarrow.array(numpy.asarray(values["utc_offset"]).tolist(), type=pyarrow.string()),
+            "data_value": pyarrow.array(numpy.asarray(values["data_value"]), type=pyarrow.float64()),
+            "censor_code": pyarrow.array(numpy.asarray(values["censor_code"]).tolist(), type=pyarrow.string()),
+        })
+        export_filepath = base_path + "_" + str(series_id) + ".parquet"
+        pyarrow.parquet.write_table(table, export_filepath)
+        export_filepaths.append(export_filepath)
+
+    metadata_rows = get_series_metadata(series_list)
+    metadata_table = pyarrow.table(dict(
+        (column, [str(row[column]) if row[column] is not None else None for row in metadata_rows])
+        for column in metadata_rows[0]
+    ))
+    export_filepath = base_path + "_metadata.parquet"
+    pyarrow.parquet.write_table(metadata_table, export_filepath)
+    export_filepaths.append(export_filepath)
+
+    return export_filepaths
+
+
+def write_csv_export(series_list, base_path):
+    """
+    Writes all series to a single gzipped long-format CSV file, plus a JSON metadata file.
+
+    Arguments:      [series_list, base_path]
+    Returns:        [export_filepaths]
+    Referenced By:  [write_exports]
+    References:     [get_series_metadata]
+    Libraries:      [gzip, json]
+    """
+
+    export_filepath = base_path + ".csv.gz"
+    with gzip.open(export_filepath, "wb") as export_file:
+        export_file.write(b"series_id,date_time,utc_offset,data_value,censor_code\n")
+        for series_id, series in enumerate(series_list):
+            values = series["values"]
+            rows = zip(
+                numpy.asarray(values["date_time"]).tolist(),
+                numpy.asarray(values["utc_offset"]).tolist(),
+                numpy.asarray(values["data_value"]).tolist(),
+                numpy.asarray(values["censor_code"]).tolist(),
+            )
+            lines = "".join("%d,%s,%s,%r,%s\n" % ((series_id,) + row) for row in rows)
+            export_file.write(lines.encode("utf-8"))
+
+    metadata_filepath = base_path + "_metadata.json"
+    with open(metadata_filepath, "w") as metadata_file:
+        json.dump(get_series_metadata(series_list), metadata_file)
+
+    return [export_filepath, metadata_filepath]
+
+
+def write_netcdf_export(series_list, base_path):
+    """
+    Writes all series to a CF discrete sampling geometry NetCDF file using the contiguous ragged array
+    representation, with one station per series.
+
+    Arguments:      [series_list, base_path]
+    Returns:        [export_filepaths]
+    Referenced By:  [write_exports]
+    References:     [get_series_metadata, get_float_values, timeseries.get_utc_epochs]
+    Libraries:      [netCDF4]
+    """
+
+    export_filepath = base_path + ".nc"
+    metadata_rows = get_series_metadata(series_list)
+    row_sizes = [len(series["values"]["date_time"]) for series in series_list]
+
+    dataset = netCDF4.Dataset(export_filepath, "w", format="NETCDF4")
+    try:
+        dataset.featureType = "timeSeries"
+        dataset.Conventions = "CF-1.6"
+        dataset.createDimension("station", len(series_list))
+        dataset.createDimension("obs", sum(row_sizes))
+
+        for column in ("site_code", "site_name", "variable_code", "variable_name", "unit_abbreviation",
+                       "sample_medium", "method_codes", "processing_level_codes"):
+            variable = dataset.createVariable(column, str, ("station",))
+            for series_id, row in enumerate(metadata_rows):
+                variable[series_id] = str(row[column])
+        dataset.variables["site_code"].cf_role = "timeseries_id"
+        for column, standard_name in (("latitude", "latitude"), ("longitude", "longitude")):
+            variable = dataset.createVariable(column, "f8", ("station",))
+            variable.standard_name = standard_name
+            variable[:] = get_float_values([row[column] for row in metadata_rows])
+        row_size = dataset.createVariable("row_size", "i8", ("station",))
+        row_size.sample_dimension = "obs"
+        row_size[:] = row_sizes
+
+        time = dataset.createVariable("time", "i8", ("obs",))
+        time.standard_name = "time"
+        time.units = "seconds since 1970-01-01 00:00:00 UTC"
+        data_value = dataset.createVariable("data_value", "f8", ("obs",))
+        data_value.coordinates = "time latitude longitude"
+        censor_code = dataset.createVariable("censor_code", str, ("obs",))
+        start = 0
+        for series in series_list:
+            values = series["values"]
+            end = start + len(values["date_time"])
+            time[start:end] = get_utc_epochs(values["date_time"], values["utc_offset"])
+            data_value[start:end] = numpy.asarray(values["data_value"])
+            censor_code[start:end] = numpy.asarray(values["censor_code"], dtype=object)
+            start = end
+    finally:
+        dataset.close()
+
+    return [export_filepath]
+
+
+EXPORT_FORMATS = {
+    "parquet": (write_parquet_export, use_pyarrow),
+    "csv.gz": (write_csv_export, True),
+    "netcdf": (write_netcdf_export, use_netcdf),
+}
+
+
+def write_exports(series_list, output_formats, base_path):
+    """
+    Writes the parsed series to each requested columnar export format. A format that fails is logged and
+    skipped so that it does not fail the rest of the resource.
+
+    Arguments:      [series_list, output_formats, base_path]
+    Returns:        [export_filepaths]
+    Referenced By:  [utilities.create_ts_resource]
+    References:     [write_parquet_export, write_csv_export, write_netcdf_export]
+    Libraries:      []
+    """
+
+    export_filepaths = []
+    if not series_list:
+        return export_filepaths
+    for output_format in output_formats:
+        if output_format not in EXPORT_FORMATS:
+            continue
+        export_writer, export_available = EXPORT_FORMATS[output_format]
+        if not export_available:
+            logger.error("Export format " + output_format + " requires a library that is not installed.")
+            continue
+        try:
+            export_filepaths += export_writer(series_list, base_path)
+        except Exception as ex:
+            logger.error("Unable to write export format " + output_format + ": " + str(ex))
+
+    return export_filepaths
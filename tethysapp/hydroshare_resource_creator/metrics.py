@@ -0,0 +1,211 @@
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from logging import getLogger
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+metrics_logger = getLogger('hydroshare_resource_creator.metrics')
+
+# Build stages reported by the pipeline.
+BUILD_STAGES = ("preflight", "download", "parse", "reconcile", "normalize", "dimension_lookup", "value_insert",
+                "commit", "shard_build", "merge", "partition_build", "refts_write", "export", "finalize", "build",
+                "upload")
+
+# Upper bounds, in seconds, of the stage duration histogram buckets.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+counters = {}
+histograms = {}
+metrics_lock = threading.Lock()
+
+
+def get_metric_key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+
+def get_service_host(url):
+    try:
+        return urlparse(url).hostname or "unknown"
+    except (AttributeError, ValueError):
+        return "unknown"
+
+
+def increment(name, value=1, **labels):
+    """
+    Adds to a counter of this process.
+
+    Arguments:      [name, value, labels]
+    Returns:        []
+    Referenced By:  [observe_stage, record_error, controllers_ajax.build_resource, controllers_ajax.ajax_create_resource,
+                     admission.acquire_build, prefetch.get_prefetch_series, prefetch.run_prefetch,
+                     deferred.finish_deferred_build]
+    References:     [get_metric_key]
+    Libraries:      [threading]
+    """
+
+    metric_key = get_metric_key(name, labels)
+    with metrics_lock:
+        counters[metric_key] = counters.get(metric_key, 0) + value
+
+
+def observe(name, value, buckets=DURATION_BUCKETS, **labels):
+    """
+    Records a value in a histogram of this process.
+
+    Arguments:      [name, value, buckets, labels]
+    Returns:        []
+    Referenced By:  [observe_stage]
+    References:     [get_metric_key]
+    Libraries:      [bisect, threading]
+    """
+
+    metric_key = get_metric_key(name, labels)
+    with metrics_lock:
+        histogram = histograms.get(metric_key)
+        if histogram is None:
+            histogram = histograms[metric_key] = {"buckets": buckets, "counts": [0] * (len(buckets) + 1),
+                                                  "sum": 0.0, "count": 0}
+        histogram["counts"][bisect.bisect_left(histogram["buckets"], value)] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+def observe_stage(stage, seconds, rows=None, byte_count=None, **labels):
+    """
+    Records the duration, rows, and bytes of one run of a build stage, and emits it as a structured log
+    record.
+
+    Arguments:      [stage, seconds, rows, byte_count, labels]
+    Returns:        []
+    Referenced By:  [stage_timer, utilities.write_odm2_series]
+    References:     [observe, increment]
+    Libraries:      [json]
+    """
+
+    observe("build_stage_seconds", seconds, stage=stage, **labels)
+    if rows is not None:
+        increment("build_rows_total", rows, stage=stage)
+    if byte_count is not None:
+        increment("build_bytes_total", byte_count, stage=stage)
+
+    record = {"event": "build_stage", "stage": stage, "seconds": round(seconds, 6)}
+    if rows is not None:
+        record["rows"] = rows
+    if byte_count is not None:
+        record["bytes"] = byte_count
+    record.update(labels)
+    metrics_logger.info(json.dumps(record, sort_keys=True, default=str), extra={"metrics": record})
+
+
+@contextmanager
+def stage_timer(stage, **labels):
+    """
+    Times a block of a build stage. The block may set "rows" and "bytes" on the yielded dict, and a failed
+    block is recorded with an error status.
+
+    Arguments:      [stage, labels]
+    Returns:        [stage_record]
+    Referenced By:  [utilities.fetch_series, utilities.create_ts_resource, utilities.create_refts_resource,
+                     utilities.finalize_odm2_database, odm2_shards.build_sharded_odm2,
+                     controllers_ajax.build_resource]
+    References:     [observe_stage]
+    Libraries:      [time]
+    """
+
+    stage_record = {"rows": None, "bytes": None}
+    start_time = time.time()
+    status = "error"
+    try:
+        yield stage_record
+        status = "success"
+    finally:
+        observe_stage(stage, time.time() - start_time, rows=stage_record["rows"],
+                      byte_count=stage_record["bytes"], status=status, **labels)
+
+
+def record_error(stage, url=None, error=None):
+    """
+    Counts a failed build step by stage and service host, and emits it as a structured log record.
+
+    Arguments:      [stage, url, error]
+    Returns:        []
+    Referenced By:  [utilities.fetch_series, preflight.preflight_ts, controllers_ajax.build_resource]
+    References:     [increment, get_service_host]
+    Libraries:      [json]
+    """
+
+    host = get_service_host(url) if url else "local"
+    increment("build_errors_total", stage=stage, host=host)
+    record = {"event": "build_error", "stage": stage, "host": host, "error": str(error) if error else None}
+    metrics_logger.warning(json.dumps(record, sort_keys=True), extra={"metrics": record})
+
+
+def get_metrics():
+    """
+    Gets a snapshot of every counter and histogram of this process.
+
+    Arguments:      []
+    Returns:        [snapshot]
+    Referenced By:  [render_metrics, controllers_ajax.ajax_metrics]
+    References:     []
+    Libraries:      []
+    """
+
+    with metrics_lock:
+        snapshot = {
+            "counters": [{"name": name, "labels": dict(labels), "value": value}
+                         for (name, labels), value in sorted(counters.items())],
+            "histograms": [{"name": name, "labels": dict(labels), "buckets": list(histogram["buckets"]),
+                            "counts": list(histogram["counts"]), "sum": histogram["sum"],
+                            "count": histogram["count"]}
+                           for (name, labels), histogram in sorted(histograms.items())]
+        }
+
+    return snapshot
+
+
+def render_metrics():
+    """
+    Renders the metrics of this process in the Prometheus text exposition format.
+
+    Arguments:      []
+    Returns:        [metrics_text]
+    Referenced By:  [controllers_ajax.ajax_metrics]
+    References:     [get_metrics]
+    Libraries:      []
+    """
+
+    def get_label_text(labels, extra_labels=()):
+        items = sorted(labels.items()) + list(extra_labels)
+        if not items:
+            return ""
+        return "{" + ",".join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in items) + "}"
+
+    snapshot = get_metrics()
+    lines = []
+    typed = set()
+    for counter in snapshot["counters"]:
+        if counter["name"] not in typed:
+            lines.append("# TYPE hs_resource_creator_%s counter" % counter["name"])
+            typed.add(counter["name"])
+        lines.append("hs_resource_creator_%s%s %s" % (counter["name"], get_label_text(counter["labels"]),
+                                                      counter["value"]))
+    for histogram in snapshot["histograms"]:
+        name = "hs_resource_creator_" + histogram["name"]
+        if histogram["name"] not in typed:
+            lines.append("# TYPE %s histogram" % name)
+            typed.add(histogram["name"])
+        cumulative = 0
+        for bound, count in zip(list(histogram["buckets"]) + ["+Inf"], histogram["counts"]):
+            cumulative += count
+            lines.append("%s_bucket%s %d" % (name, get_label_text(histogram["labels"], [("le", bound)]), cumulative))
+        lines.append("%s_sum%s %r" % (name, get_label_text(histogram["labels"]), histogram["sum"]))
+        lines.append("%s_count%s %d" % (name, get_label_text(histogram["labels"]), histogram["count"]))
+
+    return "\n".join(lines) + "\n"
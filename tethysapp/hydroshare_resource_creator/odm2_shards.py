@@ -0,0 +1,318 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import multiprocessing
+from logging import getLogger
+from django.conf import settings
+from .metrics import stage_timer
+
+logger = getLogger('django')
+
+# Dimension tables merged by natural key, in dependency order: (table, surrogate id column, key columns).
+# Units are keyed by their id, which is the unit code, and Sites by their sampling feature.
+MERGE_DIMENSIONS = (
+    ("Datasets", "DatasetID", ("DatasetCode",)),
+    ("SamplingFeatures", "SamplingFeatureID", ("SamplingFeatureCode",)),
+    ("SpatialReferences", "SpatialReferenceID", ("SRSCode",)),
+    ("Sites", None, ("SamplingFeatureID",)),
+    ("Variables", "VariableID", ("VariableCode",)),
+    ("Units", "UnitsID", ("UnitsID",)),
+    ("People", "PersonID", ("PersonFirstName",)),
+    ("Organizations", "OrganizationID", ("OrganizationCode",)),
+    ("Affiliations", "AffiliationID", ("PersonID", "OrganizationID")),
+    ("ProcessingLevels", "ProcessingLevelID", ("ProcessingLevelCode",)),
+    ("Methods", "MethodID", ("MethodCode",)),
+)
+
+# Per-series tables appended with their surrogate ids shifted past the rows already merged, in dependency
+# order: (table, surrogate id column).
+MERGE_FACTS = (
+    ("Actions", "ActionID"),
+    ("ActionBy", "BridgeID"),
+    ("FeatureActions", "FeatureActionID"),
+    ("Results", "ResultID"),
+    ("TimeSeriesResults", None),
+    ("TimeSeriesResultValues", "ValueID"),
+    ("DataSetsResults", "BridgeID"),
+)
+
+# Columns holding surrogate ids of other merged tables.
+MERGE_REFERENCES = {
+    "Sites": {"SamplingFeatureID": "SamplingFeatures", "SpatialReferenceID": "SpatialReferences"},
+    "Affiliations": {"PersonID": "People", "OrganizationID": "Organizations"},
+    "Methods": {"OrganizationID": "Organizations"},
+    "Actions": {"MethodID": "Methods"},
+    "ActionBy": {"ActionID": "Actions", "AffiliationID": "Affiliations"},
+    "FeatureActions": {"SamplingFeatureID": "SamplingFeatures", "ActionID": "Actions"},
+    "Results": {"FeatureActionID": "FeatureActions", "VariableID": "Variables", "UnitsID": "Units",
+                "ProcessingLevelID": "ProcessingLevels"},
+    "TimeSeriesResults": {"ResultID": "Results", "SpatialReferenceID": "SpatialReferences"},
+    "TimeSeriesResultValues": {"ResultID": "Results"},
+    "DataSetsResults": {"DatasetID": "Datasets", "ResultID": "Results"},
+}
+
+
+def get_shard_count(requested_shards, series_total):
+    """
+    Gets the number of shards to build a database with: the requested count, or the
+    HS_RESOURCE_CREATOR_BUILD_SHARDS setting, where "auto" uses one shard per CPU. Builds inside daemonic
+    worker processes, such as those of the command line pool, cannot start their own workers and use one.
+
+    Arguments:      [requested_shards, series_total]
+    Returns:        [shard_count]
+    Referenced By:  [utilities.create_ts_resource]
+    References:     []
+    Libraries:      [multiprocessing]
+    """
+
+    if not requested_shards:
+        requested_shards = getattr(settings, "HS_RESOURCE_CREATOR_BUILD_SHARDS", 1)
+    if str(requested_shards).lower() == "auto":
+        requested_shards = multiprocessing.cpu_count()
+    try:
+        shard_count = min(int(requested_shards), series_total)
+    except (TypeError, ValueError):
+        shard_count = 1
+    if shard_count > 1 and multiprocessing.current_process().daemon:
+        shard_count = 1
+
+    return max(shard_count, 1)
+
+
+def split_shards(ts_list, shard_count, series_groups=None):
+    """
+    Splits the series of a refts into contiguous runs with similar value counts, one per shard, so that the
+    merged database keeps the refts order. Series of a group from reconcile.group_series_ids are kept in the
+    same shard so that they can be merged.
+
+    Arguments:      [ts_list, shard_count, series_groups]
+    Returns:        [shard_groups]
+    Referenced By:  [build_sharded_odm2]
+    References:     []
+    Libraries:      []
+    """
+
+    if series_groups is None:
+        series_groups = [[index] for index in range(len(ts_list))]
+
+    value_counts = []
+    for series_group in series_groups:
+        group_count = 0
+        for index in series_group:
+            try:
+                group_count += max(int(ts_list[index].get("valueCount") or 0), 1)
+            except (TypeError, ValueError):
+                group_count += 1
+        value_counts.append(group_count)
+    total_count = float(sum(value_counts))
+
+    shard_groups = [[] for _ in range(shard_count)]
+    cumulative_count = 0
+    for group_number, value_count in enumerate(value_counts):
+        shard_number = min(int(cumulative_count / total_count * shard_count), shard_count - 1)
+        shard_number = max(shard_number, shard_count - (len(value_counts) - group_number))
+        shard_groups[shard_number].append(series_groups[group_number])
+        cumulative_count += value_count
+
+    return [groups for groups in shard_groups if groups]
+
+
+def build_odm2_shard(shard_options):
+    """
+    Writes a run of series groups into its own copy of the ODM2 template, merging overlapping series of a
+    group. Runs in a worker process, so errors are logged and the series skipped, as in a single database
+    build.
+
+    Arguments:      [shard_options]
+    Returns:        [series_indexes, reconcile_records]
+    Referenced By:  [build_sharded_odm2, partitions.build_partition]
+    References:     [reconcile.fetch_series_group, utilities.write_odm2_series]
+    Libraries:      [sqlite3, shutil]
+    """
+
+    from .utilities import write_odm2_series
+    from .reconcile import fetch_series_group
+
+    shutil.copy(shard_options["odm_master"], shard_options["shard_filepath"])
+    sql_connect = sqlite3.connect(shard_options["shard_filepath"], isolation_level=None)
+    curs = sql_connect.cursor()
+    curs.execute("PRAGMA journal_mode = OFF")
+    curs.execute("PRAGMA synchronous = OFF")
+
+    series_indexes = []
+    reconcile_records = []
+    for series_group in shard_options["ts_groups"]:
+        reconciled_series, group_records = fetch_series_group([ts for _, ts in series_group],
+                                                              [index for index, _ in series_group])
+        reconcile_records.extend(group_records)
+        for indexes, series in reconciled_series:
+            try:
+                curs.execute("BEGIN TRANSACTION;")
+                write_odm2_series(curs, series, shard_options["dataset"])
+                sql_connect.commit()
+            except Exception as ex:
+                logger.error("Unable to write series " + str(indexes[0] + 1) + " to shard: " + str(ex))
+                sql_connect.rollback()
+                continue
+            series_indexes.extend(indexes)
+    sql_connect.close()
+
+    return series_indexes, reconcile_records
+
+
+def get_column_expression(table, column, id_offsets):
+    """
+    Gets the SQL expression that translates a column of an attached shard row into the merged database:
+    ids of appended tables are shifted by their offset, and ids of de-duplicated tables are looked up in
+    their id map.
+
+    Arguments:      [table, column, id_offsets]
+    Returns:        [expression]
+    Referenced By:  [merge_odm2_shard]
+    References:     []
+    Libraries:      []
+    """
+
+    referenced_table = MERGE_REFERENCES.get(table, {}).get(column)
+    if referenced_table is None:
+        return "s." + column
+    if referenced_table in id_offsets:
+        return "s.%s + %d" % (column, id_offsets[referenced_table])
+    return "(SELECT new_id FROM temp.merge_map_%s WHERE old_id = s.%s)" % (referenced_table, column)
+
+
+def merge_odm2_shard(curs, shard_filepath):
+    """
+    Copies an attached shard into the open merged database. Dimension rows are inserted only when their
+    natural key is new, and every shard id is mapped to the id of the matching merged row. Per-series rows
+    are bulk-copied with their ids shifted past the existing rows and their references remapped.
+
+    Arguments:      [curs, shard_filepath]
+    Returns:        [merge_counts]
+    Referenced By:  [merge_odm2_shards]
+    References:     [get_column_expression]
+    Libraries:      [sqlite3]
+    """
+
+    merge_counts = {"value_rows": 0, "dimension_rows": 0, "duplicate_rows": 0}
+    curs.execute("ATTACH DATABASE ? AS shard", (shard_filepath,))
+    curs.execute("BEGIN TRANSACTION;")
+
+    # ------------------------------- #
+    #   Merges Shared Dimension Rows  #
+    # ------------------------------- #
+
+    for table, id_column, key_columns in MERGE_DIMENSIONS:
+        columns = [row[1] for row in curs.execute("PRAGMA main.table_info(" + table + ")").fetchall()]
+        expressions = dict((column, get_column_expression(table, column, {})) for column in columns)
+        insert_columns = [column for column in columns if column != id_column or column in key_columns]
+        key_match = " AND ".join("m.%s IS %s" % (column, expressions[column]) for column in key_columns)
+        shard_rows = curs.execute("SELECT COUNT(*) FROM shard." + table).fetchone()[0]
+        curs.execute("INSERT INTO main.%s (%s) SELECT %s FROM shard.%s AS s WHERE NOT EXISTS "
+                     "(SELECT 1 FROM main.%s AS m WHERE %s)" % (
+                         table, ", ".join(insert_columns),
+                         ", ".join(expressions[column] for column in insert_columns), table, table, key_match))
+        merge_counts["dimension_rows"] += curs.rowcount
+        merge_counts["duplicate_rows"] += shard_rows - curs.rowcount
+        if id_column is not None:
+            curs.execute("DROP TABLE IF EXISTS temp.merge_map_" + table)
+            curs.execute("CREATE TEMP TABLE merge_map_%s (old_id PRIMARY KEY, new_id)" % table)
+            curs.execute("INSERT INTO temp.merge_map_%s SELECT s.%s, (SELECT MIN(m.%s) FROM main.%s AS m WHERE %s) "
+                         "FROM shard.%s AS s" % (table, id_column, id_column, table, key_match, table))
+
+    # ---------------------------- #
+    #   Appends Per-Series Rows    #
+    # ---------------------------- #
+
+    id_offsets = {}
+    for table, id_column in MERGE_FACTS:
+        columns = [row[1] for row in curs.execute("PRAGMA main.table_info(" + table + ")").fetchall()]
+        if id_column is not None:
+            id_offsets[table] = curs.execute("SELECT IFNULL(MAX(%s), 0) FROM main.%s" % (id_column,
+                                                                                       table)).fetchone()[0]
+        expressions = [get_column_expression(table, column, id_offsets) if column != id_column else
+                       "s.%s + %d" % (column, id_offsets[table]) for column in columns]
+        curs.execute("INSERT INTO main.%s (%s) SELECT %s FROM shard.%s AS s" % (
+            table, ", ".join(columns), ", ".join(expressions), table))
+        if table == "TimeSeriesResultValues":
+            merge_counts["value_rows"] += curs.rowcount
+
+    curs.execute("COMMIT")
+    curs.execute("DETACH DATABASE shard")
+
+    return merge_counts
+
+
+def merge_odm2_shards(res_filepath, shard_filepaths):
+    """
+    Merges shard databases, in order, into the ODM2 database at res_filepath.
+
+    Arguments:      [res_filepath, shard_filepaths]
+    Returns:        [merge_counts]
+    Referenced By:  [build_sharded_odm2]
+    References:     [merge_odm2_shard]
+    Libraries:      [sqlite3]
+    """
+
+    sql_connect = sqlite3.connect(res_filepath, isolation_level=None)
+    curs = sql_connect.cursor()
+    # The database is a fresh copy that is discarded if the merge fails, so it needs no rollback journal.
+    curs.execute("PRAGMA journal_mode = OFF")
+    curs.execute("PRAGMA synchronous = OFF")
+    curs.execute("PRAGMA cache_size = -65536")
+    merge_counts = {"value_rows": 0, "dimension_rows": 0, "duplicate_rows": 0}
+    try:
+        for shard_filepath in shard_filepaths:
+            shard_counts = merge_odm2_shard(curs, shard_filepath)
+            for key in merge_counts:
+                merge_counts[key] += shard_counts[key]
+    finally:
+        sql_connect.close()
+
+    return merge_counts
+
+
+def build_sharded_odm2(ts_list, dataset, odm_master, res_filepath, shard_count, series_groups=None):
+    """
+    Builds the ODM2 database of a refts with one writer process per shard, then merges the shards into the
+    database at res_filepath, which must be a fresh copy of the template. series_groups lists the indexes of
+    series that may overlap, as from reconcile.group_series_ids, and defaults to one group per series.
+
+    Arguments:      [ts_list, dataset, odm_master, res_filepath, shard_count, series_groups]
+    Returns:        [series_indexes, reconcile_records]
+    Referenced By:  [utilities.create_ts_resource]
+    References:     [split_shards, build_odm2_shard, merge_odm2_shards]
+    Libraries:      [multiprocessing, tempfile]
+    """
+
+    shard_path = tempfile.mkdtemp(prefix="odm2_shards_", dir=os.path.dirname(os.path.abspath(res_filepath)))
+    shard_options = [{
+        "odm_master": odm_master,
+        "shard_filepath": os.path.join(shard_path, "shard_%d.sqlite" % shard_number),
+        "ts_groups": [[(index, ts_list[index]) for index in series_group] for series_group in shard_groups],
+        "dataset": dataset
+    } for shard_number, shard_groups in enumerate(split_shards(ts_list, shard_count, series_groups))]
+
+    try:
+        with stage_timer("shard_build", shards=len(shard_options)):
+            pool = multiprocessing.Pool(len(shard_options))
+            try:
+                shard_results = pool.map(build_odm2_shard, shard_options, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+        with stage_timer("merge", shards=len(shard_options)) as stage_record:
+            merge_counts = merge_odm2_shards(res_filepath, [options["shard_filepath"] for options in shard_options])
+            stage_record["rows"] = merge_counts["value_rows"]
+        logger.info("Merged %d ODM2 shards: %d values, %d dimension rows, %d duplicate dimension rows removed" % (
+            len(shard_options), merge_counts["value_rows"], merge_counts["dimension_rows"],
+            merge_counts["duplicate_rows"]))
+    finally:
+        shutil.rmtree(shard_path, ignore_errors=True)
+
+    series_indexes = sorted(index for shard_indexes, _ in shard_results for index in shard_indexes)
+    reconcile_records = [record for _, shard_records in shard_results for record in shard_records]
+
+    return series_indexes, reconcile_records
@@ -0,0 +1,626 @@
+import re
+import json
+import zlib
+from logging import getLogger
+from django.conf import settings
+
+# numpy and lxml are imported where they are used, like in utilities, so that loading the controllers does
+# not pay for them.
+
+logger = getLogger('django')
+
+# WaterML 1.x namespaces by refts return type.
+WML1_NAMESPACES = {
+    "WaterML 1.1": "{http://www.cuahsi.org/waterML/1.1/}",
+    "WaterML 1.0": "{http://www.cuahsi.org/waterML/1.0/}",
+}
+
+# WaterML 2.0 and the OGC namespaces its observations use.
+WML2_NS = "{http://www.opengis.net/waterml/2.0}"
+GML_NS = "{http://www.opengis.net/gml/3.2}"
+OM_NS = "{http://www.opengis.net/om/2.0}"
+XLINK_NS = "{http://www.w3.org/1999/xlink}"
+XSI_NS = "{http://www.w3.org/2001/XMLSchema-instance}"
+
+# USGS water services standing in for the NWIS networks of the CUAHSI hydroportal. Daily and instantaneous
+# values are also served there as RDB, JSON, and WaterML 2.0, which are cheaper to transfer and parse than
+# SOAP-wrapped WaterML 1.1. They are used only when the HS_RESOURCE_CREATOR_ALTERNATE_FORMATS setting is on, and
+# the base URL can be changed with the HS_RESOURCE_CREATOR_NWIS_URL setting.
+NWIS_URL = "https://waterservices.usgs.gov/nwis/"
+NWIS_NETWORK_SERVICES = {
+    "NWISDV": "dv",
+    "NWISUV": "iv",
+    "NWISIV": "iv",
+}
+NWIS_STATISTIC_CODES = {
+    "maximum": "00001",
+    "minimum": "00002",
+    "mean": "00003",
+    "sum": "00006",
+    "median": "00008",
+}
+NWIS_PROCESSING_LEVELS = {
+    "A": "Approved for publication -- Processing and review completed.",
+    "P": "Provisional data subject to revision.",
+}
+NWIS_TIME_ZONES = {
+    "UTC": "+00:00", "GMT": "+00:00", "AST": "-04:00", "ADT": "-03:00", "EST": "-05:00", "EDT": "-04:00",
+    "CST": "-06:00", "CDT": "-05:00", "MST": "-07:00", "MDT": "-06:00", "PST": "-08:00", "PDT": "-07:00",
+    "AKST": "-09:00", "AKDT": "-08:00", "HST": "-10:00", "HDT": "-09:00", "SST": "-11:00", "ChST": "+10:00",
+}
+
+# Units without a numeric code get an ID derived from their name, above the range of CUAHSI unit codes.
+UNIT_ID_OFFSET = 100000
+UNIT_ID_RANGE = 900000
+
+PARSERS = {}
+RETURN_TYPE_PARSERS = {}
+
+
+def register_parser(service_type, return_type, format_name, cost, download, parse):
+    """
+    Registers the download and parse functions of a return type. download takes a referenced timeseries and
+    returns the response body. parse takes the body and the referenced timeseries, and returns a series in
+    the form of utilities.parse_wml_series, or None if the body holds no values. cost ranks formats from
+    cheapest to most expensive to transfer and parse, and is measured by benchmarks/bench_parsers.py.
+
+    Arguments:      [service_type, return_type, format_name, cost, download, parse]
+    Returns:        [parser]
+    Referenced By:  [parsers]
+    References:     []
+    Libraries:      []
+    """
+
+    parser = {
+        "service_type": service_type,
+        "return_type": return_type,
+        "format": format_name,
+        "cost": cost,
+        "download": download,
+        "parse": parse
+    }
+    PARSERS[(service_type, return_type)] = parser
+    RETURN_TYPE_PARSERS.setdefault(return_type, parser)
+
+    return parser
+
+
+def get_parser(ts):
+    """
+    Gets the parser of a referenced timeseries by its service and return type. Refts often leave the service
+    type out or name it differently, so a pair that is not registered falls back to the return type alone.
+
+    Arguments:      [ts]
+    Returns:        [parser]
+    Referenced By:  [get_format_requests]
+    References:     []
+    Libraries:      []
+    """
+
+    return_type = ts["requestInfo"].get("returnType")
+    parser = PARSERS.get((ts["requestInfo"].get("serviceType"), return_type))
+    if parser is None:
+        parser = RETURN_TYPE_PARSERS.get(return_type)
+
+    return parser
+
+
+def get_unit_id(unit_name):
+    return UNIT_ID_OFFSET + (zlib.crc32(unit_name.encode("utf-8")) & 0xffffffff) % UNIT_ID_RANGE
+
+
+def get_unknown_unit():
+    return {"unit_code": 9999, "unit_type": "other", "unit_abbreviation": "unknown", "unit_name": "unknown",
+            "unit_link": None}
+
+
+def get_named_unit(unit_name):
+    if not unit_name:
+        return get_unknown_unit()
+    return {"unit_code": get_unit_id(unit_name), "unit_type": "other", "unit_abbreviation": unit_name,
+            "unit_name": unit_name, "unit_link": None}
+
+
+def strip_network(code):
+    return str(code).split(":", 1)[-1]
+
+
+def get_series_template(ts):
+    """
+    Builds a series holding the metadata of a referenced timeseries, for formats that carry little metadata
+    of their own. Parsers fill in what their format provides, and the values.
+
+    Arguments:      [ts]
+    Returns:        [series]
+    Referenced By:  [parse_wml2, parse_nwis_rdb, parse_nwis_json]
+    References:     [get_unknown_unit, strip_network]
+    Libraries:      []
+    """
+
+    site = ts.get("site", {})
+    variable = ts.get("variable", {})
+    method = ts.get("method", {})
+    method_description = method.get("methodDescription")
+
+    return {
+        "site": {
+            "site_code": strip_network(site.get("siteCode", "")) or None,
+            "site_name": site.get("siteName"),
+            "latitude": str(site.get("latitude", "")),
+            "longitude": str(site.get("longitude", "")),
+            "elevation_m": None,
+            "vertical_datum": None,
+            "srs_code": "EPSG:4269",
+        },
+        "variable": {
+            "variable_code": strip_network(variable.get("variableCode", "")) or None,
+            "variable_name": variable.get("variableName") or "Unknown",
+            "variable_description": None,
+            "speciation": None,
+            "no_data_value": -9999,
+            "sample_medium": ts.get("sampleMedium") or "unknown",
+        },
+        "unit": get_unknown_unit(),
+        "time_unit": get_unknown_unit(),
+        "source": {
+            "contact_name": "unknown",
+            "organization_code": "unknown",
+            "organization": "unknown",
+            "source_description": None,
+            "source_link": None,
+            "phone": None,
+            "email": "unknown",
+            "address": None,
+        },
+        "processing_levels": [{
+            "processing_level_code": 9999,
+            "definition": None,
+            "explanation": None,
+        }],
+        "methods": [{
+            "method_code": 9999,
+            "method_description": method_description if method_description != "UNKNOWN" else None,
+            "method_link": method.get("methodLink"),
+        }]
+    }
+
+
+def get_values_columns(data_values, date_times, utc_offsets, censor_codes=None, method_codes=None):
+    import numpy
+
+    value_count = len(data_values)
+    return {
+        "data_value": numpy.array(data_values, dtype=numpy.float64),
+        "date_time": numpy.array(date_times, dtype="U"),
+        "utc_offset": numpy.array(utc_offsets, dtype="U"),
+        "censor_code": numpy.array(censor_codes if censor_codes is not None else ["nc"] * value_count, dtype="U"),
+        "method_code": numpy.array(method_codes if method_codes is not None else [""] * value_count, dtype="U"),
+    }
+
+
+def split_iso_date_time(date_time):
+    """
+    Splits an ISO 8601 date and time into the local date and time, without fractional seconds, and its UTC
+    offset.
+
+    Arguments:      [date_time]
+    Returns:        [local_date_time, utc_offset]
+    Referenced By:  [parse_wml2, parse_nwis_json]
+    References:     []
+    Libraries:      []
+    """
+
+    date_time = date_time.strip()
+    if len(date_time) == 10:
+        return date_time + "T00:00:00", "+00:00"
+    local_date_time = date_time[:19]
+    if date_time.endswith("Z"):
+        return local_date_time, "+00:00"
+    if len(date_time) >= 25 and date_time[-6] in "+-" and date_time[-3] == ":":
+        return local_date_time, date_time[-6:]
+
+    return local_date_time, "+00:00"
+
+
+def get_processing_levels(codes):
+    return [{
+        "processing_level_code": code,
+        "definition": NWIS_PROCESSING_LEVELS[code],
+        "explanation": NWIS_PROCESSING_LEVELS[code],
+    } for code in sorted(set(codes)) if code in NWIS_PROCESSING_LEVELS] or [{
+        "processing_level_code": 9999,
+        "definition": None,
+        "explanation": None,
+    }]
+
+
+def set_nwis_source(series):
+    # Codes follow the NWIS networks of the CUAHSI hydroportal, as in 00060/DataType=Mean.
+    parameter_code, _, data_type = series["variable"]["variable_code"].partition("/DataType=")
+    if data_type:
+        series["variable"]["variable_code"] = parameter_code + "/DataType=" + data_type.capitalize()
+    series["source"].update({
+        "organization_code": "USGS",
+        "organization": "U.S. Geological Survey",
+        "source_description": "USGS National Water Information System",
+        "source_link": "https://waterservices.usgs.gov/",
+    })
+
+
+def download_wml1(ts):
+    from .utilities import download_wml
+
+    return download_wml(ts)[0]
+
+
+def parse_wml1(payload, ts):
+    """
+    Parses a WaterML 1.0 or 1.1 GetValuesObject response.
+
+    Arguments:      [payload, ts]
+    Returns:        [series]
+    Referenced By:  [utilities.fetch_series]
+    References:     [utilities.parse_wml_series]
+    Libraries:      [lxml.etree]
+    """
+
+    from lxml import etree
+    from .utilities import parse_wml_series
+
+    # The return type's version is looked for first, since the service registry may have asked for the other.
+    return_type_ns = WML1_NAMESPACES[ts["requestInfo"]["returnType"]]
+    wml_tree = etree.fromstring(payload)
+    for ns in [return_type_ns] + [ns for ns in WML1_NAMESPACES.values() if ns != return_type_ns]:
+        values_trees = list(wml_tree.iter(ns + "values"))
+        if values_trees:
+            break
+    if not values_trees or next(values_trees[0].iter(ns + "value"), None) is None:
+        return None
+
+    return parse_wml_series(wml_tree, ns)
+
+
+def get_nwis_query(ts):
+    """
+    Gets the service URL and query parameters of a NWIS request, from a referenced timeseries whose url is a
+    USGS water service, such as https://waterservices.usgs.gov/nwis/dv/. Codes may carry a network prefix
+    and, for daily values, a /DataType= statistic, as in the NWIS networks of the CUAHSI hydroportal.
+
+    Arguments:      [ts]
+    Returns:        [url, params]
+    Referenced By:  [download_nwis, get_nwis_alternates]
+    References:     [strip_network]
+    Libraries:      [re]
+    """
+
+    url = ts["requestInfo"]["url"]
+    if url.endswith("?WSDL"):
+        url = url[:-len("?WSDL")]
+    variable_code = strip_network(ts["variable"]["variableCode"])
+    parameter_code, _, data_type = variable_code.partition("/DataType=")
+    params = {
+        "sites": strip_network(ts["site"]["siteCode"]),
+        "parameterCd": parameter_code,
+    }
+    if "/dv" in url:
+        statistic_code = NWIS_STATISTIC_CODES.get(data_type.lower()) if data_type else None
+        if data_type and statistic_code is None:
+            raise ValueError("Unsupported NWIS statistic: " + data_type)
+        if statistic_code:
+            params["statCd"] = statistic_code
+    for param_name, date_name in (("startDT", "beginDate"), ("endDT", "endDate")):
+        date_time = str(ts.get(date_name) or "")
+        if re.match(r"^\d{4}-\d{2}-\d{2}", date_time):
+            params[param_name] = date_time[:10] if "/dv" in url else date_time[:19]
+
+    return url, params
+
+
+def download_nwis(ts, format_code):
+    from .service_registry import request_service
+
+    url, params = get_nwis_query(ts)
+    params["format"] = format_code
+    response = request_service(ts, "GET", url=url, params=params)
+    response.raise_for_status()
+
+    return response.content
+
+
+def download_nwis_rdb(ts):
+    return download_nwis(ts, "rdb")
+
+
+def download_nwis_json(ts):
+    return download_nwis(ts, "json")
+
+
+def download_wml2(ts):
+    from .service_registry import request_service
+
+    url = ts["requestInfo"]["url"]
+    if "/nwis/" in url:
+        return download_nwis(ts, "waterml,2.0")
+
+    # Other WaterML 2.0 services are referenced by their full request URL.
+    response = request_service(ts, "GET")
+    response.raise_for_status()
+
+    return response.content
+
+
+def parse_nwis_rdb(payload, ts):
+    """
+    Parses a NWIS RDB (tab-delimited) daily or instantaneous values response. Site and parameter names are
+    read from the header comments, and rows without a numeric value, such as ice or equipment codes, are
+    skipped.
+
+    Arguments:      [payload, ts]
+    Returns:        [series]
+    Referenced By:  [utilities.fetch_series]
+    References:     [get_series_template, get_values_columns, get_processing_levels, set_nwis_source]
+    Libraries:      [re]
+    """
+
+    series = get_series_template(ts)
+    set_nwis_source(series)
+    parameter_code = series["variable"]["variable_code"].split("/")[0]
+    lines = payload.decode("utf-8", "replace").splitlines()
+
+    column_names = None
+    descriptions = {}
+    data_start = None
+    for line_index, line in enumerate(lines):
+        if line.startswith("#"):
+            site_match = re.match(r"^#\s+USGS\s+(\d+)\s+(.+)$", line)
+            if site_match:
+                series["site"]["site_code"] = site_match.group(1)
+                series["site"]["site_name"] = site_match.group(2).strip()
+            description_match = re.match(r"^#\s+(\d+)\s+(\d{5})\s+(?:(\d{5})\s+)?(.+)$", line)
+            if description_match:
+                descriptions["_".join(code for code in description_match.group(1, 2, 3) if code)] = \
+                    description_match.group(4).strip()
+        elif line.strip():
+            column_names = line.split("\t")
+            data_start = line_index + 2
+            break
+    if column_names is None:
+        return None
+
+    value_columns = [index for index, name in enumerate(column_names)
+                     if re.match(r"^\d+_" + parameter_code + r"(_\d{5})?$", name)]
+    if not value_columns:
+        return None
+    value_index = value_columns[0]
+    code_index = column_names.index(column_names[value_index] + "_cd") \
+        if column_names[value_index] + "_cd" in column_names else None
+    date_index = column_names.index("datetime")
+    zone_index = column_names.index("tz_cd") if "tz_cd" in column_names else None
+
+    data_values = []
+    date_times = []
+    utc_offsets = []
+    censor_codes = []
+    qualifiers = set()
+    for line in lines[data_start:]:
+        fields = line.split("\t")
+        if len(fields) <= value_index:
+            continue
+        try:
+            data_value = float(fields[value_index])
+        except ValueError:
+            continue
+        data_values.append(data_value)
+        date_time = fields[date_index]
+        date_times.append(date_time + "T00:00:00" if len(date_time) == 10 else
+                          date_time.replace(" ", "T") + (":00" if len(date_time) == 16 else ""))
+        utc_offsets.append(NWIS_TIME_ZONES.get(fields[zone_index], "+00:00") if zone_index is not None
+                           else "+00:00")
+        value_codes = fields[code_index].split() if code_index is not None and code_index < len(fields) else []
+        censor_codes.append("lt" if "<" in value_codes else "gt" if ">" in value_codes else "nc")
+        qualifiers.update(value_codes)
+    if not data_values:
+        return None
+
+    description = descriptions.get(column_names[value_index], "")
+    if description:
+        series["variable"]["variable_description"] = description
+        series["unit"] = get_named_unit(description.split(",", 1)[1].split("(")[0].strip()
+                                        if "," in description else None)
+    series["processing_levels"] = get_processing_levels(qualifiers)
+    series["values"] = get_values_columns(data_values, date_times, utc_offsets, censor_codes)
+
+    return series
+
+
+def parse_nwis_json(payload, ts):
+    """
+    Parses a NWIS JSON daily or instantaneous values response, the JSON form of WaterML 1.1.
+
+    Arguments:      [payload, ts]
+    Returns:        [series]
+    Referenced By:  [utilities.fetch_series]
+    References:     [get_series_template, get_values_columns, get_processing_levels, set_nwis_source,
+                     split_iso_date_time]
+    Libraries:      [json]
+    """
+
+    series = get_series_template(ts)
+    set_nwis_source(series)
+    time_series_list = json.loads(payload.decode("utf-8"))["value"]["timeSeries"]
+    time_series_list = [time_series for time_series in time_series_list
+                        if time_series.get("values") and time_series["values"][0].get("value")]
+    if not time_series_list:
+        return None
+    time_series = time_series_list[0]
+
+    source_info = time_series.get("sourceInfo", {})
+    location = source_info.get("geoLocation", {}).get("geogLocation", {})
+    site_codes = source_info.get("siteCode") or [{}]
+    series["site"].update({
+        "site_code": site_codes[0].get("value") or series["site"]["site_code"],
+        "site_name": source_info.get("siteName") or series["site"]["site_name"],
+        "latitude": str(location.get("latitude", series["site"]["latitude"])),
+        "longitude": str(location.get("longitude", series["site"]["longitude"])),
+        "srs_code": location.get("srs") or series["site"]["srs_code"],
+    })
+    variable = time_series.get("variable", {})
+    series["variable"].update({
+        "variable_name": variable.get("variableName") or series["variable"]["variable_name"],
+        "variable_description": variable.get("variableDescription"),
+        "no_data_value": variable.get("noDataValue", series["variable"]["no_data_value"]),
+    })
+    series["unit"] = get_named_unit(variable.get("unit", {}).get("unitCode"))
+
+    values = time_series["values"][0]
+    methods = values.get("method") or []
+    if methods and methods[0].get("methodID") is not None:
+        series["methods"] = [{
+            "method_code": method.get("methodID"),
+            "method_description": method.get("methodDescription") or None,
+            "method_link": None,
+        } for method in methods]
+
+    data_values = []
+    date_times = []
+    utc_offsets = []
+    censor_codes = []
+    qualifiers = set()
+    for value in values["value"]:
+        data_values.append(float(value["value"]))
+        date_time, utc_offset = split_iso_date_time(value["dateTime"])
+        date_times.append(date_time)
+        utc_offsets.append(utc_offset)
+        value_qualifiers = value.get("qualifiers") or []
+        censor_codes.append("lt" if "<" in value_qualifiers else "gt" if ">" in value_qualifiers else "nc")
+        qualifiers.update(value_qualifiers)
+
+    series["processing_levels"] = get_processing_levels(qualifiers)
+    series["values"] = get_values_columns(data_values, date_times, utc_offsets, censor_codes)
+
+    return series
+
+
+def parse_wml2(payload, ts):
+    """
+    Parses the first measurement timeseries of a WaterML 2.0 observation collection. Points without a value
+    are skipped.
+
+    Arguments:      [payload, ts]
+    Returns:        [series]
+    Referenced By:  [utilities.fetch_series]
+    References:     [get_series_template, get_values_columns, split_iso_date_time]
+    Libraries:      [lxml.etree]
+    """
+
+    from lxml import etree
+
+    series = get_series_template(ts)
+    wml_tree = etree.fromstring(payload)
+    observation = next(wml_tree.iter(OM_NS + "OM_Observation"), None)
+    timeseries = next(wml_tree.iter(WML2_NS + "MeasurementTimeseries"), None)
+    if observation is None or timeseries is None:
+        return None
+
+    feature = observation.find(OM_NS + "featureOfInterest")
+    if feature is not None:
+        site_name = feature.get(XLINK_NS + "title") or feature.findtext(".//" + GML_NS + "name")
+        if site_name:
+            series["site"]["site_name"] = site_name.strip()
+        position = feature.findtext(".//" + GML_NS + "pos")
+        if position and len(position.split()) == 2:
+            series["site"]["latitude"], series["site"]["longitude"] = position.split()
+    observed_property = observation.find(OM_NS + "observedProperty")
+    if observed_property is not None and observed_property.get(XLINK_NS + "title"):
+        series["variable"]["variable_description"] = observed_property.get(XLINK_NS + "title")
+    unit = next(timeseries.iter(WML2_NS + "uom"), None)
+    if unit is not None:
+        series["unit"] = get_named_unit(unit.get("code") or unit.get(XLINK_NS + "title"))
+    if "USGS" in (observation.findtext(".//" + GML_NS + "identifier") or "") or "/nwis/" in \
+            ts["requestInfo"]["url"]:
+        set_nwis_source(series)
+
+    data_values = []
+    date_times = []
+    utc_offsets = []
+    for point in timeseries.iter(WML2_NS + "MeasurementTVP"):
+        value = point.find(WML2_NS + "value")
+        if value is None or not value.text or value.get(XSI_NS + "nil") == "true":
+            continue
+        date_time, utc_offset = split_iso_date_time(point.findtext(WML2_NS + "time"))
+        data_values.append(float(value.text))
+        date_times.append(date_time)
+        utc_offsets.append(utc_offset)
+    if not data_values:
+        return None
+    series["values"] = get_values_columns(data_values, date_times, utc_offsets)
+
+    return series
+
+
+def get_nwis_alternates(ts):
+    """
+    Gets requests for the same series from the USGS water services, for series of the NWIS networks of the
+    CUAHSI hydroportal.
+
+    Arguments:      [ts]
+    Returns:        [alternate_ts_list]
+    Referenced By:  [get_format_requests]
+    References:     [get_nwis_query]
+    Libraries:      []
+    """
+
+    network_name = str(ts["requestInfo"].get("networkName", "")).upper()
+    service_name = NWIS_NETWORK_SERVICES.get(network_name)
+    if service_name is None:
+        return []
+
+    nwis_url = getattr(settings, "HS_RESOURCE_CREATOR_NWIS_URL", NWIS_URL).rstrip("/") + "/"
+    alternate_ts_list = []
+    for return_type in ("NWIS RDB", "NWIS JSON", "WaterML 2.0"):
+        alternate_ts = dict(ts)
+        alternate_ts["requestInfo"] = dict(ts["requestInfo"], serviceType="REST", returnType=return_type,
+                                           url=nwis_url + service_name + "/")
+        alternate_ts_list.append(alternate_ts)
+    try:
+        get_nwis_query(alternate_ts_list[0])
+    except ValueError:
+        return []
+
+    return alternate_ts_list
+
+
+def get_format_requests(ts):
+    """
+    Gets the requests that can fetch a referenced timeseries, cheapest format first: the return type the
+    refts names, and, when the HS_RESOURCE_CREATOR_ALTERNATE_FORMATS setting turns them on, the formats other
+    services offer for the same series. They are off by default because those services describe units, UTC
+    offsets, processing levels, and sources differently than the referenced service.
+
+    Arguments:      [ts]
+    Returns:        [format_requests]
+    Referenced By:  [utilities.fetch_series]
+    References:     [get_parser, get_nwis_alternates]
+    Libraries:      []
+    """
+
+    format_requests = []
+    parser = get_parser(ts)
+    if parser is not None:
+        format_requests.append((parser, ts))
+    if getattr(settings, "HS_RESOURCE_CREATOR_ALTERNATE_FORMATS", False):
+        for alternate_ts in get_nwis_alternates(ts):
+            alternate_parser = get_parser(alternate_ts)
+            if alternate_parser is not None and alternate_parser is not parser:
+                format_requests.append((alternate_parser, alternate_ts))
+
+    return sorted(format_requests, key=lambda format_request: format_request[0]["cost"])
+
+
+# Costs rank payload size and parse time per value, as measured by benchmarks/bench_parsers.py: RDB is about
+# a quarter of the size of WaterML 1.1 and parses three times faster, JSON about half, WaterML 2.0 about 80%.
+register_parser("SOAP", "WaterML 1.1", "wml11", 4, download_wml1, parse_wml1)
+register_parser("SOAP", "WaterML 1.0", "wml10", 4, download_wml1, parse_wml1)
+register_parser("REST", "WaterML 2.0", "wml2", 3, download_wml2, parse_wml2)
+register_parser("REST", "NWIS JSON", "nwis_json", 2, download_nwis_json, parse_nwis_json)
+register_parser("REST", "NWIS RDB", "nwis_rdb", 1, download_nwis_rdb, parse_nwis_rdb)
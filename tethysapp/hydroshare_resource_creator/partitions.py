@@ -0,0 +1,364 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from logging import getLogger
+from django.conf import settings
+from .metrics import stage_timer, record_error
+
+logger = getLogger('django')
+
+# Ways a build can be partitioned into several ODM2 files: one file per site, one per network, or files of
+# consecutive series filled up to the partition size. Site and network partitions that would grow past the
+# partition size are split further by size.
+PARTITION_MODES = ("site", "network", "size")
+
+# Default of the HS_RESOURCE_CREATOR_PARTITION_BYTES setting: the size no partition is planned to grow past,
+# well below what HydroShare accepts comfortably in a single file upload.
+PARTITION_BYTES = 524288000
+
+# ODM2 database bytes per value, as measured for the bundled fixtures, used to plan partition sizes from
+# value counts. Series without a value count are planned at DEFAULT_VALUE_COUNT.
+ODM2_BYTES_PER_VALUE = 160
+DEFAULT_VALUE_COUNT = 10000
+
+# Attempts for each partition build, and for each file upload, with the seconds waited before the first
+# upload retry, doubled after each failure. Default of the HS_RESOURCE_CREATOR_UPLOAD_WORKERS setting.
+PARTITION_ATTEMPTS = 2
+UPLOAD_ATTEMPTS = 3
+UPLOAD_RETRY_SECONDS = 2
+UPLOAD_WORKERS = 4
+
+
+def get_partition_mode(res_data):
+    """
+    Gets how a build should be partitioned: as res_data asks, or otherwise as the HS_RESOURCE_CREATOR_PARTITION
+    setting, off by default, asks. Unknown modes build a single database.
+
+    Arguments:      [res_data]
+    Returns:        [partition_mode]
+    Referenced By:  [utilities.create_ts_resource]
+    References:     []
+    Libraries:      []
+    """
+
+    partition_mode = res_data.get("partition")
+    if partition_mode is None:
+        partition_mode = getattr(settings, "HS_RESOURCE_CREATOR_PARTITION", None)
+    partition_mode = str(partition_mode or "").lower()
+
+    return partition_mode if partition_mode in PARTITION_MODES else None
+
+
+def get_group_bytes(ts_list, series_group):
+    group_values = 0
+    for index in series_group:
+        try:
+            group_values += max(int(ts_list[index].get("valueCount")), 0)
+        except (TypeError, ValueError):
+            group_values += DEFAULT_VALUE_COUNT
+    return group_values * ODM2_BYTES_PER_VALUE
+
+
+def get_partition_key(ts, partition_mode):
+    """
+    Gets the key a referenced series is partitioned on: its site code without the network prefix, its
+    network name, or nothing when partitioning by size only.
+
+    Arguments:      [ts, partition_mode]
+    Returns:        [partition_key]
+    Referenced By:  [split_partitions]
+    References:     [reconcile.get_candidate_key]
+    Libraries:      []
+    """
+
+    from .reconcile import get_candidate_key
+
+    if partition_mode == "site":
+        return get_candidate_key(ts)[0]
+    if partition_mode == "network":
+        network_name = ts["requestInfo"].get("networkName")
+        if not network_name:
+            site_code = str(ts["site"]["siteCode"])
+            network_name = site_code.split(":", 1)[0] if ":" in site_code else ""
+        return str(network_name).lower()
+
+    return ""
+
+
+def split_partitions(ts_list, series_groups, partition_mode, partition_bytes=None):
+    """
+    Splits the series groups of a build into partitions. Groups go to the partition of the key of their first
+    series, in refts order, and the groups of each key are cut into runs whose planned size stays within
+    partition_bytes, by default the HS_RESOURCE_CREATOR_PARTITION_BYTES setting. A group is never split, so
+    that its series can still be merged.
+
+    Arguments:      [ts_list, series_groups, partition_mode, partition_bytes]
+    Returns:        [partitions]
+    Referenced By:  [utilities.create_ts_resource]
+    References:     [get_partition_key, get_group_bytes]
+    Libraries:      []
+    """
+
+    if partition_bytes is None:
+        partition_bytes = int(getattr(settings, "HS_RESOURCE_CREATOR_PARTITION_BYTES", PARTITION_BYTES))
+
+    key_groups = []
+    key_indexes = {}
+    for series_group in series_groups:
+        partition_key = get_partition_key(ts_list[series_group[0]], partition_mode)
+        if partition_key not in key_indexes:
+            key_indexes[partition_key] = len(key_groups)
+            key_groups.append((partition_key, []))
+        key_groups[key_indexes[partition_key]][1].append(series_group)
+
+    partitions = []
+    for partition_key, groups in key_groups:
+        partition = None
+        for series_group in groups:
+            group_bytes = get_group_bytes(ts_list, series_group)
+            if partition is None or partition["planned_bytes"] + group_bytes > partition_bytes:
+                partition = {"key": partition_key, "groups": [], "planned_bytes": 0}
+                partitions.append(partition)
+            partition["groups"].append(series_group)
+            partition["planned_bytes"] += group_bytes
+            if group_bytes > partition_bytes:
+                logger.warning("Series %d alone is planned at %d bytes, above the partition size of %d bytes" % (
+                    series_group[0] + 1, group_bytes, partition_bytes))
+
+    return partitions
+
+
+def get_partition_filepath(base_path, partition_number, partition_key):
+    partition_name = re.sub(r"[^A-Za-z0-9_.-]+", "_", partition_key).strip("_.")[:40]
+    return "%s.part%03d%s.odm2.sqlite" % (base_path, partition_number + 1,
+                                          "." + partition_name if partition_name else "")
+
+
+def build_partition(partition_options):
+    """
+    Builds the ODM2 database of one partition, and finalizes it when asked. Runs in a worker process.
+
+    Arguments:      [partition_options]
+    Returns:        [series_indexes, reconcile_records]
+    Referenced By:  [build_partitions]
+    References:     [odm2_shards.build_odm2_shard, utilities.finalize_odm2_database]
+    Libraries:      []
+    """
+
+    from .odm2_shards import build_odm2_shard
+    from .utilities import finalize_odm2_database
+
+    series_indexes, reconcile_records = build_odm2_shard(partition_options)
+    if partition_options["finalize"] and series_indexes:
+        finalize_odm2_database(partition_options["shard_filepath"])
+
+    return series_indexes, reconcile_records
+
+
+def build_partitions(ts_list, dataset, odm_master, base_path, partitions, workers, finalize=False):
+    """
+    Builds one ODM2 database per partition, with up to workers partitions built at a time in worker
+    processes. A partition whose build fails is built again on its own, up to PARTITION_ATTEMPTS times in
+    all. Partitions that end up without series are removed.
+
+    Arguments:      [ts_list, dataset, odm_master, base_path, partitions, workers, finalize]
+    Returns:        [partition_records, reconcile_records]
+    Referenced By:  [utilities.create_ts_resource]
+    References:     [build_partition, get_partition_filepath]
+    Libraries:      [multiprocessing]
+    """
+
+    partition_options = [{
+        "odm_master": odm_master,
+        "shard_filepath": get_partition_filepath(base_path, partition_number, partition["key"]),
+        "ts_groups": [[(index, ts_list[index]) for index in series_group] for series_group in partition["groups"]],
+        "dataset": dataset,
+        "finalize": finalize
+    } for partition_number, partition in enumerate(partitions)]
+    partition_results = [None] * len(partition_options)
+
+    # ----------------------------------------- #
+    #   Builds Partitions in Worker Processes   #
+    # ----------------------------------------- #
+
+    pooled = workers > 1 and len(partition_options) > 1
+    with stage_timer("partition_build", partitions=len(partition_options)):
+        if pooled:
+            pool = multiprocessing.Pool(min(workers, len(partition_options)))
+            try:
+                async_results = [pool.apply_async(build_partition, (options,)) for options in partition_options]
+                for partition_number, async_result in enumerate(async_results):
+                    try:
+                        partition_results[partition_number] = async_result.get()
+                    except Exception as ex:
+                        logger.error("Unable to build partition %d: %s" % (partition_number + 1, ex))
+            finally:
+                pool.close()
+                pool.join()
+
+        for attempt in range(PARTITION_ATTEMPTS - 1 if pooled else PARTITION_ATTEMPTS):
+            for partition_number, options in enumerate(partition_options):
+                if partition_results[partition_number] is not None:
+                    continue
+                try:
+                    partition_results[partition_number] = build_partition(options)
+                except Exception as ex:
+                    logger.error("Unable to build partition %d: %s" % (partition_number + 1, ex))
+
+    failed_numbers = [partition_number + 1 for partition_number, result in enumerate(partition_results)
+                      if result is None]
+    if failed_numbers:
+        raise Exception("Unable to build partitions " + ", ".join(str(number) for number in failed_numbers))
+
+    # ------------------------------ #
+    #   Describes Built Partitions   #
+    # ------------------------------ #
+
+    partition_records = []
+    reconcile_records = []
+    for partition, options, (series_indexes, partition_reconcile) in zip(partitions, partition_options,
+                                                                         partition_results):
+        reconcile_records.extend(partition_reconcile)
+        if not series_indexes:
+            os.remove(options["shard_filepath"])
+            continue
+        sql_connect = sqlite3.connect(options["shard_filepath"])
+        value_count = sql_connect.execute("SELECT COUNT(*) FROM TimeSeriesResultValues").fetchone()[0]
+        sql_connect.close()
+        partition_ts = [ts_list[index] for index in sorted(series_indexes)]
+        partition_records.append({
+            "file_name": os.path.basename(options["shard_filepath"]),
+            "filepath": options["shard_filepath"],
+            "key": partition["key"],
+            "series_ids": sorted(series_indexes),
+            "site_codes": sorted(set(str(ts["site"]["siteCode"]) for ts in partition_ts)),
+            "variable_codes": sorted(set(str(ts["variable"]["variableCode"]) for ts in partition_ts)),
+            "value_count": value_count,
+            "size_bytes": os.path.getsize(options["shard_filepath"])
+        })
+
+    return partition_records, reconcile_records
+
+
+def write_manifest(manifest_filepath, res_title, partition_mode, partition_records):
+    """
+    Writes the manifest of a partitioned build: the partitioning, and for each ODM2 file its refts series
+    ids, site codes, variable codes, value count, and size, so that clients can find the file holding a
+    series without opening every database.
+
+    Arguments:      [manifest_filepath, res_title, partition_mode, partition_records]
+    Returns:        [manifest_filepath]
+    Referenced By:  [utilities.create_ts_resource]
+    References:     []
+    Libraries:      [json]
+    """
+
+    manifest = {
+        "title": res_title,
+        "partition": partition_mode,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "series_count": sum(len(record["series_ids"]) for record in partition_records),
+        "files": [dict((key, value) for key, value in record.items() if key != "filepath")
+                  for record in partition_records]
+    }
+    with open(manifest_filepath, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    return manifest_filepath
+
+
+def upload_resource_file(hs_api, resource_id, filepath):
+    """
+    Adds one file to a HydroShare resource, retried up to UPLOAD_ATTEMPTS times with a growing wait.
+
+    Arguments:      [hs_api, resource_id, filepath]
+    Returns:        [error]
+    Referenced By:  [upload_resource_files, replace_resource_file, controllers_ajax.build_resource]
+    References:     []
+    Libraries:      [time]
+    """
+
+    error = None
+    for attempt in range(UPLOAD_ATTEMPTS):
+        if attempt:
+            time.sleep(UPLOAD_RETRY_SECONDS * 2 ** (attempt - 1))
+        try:
+            hs_api.addResourceFile(resource_id, resource_file=filepath)
+            return None
+        except Exception as ex:
+            error = ex
+            logger.warning("Unable to upload %s, attempt %d: %s" % (os.path.basename(filepath), attempt + 1, ex))
+            record_error("upload", "https://" + str(getattr(hs_api, "hostname", "")), ex)
+
+    return error
+
+
+def replace_resource_file(hs_api, resource_id, res_filename, filepath, backup_filepath):
+    """
+    Replaces a file of a HydroShare resource with an updated copy of the same name. HydroShare cannot replace
+    a file in place, so the old file is removed first; if the updated file then cannot be uploaded, the
+    unchanged backup_filepath, which has the same name, is uploaded back so that the resource is not left
+    without the file.
+
+    Arguments:      [hs_api, resource_id, res_filename, filepath, backup_filepath]
+    Returns:        [error]
+    Referenced By:  [controllers_ajax.build_resource, deferred.finish_deferred_build]
+    References:     [upload_resource_file]
+    Libraries:      []
+    """
+
+    try:
+        hs_api.deleteResourceFile(resource_id, res_filename)
+    except Exception as ex:
+        logger.error("Unable to remove %s from resource %s: %s" % (res_filename, resource_id, ex))
+        record_error("upload", "https://" + str(getattr(hs_api, "hostname", "")), ex)
+        return ex
+
+    error = upload_resource_file(hs_api, resource_id, filepath)
+    if error is None:
+        return None
+    restore_error = upload_resource_file(hs_api, resource_id, backup_filepath)
+    if restore_error is not None:
+        logger.error("Unable to restore %s to resource %s: %s" % (res_filename, resource_id, restore_error))
+    else:
+        logger.warning("Restored the original %s to resource %s" % (res_filename, resource_id))
+
+    return error
+
+
+def upload_resource_files(hs_api, resource_id, filepaths, workers=None):
+    """
+    Adds files to a HydroShare resource, up to the HS_RESOURCE_CREATOR_UPLOAD_WORKERS setting at a time.
+    Each file is retried on its own, and an exception naming the files that still failed is raised.
+
+    Arguments:      [hs_api, resource_id, filepaths, workers]
+    Returns:        []
+    Referenced By:  [controllers_ajax.build_resource]
+    References:     [upload_resource_file]
+    Libraries:      [multiprocessing.pool]
+    """
+
+    if not filepaths:
+        return
+    if workers is None:
+        workers = int(getattr(settings, "HS_RESOURCE_CREATOR_UPLOAD_WORKERS", UPLOAD_WORKERS))
+    workers = max(min(workers, len(filepaths)), 1)
+
+    if workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            errors = pool.map(lambda filepath: upload_resource_file(hs_api, resource_id, filepath), filepaths,
+                              chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        errors = [upload_resource_file(hs_api, resource_id, filepath) for filepath in filepaths]
+
+    failed_names = [os.path.basename(filepath) for filepath, error in zip(filepaths, errors) if error is not None]
+    if failed_names:
+        raise Exception("Unable to upload " + ", ".join(failed_names))
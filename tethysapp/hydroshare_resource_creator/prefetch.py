@@ -0,0 +1,288 @@
+import time
+import threading
+import traceback
+from logging import getLogger
+from django.conf import settings
+from .metrics import increment
+
+logger = getLogger('django')
+
+# Defaults of the HS_RESOURCE_CREATOR_PREFETCH_BYTES and HS_RESOURCE_CREATOR_PREFETCH_PERIOD settings: the
+# bytes of series one user may prefetch into the series store, and the seconds after which that budget resets.
+PREFETCH_BYTES = 268435456
+PREFETCH_PERIOD = 3600
+
+# Bytes a series takes per value in the series store, as measured for the bundled fixtures, used to check a
+# series against the budget before it is downloaded.
+STORED_BYTES_PER_VALUE = 120
+
+# Seconds a prefetch runs after its page was loaded, seconds the worker waits between checks while builds
+# are running, and seconds a build waits for the series being prefetched for its session to be stored.
+PREFETCH_MAX_AGE = 1800
+PREFETCH_BUILD_WAIT = 1.0
+PREFETCH_CANCEL_WAIT = 60
+
+# Prefetch state of this process. Prefetched series go to the shared series store, so builds run by other
+# processes use them too.
+prefetch_condition = threading.Condition()
+prefetch_jobs = []
+prefetch_usage = {}
+prefetch_state = {"thread": None, "next_index": 0}
+
+
+def should_prefetch():
+    """
+    Checks whether series should be prefetched when a refts is opened: only when the
+    HS_RESOURCE_CREATOR_PREFETCH setting, off by default, turns it on.
+
+    Arguments:      []
+    Returns:        [use_prefetch]
+    Referenced By:  [controllers.home]
+    References:     []
+    Libraries:      []
+    """
+
+    return bool(getattr(settings, "HS_RESOURCE_CREATOR_PREFETCH", False))
+
+
+def get_prefetch_budget(user):
+    """
+    Gets the bytes a user may still prefetch in the current budget period. Called with the prefetch lock held.
+
+    Arguments:      [user]
+    Returns:        [remaining_bytes]
+    Referenced By:  [get_prefetch_series]
+    References:     []
+    Libraries:      [time]
+    """
+
+    budget_bytes = int(getattr(settings, "HS_RESOURCE_CREATOR_PREFETCH_BYTES", PREFETCH_BYTES))
+    budget_period = float(getattr(settings, "HS_RESOURCE_CREATOR_PREFETCH_PERIOD", PREFETCH_PERIOD))
+    usage = prefetch_usage.get(user)
+    if usage is None or time.time() - usage["since"] > budget_period:
+        usage = prefetch_usage[user] = {"bytes": 0, "since": time.time()}
+
+    return budget_bytes - usage["bytes"]
+
+
+def get_estimated_bytes(ts):
+    try:
+        return max(int(ts.get("valueCount")), 0) * STORED_BYTES_PER_VALUE
+    except (TypeError, ValueError):
+        return None
+
+
+def start_prefetch(request):
+    """
+    Starts prefetching the series of the refts loaded in a session, replacing any prefetch the session had,
+    and starts the background worker if it is not running.
+
+    Arguments:      [request]
+    Returns:        [job]
+    Referenced By:  [controllers.home]
+    References:     [cancel_prefetch, run_prefetch, get_estimated_bytes, session_store.load_session_data,
+                     session_store.get_session_path]
+    Libraries:      [threading]
+    """
+
+    from .session_store import load_session_data, get_session_path
+
+    session_data = load_session_data(request)
+    if session_data is None:
+        return None
+    session_path = get_session_path(request)
+    ts_list = session_data["form_body"]["timeSeriesReferenceFile"]["referencedTimeSeries"]
+
+    # Smaller series are prefetched first, so that as many series as possible are stored by the time the
+    # build starts. Series without a value count come last.
+    estimated_bytes = [get_estimated_bytes(ts) for ts in ts_list]
+    order = sorted(range(len(ts_list)), key=lambda series_id: (estimated_bytes[series_id] is None,
+                                                                estimated_bytes[series_id]))
+
+    cancel_prefetch(request.session.session_key)
+    job = {
+        "session_key": request.session.session_key,
+        "session_path": session_path,
+        "user": str(request.user),
+        "ts_list": ts_list,
+        "order": order,
+        "estimated_bytes": estimated_bytes,
+        "done_ids": set(),
+        "active_id": None,
+        "started_at": time.time(),
+        "cancelled": False,
+        "stored_count": 0,
+        "stored_bytes": 0
+    }
+
+    with prefetch_condition:
+        prefetch_jobs.append(job)
+        if prefetch_state["thread"] is None:
+            prefetch_state["thread"] = threading.Thread(target=run_prefetch, name="prefetch")
+            prefetch_state["thread"].daemon = True
+            prefetch_state["thread"].start()
+        prefetch_condition.notify_all()
+
+    return job
+
+
+def cancel_prefetch(session_key, wait_seconds=0):
+    """
+    Cancels the prefetch of a session. When wait_seconds is given, waits up to that long for the series
+    being downloaded to be stored, so that a build starting for the session does not download it again.
+
+    Arguments:      [session_key, wait_seconds]
+    Returns:        [cancelled]
+    Referenced By:  [start_prefetch, controllers_ajax.ajax_create_resource, controllers_ajax.ajax_prefetch]
+    References:     []
+    Libraries:      [threading, time]
+    """
+
+    if not session_key:
+        return False
+
+    with prefetch_condition:
+        session_jobs = [job for job in prefetch_jobs if job["session_key"] == session_key]
+        for job in session_jobs:
+            job["cancelled"] = True
+            prefetch_jobs.remove(job)
+        deadline = time.time() + wait_seconds
+        while any(job["active_id"] is not None for job in session_jobs) and time.time() < deadline:
+            prefetch_condition.wait(deadline - time.time())
+
+    for job in session_jobs:
+        logger.info("Cancelled prefetch of session %s: %d series and %d bytes stored" % (
+            session_key, job["stored_count"], job["stored_bytes"]))
+
+    return bool(session_jobs)
+
+
+def get_prefetch_series(job):
+    """
+    Gets the next series of a job to prefetch: the first series in the job order that is selected in the
+    session, has not been prefetched, and fits in the budget of its user. Selection changes made while the
+    prefetch runs are followed. Called with the prefetch lock held.
+
+    Arguments:      [job]
+    Returns:        [series_id]
+    Referenced By:  [run_prefetch]
+    References:     [get_prefetch_budget, session_store.read_selection, session_store.is_selected]
+    Libraries:      []
+    """
+
+    from .session_store import read_selection, is_selected
+
+    selection = read_selection(job["session_path"])
+    exceptions = set(selection["exceptions"])
+    remaining_bytes = get_prefetch_budget(job["user"])
+    for series_id in job["order"]:
+        if series_id in job["done_ids"] or not is_selected(selection, series_id, exceptions):
+            continue
+        if remaining_bytes <= 0 or (job["estimated_bytes"][series_id] or 0) > remaining_bytes:
+            increment("prefetch_series_total", status="over_budget")
+            job["done_ids"].add(series_id)
+            continue
+        return series_id
+
+    return None
+
+
+def prefetch_series(ts):
+    """
+    Stores one referenced series in the series store, unless it is stored already.
+
+    Arguments:      [ts]
+    Returns:        [status, stored_bytes]
+    Referenced By:  [run_prefetch]
+    References:     [series_store.load_series, utilities.fetch_series]
+    Libraries:      []
+    """
+
+    from .series_store import load_series
+    from .utilities import fetch_series
+
+    if load_series(ts) is not None:
+        return "cached", 0
+    series = fetch_series(ts)
+    if series is None:
+        return "failed", 0
+
+    return "stored", sum(series["values"][column].nbytes for column in series["values"])
+
+
+def run_prefetch():
+    """
+    Prefetches the series of the running jobs, one series at a time and taking turns between sessions, until
+    no job is left. Prefetching is low priority: no series is started while a build runs in this process.
+    Runs in a daemon thread.
+
+    Arguments:      []
+    Returns:        []
+    Referenced By:  [start_prefetch]
+    References:     [get_prefetch_series, prefetch_series, admission.get_admission_status]
+    Libraries:      [threading, time]
+    """
+
+    from .admission import get_admission_status
+
+    while True:
+        with prefetch_condition:
+            for job in [job for job in prefetch_jobs if time.time() - job["started_at"] > PREFETCH_MAX_AGE]:
+                job["cancelled"] = True
+                prefetch_jobs.remove(job)
+            if not prefetch_jobs:
+                prefetch_state["thread"] = None
+                return
+            if get_admission_status()["running_builds"]:
+                prefetch_condition.wait(PREFETCH_BUILD_WAIT)
+                continue
+
+            prefetch_state["next_index"] = prefetch_state["next_index"] % len(prefetch_jobs)
+            job = prefetch_jobs[prefetch_state["next_index"]]
+            prefetch_state["next_index"] += 1
+            series_id = get_prefetch_series(job)
+            if series_id is None:
+                prefetch_jobs.remove(job)
+                logger.info("Finished prefetch of session %s: %d series and %d bytes stored" % (
+                    job["session_key"], job["stored_count"], job["stored_bytes"]))
+                continue
+            job["active_id"] = series_id
+
+        try:
+            status, stored_bytes = prefetch_series(job["ts_list"][series_id])
+        except Exception:
+            logger.error("Unable to prefetch series: " + traceback.format_exc())
+            status, stored_bytes = "failed", 0
+        increment("prefetch_series_total", status=status)
+        increment("prefetch_bytes_total", stored_bytes)
+
+        with prefetch_condition:
+            job["active_id"] = None
+            job["done_ids"].add(series_id)
+            if status == "stored":
+                job["stored_count"] += 1
+                job["stored_bytes"] += stored_bytes
+                get_prefetch_budget(job["user"])
+                prefetch_usage[job["user"]]["bytes"] += stored_bytes
+            prefetch_condition.notify_all()
+
+
+def get_prefetch_status():
+    """
+    Gets the running prefetch jobs of this process, and how many users have prefetched and how many bytes.
+    The metrics endpoint is public, so usernames are not reported.
+
+    Arguments:      []
+    Returns:        [prefetch_status]
+    Referenced By:  [controllers_ajax.ajax_metrics]
+    References:     []
+    Libraries:      []
+    """
+
+    with prefetch_condition:
+        return {
+            "jobs": len(prefetch_jobs),
+            "pending_series": sum(len(job["ts_list"]) - len(job["done_ids"]) for job in prefetch_jobs),
+            "users": len(prefetch_usage),
+            "bytes": sum(usage["bytes"] for usage in prefetch_usage.values())
+        }
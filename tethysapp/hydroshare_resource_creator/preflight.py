@@ -0,0 +1,307 @@
+import time
+import threading
+import requests
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from logging import getLogger
+from django.conf import settings
+from .metrics import record_error
+from .service_registry import load_service
+
+logger = getLogger('django')
+
+# WaterOneFlow versions by refts return type: (SOAP version, WaterML namespace).
+WOF_VERSIONS = {
+    "WaterML 1.1": ("1.1", "{http://www.cuahsi.org/waterML/1.1/}"),
+    "WaterML 1.0": ("1.0", "{http://www.cuahsi.org/waterML/1.0/}"),
+}
+
+# Concurrent GetSiteInfo and GetVariableInfo requests, and the timeout of each in seconds.
+PREFLIGHT_WORKERS = 8
+PREFLIGHT_TIMEOUT = 30
+
+# Seconds a site or variable response is reused, so that login_test and the build that follows it share one
+# round of requests, and the number of responses kept.
+PREFLIGHT_CACHE_SECONDS = 600
+PREFLIGHT_CACHE_SIZE = 512
+
+# Seconds a failed request is remembered, so that series of a broken service do not each wait for it.
+PREFLIGHT_FAILURE_SECONDS = 60
+
+# Preflight statuses of series that are dropped before download.
+PRUNED_STATUSES = ("empty", "unavailable")
+
+preflight_cache = {}
+preflight_cache_lock = threading.Lock()
+
+
+def should_preflight(res_data):
+    """
+    Checks whether a build should run the preflight: when res_data asks for it, or otherwise when the
+    HS_RESOURCE_CREATOR_PREFLIGHT setting turns it on. It is off by default, because login_test waits for it
+    before answering.
+
+    Arguments:      [res_data]
+    Returns:        [use_preflight]
+    Referenced By:  [utilities.create_ts_resource, controllers_ajax.login_test]
+    References:     []
+    Libraries:      []
+    """
+
+    if res_data.get("preflight") is not None:
+        return bool(res_data.get("preflight"))
+
+    return bool(getattr(settings, "HS_RESOURCE_CREATOR_PREFLIGHT", False))
+
+
+def post_wof_request(url, method, wof_version, parameter_name, parameter_value):
+    """
+    Posts a WaterOneFlow SOAP request with a single parameter and the empty auth token, and gets its
+    response body. Responses are cached per process for PREFLIGHT_CACHE_SECONDS, and failures for
+    PREFLIGHT_FAILURE_SECONDS.
+
+    Arguments:      [url, method, wof_version, parameter_name, parameter_value]
+    Returns:        [response_content]
+    Referenced By:  [get_site_catalog, check_variable]
+    References:     []
+    Libraries:      [requests]
+    """
+
+    cache_key = (url, method, parameter_value)
+    with preflight_cache_lock:
+        cache_entry = preflight_cache.get(cache_key)
+    if cache_entry is not None:
+        cached_at, response_content, error_message = cache_entry
+        if response_content is not None and time.time() - cached_at < PREFLIGHT_CACHE_SECONDS:
+            return response_content
+        if response_content is None and time.time() - cached_at < PREFLIGHT_FAILURE_SECONDS:
+            raise requests.RequestException(error_message)
+
+    response_content = None
+    error_message = None
+    try:
+        response = requests.post(
+            url=url,
+            headers={
+                "SOAPAction": "http://www.cuahsi.org/his/" + wof_version + "/ws/" + method,
+                "Content-Type": "text/xml; charset=utf-8"
+            },
+            data='<soap-env:Envelope xmlns:soap-env="http://schemas.xmlsoap.org/soap/envelope/">' +
+                 '<soap-env:Body>' +
+                 '<ns0:' + method + ' xmlns:ns0="http://www.cuahsi.org/his/' + wof_version + '/ws/">' +
+                 '<ns0:' + parameter_name + '>' + parameter_value + '</ns0:' + parameter_name + '>' +
+                 '<ns0:authToken></ns0:authToken>' +
+                 '</ns0:' + method + '>' +
+                 '</soap-env:Body>' +
+                 '</soap-env:Envelope>',
+            timeout=PREFLIGHT_TIMEOUT
+        )
+        response.raise_for_status()
+        response_content = response.content
+    except requests.RequestException as ex:
+        error_message = str(ex) or type(ex).__name__
+        raise
+    finally:
+        with preflight_cache_lock:
+            if len(preflight_cache) >= PREFLIGHT_CACHE_SIZE:
+                old_keys = sorted(preflight_cache, key=lambda key: preflight_cache[key][0])
+                for old_key in old_keys[:PREFLIGHT_CACHE_SIZE // 4]:
+                    del preflight_cache[old_key]
+            preflight_cache[cache_key] = (time.time(), response_content, error_message)
+
+    return response_content
+
+
+def get_site_catalog(url, site_code, return_type):
+    """
+    Gets the series catalog of a site from GetSiteInfo: the variable code, value count, and period of each
+    series, or None if the service returned no catalog.
+
+    Arguments:      [url, site_code, return_type]
+    Returns:        [catalog]
+    Referenced By:  [preflight_ts]
+    References:     [post_wof_request]
+    Libraries:      [lxml.etree]
+    """
+
+    from lxml import etree
+
+    wof_version, ns = WOF_VERSIONS[return_type]
+    site_tree = etree.fromstring(post_wof_request(url, "GetSiteInfoObject", wof_version, "site", site_code))
+    catalog_trees = list(site_tree.iter(ns + "seriesCatalog"))
+    if not catalog_trees:
+        return None
+
+    catalog = []
+    for catalog_tree in catalog_trees:
+        for series_tree in catalog_tree.iter(ns + "series"):
+            variable_code = series_tree.find(".//" + ns + "variableCode")
+            value_count = series_tree.findtext(ns + "valueCount")
+            catalog.append({
+                "variable_code": (variable_code.text or "").strip() if variable_code is not None else "",
+                "vocabulary": variable_code.get("vocabulary", "") if variable_code is not None else "",
+                "value_count": int(value_count) if value_count and value_count.strip().isdigit() else None,
+                "begin_date": series_tree.findtext(".//" + ns + "beginDateTime"),
+                "end_date": series_tree.findtext(".//" + ns + "endDateTime")
+            })
+
+    return catalog
+
+
+def check_variable(url, variable_code, return_type):
+    """
+    Checks with GetVariableInfo whether a service knows a variable.
+
+    Arguments:      [url, variable_code, return_type]
+    Returns:        [variable_exists]
+    Referenced By:  [preflight_ts]
+    References:     [post_wof_request]
+    Libraries:      [lxml.etree]
+    """
+
+    from lxml import etree
+
+    wof_version, ns = WOF_VERSIONS[return_type]
+    variable_tree = etree.fromstring(post_wof_request(url, "GetVariableInfoObject", wof_version, "variable",
+                                                      variable_code))
+
+    return any(True for _ in variable_tree.iter(ns + "variableCode"))
+
+
+def parse_catalog_date(date_text):
+    try:
+        return datetime.strptime(str(date_text).strip()[:19], "%Y-%m-%dT%H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+
+
+def get_window_value_count(catalog_series, begin_date, end_date):
+    """
+    Estimates how many values of a catalog series fall within a requested period, assuming they are evenly
+    spread over the catalog period. Catalogs can be stale, so a catalog period that ends before the requested
+    period gives no estimate rather than zero values.
+
+    Arguments:      [catalog_series, begin_date, end_date]
+    Returns:        [value_count]
+    Referenced By:  [preflight_ts]
+    References:     [parse_catalog_date]
+    Libraries:      [datetime]
+    """
+
+    value_count = catalog_series["value_count"]
+    catalog_begin = parse_catalog_date(catalog_series["begin_date"])
+    catalog_end = parse_catalog_date(catalog_series["end_date"])
+    window_begin = parse_catalog_date(begin_date) or catalog_begin
+    window_end = parse_catalog_date(end_date) or catalog_end
+    if value_count is None or None in (catalog_begin, catalog_end, window_begin, window_end):
+        return value_count
+
+    overlap_seconds = (min(catalog_end, window_end) - max(catalog_begin, window_begin)).total_seconds()
+    catalog_seconds = (catalog_end - catalog_begin).total_seconds()
+    if overlap_seconds < 0:
+        return None
+    if catalog_seconds <= 0 or value_count == 0:
+        return value_count
+
+    return max(int(round(value_count * min(overlap_seconds / catalog_seconds, 1.0))), 1)
+
+
+def preflight_ts(ts):
+    """
+    Checks one referenced series against the catalog of its site. A series is available with its value
+    count in the requested period, empty when the catalog reports no values for it, unavailable when the
+    service does not know its variable, or unknown when the service cannot be asked, its requests fail, or
+    its catalog does not give a value count for the requested period. Only the service's own answers mark a
+    series empty or unavailable, since GetValues may work when the catalog requests do not.
+
+    Arguments:      [ts]
+    Returns:        [preflight_result]
+    Referenced By:  [preflight_series]
+    References:     [get_site_catalog, check_variable, get_window_value_count, service_registry.load_service]
+    Libraries:      []
+    """
+
+    preflight_result = {"status": "unknown", "value_count": None, "begin_date": None, "end_date": None,
+                        "message": None}
+    return_type = ts["requestInfo"].get("returnType")
+    if return_type not in WOF_VERSIONS or ts["requestInfo"].get("serviceType", "SOAP") != "SOAP":
+        return preflight_result
+    url = ts["requestInfo"]["url"]
+    variable_code = ts["variable"]["variableCode"]
+
+    # Services whose WSDL shows they do not offer GetSiteInfoObject are not asked.
+    service_methods = load_service(url)["methods"]
+    if service_methods is not None and "GetSiteInfoObject" not in service_methods:
+        return preflight_result
+
+    try:
+        catalog = get_site_catalog(url, ts["site"]["siteCode"], return_type)
+        catalog_series = [series for series in catalog or [] if variable_code.lower() in (
+            series["variable_code"].lower(), (series["vocabulary"] + ":" + series["variable_code"]).lower())]
+
+        # Catalogs can be missing or stale, so a series the catalog does not list is only pruned when the
+        # service does not know its variable either.
+        if not catalog_series:
+            if not check_variable(url, variable_code, return_type):
+                preflight_result["status"] = "unavailable"
+                preflight_result["message"] = "The service does not know this variable."
+            elif catalog is not None:
+                preflight_result["message"] = "The site catalog does not list this variable."
+            return preflight_result
+    except Exception as ex:
+        record_error("preflight", url, ex)
+        preflight_result["message"] = str(ex) or type(ex).__name__
+        return preflight_result
+
+    value_counts = [get_window_value_count(series, ts.get("beginDate"), ts.get("endDate"))
+                    for series in catalog_series]
+    begin_dates = [series["begin_date"] for series in catalog_series if series["begin_date"]]
+    end_dates = [series["end_date"] for series in catalog_series if series["end_date"]]
+    preflight_result["begin_date"] = min(begin_dates) if begin_dates else None
+    preflight_result["end_date"] = max(end_dates) if end_dates else None
+    if all(series["value_count"] == 0 for series in catalog_series):
+        preflight_result["value_count"] = 0
+        preflight_result["status"] = "empty"
+    elif None in value_counts:
+        preflight_result["message"] = "The site catalog does not give a value count for the requested period."
+    else:
+        preflight_result["value_count"] = sum(value_counts)
+        preflight_result["status"] = "available"
+
+    return preflight_result
+
+
+def preflight_series(ts_list, workers=PREFLIGHT_WORKERS):
+    """
+    Runs the preflight of several referenced series, one site at a time per worker thread, so that series of
+    the same site share one GetSiteInfo request. The referenced series are not modified.
+
+    Arguments:      [ts_list, workers]
+    Returns:        [preflight_results]
+    Referenced By:  [utilities.create_ts_resource, controllers_ajax.login_test]
+    References:     [preflight_ts]
+    Libraries:      [multiprocessing.pool.ThreadPool]
+    """
+
+    if not ts_list:
+        return []
+
+    site_indexes = {}
+    for index, ts in enumerate(ts_list):
+        site_indexes.setdefault((ts["requestInfo"].get("url"), ts["site"]["siteCode"]), []).append(index)
+
+    def preflight_site(indexes):
+        return [(index, preflight_ts(ts_list[index])) for index in indexes]
+
+    pool = ThreadPool(max(min(workers, len(site_indexes)), 1))
+    try:
+        site_results = pool.map(preflight_site, list(site_indexes.values()))
+    finally:
+        pool.close()
+        pool.join()
+
+    preflight_results = [None] * len(ts_list)
+    for index, preflight_result in [result for results in site_results for result in results]:
+        preflight_results[index] = preflight_result
+
+    return preflight_results
@@ -0,0 +1,241 @@
+import os
+import io
+import json
+import time
+import uuid
+import random
+import pstats
+import cProfile
+from logging import getLogger
+from django.conf import settings
+from .app import HydroshareResourceCreator
+
+logger = getLogger('django')
+use_tracemalloc = True
+try:
+    import tracemalloc
+except ImportError:
+    use_tracemalloc = False
+
+# Request header and query/form flag that turn on profiling for a single request.
+PROFILE_HEADER = "HTTP_X_PROFILE_BUILD"
+PROFILE_FLAG = "profile"
+
+# Number of functions kept in the summary of each profile.
+PROFILE_TOP_FUNCTIONS = 40
+
+# Number of profiles kept in the app workspace. The oldest are removed first.
+PROFILE_RETENTION = 200
+
+
+def get_profile_path(profile_id=None):
+    """
+    Gets the app workspace directory holding saved profiles, or the directory of a single profile.
+
+    Arguments:      [profile_id]
+    Returns:        [profile_path]
+    Referenced By:  [save_profile, list_profiles, load_profile_summary, get_profile_file]
+    References:     [app.HydroshareResourceCreator]
+    Libraries:      [os]
+    """
+
+    profile_path = os.path.join(HydroshareResourceCreator.get_app_workspace().path, "profiles")
+    if profile_id is not None:
+        profile_path = os.path.join(profile_path, "".join(char for char in profile_id if char.isalnum() or char in "-_"))
+
+    return profile_path
+
+
+def should_profile(request):
+    """
+    Checks whether a request should be profiled: when it carries the X-Profile-Build header or the profile
+    flag, or when it is picked by the HS_RESOURCE_CREATOR_PROFILE_SAMPLE_RATE setting.
+
+    Arguments:      [request]
+    Returns:        [profile_request]
+    Referenced By:  [controllers_ajax.ajax_create_resource]
+    References:     []
+    Libraries:      [random]
+    """
+
+    if request.META.get(PROFILE_HEADER, "").lower() in ("1", "true", "yes"):
+        return True
+    if str(request.GET.get(PROFILE_FLAG, request.POST.get(PROFILE_FLAG, ""))).lower() in ("1", "true", "yes"):
+        return True
+    sample_rate = float(getattr(settings, "HS_RESOURCE_CREATOR_PROFILE_SAMPLE_RATE", 0.0) or 0.0)
+
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def get_top_functions(profiler, limit=PROFILE_TOP_FUNCTIONS):
+    """
+    Gets the functions with the highest cumulative time from a profiler.
+
+    Arguments:      [profiler, limit]
+    Returns:        [top_functions]
+    Referenced By:  [profile_call]
+    References:     []
+    Libraries:      [pstats]
+    """
+
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    top_functions = []
+    for (filename, line_number, function_name), (primitive_calls, call_count, total_time, cumulative_time, _) in \
+            stats.stats.items():
+        top_functions.append({
+            "function": "%s:%d(%s)" % (filename, line_number, function_name),
+            "calls": call_count,
+            "primitive_calls": primitive_calls,
+            "total_time": total_time,
+            "cumulative_time": cumulative_time
+        })
+    top_functions.sort(key=lambda function: function["cumulative_time"], reverse=True)
+
+    return top_functions[:limit]
+
+
+def save_profile(profiler, summary, payload=None):
+    """
+    Saves a profile to the app workspace: the raw cProfile stats, a JSON summary, and the request payload
+    that was being processed. Old profiles past the retention limit are removed.
+
+    Arguments:      [profiler, summary, payload]
+    Returns:        [profile_id]
+    Referenced By:  [profile_call]
+    References:     [get_profile_path]
+    Libraries:      [json, os]
+    """
+
+    profile_id = time.strftime("%Y%m%dT%H%M%S", time.gmtime()) + "-" + uuid.uuid4().hex[:8]
+    profile_path = get_profile_path(profile_id)
+    os.makedirs(profile_path)
+    profiler.dump_stats(os.path.join(profile_path, "profile.prof"))
+    if payload is not None:
+        with open(os.path.join(profile_path, "payload.json"), "w") as payload_file:
+            json.dump(payload, payload_file, default=str)
+    summary["profile_id"] = profile_id
+    with open(os.path.join(profile_path, "summary.json"), "w") as summary_file:
+        json.dump(summary, summary_file, indent=4, default=str)
+
+    profile_ids = sorted(os.listdir(get_profile_path()))
+    for old_profile_id in profile_ids[:max(len(profile_ids) - PROFILE_RETENTION, 0)]:
+        old_profile_path = get_profile_path(old_profile_id)
+        for file_name in os.listdir(old_profile_path):
+            os.remove(os.path.join(old_profile_path, file_name))
+        os.rmdir(old_profile_path)
+
+    return profile_id
+
+
+def profile_call(name, function, args=(), payload=None, labels=None):
+    """
+    Runs a function under cProfile and, when available, tracemalloc, then saves the profile with a summary
+    of its duration, peak traced memory, and top functions. Failures are profiled and saved as well.
+
+    Arguments:      [name, function, args, payload, labels]
+    Returns:        [result]
+    Referenced By:  [controllers_ajax.ajax_create_resource]
+    References:     [get_top_functions, save_profile]
+    Libraries:      [cProfile, tracemalloc]
+    """
+
+    start_tracing = use_tracemalloc and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start()
+    elif use_tracemalloc and hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    start_time = time.time()
+    error = None
+
+    try:
+        profiler.enable()
+        try:
+            return function(*args)
+        finally:
+            profiler.disable()
+    except Exception as ex:
+        error = str(ex) or type(ex).__name__
+        raise
+    finally:
+        seconds = time.time() - start_time
+        peak_memory = None
+        if use_tracemalloc and tracemalloc.is_tracing():
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            if start_tracing:
+                tracemalloc.stop()
+        summary = {
+            "name": name,
+            "labels": labels or {},
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start_time)),
+            "seconds": seconds,
+            "peak_memory_bytes": peak_memory,
+            "error": error,
+            "top_functions": get_top_functions(profiler)
+        }
+        try:
+            profile_id = save_profile(profiler, summary, payload)
+            logger.info("Saved build profile " + profile_id + " (" + name + ", %.2f s)" % seconds)
+        except Exception as save_error:
+            logger.error("Unable to save build profile: " + str(save_error))
+
+
+def list_profiles():
+    """
+    Lists the saved profiles, newest first, without their function tables.
+
+    Arguments:      []
+    Returns:        [profiles]
+    Referenced By:  [controllers.profiles]
+    References:     [get_profile_path, load_profile_summary]
+    Libraries:      [os]
+    """
+
+    profile_root = get_profile_path()
+    if not os.path.isdir(profile_root):
+        return []
+    profiles = []
+    for profile_id in sorted(os.listdir(profile_root), reverse=True):
+        summary = load_profile_summary(profile_id)
+        if summary is not None:
+            summary.pop("top_functions", None)
+            profiles.append(summary)
+
+    return profiles
+
+
+def load_profile_summary(profile_id):
+    """
+    Loads the summary of a saved profile.
+
+    Arguments:      [profile_id]
+    Returns:        [summary]
+    Referenced By:  [list_profiles, controllers.profiles]
+    References:     [get_profile_path]
+    Libraries:      [json]
+    """
+
+    try:
+        with open(os.path.join(get_profile_path(profile_id), "summary.json"), "r") as summary_file:
+            return json.load(summary_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def get_profile_file(profile_id, file_type):
+    """
+    Gets the path of the raw stats ("prof") or payload ("payload") file of a saved profile.
+
+    Arguments:      [profile_id, file_type]
+    Returns:        [file_path]
+    Referenced By:  [controllers.profiles]
+    References:     [get_profile_path]
+    Libraries:      [os]
+    """
+
+    file_name = {"prof": "profile.prof", "payload": "payload.json"}.get(file_type)
+    if file_name is None:
+        return None
+    file_path = os.path.join(get_profile_path(profile_id), file_name)
+
+    return file_path if os.path.isfile(file_path) else None
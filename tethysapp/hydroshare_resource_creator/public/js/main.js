@@ -9,6 +9,9 @@ var $modalErrorDialog = $('#modal-error-dialog');
 var $modalRedirectDialog = $('#modal-redirect-dialog');
 var $modalErrorMessage = $('#modal-error-message');
 var $modalLoginDialog = $('#modal-login-dialog');
+var $modalPreviewDialog = $('#modal-preview-dialog');
+var $modalPreviewTitle = $('#modal-preview-title');
+var $modalPreviewInfo = $('#modal-preview-info');
 var $btnCreateReferenceTimeseries = $('#btn-create-reference-timeseries');
 var $btnUpdateCurrentResource = $('#btn-update-current-resource');
 var $btnCreateTimeseriesResource = $('#btn-create-timeseries-resource');
@@ -21,6 +24,18 @@ var $tableResourceData = $('#table-resource-data');
 var $resTitle = $('#res-title');
 var $resAbstract = $('#res-abstract');
 var $resKeywords = $('#res-keywords');
+var $resId = $('#res_id');
+var $selectedCount = $('#selected-count');
+var $siteFilter = $('#site-filter');
+var $variableFilter = $('#variable-filter');
+var $networkFilter = $('#network-filter');
+var $btnSelectAll = $('#btn-select-all');
+var $btnSelectNone = $('#btn-select-none');
+var $spatialQueryType = $('#spatial-query-type');
+var $spatialQuery = $('#spatial-query');
+var $btnSelectSpatial = $('#btn-select-spatial');
+var $partition = $('#partition');
+var $buildDeadline = $('#build-deadline');
 
 
 /**********************************************
@@ -28,6 +43,10 @@ var $resKeywords = $('#res-keywords');
 **********************************************/
 
 var loadResource;
+var getAppUrl;
+var getListingFilters;
+var ajaxSelectSeries;
+var loadFormData;
 var createTimeseriesResource;
 var updateResource;
 var createReftsResource;
@@ -35,8 +54,11 @@ var finishLoading;
 var viewResource;
 var getCookie;
 var errorReport;
+var drawPreview;
 var ajaxLoginTest;
 var ajaxCreateResource;
+var ajaxPreviewSeries;
+var ajaxBuildStatus;
 
 
 /**********************************************
@@ -78,81 +100,68 @@ loadResource = function (){
 
     }
     else{
-        var formBody = JSON.parse($('#form_body').text())
-        var dataSeriesList = formBody['timeSeriesReferenceFile']['referencedTimeSeries']
-        var dataSet = []
-        var varList = []
-        var siteList = []
-        var keywordsList = []
-        var dateList = []
+        var summary = JSON.parse($('#form_body').text())
         var dateNow = new Date();
-        for (var dataSeriesCount = 0; dataSeriesCount < dataSeriesList.length; dataSeriesCount++) {
-            var legend = "<div style='text-align:center' '>" +
-                            "<input class = 'checkbox' id =" + dataSeriesCount + 
-                            " data1-resid =" + dataSeriesCount + 
-                            " type='checkbox' checked = 'checked'>" + 
-                         "</div>"
-            var siteName = dataSeriesList[dataSeriesCount]['site']['siteName']
-            var refType = dataSeriesList[dataSeriesCount]['requestInfo']['refType']
-            var serviceType = dataSeriesList[dataSeriesCount]['requestInfo']['serviceType']
-            var url = dataSeriesList[dataSeriesCount]['requestInfo']['url']
-            var returnType = dataSeriesList[dataSeriesCount]['requestInfo']['returnType']
-            var latitude = dataSeriesList[dataSeriesCount]['site']['latitude']
-            var longitude = dataSeriesList[dataSeriesCount]['site']['longitude']
-            var beginDate = dataSeriesList[dataSeriesCount]['beginDate']
-            var endDate = dataSeriesList[dataSeriesCount]['endDate']
-            var variableName = dataSeriesList[dataSeriesCount]['variable']['variableName']
-            var variableCode = dataSeriesList[dataSeriesCount]['variable']['variableCode']
-            var siteCode = dataSeriesList[dataSeriesCount]['site']['siteCode']
-            var networkName = dataSeriesList[dataSeriesCount]['requestInfo']['networkName']
-            var methodDescription = dataSeriesList[dataSeriesCount]['method']['methodDescription']
-            var methodLink = dataSeriesList[dataSeriesCount]['method']['methodLink']
-            var valueCount = dataSeriesList[dataSeriesCount]['valueCount']
-            var sampleMedium = dataSeriesList[dataSeriesCount]['sampleMedium']
-            dataSet.push([legend, siteName, refType, serviceType, url, returnType, latitude, longitude,
-                          beginDate, endDate, variableName, variableCode, siteCode, networkName, 
-                          methodDescription, methodLink, valueCount, sampleMedium])
-            varList.push(variableName.replace(/,/g, ''));
-            siteList.push(siteName.replace(/,/g, ''));
-            keywordsList.push(variableName.replace(/,/g, ''))
-            keywordsList.push(networkName.replace(/,/g, ''))
-            dateList.push(beginDate);
-            dateList.push(endDate);
-        };
         var tableResourceData = $('#table-resource-data').DataTable({
             scrollX: true,
-            data: dataSet, 
+            serverSide: true,
+            processing: true,
+            deferRender: true,
+            pageLength: 25,
+            ajax: {
+                url: getAppUrl('list-series/'),
+                type: 'POST',
+                headers: {'X-CSRFToken': getCookie('csrftoken')},
+                data: function (data) {
+                    data.siteFilter = $siteFilter.val();
+                    data.variableFilter = $variableFilter.val();
+                    data.networkFilter = $networkFilter.val();
+                },
+                dataSrc: function (response) {
+                    $selectedCount.text(response.selectedCount);
+                    return response.data;
+                }
+            },
             columns: [
-                {title: ""},
-                {title: "Site Name"},
-                {title: "Reference Type"},
-                {title: "Service Type"},
-                {title: "URL"},
-                {title: "Return Type"},
-                {title: "Latitude"},
-                {title: "Longitude"},
-                {title: "Begin Date"},
-                {title: "End Date"},
-                {title: "Variable Name"},
-                {title: "Variable Code"},
-                {title: "Site Code"},
-                {title: "Network Name"},
-                {title: "Method Description"},
-                {title: "Method Link"},
-                {title: "Value Count"},
-                {title: "Sample Medium"},
+                {title: "", render: function (data, type, row) {
+                    return "<div style='text-align:center'>" +
+                               "<input class='checkbox' data1-resid=" + row[0] + " type='checkbox'" +
+                               (row[1] ? " checked='checked'" : "") + ">" +
+                           "</div>";
+                }},
+                {title: "", render: function (data, type, row) {
+                    return "<button type='button' class='btn btn-default btn-xs btn-preview' data-series-id=" +
+                           row[0] + ">Preview</button>";
+                }},
+                {title: "Site Name", data: 2},
+                {title: "Reference Type", data: 3},
+                {title: "Service Type", data: 4},
+                {title: "URL", data: 5},
+                {title: "Return Type", data: 6},
+                {title: "Latitude", data: 7},
+                {title: "Longitude", data: 8},
+                {title: "Begin Date", data: 9},
+                {title: "End Date", data: 10},
+                {title: "Variable Name", data: 11},
+                {title: "Variable Code", data: 12},
+                {title: "Site Code", data: 13},
+                {title: "Network Name", data: 14},
+                {title: "Method Description", data: 15},
+                {title: "Method Link", data: 16},
+                {title: "Value Count", data: 17},
+                {title: "Sample Medium", data: 18},
             ],
-            order: [[1, 'asc']],
+            order: [[2, 'asc']],
             columnDefs: [
-                { orderable: false, targets: 0 }
+                { orderable: false, targets: [0, 1] }
             ]
         });
 
-        var uSiteList = []
+        var siteList = summary['site_names'].slice()
+        var varList = summary['variable_names']
+        var uKeywordsList = summary['keywords']
+        var uSiteList = siteList
         var siteMultiplicty = 's'
-        $.each(siteList, function(i, el){
-            if($.inArray(el, uSiteList) === -1) uSiteList.push(el);
-        });
         if(uSiteList.length === 2) {
             var sSiteList = uSiteList.join(" and ")
         }
@@ -165,10 +174,7 @@ loadResource = function (){
             uSiteList.push("and " + uSiteListLast)
             var sSiteList = (uSiteList.join(", "))
         }
-        var uVarList = []
-        $.each(varList, function(i, el){
-            if($.inArray(el, uVarList) === -1) uVarList.push(el);
-        });
+        var uVarList = varList.slice()
         if(uVarList.length === 2) {
             sVarList = ((uVarList.join(" and ")).toLowerCase()).charAt(0).toUpperCase() + ((uVarList.join(" and ")).toLowerCase()).slice(1);
         }
@@ -180,13 +186,7 @@ loadResource = function (){
             uVarList.push("and " + uVarListLast)
             sVarList = ((uVarList.join(", ")).toLowerCase()).charAt(0).toUpperCase() + ((uVarList.join(", ")).toLowerCase()).slice(1);
         }
-        var uKeywordsList = []
-        $.each(keywordsList, function(i, el){
-            if($.inArray(el, uKeywordsList) === -1) uKeywordsList.push(el);
-        });  
-        orderedDates = dateList.sort(function(a,b){
-            return Date.parse(a) > Date.parse(b);
-        })                                                     
+        orderedDates = [summary['begin_date'], summary['end_date']]
         title = "Time series dataset created on " + dateNow + " by the CUAHSI HydroClient";
         abstract = sVarList + " data collected from " + orderedDates[0] +
             " to " + orderedDates.slice(-1)[0] + " created on " + dateNow +
@@ -213,6 +213,37 @@ loadResource = function (){
 };
 
 
+getAppUrl = function (path){
+    /**
+     * Builds the url of an app endpoint from the current page url.
+     *
+     * @parameter path
+     * @returns url
+     */
+
+    var currentUrl = location.href;
+    var index = currentUrl.indexOf("hydroshare-resource-creator");
+
+    return currentUrl.substring(0, index) + 'hydroshare-resource-creator/' + path
+};
+
+
+getListingFilters = function (){
+    /**
+     * Gets the search string and filters currently applied to the series listing.
+     *
+     * @returns filters
+     */
+
+    return {
+        'search': $tableResourceData.DataTable().search(),
+        'siteFilter': $siteFilter.val(),
+        'variableFilter': $variableFilter.val(),
+        'networkFilter': $networkFilter.val()
+    }
+};
+
+
 createTimeseriesResource = function (){
     /**
      * Runs when Create Timeseries Resource button is clicked. Passes data from loadFormData to ajaxLoginTest.
@@ -232,29 +263,70 @@ createTimeseriesResource = function (){
     var resTitle = $resTitle.val();
     var resAbstract = $resAbstract.val();
     var resKeywords = $resKeywords.val();
-    var checkedIds = $('input[data1-resid]:checkbox:checked').map(function() {
-        return this.getAttribute("data1-resid");
+    var outputFormats = $('.output-format:checkbox:checked').map(function() {
+        return this.value;
     }).get();
     if($("#chk_public").is(':checked'))
         var resAccess = 'public';
     else
         resAccess = 'private';
-    formBody = $('#form_body').text()
     var data = {
         'baseUrl': baseUrl,
         'dataUrl': dataUrl,
         'resTitle': resTitle,
         'resAbstract': resAbstract,
         'resKeywords': resKeywords,
-        'checkedIds': checkedIds.toString(),
         'resAccess': resAccess,
-        'formBody': formBody,
+        'outputFormats': outputFormats.toString(),
+        'finalize': $("#chk_finalize").is(':checked'),
+        'partition': $partition.val(),
+        'deadline': $buildDeadline.val(),
         'actionRequest': 'ts'
     }
     ajaxLoginTest(data)
 };
 
 
+loadFormData = function (actionRequest){
+    /**
+     * Gets the resource request data from the page.
+     *
+     * @parameter actionRequest
+     * @returns data
+     */
+
+    // Gets data from the page's data table. //
+    var currentUrl = location.href;
+    var index = currentUrl.indexOf("hydroshare-resource-creator");
+    var baseUrl = currentUrl.substring(0, index);
+    var dataUrl = baseUrl + 'hydroshare-resource-creator/login-test';
+    if($("#chk_public").is(':checked')){
+        var resAccess = 'public';
+    }
+    else{
+        resAccess = 'private';
+    };
+    var data = {
+        'baseUrl': baseUrl,
+        'dataUrl': dataUrl,
+        'resTitle': $resTitle.val(),
+        'resAbstract': $resAbstract.val(),
+        'resKeywords': $resKeywords.val(),
+        'resAccess': resAccess,
+        'resId': $resId.text(),
+        'outputFormats': $('.output-format:checkbox:checked').map(function() {
+            return this.value;
+        }).get().toString(),
+        'finalize': $("#chk_finalize").is(':checked'),
+        'partition': $partition.val(),
+        'deadline': $buildDeadline.val(),
+        'actionRequest': actionRequest
+    }
+
+    return data
+};
+
+
 updateResource = function (){
     /**
      * Runs when Update Resource button is clicked. Passes data from loadFormData to ajaxLoginTest.
@@ -291,16 +363,12 @@ createReftsResource = function (){
     var resTitle = $resTitle.val();
     var resAbstract = $resAbstract.val();
     var resKeywords = $resKeywords.val();
-    var checkedIds = $('input[data1-resid]:checkbox:checked').map(function() {
-        return this.getAttribute("data1-resid");
-    }).get();
     if($("#chk_public").is(':checked')){
         var resAccess = 'public';
     }
     else{
         resAccess = 'private';
     };
-    formBody = $('#form_body').text()
     
     var data = {
         'baseUrl': baseUrl,
@@ -308,9 +376,7 @@ createReftsResource = function (){
         'resTitle': resTitle,
         'resAbstract': resAbstract,
         'resKeywords': resKeywords,
-        'checkedIds': checkedIds.toString(),
         'resAccess': resAccess,
-        'formBody': formBody,
         'actionRequest': 'refts',
     }
     ajaxLoginTest(data)
@@ -333,6 +399,49 @@ finishLoading = function() {
 
     // Reveals Update Current Resource button only if a HydroShare resource is loaded. //
     $('#multiple_units').show();
+    if ($resId.text() !== '') {
+        $btnUpdateCurrentResource.show();
+    }
+};
+
+
+drawPreview = function(preview){
+    /**
+     * Draws a downsampled timeseries preview on the preview canvas.
+     *
+     * @parameter preview
+     */
+
+    // Scales the preview points to the canvas and draws them as a line. //
+    var canvas = document.getElementById('preview-canvas');
+    var context = canvas.getContext('2d');
+    var padding = 40;
+    var minT = Math.min.apply(null, preview['t']);
+    var maxT = Math.max.apply(null, preview['t']);
+    var minV = Math.min.apply(null, preview['v']);
+    var maxV = Math.max.apply(null, preview['v']);
+    var scaleX = (canvas.width - 2 * padding) / ((maxT - minT) || 1);
+    var scaleY = (canvas.height - 2 * padding) / ((maxV - minV) || 1);
+    context.clearRect(0, 0, canvas.width, canvas.height);
+    context.strokeStyle = '#999';
+    context.strokeRect(padding, padding, canvas.width - 2 * padding, canvas.height - 2 * padding);
+    context.fillStyle = '#333';
+    context.fillText(maxV, 2, padding);
+    context.fillText(minV, 2, canvas.height - padding);
+    context.fillText(new Date(minT * 1000).toISOString().substring(0, 10), padding, canvas.height - padding / 2);
+    context.fillText(new Date(maxT * 1000).toISOString().substring(0, 10), canvas.width - padding - 60, canvas.height - padding / 2);
+    context.strokeStyle = '#2ecc71';
+    context.beginPath();
+    for (var i = 0; i < preview['t'].length; i++) {
+        var x = padding + (preview['t'][i] - minT) * scaleX;
+        var y = canvas.height - padding - (preview['v'][i] - minV) * scaleY;
+        if (i === 0) {
+            context.moveTo(x, y);
+        } else {
+            context.lineTo(x, y);
+        }
+    }
+    context.stroke();
 };
 
 
@@ -411,6 +520,41 @@ ajaxCreateResource = function (data) {
                 var resource = response.results;
                 var hs_href = 'https://' + resource['hs_version'] + '/resource/' + resource['resource_id'];
                 $modalResourceDialogWelcomeInfo.append('<a href=' + hs_href + ' target="_blank">Click here to view.</a>');
+                if (resource['pruned_series'] && resource['pruned_series'].length > 0) {
+                    var $prunedList = $('<ul style="list-style-type:circle; margin-left: 2em; padding:0"></ul>');
+                    for (var i = 0; i < resource['pruned_series'].length; i++) {
+                        var pruned = resource['pruned_series'][i];
+                        $prunedList.append($('<li></li>').text(pruned['site_name'] + ': ' + pruned['variable_name'] +
+                            (pruned['status'] === 'empty' ? ' (no values in the selected period)' : ' (unavailable)')));
+                    };
+                    $modalResourceDialogWelcomeInfo.append('<div>The following timeseries were skipped:</div>', $prunedList);
+                }
+                if (resource['reconciled_series'] && resource['reconciled_series'].length > 0) {
+                    var $reconciledList = $('<ul style="list-style-type:circle; margin-left: 2em; padding:0"></ul>');
+                    for (var i = 0; i < resource['reconciled_series'].length; i++) {
+                        var reconciled = resource['reconciled_series'][i];
+                        $reconciledList.append($('<li></li>').text(reconciled['site_name'] + ': ' + reconciled['variable_name'] +
+                            ' (' + reconciled['series_ids'].length + ' series, ' + reconciled['rows_removed'] + ' duplicate values removed)'));
+                    };
+                    $modalResourceDialogWelcomeInfo.append('<div>The following overlapping timeseries were merged:</div>', $reconciledList);
+                }
+                if (resource['partitions'] && resource['partitions'].length > 0) {
+                    $modalResourceDialogWelcomeInfo.append($('<div></div>').text('The timeseries were written to ' +
+                        resource['partitions'].length + ' ODM2 files, listed in the resource manifest.'));
+                }
+                if (resource['pending_series'] && resource['pending_series'].length > 0) {
+                    var $pendingList = $('<ul style="list-style-type:circle; margin-left: 2em; padding:0"></ul>');
+                    for (var i = 0; i < resource['pending_series'].length; i++) {
+                        var pending = resource['pending_series'][i];
+                        $pendingList.append($('<li></li>').text(pending['site_name'] + ': ' + pending['variable_name']));
+                    };
+                    var $pendingStatus = $('<div>They will be added to the resource when they have been downloaded.</div>');
+                    $modalResourceDialogWelcomeInfo.append('<div>The following timeseries were not ready in time:</div>',
+                        $pendingList, $pendingStatus);
+                    if (resource['deferred_job']) {
+                        ajaxBuildStatus(resource['deferred_job'], $pendingStatus);
+                    }
+                }
                 $btnCreateTimeseriesResource.hide();
                 $btnCreateReferenceTimeseries.hide();
                 $publicResource.hide()
@@ -448,6 +592,8 @@ ajaxCreateResource = function (data) {
             console.log('Error: ', errorThrown)
             if (errorThrown === 'timeout') {
                 $modalErrorMessage.text('Call has timed out.');
+            } else if (XMLHttpRequest.status === 429 && XMLHttpRequest.responseJSON) {
+                $modalErrorMessage.text(XMLHttpRequest.responseJSON.message);
             } else {
                 $modalErrorMessage.text('Encountered unknown error.');
             }
@@ -458,6 +604,116 @@ ajaxCreateResource = function (data) {
 };
 
 
+ajaxSelectSeries = function (action, seriesIds, spatialQuery) {
+    /**
+     * Updates the series selection kept on the server. Without series ids, the action applies to the series
+     * matching the spatial query if one is given, otherwise to every series matching the listing filters.
+     *
+     * @parameter action
+     * @parameter seriesIds
+     * @parameter spatialQuery
+     */
+
+    var data = getListingFilters();
+    data['action'] = action;
+    if (seriesIds !== undefined) {
+        data['seriesIds'] = seriesIds.toString();
+    }
+    $.extend(data, spatialQuery);
+    $.ajax({
+        type: 'POST',
+        headers: {'X-CSRFToken': getCookie('csrftoken')},
+        dataType: 'json',
+        data: data,
+        url: getAppUrl('select-series/'),
+        success: function (response) {
+            if (response.success === true) {
+                $selectedCount.text(response.results.selected_count);
+                if (seriesIds === undefined) {
+                    $tableResourceData.DataTable().draw(false);
+                }
+            }
+            else {
+                alert(response.message);
+            }
+        }
+    })
+};
+
+
+ajaxBuildStatus = function (jobId, $pendingStatus) {
+    /**
+     * Polls the deferred build that adds the timeseries left pending by the build deadline to the resource,
+     * and shows its result.
+     *
+     * @parameter jobId
+     * @parameter $pendingStatus
+     */
+
+    $.ajax({
+        type: 'GET',
+        dataType: 'json',
+        data: {'jobId': jobId},
+        url: getAppUrl('build-status/'),
+        success: function (response) {
+            if (response.success !== true) {
+                return;
+            }
+            var status = response.results;
+            if (status['status'] === 'pending') {
+                setTimeout(function () {ajaxBuildStatus(jobId, $pendingStatus);}, 10000);
+            }
+            else if (status['status'] === 'done') {
+                $pendingStatus.text(status['series_count'] + ' of ' + status['pending_ids'].length +
+                                    ' timeseries were added to the resource.');
+            }
+            else {
+                $pendingStatus.text('We were unable to add these timeseries to the resource.');
+            }
+        }
+    })
+};
+
+
+ajaxPreviewSeries = function (seriesId) {
+    var currentUrl = location.href;
+    var index = currentUrl.indexOf("hydroshare-resource-creator");
+    var dataUrl = currentUrl.substring(0, index) + 'hydroshare-resource-creator/preview-series/';
+    var canvas = document.getElementById('preview-canvas');
+    $modalPreviewTitle.text('Loading preview...');
+    $modalPreviewInfo.empty();
+    canvas.getContext('2d').clearRect(0, 0, canvas.width, canvas.height);
+    $modalPreviewDialog.modal('show');
+    $.ajax({
+        type: 'POST',
+        headers: {'X-CSRFToken': getCookie('csrftoken')},
+        dataType: 'json',
+        data: {
+            'seriesId': seriesId,
+            'maxPoints': canvas.width
+        },
+        url: dataUrl,
+        success: function (response) {
+            if (response.success === true) {
+                var preview = response.results;
+                $modalPreviewTitle.text(preview['site_name'] + ': ' + preview['variable_name']);
+                $modalPreviewInfo.text('Showing ' + preview['t'].length + ' of ' + preview['value_count'] +
+                                       ' values (' + preview['unit'] + ').');
+                drawPreview(preview);
+            }
+            else {
+                $modalPreviewTitle.text('Preview unavailable');
+                $modalPreviewInfo.text(response.message);
+            }
+        },
+        error: function (XMLHttpRequest, textStatus, errorThrown) {
+            $modalPreviewTitle.text('Preview unavailable');
+            $modalPreviewInfo.text('Encountered unknown error.');
+        }
+    })
+};
+
+
 ajaxLoginTest = function (data){
     $.ajax({
         headers: {'X-CSRFToken': getCookie('csrftoken')},
@@ -473,7 +729,7 @@ ajaxLoginTest = function (data){
                 if (response['message'] === "TooManyValues"){
                     errorList.push('Your selected resources contain more than one hundred thousand total values. Please select fewer resources to continue.')
                 }
-                if (data['checkedIds'].length === 0){
+                if (response['results']['selected_count'] === 0){
                     errorList.push('Please select at least one resource to create.')
                 }
                 if (data['resTitle'] === '') {
@@ -542,3 +798,31 @@ $document.ready(loadResource);
 $btnCreateReferenceTimeseries.on('click', createReftsResource);
 $btnUpdateCurrentResource.on('click', updateResource);
 $btnCreateTimeseriesResource.on('click', createTimeseriesResource);
+$tableResourceData.on('click', '.btn-preview', function() {
+    ajaxPreviewSeries(this.getAttribute('data-series-id'));
+});
+$tableResourceData.on('change', 'input[data1-resid]', function() {
+    ajaxSelectSeries(this.checked ? 'select' : 'deselect', [this.getAttribute('data1-resid')]);
+});
+$btnSelectAll.on('click', function() {
+    ajaxSelectSeries('select');
+});
+$btnSelectNone.on('click', function() {
+    ajaxSelectSeries('deselect');
+});
+$btnSelectSpatial.on('click', function() {
+    var spatialQuery = {};
+    spatialQuery[$spatialQueryType.val()] = $spatialQuery.val();
+    ajaxSelectSeries('replace', undefined, spatialQuery);
+});
+$('.listing-filter').on('change', function() {
+    $tableResourceData.DataTable().draw();
+});
+$(window).on('pagehide', function() {
+    // Stops the server from prefetching the series of this page once it is left. //
+    if (navigator.sendBeacon) {
+        var data = new FormData();
+        data.append('action', 'cancel');
+        navigator.sendBeacon(getAppUrl('prefetch/'), data);
+    }
+});
@@ -0,0 +1,185 @@
+from __future__ import print_function
+from logging import getLogger
+from django.conf import settings
+from .metrics import stage_timer
+
+logger = getLogger('django')
+
+# Value columns merged for every series, as parsed by utilities.parse_wml_series.
+VALUE_COLUMNS = ("data_value", "date_time", "utc_offset", "censor_code", "method_code")
+
+
+def should_reconcile(res_data):
+    """
+    Checks whether a build should merge overlapping series: when res_data asks for it, or otherwise when the
+    HS_RESOURCE_CREATOR_RECONCILE setting, on by default, allows it.
+
+    Arguments:      [res_data]
+    Returns:        [use_reconcile]
+    Referenced By:  [utilities.create_ts_resource, utilities.update_ts_resource]
+    References:     []
+    Libraries:      []
+    """
+
+    if res_data.get("reconcile") is not None:
+        return bool(res_data.get("reconcile"))
+
+    return bool(getattr(settings, "HS_RESOURCE_CREATOR_RECONCILE", True))
+
+
+def get_candidate_key(ts):
+    return (str(ts["site"]["siteCode"]).split(":", 1)[-1].lower(),
+            str(ts["variable"]["variableCode"]).split(":", 1)[-1].lower())
+
+
+def group_series_ids(ts_list, series_ids, use_reconcile=True):
+    """
+    Groups referenced series that may overlap: those with the same site code and variable code once their
+    network and vocabulary prefixes are removed, such as one site selected over two date ranges or from two
+    networks that mirror each other. Groups are ordered by their first series, and keep the refts order.
+
+    Arguments:      [ts_list, series_ids, use_reconcile]
+    Returns:        [series_groups]
+    Referenced By:  [utilities.create_ts_resource, utilities.update_ts_resource]
+    References:     [get_candidate_key]
+    Libraries:      []
+    """
+
+    if not use_reconcile:
+        return [[series_id] for series_id in series_ids]
+
+    series_groups = []
+    group_indexes = {}
+    for series_id in series_ids:
+        candidate_key = get_candidate_key(ts_list[series_id])
+        if candidate_key not in group_indexes:
+            group_indexes[candidate_key] = len(series_groups)
+            series_groups.append([])
+        series_groups[group_indexes[candidate_key]].append(series_id)
+
+    return series_groups
+
+
+def get_reconcile_key(series):
+    """
+    Builds the key parsed series are merged on: site code, variable code, unit, methods, and processing
+    levels. The unit is included so that values in different units are never mixed.
+
+    Arguments:      [series]
+    Returns:        [reconcile_key]
+    Referenced By:  [reconcile_series]
+    References:     []
+    Libraries:      []
+    """
+
+    return (
+        str(series["site"]["site_code"]).lower(),
+        str(series["variable"]["variable_code"]).lower(),
+        str(series["unit"]["unit_code"]),
+        tuple(sorted(str(method["method_code"]) for method in series["methods"])),
+        tuple(sorted(str(processing_level["processing_level_code"])
+                     for processing_level in series["processing_levels"])),
+    )
+
+
+def merge_series(series_group):
+    """
+    Merges the values of series sharing a reconcile key on their UTC time and method. Where several series
+    hold a value for the same instant and method, the value of the series listed first in the refts is kept,
+    so values of other methods at the same time are not dropped. The merged series takes the metadata of the
+    first series, and its values are sorted by time.
+
+    Arguments:      [series_group]
+    Returns:        [merged_series, rows_removed]
+    Referenced By:  [reconcile_series, utilities.fetch_format_series]
+    References:     [timeseries.normalize_values]
+    Libraries:      [numpy]
+    """
+
+    import numpy
+    from .timeseries import normalize_values
+
+    columns = dict((column, numpy.concatenate([numpy.asarray(series["values"][column]) for series in series_group]))
+                   for column in VALUE_COLUMNS)
+
+    # normalize_values keeps the first row of each UTC time and method, so the concatenation order is the
+    # precedence.
+    merged_values = normalize_values(columns)[0]
+
+    merged_series = dict(series_group[0])
+    merged_series["values"] = merged_values
+
+    return merged_series, len(columns["date_time"]) - len(merged_values["date_time"])
+
+
+def reconcile_series(fetched_series):
+    """
+    Merges the parsed series of a group that share a reconcile key into one series each. Series without a
+    match are returned unchanged.
+
+    Arguments:      [fetched_series]
+    Returns:        [reconciled_series, reconcile_records]
+    Referenced By:  [fetch_series_group]
+    References:     [get_reconcile_key, merge_series]
+    Libraries:      []
+    """
+
+    key_groups = []
+    key_indexes = {}
+    for series_id, series in fetched_series:
+        reconcile_key = get_reconcile_key(series)
+        if reconcile_key not in key_indexes:
+            key_indexes[reconcile_key] = len(key_groups)
+            key_groups.append(([], []))
+        key_groups[key_indexes[reconcile_key]][0].append(series_id)
+        key_groups[key_indexes[reconcile_key]][1].append(series)
+
+    reconciled_series = []
+    reconcile_records = []
+    for series_ids, series_group in key_groups:
+        if len(series_group) == 1:
+            reconciled_series.append((series_ids, series_group[0]))
+            continue
+        with stage_timer("reconcile") as stage_record:
+            merged_series, rows_removed = merge_series(series_group)
+            stage_record["rows"] = rows_removed
+        reconciled_series.append((series_ids, merged_series))
+        reconcile_records.append({
+            "series_ids": series_ids,
+            "site_name": merged_series["site"]["site_name"],
+            "variable_name": merged_series["variable"]["variable_name"],
+            "value_count": len(merged_series["values"]["date_time"]),
+            "rows_removed": rows_removed
+        })
+        logger.info("Merged %d series of %s: %d duplicate rows removed" % (
+            len(series_group), merged_series["site"]["site_code"], rows_removed))
+
+    return reconciled_series, reconcile_records
+
+
+def fetch_series_group(ts_group, series_ids):
+    """
+    Fetches the series of a group from group_series_ids and merges those that overlap. Each reconciled series
+    is returned with the ids of the referenced series it holds.
+
+    Arguments:      [ts_group, series_ids]
+    Returns:        [reconciled_series, reconcile_records]
+    Referenced By:  [utilities.create_ts_resource, utilities.update_ts_resource, odm2_shards.build_odm2_shard,
+                     deferred.fetch_groups_until]
+    References:     [utilities.fetch_series, reconcile_series]
+    Libraries:      []
+    """
+
+    from .utilities import fetch_series
+
+    fetched_series = []
+    for series_id, ts in zip(series_ids, ts_group):
+        print("Preparing Series " + str(series_id + 1), end=" ")
+        series = fetch_series(ts)
+        if series is not None:
+            fetched_series.append((series_id, series))
+
+    if len(fetched_series) < 2:
+        return [([series_id], series) for series_id, series in fetched_series], []
+
+    return reconcile_series(fetched_series)
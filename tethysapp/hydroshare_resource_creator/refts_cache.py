@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import uuid
+import requests
+from logging import getLogger
+from .app import HydroshareResourceCreator
+
+logger = getLogger('django')
+
+HYDROSHARE_URL = "https://beta.hydroshare.org"
+
+# Cached refts are served without contacting HydroShare for this many seconds after they were last
+# validated. After that, the file listing is checked and the file is revalidated with a conditional GET.
+REFTS_CACHE_FRESHNESS = 60
+
+# Bytes read at a time when a refts file is downloaded to the cache.
+REFTS_DOWNLOAD_CHUNK_SIZE = 65536
+
+# Replaced refts payloads are kept for this many seconds, so requests that were handed the previous payload
+# can still open it.
+REFTS_PAYLOAD_GRACE = 300
+
+# Times a cached refts file is looked up again when it was removed before it could be opened.
+REFTS_OPEN_ATTEMPTS = 3
+
+hs_session = requests.Session()
+
+
+def get_refts_cache_path(res_id):
+    """
+    Gets the app workspace directory holding the cached refts file of a HydroShare resource.
+
+    Arguments:      [res_id]
+    Returns:        [cache_path]
+    Referenced By:  [load_cache_entry, save_cache_entry, get_cached_refts_path]
+    References:     [app.HydroshareResourceCreator]
+    Libraries:      [os]
+    """
+
+    cache_path = os.path.join(HydroshareResourceCreator.get_app_workspace().path, "refts_cache",
+                              "".join(char for char in res_id if char.isalnum()))
+    if not os.path.isdir(cache_path):
+        try:
+            os.makedirs(cache_path)
+        except OSError:
+            pass
+
+    return cache_path
+
+
+def load_cache_entry(res_id):
+    """
+    Loads the cache metadata of a resource's refts file. Metadata hold the file url, checksum, ETag,
+    Last-Modified date, and the time the file was last validated.
+
+    Arguments:      [res_id]
+    Returns:        [entry]
+    Referenced By:  [get_hs_refts_path]
+    References:     [get_refts_cache_path]
+    Libraries:      [json]
+    """
+
+    entry_path = os.path.join(get_refts_cache_path(res_id), "entry.json")
+    try:
+        with open(entry_path, "r") as entry_file:
+            entry = json.load(entry_file)
+    except (IOError, OSError, ValueError):
+        return None
+    if not os.path.isfile(os.path.join(get_refts_cache_path(res_id), entry["payload_name"])):
+        return None
+
+    return entry
+
+
+def save_cache_entry(res_id, entry, payload_chunks):
+    """
+    Saves a refts payload, written chunk by chunk as it is downloaded, and its cache metadata. Both files are
+    written to temporary paths and moved into place so concurrent readers never see a partial file. Replaced
+    payloads are removed once they are older than the grace period; temporary files of other downloads are
+    left alone.
+
+    Arguments:      [res_id, entry, payload_chunks]
+    Returns:        [entry]
+    Referenced By:  [get_hs_refts_path]
+    References:     [get_refts_cache_path]
+    Libraries:      [json, time, uuid]
+    """
+
+    cache_path = get_refts_cache_path(res_id)
+    if payload_chunks is not None:
+        entry["payload_name"] = "refts_" + uuid.uuid4().hex + ".json"
+        payload_path = os.path.join(cache_path, entry["payload_name"])
+        try:
+            with open(payload_path + ".tmp", "wb") as payload_file:
+                for payload_chunk in payload_chunks:
+                    payload_file.write(payload_chunk)
+        except Exception:
+            os.remove(payload_path + ".tmp")
+            raise
+        os.rename(payload_path + ".tmp", payload_path)
+
+    entry_path = os.path.join(cache_path, "entry.json")
+    temp_path = entry_path + "." + uuid.uuid4().hex
+    with open(temp_path, "w") as entry_file:
+        json.dump(entry, entry_file)
+    os.rename(temp_path, entry_path)
+
+    for file_name in os.listdir(cache_path):
+        if not file_name.startswith("refts_") or file_name.endswith(".tmp") or file_name == entry["payload_name"]:
+            continue
+        try:
+            file_path = os.path.join(cache_path, file_name)
+            if time.time() - os.path.getmtime(file_path) > REFTS_PAYLOAD_GRACE:
+                os.remove(file_path)
+        except OSError:
+            pass
+
+    return entry
+
+
+def get_cached_refts_path(res_id, entry):
+    return os.path.join(get_refts_cache_path(res_id), entry["payload_name"])
+
+
+def find_refts_file(res_id):
+    """
+    Finds the refts file of a HydroShare resource, following every page of the resource file listing.
+
+    Arguments:      [res_id]
+    Returns:        [refts_file]
+    Referenced By:  [get_hs_refts_path]
+    References:     []
+    Libraries:      [requests]
+    """
+
+    rest_url = HYDROSHARE_URL + "/hsapi/resource/" + res_id + "/files/"
+    while rest_url:
+        response = hs_session.get(rest_url, timeout=30)
+        response.raise_for_status()
+        listing = response.json()
+        for refts_file in listing.get("results", []):
+            if ".refts.json" in refts_file["url"]:
+                refts_file["url"] = str(refts_file["url"]).replace("www", "beta")
+                return refts_file
+        rest_url = listing.get("next")
+
+    return None
+
+
+def get_hs_refts_path(res_id, freshness=REFTS_CACHE_FRESHNESS):
+    """
+    Gets the path of the refts file of a HydroShare resource in the app-level refts cache. A recently
+    validated cache entry is used as is. Otherwise the file listing is checked, and an entry whose checksum
+    still matches is reused without downloading. Changed or unknown files are fetched with
+    If-None-Match/If-Modified-Since, so an unchanged file costs only a 304 response, and are streamed to the
+    cache rather than read into memory.
+
+    Arguments:      [res_id, freshness]
+    Returns:        [refts_path]
+    Referenced By:  [open_hs_refts_file]
+    References:     [load_cache_entry, save_cache_entry, get_cached_refts_path, find_refts_file]
+    Libraries:      [requests, time]
+    """
+
+    entry = load_cache_entry(res_id)
+    if entry is not None and time.time() - entry["validated_at"] < freshness:
+        return get_cached_refts_path(res_id, entry)
+
+    try:
+        refts_file = find_refts_file(res_id)
+    except (requests.RequestException, ValueError) as ex:
+        if entry is None:
+            raise
+        logger.error("Unable to check refts file of resource " + res_id + ", using cached copy: " + str(ex))
+        return get_cached_refts_path(res_id, entry)
+    if refts_file is None:
+        raise ValueError("No refts file found in resource " + res_id)
+
+    checksum = refts_file.get("checksum")
+    if entry is not None and entry["url"] == refts_file["url"] and checksum and entry.get("checksum") == checksum:
+        entry["validated_at"] = time.time()
+        save_cache_entry(res_id, entry, None)
+        return get_cached_refts_path(res_id, entry)
+
+    headers = {}
+    if entry is not None and entry["url"] == refts_file["url"]:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    response = hs_session.get(refts_file["url"], headers=headers, timeout=60, stream=True)
+
+    if response.status_code == 304 and entry is not None:
+        entry.update({"checksum": checksum, "validated_at": time.time()})
+        save_cache_entry(res_id, entry, None)
+        return get_cached_refts_path(res_id, entry)
+
+    response.raise_for_status()
+    entry = {
+        "url": refts_file["url"],
+        "checksum": checksum,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "validated_at": time.time()
+    }
+    save_cache_entry(res_id, entry, response.iter_content(REFTS_DOWNLOAD_CHUNK_SIZE))
+
+    return get_cached_refts_path(res_id, entry)
+
+
+def open_hs_refts_file(res_id, freshness=REFTS_CACHE_FRESHNESS):
+    """
+    Opens the cached refts file of a HydroShare resource. A payload removed by the cache clean-up between the
+    lookup and the open is looked up again, so the caller gets the file of the current cache entry.
+
+    Arguments:      [res_id, freshness]
+    Returns:        [refts_file]
+    Referenced By:  [controllers.home]
+    References:     [get_hs_refts_path]
+    Libraries:      []
+    """
+
+    for attempt in range(REFTS_OPEN_ATTEMPTS):
+        refts_path = get_hs_refts_path(res_id, freshness)
+        try:
+            return open(refts_path, "rb")
+        except (IOError, OSError):
+            if attempt == REFTS_OPEN_ATTEMPTS - 1:
+                raise
+            logger.info("Cached refts file of resource " + res_id + " was replaced, looking it up again")
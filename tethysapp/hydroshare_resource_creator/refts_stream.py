@@ -0,0 +1,145 @@
+import io
+import json
+from logging import getLogger
+
+logger = getLogger('django')
+use_ijson = True
+try:
+    import ijson
+except ImportError:
+    use_ijson = False
+
+# Top-level key of a refts file, and the key of its series list within it.
+REFTS_KEY = "timeSeriesReferenceFile"
+SERIES_KEY = "referencedTimeSeries"
+
+# JSON formatting of refts files: pretty printed as the app has always written them, or compact.
+PRETTY_SEPARATORS = (',', ': ')
+COMPACT_SEPARATORS = (',', ':')
+
+
+def iter_referenced_series(refts_file, header=None, refts_key=REFTS_KEY):
+    """
+    Reads the referenced series of a refts file one at a time. With ijson installed, the file is parsed
+    incrementally so memory use is bounded by one series. Without it, the file is loaded whole. The other
+    fields of the refts, such as its title and abstract, are added to header as they are read, so they are
+    complete once the series are exhausted. refts_key is None for a file holding the refts object itself,
+    as posted by the data client.
+
+    Arguments:      [refts_file, header, refts_key]
+    Returns:        [ts_iter]
+    Referenced By:  [controllers.home]
+    References:     []
+    Libraries:      [ijson, json]
+    """
+
+    header = header if header is not None else {}
+    if not use_ijson:
+        refts_data = json.load(refts_file)
+        if refts_key is not None:
+            refts_data = refts_data[refts_key]
+        while not isinstance(refts_data, dict):
+            refts_data = json.loads(refts_data)
+        for key, value in refts_data.items():
+            if key != SERIES_KEY:
+                header[key] = value
+        for ts in refts_data[SERIES_KEY]:
+            yield ts
+        return
+
+    refts_prefix = refts_key or ""
+    field_prefix = refts_prefix + "." if refts_prefix else ""
+    series_prefix = field_prefix + SERIES_KEY + ".item"
+    series_builder = None
+    field_builders = {}
+
+    for prefix, event, value in ijson.parse(refts_file, use_float=True):
+        if series_builder is not None:
+            series_builder.event(event, value)
+            if prefix == series_prefix and event == "end_map":
+                yield series_builder.value
+                series_builder = None
+        elif prefix == series_prefix and event == "start_map":
+            series_builder = ijson.ObjectBuilder()
+            series_builder.event(event, value)
+        elif prefix == refts_prefix and event == "string":
+            # The data client posts the refts object as a JSON string.
+            for ts in iter_referenced_series(io.BytesIO(value.encode("utf-8")), header, None):
+                yield ts
+        elif prefix.startswith(field_prefix) and prefix != refts_prefix:
+            field_name = prefix[len(field_prefix):].split(".")[0]
+            if field_name != SERIES_KEY:
+                field_builders.setdefault(field_name, ijson.ObjectBuilder()).event(event, value)
+
+    for field_name, field_builder in field_builders.items():
+        header[field_name] = field_builder.value
+
+
+def write_json_value(json_file, value, indent_level, compact):
+    if compact:
+        json_file.write(json.dumps(value, sort_keys=True, separators=COMPACT_SEPARATORS))
+    else:
+        json_file.write(json.dumps(value, sort_keys=True, indent=4, separators=PRETTY_SEPARATORS).replace(
+            "\n", "\n" + " " * 4 * indent_level))
+
+
+def write_refts(refts_file, header, ts_iter, compact=False):
+    """
+    Writes a refts file, writing each series as it is read from ts_iter so that the series never need to be
+    held in memory together. Pretty output matches json.dump with sorted keys and an indent of 4. Header
+    fields added while ts_iter is consumed are written after the series.
+
+    Arguments:      [refts_file, header, ts_iter, compact]
+    Returns:        [series_count]
+    Referenced By:  [utilities.create_refts_resource, session_store.save_session_refts_stream]
+    References:     [write_json_value]
+    Libraries:      [json]
+    """
+
+    newline = "" if compact else "\n"
+    key_separator = COMPACT_SEPARATORS[1] if compact else PRETTY_SEPARATORS[1]
+
+    def write_indent(indent_level):
+        refts_file.write(newline + ("" if compact else " " * 4 * indent_level))
+
+    def write_field(field_name, value, first_field):
+        if not first_field:
+            refts_file.write(",")
+        write_indent(2)
+        refts_file.write(json.dumps(field_name) + key_separator)
+        write_json_value(refts_file, value, 2, compact)
+
+    refts_file.write("{")
+    write_indent(1)
+    refts_file.write(json.dumps(REFTS_KEY) + key_separator + "{")
+
+    written_fields = set()
+    for field_name in sorted(field_name for field_name in header if field_name < SERIES_KEY):
+        write_field(field_name, header[field_name], not written_fields)
+        written_fields.add(field_name)
+
+    if written_fields:
+        refts_file.write(",")
+    write_indent(2)
+    refts_file.write(json.dumps(SERIES_KEY) + key_separator + "[")
+    series_count = 0
+    for ts in ts_iter:
+        if series_count:
+            refts_file.write(",")
+        write_indent(3)
+        write_json_value(refts_file, ts, 3, compact)
+        series_count += 1
+    if series_count:
+        write_indent(2)
+    refts_file.write("]")
+
+    for field_name in sorted(field_name for field_name in header if field_name not in written_fields and
+                             field_name != SERIES_KEY):
+        write_field(field_name, header[field_name], False)
+
+    write_indent(1)
+    refts_file.write("}")
+    write_indent(0)
+    refts_file.write("}")
+
+    return series_count
@@ -0,0 +1,288 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import numpy
+from logging import getLogger
+from django.conf import settings
+from .app import HydroshareResourceCreator
+from .parsers import split_iso_date_time
+from .timeseries import get_utc_epochs
+
+logger = getLogger('django')
+
+# Columns stored for every series. Each column is saved as its own .npy file so it can be memory-mapped.
+SERIES_COLUMNS = ("data_value", "date_time", "utc_offset", "censor_code", "method_code")
+
+# Environment variable that overrides the location of the series store, for builds run outside the app.
+SERIES_STORE_PATH_VARIABLE = "HS_RESOURCE_CREATOR_SERIES_STORE"
+
+# Entries whose requested window extends past the time they were stored may be missing newer values,
+# so they are only served for this many seconds.
+SERIES_STORE_MAX_AGE = 86400
+
+# Entries unused for this many seconds are pruned, and the oldest are pruned past the size cap. Both can be
+# overridden with HS_RESOURCE_CREATOR_SERIES_STORE_RETENTION and HS_RESOURCE_CREATOR_SERIES_STORE_BYTES.
+SERIES_STORE_RETENTION = 604800
+SERIES_STORE_BYTES = 10 * 1024 ** 3
+
+# Seconds between prunes of the series store by one process.
+SERIES_STORE_PRUNE_INTERVAL = 600
+
+prune_state = {"pruned_at": 0}
+
+
+def get_series_store_path():
+    """
+    Gets the path of the shared series store, in the app workspace unless overridden by the environment.
+
+    Arguments:      []
+    Returns:        [store_path]
+    Referenced By:  [load_series, save_series, prune_series_store]
+    References:     [app.HydroshareResourceCreator]
+    Libraries:      [os]
+    """
+
+    store_path = os.environ.get(SERIES_STORE_PATH_VARIABLE)
+    if not store_path:
+        store_path = os.path.join(HydroshareResourceCreator.get_app_workspace().path, "series_store")
+    if not os.path.isdir(store_path):
+        try:
+            os.makedirs(store_path)
+        except OSError:
+            pass
+
+    return store_path
+
+
+def get_series_key(ts):
+    """
+    Builds the identity key of a referenced timeseries from its service url, site code, and variable code.
+
+    Arguments:      [ts]
+    Returns:        [series_key]
+    Referenced By:  [load_series, save_series]
+    References:     []
+    Libraries:      [hashlib]
+    """
+
+    identity = "|".join((
+        ts["requestInfo"]["url"],
+        ts["site"]["siteCode"],
+        ts["variable"]["variableCode"],
+    ))
+    series_key = hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+    return series_key
+
+
+def get_window(ts):
+    """
+    Gets the requested time window of a referenced timeseries as comparable local datetime strings.
+
+    Arguments:      [ts]
+    Returns:        [begin_date, end_date]
+    Referenced By:  [load_series, save_series]
+    References:     []
+    Libraries:      []
+    """
+
+    return ts["beginDate"][:19], ts["endDate"][:19]
+
+
+def get_utc_epoch(date_time):
+    """
+    Converts an ISO 8601 date and time into UTC epoch seconds. A date and time without an offset is taken as
+    UTC.
+
+    Arguments:      [date_time]
+    Returns:        [epoch]
+    Referenced By:  [load_series, save_series]
+    References:     [parsers.split_iso_date_time, timeseries.get_utc_epochs]
+    Libraries:      []
+    """
+
+    local_date_time, utc_offset = split_iso_date_time(date_time)
+
+    return int(get_utc_epochs([local_date_time], [utc_offset])[0])
+
+
+def load_series(ts, max_age=SERIES_STORE_MAX_AGE):
+    """
+    Loads a parsed series from the shared series store. Any stored entry whose window covers the requested
+    window is used, and its memory-mapped columns are sliced down to the requested range. Using an entry
+    marks it as recently used for pruning.
+
+    Arguments:      [ts, max_age]
+    Returns:        [series]
+    Referenced By:  [utilities.create_ts_resource]
+    References:     [get_series_store_path, get_series_key, get_window, get_utc_epoch]
+    Libraries:      [numpy, json]
+    """
+
+    try:
+        series_path = os.path.join(get_series_store_path(), get_series_key(ts))
+        if not os.path.isdir(series_path):
+            return None
+        begin_date, end_date = get_window(ts)
+        now = time.time()
+        for entry_name in sorted(os.listdir(series_path)):
+            entry_path = os.path.join(series_path, entry_name)
+            metadata_path = os.path.join(entry_path, "metadata.json")
+            if not os.path.isfile(metadata_path):
+                continue
+            with open(metadata_path, "r") as metadata_file:
+                metadata = json.load(metadata_file)
+            if not (metadata["begin_date"] <= begin_date and end_date <= metadata["end_date"]):
+                continue
+            # Entries stored before the end of their window was reached are compared in UTC, since the
+            # window itself is in the site's local time.
+            end_epoch = metadata.get("end_epoch")
+            if end_epoch is None:
+                end_epoch = get_utc_epoch(metadata["end_date"])
+            if end_epoch > metadata["stored_at"] and now - metadata["stored_at"] > max_age:
+                continue
+            values = dict((column, numpy.load(os.path.join(entry_path, column + ".npy"), mmap_mode="r"))
+                          for column in SERIES_COLUMNS)
+            start_index = numpy.searchsorted(values["date_time"], begin_date, side="left")
+            end_index = numpy.searchsorted(values["date_time"], end_date + "~", side="right")
+            if start_index >= end_index:
+                continue
+            series = metadata["series"]
+            series["values"] = dict((column, values[column][start_index:end_index]) for column in SERIES_COLUMNS)
+            try:
+                os.utime(metadata_path, None)
+            except OSError:
+                pass
+            return series
+    except Exception as ex:
+        logger.error("Unable to load series from the series store: " + str(ex))
+
+    return None
+
+
+def save_series(ts, series):
+    """
+    Saves a parsed series to the shared series store. Columns are sorted by datetime so that sub-ranges can
+    be served with a binary search, and the entry is moved into place atomically. The store is pruned at most
+    once every SERIES_STORE_PRUNE_INTERVAL seconds.
+
+    Arguments:      [ts, series]
+    Returns:        [entry_path]
+    Referenced By:  [utilities.fetch_series]
+    References:     [get_series_store_path, get_series_key, get_window, get_utc_epoch, prune_series_store]
+    Libraries:      [numpy, json, shutil]
+    """
+
+    series_path = os.path.join(get_series_store_path(), get_series_key(ts))
+    begin_date, end_date = get_window(ts)
+    entry_name = hashlib.sha1((begin_date + "|" + end_date).encode("utf-8")).hexdigest()
+    entry_path = os.path.join(series_path, entry_name)
+    temp_path = os.path.join(series_path, "." + entry_name + "." + uuid.uuid4().hex)
+    os.makedirs(temp_path)
+
+    try:
+        order = numpy.argsort(series["values"]["date_time"], kind="mergesort")
+        for column in SERIES_COLUMNS:
+            numpy.save(os.path.join(temp_path, column + ".npy"), numpy.asarray(series["values"][column])[order])
+        metadata = {
+            "begin_date": begin_date,
+            "end_date": end_date,
+            "end_epoch": get_utc_epoch(ts["endDate"]),
+            "stored_at": time.time(),
+            "stored_date": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()),
+            "series": dict((key, value) for key, value in series.items() if key != "values")
+        }
+        with open(os.path.join(temp_path, "metadata.json"), "w") as metadata_file:
+            json.dump(metadata, metadata_file)
+        if os.path.isdir(entry_path):
+            shutil.rmtree(entry_path, ignore_errors=True)
+        try:
+            os.rename(temp_path, entry_path)
+        except OSError:
+            # Another process stored the same entry between the removal and the rename.
+            if not os.path.isdir(entry_path):
+                raise
+            shutil.rmtree(temp_path, ignore_errors=True)
+    except:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+
+    if time.time() - prune_state["pruned_at"] > SERIES_STORE_PRUNE_INTERVAL:
+        prune_state["pruned_at"] = time.time()
+        try:
+            prune_series_store()
+        except Exception as ex:
+            logger.error("Unable to prune the series store: " + str(ex))
+
+    return entry_path
+
+
+def prune_series_store(retention=None, max_bytes=None):
+    """
+    Removes series store entries that have not been used within the retention period, then the least
+    recently used entries until the store fits within its size cap.
+
+    Arguments:      [retention, max_bytes]
+    Returns:        [removed_count]
+    Referenced By:  [save_series]
+    References:     [get_series_store_path]
+    Libraries:      [shutil]
+    """
+
+    if retention is None:
+        retention = getattr(settings, "HS_RESOURCE_CREATOR_SERIES_STORE_RETENTION", SERIES_STORE_RETENTION)
+    if max_bytes is None:
+        max_bytes = getattr(settings, "HS_RESOURCE_CREATOR_SERIES_STORE_BYTES", SERIES_STORE_BYTES)
+    store_path = get_series_store_path()
+    now = time.time()
+
+    # ----------------------------------- #
+    #   Lists Entries by Their Last Use   #
+    # ----------------------------------- #
+
+    entries = []
+    total_bytes = 0
+    for series_key in os.listdir(store_path):
+        series_path = os.path.join(store_path, series_key)
+        if not os.path.isdir(series_path):
+            continue
+        for entry_name in os.listdir(series_path):
+            entry_path = os.path.join(series_path, entry_name)
+            metadata_path = os.path.join(entry_path, "metadata.json")
+            try:
+                if entry_name.startswith("."):
+                    # Abandoned temporary entries of interrupted saves.
+                    if now - os.path.getmtime(entry_path) > SERIES_STORE_MAX_AGE:
+                        shutil.rmtree(entry_path, ignore_errors=True)
+                    continue
+                used_at = os.path.getmtime(metadata_path)
+                entry_bytes = sum(os.path.getsize(os.path.join(entry_path, file_name))
+                                  for file_name in os.listdir(entry_path))
+            except OSError:
+                continue
+            entries.append((used_at, entry_bytes, entry_path))
+            total_bytes += entry_bytes
+
+    # ------------------------------------------------- #
+    #   Removes Stale and Least Recently Used Entries   #
+    # ------------------------------------------------- #
+
+    removed_count = 0
+    for used_at, entry_bytes, entry_path in sorted(entries):
+        if now - used_at <= retention and total_bytes <= max_bytes:
+            break
+        shutil.rmtree(entry_path, ignore_errors=True)
+        total_bytes -= entry_bytes
+        removed_count += 1
+        try:
+            os.rmdir(os.path.dirname(entry_path))
+        except OSError:
+            pass
+
+    if removed_count:
+        logger.info("Pruned " + str(removed_count) + " entries from the series store.")
+
+    return removed_count
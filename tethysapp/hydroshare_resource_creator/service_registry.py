@@ -0,0 +1,521 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+import requests
+from datetime import datetime, timedelta
+from logging import getLogger
+from django.conf import settings
+from .app import HydroshareResourceCreator
+
+logger = getLogger('django')
+
+# Environment variable that overrides the location of the service registry, for builds run outside the app.
+SERVICE_REGISTRY_PATH_VARIABLE = "HS_RESOURCE_CREATOR_SERVICE_REGISTRY"
+
+# Seconds a WSDL probe is trusted before the service is probed again, and before a failed probe is retried.
+SERVICE_REFRESH_SECONDS = 86400
+SERVICE_RETRY_SECONDS = 600
+SERVICE_PROBE_TIMEOUT = 30
+
+# Request timeouts in seconds: used while a service has no measurements, and the bounds of the timeout
+# estimated from its latency and throughput, which is TIMEOUT_FACTOR times the expected request time.
+DEFAULT_TIMEOUT = 120
+MIN_TIMEOUT = 30
+MAX_TIMEOUT = 600
+TIMEOUT_FACTOR = 4
+
+# Response bytes expected per value, as measured for WaterML 1.1 by benchmarks/bench_parsers.py, and the
+# smallest response that updates the measured throughput.
+BYTES_PER_VALUE = 180
+MIN_THROUGHPUT_BYTES = 65536
+
+# Weight of each new measurement in the running latency and throughput.
+MEASUREMENT_WEIGHT = 0.3
+
+# A request window that times out halves the safe window of its service, down to MIN_WINDOW_DAYS.
+MIN_WINDOW_DAYS = 30
+
+# Services failing this many requests in a row are skipped for FAILURE_SECONDS.
+FAILURE_LIMIT = 3
+FAILURE_SECONDS = 300
+
+# Entries are used from the in-process copy for this many seconds before the registry file is checked for
+# changes saved by other processes.
+REGISTRY_CHECK_SECONDS = 60
+
+# Running measurements change with every request, so they are saved with the next capability change, or once
+# they are this many seconds newer than the saved entry.
+MEASUREMENT_FIELDS = ("latency", "throughput", "requests")
+MEASUREMENT_SAVE_SECONDS = 300
+
+# WSDL namespace, and the WaterOneFlow versions by the target namespace of their WSDL.
+WSDL_NS = "{http://schemas.xmlsoap.org/wsdl/}"
+WOF_TARGET_NAMESPACES = {
+    "http://www.cuahsi.org/his/1.1/ws/": "1.1",
+    "http://www.cuahsi.org/his/1.0/ws/": "1.0",
+}
+
+registry_cache = {}
+registry_lock = threading.Lock()
+update_lock = threading.Lock()
+refresh_condition = threading.Condition()
+refresh_queue = []
+refresh_state = {"thread": None}
+
+
+def get_service_key(url):
+    """
+    Gets the registry key of a service url: the url without its query, such as the ?WSDL suffix added by
+    utilities.normalize_ts, or trailing slash, in lower case.
+
+    Arguments:      [url]
+    Returns:        [service_key]
+    Referenced By:  [load_service, schedule_service_refresh]
+    References:     []
+    Libraries:      []
+    """
+
+    return str(url).split("?", 1)[0].rstrip("/").lower()
+
+
+def get_wsdl_url(url):
+    return str(url).split("?", 1)[0] + "?WSDL"
+
+
+def get_service_registry_path():
+    """
+    Gets the path of the service registry, in the app workspace unless overridden by the environment.
+
+    Arguments:      []
+    Returns:        [registry_path]
+    Referenced By:  [load_service, save_service]
+    References:     [app.HydroshareResourceCreator]
+    Libraries:      [os]
+    """
+
+    registry_path = os.environ.get(SERVICE_REGISTRY_PATH_VARIABLE)
+    if not registry_path:
+        registry_path = os.path.join(HydroshareResourceCreator.get_app_workspace().path, "service_registry")
+    if not os.path.isdir(registry_path):
+        try:
+            os.makedirs(registry_path)
+        except OSError:
+            pass
+
+    return registry_path
+
+
+def get_service_path(service_key):
+    return os.path.join(get_service_registry_path(), hashlib.sha1(service_key.encode("utf-8")).hexdigest() + ".json")
+
+
+def load_service(url):
+    """
+    Loads the capabilities of a service. Unknown services get an empty entry. Entries are kept per process,
+    and the registry file is only checked every REGISTRY_CHECK_SECONDS, to reload entries another process
+    saved.
+
+    Arguments:      [url]
+    Returns:        [service]
+    Referenced By:  [update_service, schedule_service_refresh, get_wml_version, get_request_timeout,
+                     get_request_windows, is_service_down, preflight.preflight_ts]
+    References:     [get_service_key, get_service_path]
+    Libraries:      [json, time]
+    """
+
+    service_key = get_service_key(url)
+    service = {
+        "url": service_key,
+        "methods": None,
+        "wml_versions": None,
+        "latency": None,
+        "throughput": None,
+        "max_window_days": None,
+        "largest_window_days": None,
+        "requests": 0,
+        "failures": 0,
+        "failed_at": None,
+        "last_error": None,
+        "probed_at": None,
+        "probe_error": None
+    }
+    service_path = get_service_path(service_key)
+    with registry_lock:
+        cached = registry_cache.get(service_path)
+        if cached is not None and time.time() - cached["checked_at"] < REGISTRY_CHECK_SECONDS:
+            return dict(cached["service"])
+
+    try:
+        service_mtime = os.path.getmtime(service_path)
+    except (IOError, OSError):
+        service_mtime = None
+    if cached is not None and cached["mtime"] == service_mtime:
+        with registry_lock:
+            cached["checked_at"] = time.time()
+        return dict(cached["service"])
+
+    if service_mtime is not None:
+        try:
+            with open(service_path, "r") as service_file:
+                service.update(json.load(service_file))
+        except (IOError, OSError, ValueError):
+            return service
+    with registry_lock:
+        registry_cache[service_path] = {"service": dict(service), "mtime": service_mtime,
+                                        "checked_at": time.time(), "saved_at": time.time()}
+
+    return service
+
+
+def save_service(service):
+    """
+    Saves the capabilities of a service. The entry is written to a temporary file and moved into place so
+    that concurrent readers never see a partial file.
+
+    Arguments:      [service]
+    Returns:        []
+    Referenced By:  [update_service]
+    References:     [get_service_path]
+    Libraries:      [json, uuid]
+    """
+
+    service_path = get_service_path(service["url"])
+    temp_path = service_path + "." + uuid.uuid4().hex
+    with open(temp_path, "w") as service_file:
+        json.dump(service, service_file, sort_keys=True)
+    os.rename(temp_path, service_path)
+    with registry_lock:
+        registry_cache[service_path] = {"service": dict(service), "mtime": os.path.getmtime(service_path),
+                                        "checked_at": time.time(), "saved_at": time.time()}
+
+
+def update_service(url, update):
+    """
+    Applies update to the capabilities of a service. The entry is saved when a capability changed, or when its
+    running measurements are MEASUREMENT_SAVE_SECONDS newer than the saved entry; otherwise only the in-process
+    copy is updated. Updates are serialized within a process, and across processes the last update wins.
+    Failures are logged, since the registry only advises the download stage.
+
+    Arguments:      [url, update]
+    Returns:        [service]
+    Referenced By:  [probe_service, record_service_request, record_service_failure]
+    References:     [load_service, save_service, get_service_path]
+    Libraries:      [time]
+    """
+
+    try:
+        with update_lock:
+            service = load_service(url)
+            previous = dict(service)
+            update(service)
+            service_path = get_service_path(service["url"])
+            with registry_lock:
+                cached = registry_cache.get(service_path)
+            if cached is None or time.time() - cached["saved_at"] >= MEASUREMENT_SAVE_SECONDS or \
+                    any(service.get(field) != previous.get(field) for field in service
+                        if field not in MEASUREMENT_FIELDS):
+                save_service(service)
+            else:
+                with registry_lock:
+                    cached["service"] = dict(service)
+        return service
+    except Exception as ex:
+        logger.error("Unable to update service registry for " + str(url) + ": " + str(ex))
+        return None
+
+
+def probe_service(url):
+    """
+    Reads the WSDL of a WaterOneFlow service: the methods it offers, the WaterOneFlow versions it serves, and
+    its latency.
+
+    Arguments:      [url]
+    Returns:        [service]
+    Referenced By:  [refresh_services]
+    References:     [update_service, get_wsdl_url]
+    Libraries:      [requests, lxml.etree]
+    """
+
+    from lxml import etree
+
+    probe = {"probed_at": time.time(), "probe_error": None}
+    try:
+        response = requests.get(get_wsdl_url(url), timeout=SERVICE_PROBE_TIMEOUT)
+        response.raise_for_status()
+        wsdl_tree = etree.fromstring(response.content)
+        target_namespace = wsdl_tree.get("targetNamespace", "")
+        probe["methods"] = sorted(set(operation.get("name") for operation in wsdl_tree.iter(WSDL_NS + "operation")
+                                      if operation.get("name")))
+        probe["wml_versions"] = [WOF_TARGET_NAMESPACES[target_namespace]] \
+            if target_namespace in WOF_TARGET_NAMESPACES else None
+        probe["probe_latency"] = response.elapsed.total_seconds()
+    except Exception as ex:
+        probe["probe_error"] = str(ex) or type(ex).__name__
+
+    def apply_probe(service):
+        service.update(probe)
+        if probe.get("probe_latency") is not None and service["latency"] is None:
+            service["latency"] = probe["probe_latency"]
+
+    return update_service(url, apply_probe)
+
+
+def refresh_services():
+    """
+    Probes the services queued by schedule_service_refresh, one at a time, until the queue is empty. Runs in
+    a daemon thread.
+
+    Arguments:      []
+    Returns:        []
+    Referenced By:  [schedule_service_refresh]
+    References:     [probe_service]
+    Libraries:      [threading]
+    """
+
+    while True:
+        with refresh_condition:
+            if not refresh_queue:
+                refresh_state["thread"] = None
+                return
+            url = refresh_queue.pop(0)
+        probe_service(url)
+
+
+def is_service_stale(service):
+    if service["probed_at"] is None:
+        return True
+    refresh_seconds = SERVICE_RETRY_SECONDS if service["probe_error"] else SERVICE_REFRESH_SECONDS
+    return time.time() - service["probed_at"] > refresh_seconds
+
+
+def schedule_service_refresh(ts_list):
+    """
+    Queues the SOAP services of referenced series whose capabilities are unknown or stale, and starts the
+    background thread that probes them, unless the HS_RESOURCE_CREATOR_SERVICE_REFRESH setting turns it off.
+
+    Arguments:      [ts_list]
+    Returns:        [queued_count]
+    Referenced By:  [controllers.home, utilities.create_ts_resource]
+    References:     [load_service, is_service_stale, refresh_services]
+    Libraries:      [threading]
+    """
+
+    if not getattr(settings, "HS_RESOURCE_CREATOR_SERVICE_REFRESH", True):
+        return 0
+
+    urls = set(ts["requestInfo"]["url"] for ts in ts_list
+               if ts["requestInfo"].get("url") and ts["requestInfo"].get("serviceType") == "SOAP")
+    stale_urls = [url for url in sorted(urls) if is_service_stale(load_service(url))]
+
+    with refresh_condition:
+        queued_keys = set(get_service_key(url) for url in refresh_queue)
+        queued_count = 0
+        for url in stale_urls:
+            if get_service_key(url) not in queued_keys:
+                refresh_queue.append(url)
+                queued_keys.add(get_service_key(url))
+                queued_count += 1
+        if refresh_queue and refresh_state["thread"] is None:
+            refresh_state["thread"] = threading.Thread(target=refresh_services, name="service_registry_refresh")
+            refresh_state["thread"].daemon = True
+            refresh_state["thread"].start()
+
+    return queued_count
+
+
+def track_service_urls(ts_iter, ts_list):
+    for ts in ts_iter:
+        ts_list.append({"requestInfo": {"url": ts["requestInfo"].get("url"),
+                                        "serviceType": ts["requestInfo"].get("serviceType")}})
+        yield ts
+
+
+def parse_request_date(date_text):
+    try:
+        return datetime.strptime(str(date_text).strip()[:19], "%Y-%m-%dT%H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+
+
+def get_window_days(ts):
+    begin_date = parse_request_date(ts.get("beginDate"))
+    end_date = parse_request_date(ts.get("endDate"))
+    if begin_date is None or end_date is None:
+        return None
+    return max((end_date - begin_date).total_seconds() / 86400.0, 0.0)
+
+
+def get_wml_version(url, return_type_version):
+    """
+    Gets the WaterOneFlow version to request from a service: the version of the refts return type, unless
+    the service is known to serve only another version.
+
+    Arguments:      [url, return_type_version]
+    Returns:        [wml_version]
+    Referenced By:  [utilities.download_wml]
+    References:     [load_service]
+    Libraries:      []
+    """
+
+    wml_versions = load_service(url)["wml_versions"]
+    if not wml_versions or return_type_version in wml_versions:
+        return return_type_version
+
+    return wml_versions[0]
+
+
+def get_request_timeout(ts):
+    """
+    Gets the timeout of a request for a referenced series: TIMEOUT_FACTOR times the time its service is
+    expected to take, from its latency, its throughput, and the expected response size.
+
+    Arguments:      [ts]
+    Returns:        [timeout]
+    Referenced By:  [request_service]
+    References:     [load_service]
+    Libraries:      []
+    """
+
+    service = load_service(ts["requestInfo"]["url"])
+    if service["latency"] is None or service["throughput"] is None:
+        return DEFAULT_TIMEOUT
+    try:
+        expected_bytes = max(int(ts.get("valueCount") or 0), 1) * BYTES_PER_VALUE
+    except (TypeError, ValueError):
+        return DEFAULT_TIMEOUT
+    expected_seconds = service["latency"] + expected_bytes / float(service["throughput"])
+
+    return min(max(TIMEOUT_FACTOR * expected_seconds, MIN_TIMEOUT), MAX_TIMEOUT)
+
+
+def get_request_windows(ts):
+    """
+    Splits the requested period of a referenced series into consecutive windows no longer than the safe
+    window of its service. Series of services without a safe window, or without a parsable period, are
+    requested whole.
+
+    Arguments:      [ts]
+    Returns:        [window_ts_list]
+    Referenced By:  [utilities.fetch_format_series]
+    References:     [load_service, parse_request_date]
+    Libraries:      [datetime]
+    """
+
+    max_window_days = load_service(ts["requestInfo"]["url"])["max_window_days"]
+    begin_date = parse_request_date(ts.get("beginDate"))
+    end_date = parse_request_date(ts.get("endDate"))
+    if not max_window_days or begin_date is None or end_date is None or \
+            (end_date - begin_date).total_seconds() <= max_window_days * 86400:
+        return [ts]
+
+    window_ts_list = []
+    window_begin = begin_date
+    while window_begin < end_date:
+        window_end = min(window_begin + timedelta(days=max_window_days), end_date)
+        window_ts = dict(ts)
+        window_ts["beginDate"] = window_begin.strftime("%Y-%m-%dT%H:%M:%S")
+        window_ts["endDate"] = window_end.strftime("%Y-%m-%dT%H:%M:%S")
+        window_ts_list.append(window_ts)
+        window_begin = window_end
+
+    return window_ts_list
+
+
+def is_service_down(url):
+    service = load_service(url)
+    return service["failures"] >= FAILURE_LIMIT and time.time() - (service["failed_at"] or 0) < FAILURE_SECONDS
+
+
+def record_service_request(ts, response, seconds):
+    """
+    Records a successful request: the latency and throughput of the service, and the longest window it
+    answered.
+
+    Arguments:      [ts, response, seconds]
+    Returns:        []
+    Referenced By:  [request_service]
+    References:     [update_service, get_window_days]
+    Libraries:      []
+    """
+
+    byte_count = len(response.content)
+    latency = response.elapsed.total_seconds()
+    window_days = get_window_days(ts)
+
+    def apply_request(service):
+        service["requests"] += 1
+        service["failures"] = 0
+        service["latency"] = latency if service["latency"] is None else \
+            (1 - MEASUREMENT_WEIGHT) * service["latency"] + MEASUREMENT_WEIGHT * latency
+        if byte_count >= MIN_THROUGHPUT_BYTES:
+            throughput = byte_count / max(seconds - latency, 0.001)
+            service["throughput"] = throughput if service["throughput"] is None else \
+                (1 - MEASUREMENT_WEIGHT) * service["throughput"] + MEASUREMENT_WEIGHT * throughput
+        if window_days is not None:
+            service["largest_window_days"] = max(service["largest_window_days"] or 0, window_days)
+
+    update_service(ts["requestInfo"]["url"], apply_request)
+
+
+def record_service_failure(ts, error):
+    """
+    Records a failed request. A timed out request halves the safe window of its service, but never below the
+    longest window the service has answered or MIN_WINDOW_DAYS, so that later series are split into
+    windows the service can serve.
+
+    Arguments:      [ts, error]
+    Returns:        [service]
+    Referenced By:  [request_service]
+    References:     [update_service, get_window_days]
+    Libraries:      [requests]
+    """
+
+    window_days = get_window_days(ts)
+    timed_out = isinstance(error, requests.Timeout)
+
+    def apply_failure(service):
+        service["failures"] += 1
+        service["failed_at"] = time.time()
+        service["last_error"] = str(error) or type(error).__name__
+        if timed_out and window_days is not None and window_days > MIN_WINDOW_DAYS:
+            safe_window_days = max(window_days / 2.0, MIN_WINDOW_DAYS)
+            if service["largest_window_days"] and service["largest_window_days"] < window_days:
+                safe_window_days = max(safe_window_days, service["largest_window_days"])
+            service["max_window_days"] = min(service["max_window_days"] or window_days, safe_window_days)
+
+    return update_service(ts["requestInfo"]["url"], apply_failure)
+
+
+def request_service(ts, method, url=None, **kwargs):
+    """
+    Sends a download request for a referenced series to its service, with a timeout suited to the service,
+    and records the outcome in the registry. Services failing repeatedly are not contacted until
+    FAILURE_SECONDS have passed. url defaults to the service url of the series.
+
+    Arguments:      [ts, method, url, kwargs]
+    Returns:        [response]
+    Referenced By:  [utilities.download_wml, parsers.download_nwis, parsers.download_wml2]
+    References:     [is_service_down, get_request_timeout, record_service_request, record_service_failure]
+    Libraries:      [requests, time]
+    """
+
+    service_url = ts["requestInfo"]["url"]
+    if is_service_down(service_url):
+        raise requests.ConnectionError("Service has failed %d requests in a row: %s" % (
+            FAILURE_LIMIT, load_service(service_url)["last_error"]))
+
+    kwargs.setdefault("timeout", get_request_timeout(ts))
+    start_time = time.time()
+    try:
+        response = requests.request(method, url or service_url, **kwargs)
+        if response.status_code >= 500:
+            response.raise_for_status()
+    except requests.RequestException as ex:
+        record_service_failure(ts, ex)
+        raise
+    record_service_request(ts, response, time.time() - start_time)
+
+    return response
@@ -0,0 +1,568 @@
+import os
+import json
+import threading
+from .app import HydroshareResourceCreator
+from .refts_stream import write_refts
+
+# Fields shown in the series listing, in table column order.
+LISTING_FIELDS = (
+    ("site", "siteName"),
+    ("requestInfo", "refType"),
+    ("requestInfo", "serviceType"),
+    ("requestInfo", "url"),
+    ("requestInfo", "returnType"),
+    ("site", "latitude"),
+    ("site", "longitude"),
+    (None, "beginDate"),
+    (None, "endDate"),
+    ("variable", "variableName"),
+    ("variable", "variableCode"),
+    ("site", "siteCode"),
+    ("requestInfo", "networkName"),
+    ("method", "methodDescription"),
+    ("method", "methodLink"),
+    (None, "valueCount"),
+    (None, "sampleMedium"),
+)
+LISTING_FILTERS = {
+    "site": (0, 11),
+    "variable": (9, 10),
+    "network": (12,),
+}
+SESSION_CACHE_SIZE = 16
+
+session_cache = {}
+session_cache_lock = threading.Lock()
+
+
+def get_session_path(request):
+    """
+    Gets the app workspace directory that holds the loaded refts and selection of a browser session.
+
+    Arguments:      [request]
+    Returns:        [session_path]
+    Referenced By:  [save_session_refts, save_session_refts_stream, load_session_data, load_selection,
+                     save_selection, get_refts_summary, prefetch.start_prefetch]
+    References:     [app.HydroshareResourceCreator]
+    Libraries:      [os]
+    """
+
+    if not request.session.session_key:
+        request.session.save()
+    session_path = os.path.join(HydroshareResourceCreator.get_app_workspace().path, "sessions",
+                                request.session.session_key)
+    if not os.path.isdir(session_path):
+        try:
+            os.makedirs(session_path)
+        except OSError:
+            pass
+
+    return session_path
+
+
+def get_listing_row(ts):
+    """
+    Gets the listing fields of a referenced timeseries.
+
+    Arguments:      [ts]
+    Returns:        [row]
+    Referenced By:  [load_session_data, iter_summarized_series]
+    References:     []
+    Libraries:      []
+    """
+
+    row = []
+    for group, field in LISTING_FIELDS:
+        value = ts.get(field) if group is None else ts.get(group, {}).get(field)
+        row.append(value if value is not None else "")
+
+    return row
+
+
+def iter_summarized_series(ts_iter, summary):
+    """
+    Passes referenced timeseries through while adding their unique site names, variable names, keywords,
+    and dates to a refts summary, so that the summary is built without holding every series.
+
+    Arguments:      [ts_iter, summary]
+    Returns:        [ts_iter]
+    Referenced By:  [save_session_refts, save_session_refts_stream, get_refts_summary]
+    References:     [get_listing_row]
+    Libraries:      []
+    """
+
+    seen_names = dict((key, set()) for key in ("site_names", "variable_names", "keywords"))
+    for ts in ts_iter:
+        row = get_listing_row(ts)
+        for key, names in (("site_names", (row[0],)), ("variable_names", (row[9],)),
+                           ("keywords", (row[9], row[12]))):
+            for name in names:
+                name = str(name).replace(",", "")
+                if name not in seen_names[key]:
+                    seen_names[key].add(name)
+                    summary[key].append(name)
+        dates = (str(row[7]), str(row[8]))
+        if summary["series_count"] == 0:
+            summary["begin_date"], summary["end_date"] = min(dates), max(dates)
+        else:
+            summary["begin_date"] = min((summary["begin_date"],) + dates)
+            summary["end_date"] = max((summary["end_date"],) + dates)
+        summary["series_count"] += 1
+        yield ts
+
+
+def get_empty_summary():
+    return {"series_count": 0, "site_names": [], "variable_names": [], "keywords": [], "begin_date": "",
+            "end_date": ""}
+
+
+def save_summary(session_path, summary):
+    with open(os.path.join(session_path, "summary.json"), "w") as summary_file:
+        json.dump(summary, summary_file)
+
+
+def save_session_refts(request, form_body):
+    """
+    Saves a processed refts as the loaded refts of the session, along with its summary, and selects all of
+    its series.
+
+    Arguments:      [request, form_body]
+    Returns:        [refts_path]
+    Referenced By:  [controllers.home]
+    References:     [get_session_path, save_selection, iter_summarized_series]
+    Libraries:      [json]
+    """
+
+    session_path = get_session_path(request)
+    refts_path = os.path.join(session_path, "refts.json")
+    with open(refts_path, "w") as refts_file:
+        json.dump(form_body, refts_file)
+    summary = get_empty_summary()
+    for _ in iter_summarized_series(form_body["timeSeriesReferenceFile"]["referencedTimeSeries"], summary):
+        pass
+    save_summary(session_path, summary)
+    save_selection(request, {"mode": "all", "exceptions": []})
+
+    return refts_path
+
+
+def save_session_refts_stream(request, ts_iter, header):
+    """
+    Saves a refts read one series at a time as the loaded refts of the session, and selects all of its
+    series. The file is written to a temporary path and moved into place once every series was read, so a
+    failed read leaves the previously loaded refts in place. The summary of the refts is built from the same
+    pass.
+
+    Arguments:      [request, ts_iter, header]
+    Returns:        [refts_path]
+    Referenced By:  [controllers.home]
+    References:     [get_session_path, save_selection, iter_summarized_series, refts_stream.write_refts]
+    Libraries:      []
+    """
+
+    session_path = get_session_path(request)
+    refts_path = os.path.join(session_path, "refts.json")
+    temp_path = refts_path + ".tmp"
+    summary = get_empty_summary()
+    try:
+        with open(temp_path, "w") as refts_file:
+            write_refts(refts_file, header, iter_summarized_series(ts_iter, summary), compact=True)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    os.rename(temp_path, refts_path)
+    save_summary(session_path, summary)
+    save_selection(request, {"mode": "all", "exceptions": []})
+
+    return refts_path
+
+
+def load_session_data(request):
+    """
+    Loads the refts of the session along with its listing rows. Parsed data are cached per process and
+    reloaded only when the refts file changes.
+
+    Arguments:      [request]
+    Returns:        [session_data]
+    Referenced By:  [load_session_refts, list_session_series, select_session_series, get_refts_summary,
+                     query_session_series, prefetch.start_prefetch]
+    References:     [get_session_path, get_listing_row]
+    Libraries:      [json]
+    """
+
+    refts_path = os.path.join(get_session_path(request), "refts.json")
+    if not os.path.isfile(refts_path):
+        return None
+    refts_mtime = os.path.getmtime(refts_path)
+
+    with session_cache_lock:
+        session_data = session_cache.get(refts_path)
+        if session_data is not None and session_data["mtime"] == refts_mtime:
+            return session_data
+
+    with open(refts_path, "r") as refts_file:
+        form_body = json.load(refts_file)
+    ts_list = form_body["timeSeriesReferenceFile"]["referencedTimeSeries"]
+    session_data = {
+        "mtime": refts_mtime,
+        "form_body": form_body,
+        "rows": [get_listing_row(ts) for ts in ts_list],
+        "sort_orders": {},
+        "spatial_index": None
+    }
+
+    with session_cache_lock:
+        if len(session_cache) >= SESSION_CACHE_SIZE and refts_path not in session_cache:
+            session_cache.pop(next(iter(session_cache)))
+        session_cache[refts_path] = session_data
+
+    return session_data
+
+
+def load_session_refts(request):
+    """
+    Gets the processed refts loaded in the session.
+
+    Arguments:      [request]
+    Returns:        [form_body]
+    Referenced By:  [utilities.get_request_form_body]
+    References:     [load_session_data]
+    Libraries:      []
+    """
+
+    session_data = load_session_data(request)
+
+    return session_data["form_body"] if session_data is not None else None
+
+
+def load_selection(request):
+    """
+    Loads the series selection of the session. A selection is either all series except the listed
+    exceptions, or no series except the listed exceptions.
+
+    Arguments:      [request]
+    Returns:        [selection]
+    Referenced By:  [list_session_series, select_session_series, get_selected_ids]
+    References:     [get_session_path, read_selection]
+    Libraries:      []
+    """
+
+    return read_selection(get_session_path(request))
+
+
+def read_selection(session_path):
+    """
+    Reads the series selection saved in a session directory, for callers without the request of the session.
+
+    Arguments:      [session_path]
+    Returns:        [selection]
+    Referenced By:  [load_selection, prefetch.get_prefetch_series]
+    References:     []
+    Libraries:      [json]
+    """
+
+    selection_path = os.path.join(session_path, "selection.json")
+    try:
+        with open(selection_path, "r") as selection_file:
+            selection = json.load(selection_file)
+    except (IOError, OSError, ValueError):
+        selection = {"mode": "all", "exceptions": []}
+
+    return selection
+
+
+def save_selection(request, selection):
+    """
+    Saves the series selection of the session.
+
+    Arguments:      [request, selection]
+    Returns:        []
+    Referenced By:  [save_session_refts, select_session_series]
+    References:     [get_session_path]
+    Libraries:      [json]
+    """
+
+    selection_path = os.path.join(get_session_path(request), "selection.json")
+    temp_path = selection_path + ".tmp"
+    with open(temp_path, "w") as selection_file:
+        json.dump({"mode": selection["mode"], "exceptions": sorted(set(selection["exceptions"]))}, selection_file)
+    os.rename(temp_path, selection_path)
+
+
+def is_selected(selection, series_id, exceptions=None):
+    exceptions = exceptions if exceptions is not None else set(selection["exceptions"])
+    return (series_id in exceptions) != (selection["mode"] == "all")
+
+
+def get_selected_ids(request):
+    """
+    Gets the ids of every selected series of the session.
+
+    Arguments:      [request]
+    Returns:        [selected_ids]
+    Referenced By:  [utilities.get_request_checked_ids]
+    References:     [load_session_data, load_selection]
+    Libraries:      []
+    """
+
+    session_data = load_session_data(request)
+    if session_data is None:
+        return []
+    selection = load_selection(request)
+    exceptions = set(selection["exceptions"])
+    selected_ids = [series_id for series_id in range(len(session_data["rows"]))
+                    if is_selected(selection, series_id, exceptions)]
+
+    return selected_ids
+
+
+def get_selected_count(selection, series_count):
+    exception_count = len([series_id for series_id in set(selection["exceptions"]) if series_id < series_count])
+    return series_count - exception_count if selection["mode"] == "all" else exception_count
+
+
+def filter_series_ids(session_data, search="", filters=None):
+    """
+    Gets the ids of the series matching a search string and per-field filters. Filters are keyed by site,
+    variable, or network, and match case-insensitive substrings.
+
+    Arguments:      [session_data, search, filters]
+    Returns:        [series_ids]
+    Referenced By:  [list_session_series, select_session_series]
+    References:     []
+    Libraries:      []
+    """
+
+    rows = session_data["rows"]
+    checks = []
+    if search:
+        search = search.lower()
+        checks.append(lambda row: any(search in str(value).lower() for value in row))
+    for filter_name, filter_value in (filters or {}).items():
+        if filter_value and filter_name in LISTING_FILTERS:
+            checks.append(lambda row, columns=LISTING_FILTERS[filter_name], value=filter_value.lower():
+                          any(value in str(row[column]).lower() for column in columns))
+    series_ids = [series_id for series_id, row in enumerate(rows) if all(check(row) for check in checks)]
+
+    return series_ids
+
+
+def get_sort_order(session_data, column, descending):
+    """
+    Gets the series ids sorted by a listing column. Sort orders are cached with the session data.
+
+    Arguments:      [session_data, column, descending]
+    Returns:        [sort_order]
+    Referenced By:  [list_session_series]
+    References:     []
+    Libraries:      []
+    """
+
+    sort_key = (column, descending)
+    sort_order = session_data["sort_orders"].get(sort_key)
+    if sort_order is None:
+        rows = session_data["rows"]
+
+        def get_value(series_id):
+            value = rows[series_id][column]
+            return (0, value, "") if isinstance(value, (int, float)) else (1, 0, str(value).lower())
+
+        sort_order = sorted(range(len(rows)), key=get_value, reverse=descending)
+        session_data["sort_orders"][sort_key] = sort_order
+
+    return sort_order
+
+
+def list_session_series(request, start=0, length=25, order_column=0, descending=False, search="", filters=None):
+    """
+    Gets one page of the series listing of the session, sorted and filtered.
+
+    Arguments:      [request, start, length, order_column, descending, search, filters]
+    Returns:        [listing]
+    Referenced By:  [controllers_ajax.ajax_list_series]
+    References:     [load_session_data, load_selection, filter_series_ids, get_sort_order]
+    Libraries:      []
+    """
+
+    session_data = load_session_data(request)
+    if session_data is None:
+        return None
+    rows = session_data["rows"]
+    selection = load_selection(request)
+    exceptions = set(selection["exceptions"])
+
+    order_column = min(max(order_column, 0), len(LISTING_FIELDS) - 1)
+    sort_order = get_sort_order(session_data, order_column, descending)
+    if search or any((filters or {}).values()):
+        matching_ids = set(filter_series_ids(session_data, search, filters))
+        sort_order = [series_id for series_id in sort_order if series_id in matching_ids]
+    page_ids = sort_order[start:start + length] if length >= 0 else sort_order[start:]
+
+    listing = {
+        "records_total": len(rows),
+        "records_filtered": len(sort_order),
+        "selected_count": get_selected_count(selection, len(rows)),
+        "series": [{
+            "series_id": series_id,
+            "selected": is_selected(selection, series_id, exceptions),
+            "row": rows[series_id]
+        } for series_id in page_ids]
+    }
+
+    return listing
+
+
+def select_session_series(request, action, series_ids=None, search="", filters=None):
+    """
+    Updates the series selection of the session. Actions select or deselect the given series ids, or every
+    series matching the search string and filters when no ids are given.
+
+    Arguments:      [request, action, series_ids, search, filters]
+    Returns:        [selected_count]
+    Referenced By:  [controllers_ajax.ajax_select_series]
+    References:     [load_session_data, load_selection, save_selection, filter_series_ids]
+    Libraries:      []
+    """
+
+    session_data = load_session_data(request)
+    if session_data is None:
+        return 0
+    series_count = len(session_data["rows"])
+    selection = load_selection(request)
+
+    if series_ids is None:
+        if not search and not any((filters or {}).values()):
+            selection = {"mode": "all" if action == "select" else "none", "exceptions": []}
+            save_selection(request, selection)
+            return get_selected_count(selection, series_count)
+        series_ids = filter_series_ids(session_data, search, filters)
+
+    if action == "replace":
+        selection = {"mode": "none", "exceptions": []}
+        action = "select"
+    exceptions = set(selection["exceptions"])
+    add_exception = (action == "select") != (selection["mode"] == "all")
+    for series_id in series_ids:
+        if 0 <= series_id < series_count:
+            if add_exception:
+                exceptions.add(series_id)
+            else:
+                exceptions.discard(series_id)
+    selection["exceptions"] = list(exceptions)
+    save_selection(request, selection)
+
+    return get_selected_count(selection, series_count)
+
+
+def get_refts_summary(request):
+    """
+    Gets the unique site names, variable names, keywords, and overall date range of the session refts,
+    which the home page uses to suggest a resource title, abstract, and keywords. The summary saved with the
+    refts is used, so the refts itself is only loaded for sessions saved without one.
+
+    Arguments:      [request]
+    Returns:        [summary]
+    Referenced By:  [controllers.home]
+    References:     [get_session_path, load_session_data, iter_summarized_series]
+    Libraries:      [json]
+    """
+
+    session_path = get_session_path(request)
+    refts_path = os.path.join(session_path, "refts.json")
+    summary_path = os.path.join(session_path, "summary.json")
+    if os.path.isfile(summary_path) and os.path.getmtime(summary_path) >= os.path.getmtime(refts_path):
+        with open(summary_path, "r") as summary_file:
+            return json.load(summary_file)
+
+    session_data = load_session_data(request)
+    summary = get_empty_summary()
+    ts_list = session_data["form_body"]["timeSeriesReferenceFile"]["referencedTimeSeries"]
+    for _ in iter_summarized_series(ts_list, summary):
+        pass
+
+    return summary
+
+
+def get_session_spatial_index(session_data):
+    """
+    Gets the spatial index over the site coordinates of the session refts. The index is built on first use
+    and cached with the session data.
+
+    Arguments:      [session_data]
+    Returns:        [spatial_index]
+    Referenced By:  [query_session_series]
+    References:     [spatial_index.build_spatial_index]
+    Libraries:      []
+    """
+
+    from .spatial_index import build_spatial_index
+
+    if session_data["spatial_index"] is None:
+        rows = session_data["rows"]
+        session_data["spatial_index"] = build_spatial_index([row[5] for row in rows], [row[6] for row in rows])
+
+    return session_data["spatial_index"]
+
+
+def parse_spatial_query(params):
+    """
+    Parses a spatial query from request parameters. A query is either a bbox of "west,south,east,north", a
+    polygon given as GeoJSON geometry, feature, or list of rings, or a nearest query of "latitude,longitude,k".
+
+    Arguments:      [params]
+    Returns:        [spatial_query]
+    Referenced By:  [controllers_ajax.ajax_select_series, utilities.get_request_checked_ids]
+    References:     []
+    Libraries:      [json]
+    """
+
+    if params.get("bbox"):
+        west, south, east, north = [float(value) for value in params.get("bbox").split(",")]
+        return {"bbox": (south, west, north, east)}
+
+    if params.get("polygon"):
+        polygon = json.loads(params.get("polygon"))
+        if isinstance(polygon, dict):
+            polygon = polygon.get("geometry", polygon)
+            if polygon.get("type") == "MultiPolygon":
+                return {"polygons": polygon["coordinates"]}
+            polygon = polygon["coordinates"]
+        return {"polygons": [polygon]}
+
+    if params.get("nearest"):
+        latitude, longitude, k = params.get("nearest").split(",")
+        return {"nearest": (float(latitude), float(longitude), int(k))}
+
+    return None
+
+
+def query_session_series(request, spatial_query):
+    """
+    Gets the ids of the session series matching a spatial query from parse_spatial_query.
+
+    Arguments:      [request, spatial_query]
+    Returns:        [series_ids]
+    Referenced By:  [controllers_ajax.ajax_select_series, utilities.get_request_checked_ids]
+    References:     [load_session_data, get_session_spatial_index, spatial_index.query_bbox,
+                     spatial_index.query_polygon, spatial_index.query_nearest]
+    Libraries:      []
+    """
+
+    from .spatial_index import query_bbox, query_polygon, query_nearest
+
+    session_data = load_session_data(request)
+    if session_data is None:
+        return []
+    spatial_index = get_session_spatial_index(session_data)
+
+    if "bbox" in spatial_query:
+        series_ids = query_bbox(spatial_index, *spatial_query["bbox"])
+    elif "polygons" in spatial_query:
+        series_ids = set()
+        for rings in spatial_query["polygons"]:
+            series_ids.update(query_polygon(spatial_index, rings).tolist())
+        series_ids = sorted(series_ids)
+    else:
+        series_ids = query_nearest(spatial_index, *spatial_query["nearest"])
+
+    return [int(series_id) for series_id in series_ids]
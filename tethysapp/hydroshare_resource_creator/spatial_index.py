@@ -0,0 +1,216 @@
+import math
+import numpy
+
+# Mean earth radius used for nearest-site distances, in kilometers.
+EARTH_RADIUS = 6371.0088
+
+# Target number of sites per grid cell when the cell size is chosen automatically.
+SITES_PER_CELL = 16
+
+
+def get_coordinate(value):
+    try:
+        coordinate = float(value)
+    except (TypeError, ValueError):
+        return numpy.nan
+    return coordinate
+
+
+def build_spatial_index(latitudes, longitudes, cell_size=None):
+    """
+    Builds a uniform grid index over site coordinates. Sites are bucketed into square cells of cell_size
+    degrees, and the series ids are sorted by cell so that the ids of any cell are a contiguous slice.
+    Sites with missing or invalid coordinates are left out of the index.
+
+    Arguments:      [latitudes, longitudes, cell_size]
+    Returns:        [spatial_index]
+    Referenced By:  [session_store.get_session_spatial_index]
+    References:     [get_coordinate]
+    Libraries:      [numpy]
+    """
+
+    latitudes = numpy.array([get_coordinate(latitude) for latitude in latitudes], dtype=numpy.float64)
+    longitudes = numpy.array([get_coordinate(longitude) for longitude in longitudes], dtype=numpy.float64)
+    valid = ((numpy.abs(latitudes) <= 90) & (numpy.abs(longitudes) <= 180))
+    series_ids = numpy.nonzero(valid)[0]
+
+    if cell_size is None:
+        if len(series_ids):
+            extent = max(numpy.ptp(latitudes[series_ids]) * numpy.ptp(longitudes[series_ids]), 1e-6)
+            cell_size = math.sqrt(extent * SITES_PER_CELL / len(series_ids))
+        else:
+            cell_size = 1.0
+    cell_size = min(max(cell_size, 1e-4), 10.0)
+    row_count = int(math.ceil(180.0 / cell_size)) + 1
+    column_count = int(math.ceil(360.0 / cell_size)) + 1
+
+    rows = numpy.floor((latitudes[series_ids] + 90) / cell_size).astype(numpy.int64)
+    columns = numpy.floor((longitudes[series_ids] + 180) / cell_size).astype(numpy.int64)
+    cell_keys = rows * column_count + columns
+    order = numpy.argsort(cell_keys, kind="mergesort")
+
+    spatial_index = {
+        "latitudes": latitudes,
+        "longitudes": longitudes,
+        "cell_size": cell_size,
+        "row_count": row_count,
+        "column_count": column_count,
+        "cell_keys": cell_keys[order],
+        "series_ids": series_ids[order]
+    }
+
+    return spatial_index
+
+
+def get_cell_range(spatial_index, south, west, north, east):
+    cell_size = spatial_index["cell_size"]
+    row_range = (max(int(math.floor((south + 90) / cell_size)), 0),
+                 min(int(math.floor((north + 90) / cell_size)), spatial_index["row_count"] - 1))
+    column_range = (max(int(math.floor((west + 180) / cell_size)), 0),
+                    min(int(math.floor((east + 180) / cell_size)), spatial_index["column_count"] - 1))
+    return row_range, column_range
+
+
+def get_cell_candidates(spatial_index, row_range, column_range):
+    """
+    Gets the ids of every indexed series inside a block of grid cells. Each row of the block is a single
+    contiguous range of cell keys, so it is found with two binary searches.
+
+    Arguments:      [spatial_index, row_range, column_range]
+    Returns:        [candidate_ids]
+    Referenced By:  [query_bbox, query_polygon, query_nearest]
+    References:     []
+    Libraries:      [numpy]
+    """
+
+    cell_keys = spatial_index["cell_keys"]
+    column_count = spatial_index["column_count"]
+    slices = []
+    for row in range(row_range[0], row_range[1] + 1):
+        start = numpy.searchsorted(cell_keys, row * column_count + column_range[0], side="left")
+        end = numpy.searchsorted(cell_keys, row * column_count + column_range[1], side="right")
+        if end > start:
+            slices.append(spatial_index["series_ids"][start:end])
+
+    return numpy.concatenate(slices) if slices else numpy.array([], dtype=numpy.int64)
+
+
+def query_bbox(spatial_index, south, west, north, east):
+    """
+    Gets the ids of the series whose sites fall inside a bounding box. Boxes crossing the antimeridian are
+    given with west greater than east.
+
+    Arguments:      [spatial_index, south, west, north, east]
+    Returns:        [series_ids]
+    Referenced By:  [session_store.query_session_series]
+    References:     [get_cell_range, get_cell_candidates]
+    Libraries:      [numpy]
+    """
+
+    if west > east:
+        return numpy.union1d(query_bbox(spatial_index, south, west, north, 180.0),
+                             query_bbox(spatial_index, south, -180.0, north, east))
+
+    row_range, column_range = get_cell_range(spatial_index, south, west, north, east)
+    candidate_ids = get_cell_candidates(spatial_index, row_range, column_range)
+    latitudes = spatial_index["latitudes"][candidate_ids]
+    longitudes = spatial_index["longitudes"][candidate_ids]
+    inside = (latitudes >= south) & (latitudes <= north) & (longitudes >= west) & (longitudes <= east)
+
+    return numpy.sort(candidate_ids[inside])
+
+
+def query_polygon(spatial_index, rings):
+    """
+    Gets the ids of the series whose sites fall inside a polygon. Rings are lists of [longitude, latitude]
+    pairs as in GeoJSON, and holes are handled with the even-odd rule.
+
+    Arguments:      [spatial_index, rings]
+    Returns:        [series_ids]
+    Referenced By:  [session_store.query_session_series]
+    References:     [get_cell_range, get_cell_candidates]
+    Libraries:      [numpy]
+    """
+
+    rings = [numpy.asarray(ring, dtype=numpy.float64)[:, :2] for ring in rings if len(ring) >= 3]
+    if not rings:
+        return numpy.array([], dtype=numpy.int64)
+    shell = rings[0]
+    row_range, column_range = get_cell_range(spatial_index, shell[:, 1].min(), shell[:, 0].min(),
+                                             shell[:, 1].max(), shell[:, 0].max())
+    candidate_ids = get_cell_candidates(spatial_index, row_range, column_range)
+    x = spatial_index["longitudes"][candidate_ids]
+    y = spatial_index["latitudes"][candidate_ids]
+
+    inside = numpy.zeros(len(candidate_ids), dtype=bool)
+    for ring in rings:
+        x1, y1 = ring[:, 0], ring[:, 1]
+        x2, y2 = numpy.roll(x1, -1), numpy.roll(y1, -1)
+        for edge in range(len(ring)):
+            crosses = (y1[edge] > y) != (y2[edge] > y)
+            if not crosses.any():
+                continue
+            intersect_x = x1[edge] + (y - y1[edge]) * (x2[edge] - x1[edge]) / ((y2[edge] - y1[edge]) or 1e-12)
+            inside ^= crosses & (x < intersect_x)
+
+    return numpy.sort(candidate_ids[inside])
+
+
+def get_distances(latitude, longitude, latitudes, longitudes):
+    """
+    Gets the great-circle distances in kilometers from a point to arrays of points.
+
+    Arguments:      [latitude, longitude, latitudes, longitudes]
+    Returns:        [distances]
+    Referenced By:  [query_nearest]
+    References:     []
+    Libraries:      [numpy]
+    """
+
+    latitude, longitude = numpy.radians(latitude), numpy.radians(longitude)
+    latitudes, longitudes = numpy.radians(latitudes), numpy.radians(longitudes)
+    a = (numpy.sin((latitudes - latitude) / 2) ** 2 +
+         numpy.cos(latitude) * numpy.cos(latitudes) * numpy.sin((longitudes - longitude) / 2) ** 2)
+
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+def query_nearest(spatial_index, latitude, longitude, k):
+    """
+    Gets the ids of the series at the k sites nearest to a point, nearest first. The search expands ring by
+    ring of grid cells until the k-th distance found is shorter than any distance outside the searched block.
+
+    Arguments:      [spatial_index, latitude, longitude, k]
+    Returns:        [series_ids]
+    Referenced By:  [session_store.query_session_series]
+    References:     [get_cell_range, get_cell_candidates, get_distances]
+    Libraries:      [numpy]
+    """
+
+    indexed_count = len(spatial_index["series_ids"])
+    k = min(k, indexed_count)
+    if k <= 0:
+        return numpy.array([], dtype=numpy.int64)
+    cell_size = spatial_index["cell_size"]
+    max_rings = max(spatial_index["row_count"], spatial_index["column_count"])
+
+    rings = 0
+    while True:
+        reach = rings * cell_size
+        row_range, column_range = get_cell_range(spatial_index, latitude - reach, longitude - reach,
+                                                 latitude + reach, longitude + reach)
+        candidate_ids = get_cell_candidates(spatial_index, row_range, column_range)
+        if len(candidate_ids) >= k or rings >= max_rings:
+            distances = get_distances(latitude, longitude, spatial_index["latitudes"][candidate_ids],
+                                      spatial_index["longitudes"][candidate_ids])
+            nearest = numpy.argsort(distances, kind="mergesort")[:k]
+            if len(candidate_ids) == indexed_count or rings >= max_rings:
+                return candidate_ids[nearest]
+            # Shortest distance to any site outside the searched block: past its latitude edges, or past the
+            # meridians bounding its longitude edges.
+            reach_angle = math.radians(min(reach, 90.0))
+            outside_distance = EARTH_RADIUS * min(reach_angle, math.asin(math.cos(math.radians(latitude)) *
+                                                                         math.sin(reach_angle)))
+            if distances[nearest[-1]] <= outside_distance:
+                return candidate_ids[nearest]
+        rings = max(rings * 2, 1)
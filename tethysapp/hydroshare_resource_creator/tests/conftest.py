@@ -0,0 +1,54 @@
+import os
+import sys
+import json
+import pytest
+
+TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.dirname(TESTS_PATH)
+FIXTURE_PATH = os.path.join(APP_PATH, "static_data", "refts_test_files")
+BENCHMARK_PATH = os.path.join(APP_PATH, "..", "..", "benchmarks")
+
+
+def pytest_configure(config):
+    # The app reads its HS_RESOURCE_CREATOR settings through django.conf. Outside a Django project they are
+    # configured with their defaults, without the background service refresh.
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(HS_RESOURCE_CREATOR_SERVICE_REFRESH=False)
+
+
+@pytest.fixture
+def series_store(tmp_path, monkeypatch):
+    from tethysapp.hydroshare_resource_creator.series_store import SERIES_STORE_PATH_VARIABLE
+    from tethysapp.hydroshare_resource_creator.service_registry import SERVICE_REGISTRY_PATH_VARIABLE
+
+    store_path = str(tmp_path / "series_store")
+    monkeypatch.setenv(SERIES_STORE_PATH_VARIABLE, store_path)
+    monkeypatch.setenv(SERVICE_REGISTRY_PATH_VARIABLE, str(tmp_path / "service_registry"))
+
+    return store_path
+
+
+@pytest.fixture(scope="session")
+def wof_stub():
+    # The WaterOneFlow stub of the benchmarks replays the bundled WaterML fixtures over HTTP.
+    sys.path.insert(0, BENCHMARK_PATH)
+    from wof_stub import WaterOneFlowStub
+
+    stub = WaterOneFlowStub().start()
+    yield stub
+    stub.shutdown()
+    stub.server_close()
+
+
+@pytest.fixture
+def fixture_refts(wof_stub):
+    # Loads the refts of a bundled fixture, pointed at the stub service of a WaterML fixture.
+    def load_fixture_refts(fixture_name, wml_fixture_name=None):
+        with open(os.path.join(FIXTURE_PATH, fixture_name + "_refts.json"), "r") as refts_file:
+            form_body = json.load(refts_file)
+        for ts in form_body["timeSeriesReferenceFile"]["referencedTimeSeries"]:
+            ts["requestInfo"]["url"] = wof_stub.get_service_url(wml_fixture_name or fixture_name)
+        return form_body
+
+    return load_fixture_refts
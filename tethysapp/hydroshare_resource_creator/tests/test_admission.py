@@ -0,0 +1,110 @@
+import json
+import time
+import threading
+import pytest
+from tethysapp.hydroshare_resource_creator import admission
+from tethysapp.hydroshare_resource_creator.utilities import get_request_form_body
+
+
+@pytest.fixture
+def admission_limits(monkeypatch):
+    monkeypatch.setattr(admission, "admission_queue", [])
+    monkeypatch.setattr(admission, "user_running", {})
+    monkeypatch.setattr(admission, "user_finish", {})
+    monkeypatch.setattr(admission, "admission_state", {"virtual_time": 0.0, "in_flight_cost": 0, "sequence": 0,
+                                                       "cost_rate": admission.COST_RATE})
+    limits = {"build_budget": 100, "user_builds": 1, "admission_wait": 5.0}
+    monkeypatch.setattr(admission, "get_admission_limits",
+                        lambda: (limits["build_budget"], limits["user_builds"], limits["admission_wait"]))
+
+    return limits
+
+
+def start_acquire(user, build_cost):
+    result = {}
+
+    def acquire():
+        result["ticket"], result["retry_after"] = admission.acquire_build(user, build_cost)
+
+    thread = threading.Thread(target=acquire)
+    thread.daemon = True
+    thread.start()
+    result["thread"] = thread
+
+    return result
+
+
+def wait_for_queue(length):
+    for _ in range(200):
+        if len(admission.admission_queue) == length:
+            return
+        time.sleep(0.01)
+    raise AssertionError("Builds were not queued")
+
+
+def test_acquire_build_serves_smaller_build_of_other_user_first(admission_limits):
+    running_ticket, _ = admission.acquire_build("busy", 100)
+    heavy = start_acquire("heavy", 95)
+    wait_for_queue(1)
+    light = start_acquire("light", 10)
+    wait_for_queue(2)
+
+    admission.release_build(running_ticket)
+    light["thread"].join(5)
+
+    # The later, smaller build has the earlier finish tag, and the larger one does not fit beside it.
+    assert light["ticket"] is not None
+    assert heavy["thread"].is_alive()
+
+    admission.release_build(light["ticket"])
+    heavy["thread"].join(5)
+    assert heavy["ticket"] is not None
+    admission.release_build(heavy["ticket"])
+
+
+def test_acquire_build_limits_builds_per_user(admission_limits):
+    running_ticket, _ = admission.acquire_build("user", 10)
+    waiting = start_acquire("user", 10)
+    wait_for_queue(1)
+
+    # One build is running and one is waiting, so a third is rejected without waiting.
+    rejected_ticket, retry_after = admission.acquire_build("user", 10)
+    assert rejected_ticket is None
+    assert retry_after >= admission.RETRY_AFTER_MIN
+
+    other_ticket, _ = admission.acquire_build("other", 10)
+    assert other_ticket is not None
+    assert waiting["thread"].is_alive()
+
+    admission.release_build(running_ticket)
+    waiting["thread"].join(5)
+    assert waiting["ticket"] is not None
+    admission.release_build(waiting["ticket"])
+    admission.release_build(other_ticket)
+
+
+def test_acquire_build_rejects_after_admission_wait(admission_limits):
+    admission_limits["admission_wait"] = 0.1
+    running_ticket, _ = admission.acquire_build("busy", 100)
+
+    ticket, retry_after = admission.acquire_build("late", 50)
+
+    assert ticket is None
+    assert retry_after >= admission.RETRY_AFTER_MIN
+    assert admission.admission_queue == []
+    admission.release_build(running_ticket)
+
+
+class PostRequest(object):
+
+    def __init__(self, post):
+        self.POST = post
+
+
+def test_estimate_build_cost_of_posted_form_body():
+    refts = {"referencedTimeSeries": [{"valueCount": 500}, {"valueCount": 1500}]}
+    request = PostRequest({"formBody": json.dumps({"timeSeriesReferenceFile": json.dumps(refts)})})
+
+    form_body = get_request_form_body(request)
+
+    assert admission.estimate_build_cost("ts", form_body, ["1"]) == admission.SERIES_BASE_COST + 1500
@@ -0,0 +1,27 @@
+import os
+from tethysapp.hydroshare_resource_creator.utilities import process_form_data, create_ts_resource
+
+
+def test_export_only_build_writes_no_odm2_database(fixture_refts, series_store, tmp_path):
+    form_body = process_form_data(fixture_refts("gulf"))
+    workspace = tmp_path / "build"
+    workspace.mkdir()
+
+    res_results = create_ts_resource({
+        "workspace": str(workspace),
+        "form_body": form_body,
+        "res_title": "Exports",
+        "res_abstract": "Exports",
+        "res_keywords": [],
+        "res_filename": "exports",
+        "selected_resources": [0],
+        "output_formats": ["csv.gz"],
+        "preflight": False
+    })
+
+    assert res_results["series_count"] == 1
+    assert res_results["file_extension"] == ".refts.json"
+    assert os.path.basename(res_results["res_filepath"]) == "exports.refts.json"
+    assert [os.path.basename(export_filepath) for export_filepath in res_results["export_filepaths"]] == \
+        ["exports.csv.gz", "exports_metadata.json"]
+    assert not [file_name for file_name in os.listdir(str(workspace)) if file_name.endswith(".odm2.sqlite")]
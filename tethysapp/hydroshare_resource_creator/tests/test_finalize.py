@@ -0,0 +1,32 @@
+import sqlite3
+from tethysapp.hydroshare_resource_creator.utilities import process_form_data, create_ts_resource, \
+    finalize_odm2_database
+
+
+def test_finalize_summarizes_result_without_valid_values(fixture_refts, series_store, tmp_path):
+    form_body = process_form_data(fixture_refts("gulf"))
+    workspace = tmp_path / "build"
+    workspace.mkdir()
+    res_results = create_ts_resource({
+        "workspace": str(workspace),
+        "form_body": form_body,
+        "res_title": "Finalize",
+        "res_abstract": "Finalize",
+        "res_keywords": [],
+        "res_filename": "finalize",
+        "selected_resources": [0],
+        "output_formats": ["odm2"],
+        "preflight": False
+    })
+    sql_connect = sqlite3.connect(res_results["res_filepath"])
+    sql_connect.execute("UPDATE TimeSeriesResultValues SET DataValue = (SELECT NoDataValue FROM Variables)")
+    sql_connect.commit()
+    sql_connect.close()
+
+    finalize_odm2_database(res_results["res_filepath"])
+
+    sql_connect = sqlite3.connect(res_results["res_filepath"])
+    summaries = sql_connect.execute("""SELECT ValueCount, MinValue, MaxValue, MeanValue, BeginDateTime, EndDateTime
+                                       FROM ResultSummaries""").fetchall()
+    sql_connect.close()
+    assert summaries == [(0, None, None, None, None, None)]
@@ -0,0 +1,53 @@
+import sqlite3
+from tethysapp.hydroshare_resource_creator.utilities import process_form_data, create_ts_resource
+
+
+def build_odm2(fixture_refts, workspace, shards):
+    form_body = fixture_refts("gulf")
+    ts_list = form_body["timeSeriesReferenceFile"]["referencedTimeSeries"]
+    for fixture_name in ("nldas", "uw", "boulder"):
+        ts_list += fixture_refts(fixture_name)["timeSeriesReferenceFile"]["referencedTimeSeries"]
+    form_body = process_form_data(form_body)
+    workspace.mkdir()
+
+    return create_ts_resource({
+        "workspace": str(workspace),
+        "form_body": form_body,
+        "res_title": "Shards",
+        "res_abstract": "Shards",
+        "res_keywords": [],
+        "res_filename": "shards",
+        "selected_resources": list(range(len(ts_list))),
+        "output_formats": ["odm2"],
+        "preflight": False,
+        "shards": shards
+    })
+
+
+def read_values(res_filepath):
+    sql_connect = sqlite3.connect(res_filepath)
+    try:
+        return sorted(sql_connect.execute("""
+            SELECT SamplingFeatures.SamplingFeatureCode, Variables.VariableCode, Units.UnitsName,
+                   Methods.MethodCode, TimeSeriesResultValues.ValueDateTime,
+                   TimeSeriesResultValues.ValueDateTimeUTCOffset, TimeSeriesResultValues.DataValue
+            FROM TimeSeriesResultValues
+            JOIN Results ON TimeSeriesResultValues.ResultID = Results.ResultID
+            JOIN FeatureActions ON Results.FeatureActionID = FeatureActions.FeatureActionID
+            JOIN SamplingFeatures ON FeatureActions.SamplingFeatureID = SamplingFeatures.SamplingFeatureID
+            JOIN Actions ON FeatureActions.ActionID = Actions.ActionID
+            JOIN Methods ON Actions.MethodID = Methods.MethodID
+            JOIN Variables ON Results.VariableID = Variables.VariableID
+            JOIN Units ON Results.UnitsID = Units.UnitsID""").fetchall())
+    finally:
+        sql_connect.close()
+
+
+def test_sharded_build_equals_single_build(fixture_refts, series_store, tmp_path):
+    single_results = build_odm2(fixture_refts, tmp_path / "single", "1")
+    sharded_results = build_odm2(fixture_refts, tmp_path / "sharded", "2")
+
+    assert single_results["series_count"] == sharded_results["series_count"] == 4
+    single_values = read_values(single_results["res_filepath"])
+    assert len(single_values) > 0
+    assert read_values(sharded_results["res_filepath"]) == single_values
@@ -0,0 +1,44 @@
+from tethysapp.hydroshare_resource_creator.parsers import get_parser
+from tethysapp.hydroshare_resource_creator.utilities import process_form_data, create_ts_resource
+
+
+def get_ts(service_type, return_type):
+    return {"requestInfo": {"serviceType": service_type, "returnType": return_type}}
+
+
+def test_get_parser_by_service_and_return_type():
+    assert get_parser(get_ts("SOAP", "WaterML 1.1"))["format"] == "wml11"
+    assert get_parser(get_ts("SOAP", "WaterML 1.0"))["format"] == "wml10"
+    assert get_parser(get_ts("REST", "WaterML 2.0"))["format"] == "wml2"
+    assert get_parser(get_ts("REST", "NWIS RDB"))["format"] == "nwis_rdb"
+
+
+def test_get_parser_of_unknown_return_type():
+    assert get_parser(get_ts("SOAP", "WaterML 3.0")) is None
+
+
+def test_get_parser_falls_back_to_return_type():
+    assert get_parser(get_ts("", "WaterML 1.1"))["format"] == "wml11"
+    assert get_parser(get_ts("UNKNOWN", "WaterML 1.0"))["format"] == "wml10"
+    assert get_parser({"requestInfo": {"returnType": "WaterML 1.1"}})["format"] == "wml11"
+
+
+def test_build_without_service_type(fixture_refts, series_store, tmp_path):
+    form_body = fixture_refts("gulf")
+    form_body["timeSeriesReferenceFile"]["referencedTimeSeries"][0]["requestInfo"]["serviceType"] = ""
+    workspace = tmp_path / "build"
+    workspace.mkdir()
+
+    res_results = create_ts_resource({
+        "workspace": str(workspace),
+        "form_body": process_form_data(form_body),
+        "res_title": "Service type",
+        "res_abstract": "Service type",
+        "res_keywords": [],
+        "res_filename": "service_type",
+        "selected_resources": [0],
+        "output_formats": ["odm2"],
+        "preflight": False
+    })
+
+    assert res_results["series_count"] == 1
@@ -0,0 +1,17 @@
+import os
+import time
+from tethysapp.hydroshare_resource_creator import refts_cache
+
+
+def test_save_cache_entry_keeps_downloads_and_recent_payloads(tmp_path, monkeypatch):
+    monkeypatch.setattr(refts_cache, "get_refts_cache_path", lambda res_id: str(tmp_path))
+    for file_name in ("refts_old.json", "refts_recent.json", "refts_download.json.tmp"):
+        (tmp_path / file_name).write_text(u"{}")
+    stale_time = time.time() - refts_cache.REFTS_PAYLOAD_GRACE - 1
+    os.utime(str(tmp_path / "refts_old.json"), (stale_time, stale_time))
+    os.utime(str(tmp_path / "refts_download.json.tmp"), (stale_time, stale_time))
+
+    entry = refts_cache.save_cache_entry("resource", {"url": "refts.json", "validated_at": time.time()}, [b"{}"])
+
+    assert sorted(os.listdir(str(tmp_path))) == sorted(["entry.json", entry["payload_name"], "refts_recent.json",
+                                                       "refts_download.json.tmp"])
@@ -0,0 +1,65 @@
+import os
+import numpy
+from tethysapp.hydroshare_resource_creator.series_store import load_series, save_series, prune_series_store
+
+
+def get_ts(site_code="site", begin_date="2020-01-01T00:00:00", end_date="2020-01-10T00:00:00-07:00"):
+    return {
+        "requestInfo": {"url": "http://example.com/cuahsi_1_1.asmx?WSDL"},
+        "site": {"siteCode": site_code},
+        "variable": {"variableCode": "var"},
+        "beginDate": begin_date,
+        "endDate": end_date
+    }
+
+
+def get_series(day_count=9):
+    date_times = ["2020-01-%02dT00:00:00" % day for day in range(day_count, 0, -1)]
+    return {
+        "site": {"site_code": "site"},
+        "values": {
+            "data_value": numpy.arange(day_count, dtype=float),
+            "date_time": numpy.array(date_times),
+            "utc_offset": numpy.array(["-07:00"] * day_count),
+            "censor_code": numpy.array(["nc"] * day_count),
+            "method_code": numpy.array(["1"] * day_count)
+        }
+    }
+
+
+def test_load_series_slices_stored_window(series_store):
+    save_series(get_ts(), get_series())
+
+    series = load_series(get_ts(begin_date="2020-01-03T00:00:00", end_date="2020-01-05T00:00:00-07:00"))
+
+    assert series["site"] == {"site_code": "site"}
+    assert list(series["values"]["date_time"]) == ["2020-01-03T00:00:00", "2020-01-04T00:00:00",
+                                                   "2020-01-05T00:00:00"]
+    assert list(series["values"]["data_value"]) == [6.0, 5.0, 4.0]
+
+
+def test_load_series_misses_uncovered_window_and_other_series(series_store):
+    save_series(get_ts(), get_series())
+
+    assert load_series(get_ts(end_date="2020-02-01T00:00:00-07:00")) is None
+    assert load_series(get_ts(site_code="other")) is None
+
+
+def test_load_series_skips_stale_entry(series_store):
+    # The window ends after the entry was stored, so it may be missing newer values once max_age has passed.
+    save_series(get_ts(end_date="2099-01-01T00:00:00-07:00"), get_series())
+
+    assert load_series(get_ts(end_date="2099-01-01T00:00:00-07:00")) is not None
+    assert load_series(get_ts(end_date="2099-01-01T00:00:00-07:00"), max_age=-1) is None
+
+
+def test_prune_series_store_removes_least_recently_used(series_store):
+    first_path = save_series(get_ts(site_code="first"), get_series())
+    second_path = save_series(get_ts(site_code="second"), get_series())
+    os.utime(os.path.join(first_path, "metadata.json"), (0, 0))
+    entry_bytes = sum(os.path.getsize(os.path.join(second_path, file_name)) for file_name in os.listdir(second_path))
+
+    assert prune_series_store(max_bytes=entry_bytes) == 1
+    assert not os.path.exists(first_path)
+    assert load_series(get_ts(site_code="second")) is not None
+    assert prune_series_store(retention=-1) == 1
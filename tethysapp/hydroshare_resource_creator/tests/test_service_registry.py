@@ -0,0 +1,42 @@
+import os
+import datetime
+import requests
+from tethysapp.hydroshare_resource_creator import service_registry
+
+SERVICE_URL = "http://hydroportal.example.org/cuahsi_1_1.asmx?WSDL"
+
+
+class ServiceResponse(object):
+
+    def __init__(self, byte_count, seconds):
+        self.content = b" " * byte_count
+        self.elapsed = datetime.timedelta(seconds=seconds)
+        self.headers = {}
+
+
+def get_ts(begin_date="2020-01-01T00:00:00", end_date="2020-02-01T00:00:00"):
+    return {"requestInfo": {"url": SERVICE_URL}, "beginDate": begin_date, "endDate": end_date, "valueCount": 1000}
+
+
+def test_measurements_are_kept_in_process_until_a_capability_changes(series_store, monkeypatch):
+    service_path = service_registry.get_service_path(service_registry.get_service_key(SERVICE_URL))
+    service_registry.record_service_request(get_ts(), ServiceResponse(100, 0.5), 1.0)
+    saved_mtime = os.path.getmtime(service_path)
+
+    def fail_open(*args, **kwargs):
+        raise AssertionError("Registry file was read")
+
+    # A shorter window and the timeouts of later requests are answered from the in-process copy.
+    with monkeypatch.context() as patch:
+        patch.setattr(service_registry, "open", fail_open, raising=False)
+        service_registry.record_service_request(get_ts(end_date="2020-01-15T00:00:00"), ServiceResponse(100, 0.1),
+                                                1.0)
+        assert service_registry.get_request_timeout(get_ts()) == service_registry.DEFAULT_TIMEOUT
+    assert os.path.getmtime(service_path) == saved_mtime
+    assert service_registry.load_service(SERVICE_URL)["requests"] == 2
+
+    service_registry.record_service_failure(get_ts(), requests.ConnectionError("refused"))
+    service_registry.registry_cache.clear()
+    stored = service_registry.load_service(SERVICE_URL)
+    assert stored["failures"] == 1
+    assert stored["requests"] == 2
@@ -0,0 +1,73 @@
+import numpy
+from tethysapp.hydroshare_resource_creator.timeseries import normalize_values, downsample_lttb, downsample_min_max
+from tethysapp.hydroshare_resource_creator.reconcile import merge_series
+
+
+def get_values(date_times, utc_offsets, method_codes, data_values):
+    return {
+        "data_value": numpy.array(data_values, dtype=float),
+        "date_time": numpy.array(date_times),
+        "utc_offset": numpy.array(utc_offsets),
+        "censor_code": numpy.array(["nc"] * len(data_values)),
+        "method_code": numpy.array(method_codes)
+    }
+
+
+def test_normalize_values_sorts_by_utc_time_and_keeps_first_duplicate():
+    values = get_values(
+        ["2020-01-01T02:00:00", "2020-01-01T01:00:00", "2020-01-01T00:00:00", "2020-01-01T01:00:00"],
+        ["-07:00", "-06:00", "-07:00", "-06:00"],
+        ["1", "1", "1", "2"],
+        [1, 2, 3, 4]
+    )
+
+    normalized_values, epochs = normalize_values(values)
+
+    # 01:00-06:00 and 00:00-07:00 are the same instant, so the earlier listed row of method 1 is kept, and the
+    # row of method 2 at that instant is not a duplicate.
+    assert list(normalized_values["data_value"]) == [2.0, 4.0, 1.0]
+    assert list(normalized_values["method_code"]) == ["1", "2", "1"]
+    assert list(epochs) == sorted(epochs)
+
+
+def test_normalize_values_returns_sorted_unique_values_unchanged():
+    values = get_values(["2020-01-01T00:00:00", "2020-01-01T01:00:00"], ["+00:00", "+00:00"], ["1", "1"], [1, 2])
+
+    normalized_values, epochs = normalize_values(values)
+
+    assert normalized_values is values
+    assert list(epochs) == [1577836800, 1577840400]
+
+
+def test_merge_series_keeps_first_listed_series_and_other_methods():
+    first = {"name": "first", "values": get_values(["2020-01-01T00:00:00"] * 2, ["-07:00"] * 2, ["1", "2"], [1, 2])}
+    second = {"name": "second", "values": get_values(["2020-01-01T00:00:00", "2020-01-02T00:00:00"],
+                                                     ["-07:00"] * 2, ["1", "1"], [3, 4])}
+
+    merged_series, rows_removed = merge_series([first, second])
+
+    assert merged_series["name"] == "first"
+    assert rows_removed == 1
+    assert list(merged_series["values"]["data_value"]) == [1.0, 2.0, 4.0]
+
+
+def test_downsample_lttb_keeps_endpoints_and_count():
+    x = numpy.arange(1000)
+    y = numpy.sin(x / 20.0)
+
+    indices = downsample_lttb(x, y, 100)
+
+    assert len(indices) == 100
+    assert indices[0] == 0 and indices[-1] == 999
+    assert (numpy.diff(indices) > 0).all()
+    assert list(downsample_lttb(x[:50], y[:50], 100)) == list(range(50))
+
+
+def test_downsample_min_max_keeps_extremes():
+    y = numpy.zeros(1000)
+    y[123], y[877] = 5.0, -5.0
+
+    indices = downsample_min_max(y, 20)
+
+    assert 123 in indices and 877 in indices
+    assert len(indices) <= 20
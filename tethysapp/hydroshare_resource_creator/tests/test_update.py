@@ -0,0 +1,76 @@
+import os
+import shutil
+import sqlite3
+from tethysapp.hydroshare_resource_creator.utilities import process_form_data, create_ts_resource, update_ts_resource
+
+
+class HydroShareStub(object):
+
+    def __init__(self, res_filepath):
+        self.res_filepath = res_filepath
+
+    def getResourceFileList(self, resource_id):
+        return [{"file_name": os.path.basename(self.res_filepath)}]
+
+    def getResourceFile(self, resource_id, file_name, destination):
+        filepath = os.path.join(destination, file_name)
+        shutil.copy(self.res_filepath, filepath)
+        return filepath
+
+
+def get_res_data(workspace, form_body):
+    workspace.mkdir()
+    return {
+        "workspace": str(workspace),
+        "form_body": process_form_data(form_body),
+        "res_title": "Update",
+        "res_abstract": "Update",
+        "res_keywords": [],
+        "res_filename": "update",
+        "selected_resources": list(range(len(form_body["timeSeriesReferenceFile"]["referencedTimeSeries"]))),
+        "output_formats": ["odm2"],
+        "preflight": False
+    }
+
+
+def build_truncated_odm2(fixture_refts, tmp_path):
+    res_results = create_ts_resource(get_res_data(tmp_path / "build", fixture_refts("gulf")))
+    sql_connect = sqlite3.connect(res_results["res_filepath"])
+    value_count = sql_connect.execute("SELECT COUNT(*) FROM TimeSeriesResultValues").fetchone()[0]
+    sql_connect.execute("DELETE FROM TimeSeriesResultValues WHERE ValueDateTime > '2013-06-01'")
+    sql_connect.execute("UPDATE Results SET ValueCount = (SELECT COUNT(*) FROM TimeSeriesResultValues)")
+    sql_connect.commit()
+    sql_connect.close()
+
+    return res_results["res_filepath"], value_count
+
+
+def test_update_appends_new_values_and_unmatched_series(fixture_refts, series_store, tmp_path):
+    res_filepath, value_count = build_truncated_odm2(fixture_refts, tmp_path)
+    form_body = fixture_refts("gulf")
+    form_body["timeSeriesReferenceFile"]["referencedTimeSeries"] += \
+        fixture_refts("uw")["timeSeriesReferenceFile"]["referencedTimeSeries"]
+    res_data = get_res_data(tmp_path / "update", form_body)
+    res_data.update({"hs_api": HydroShareStub(res_filepath), "res_id": "resource"})
+
+    processed_data = update_ts_resource(res_data)
+
+    assert [status["res_status"] for status in processed_data["parse_status"]] == ["Success", "Success"]
+    assert processed_data["series_count"] == 2
+    sql_connect = sqlite3.connect(processed_data["res_filepath"])
+    result_counts = sql_connect.execute("SELECT ResultID, ValueCount FROM Results ORDER BY ResultID").fetchall()
+    assert result_counts[0][1] == value_count
+    assert len(result_counts) == 2
+    sql_connect.close()
+    assert os.path.isfile(processed_data["backup_filepath"])
+
+
+def test_update_reports_failed_download(fixture_refts, series_store, tmp_path):
+    res_filepath, _ = build_truncated_odm2(fixture_refts, tmp_path)
+    res_data = get_res_data(tmp_path / "update", fixture_refts("gulf", "missing"))
+    res_data.update({"hs_api": HydroShareStub(res_filepath), "res_id": "resource"})
+
+    processed_data = update_ts_resource(res_data)
+
+    assert [status["res_status"] for status in processed_data["parse_status"]] == ["Update failed"]
+    assert processed_data["series_count"] == 0
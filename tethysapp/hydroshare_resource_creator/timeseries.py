@@ -0,0 +1,146 @@
+import numpy
+
+
+def get_utc_offset_seconds(utc_offsets):
+    """
+    Converts an array of "+HH:MM" UTC offset strings into offsets in seconds. Missing or malformed offsets
+    are treated as UTC. A series holds few distinct offsets, so each is parsed once.
+
+    Arguments:      [utc_offsets]
+    Returns:        [offset_seconds]
+    Referenced By:  [get_utc_epochs]
+    References:     []
+    Libraries:      [numpy]
+    """
+
+    offsets = numpy.asarray(utc_offsets, dtype="U6")
+    if len(offsets) and (offsets == offsets[0]).all():
+        unique_offsets, offset_indexes = offsets[:1], numpy.zeros(len(offsets), dtype=numpy.int64)
+    else:
+        unique_offsets, offset_indexes = numpy.unique(offsets, return_inverse=True)
+    unique_seconds = numpy.zeros(len(unique_offsets), dtype=numpy.int64)
+    for n, offset in enumerate(unique_offsets):
+        if len(offset) == 6:
+            sign = -1 if offset[0] == "-" else 1
+            unique_seconds[n] = sign * (int(offset[1:3]) * 3600 + int(offset[4:6]) * 60)
+    offset_seconds = unique_seconds[offset_indexes.reshape(-1)]
+
+    return offset_seconds
+
+
+def get_utc_epochs(date_times, utc_offsets):
+    """
+    Converts arrays of local WaterML dateTime strings and their UTC offsets into UTC epoch seconds.
+
+    Arguments:      [date_times, utc_offsets]
+    Returns:        [epochs]
+    Referenced By:  [normalize_values, exports.write_parquet_export, exports.write_netcdf_export,
+                     utilities.get_series_preview, utilities.update_ts_resource]
+    References:     [get_utc_offset_seconds]
+    Libraries:      [numpy]
+    """
+
+    local_times = numpy.asarray(date_times, dtype="U19").astype("datetime64[s]").astype(numpy.int64)
+    epochs = local_times - get_utc_offset_seconds(utc_offsets)
+
+    return epochs
+
+
+def normalize_values(values):
+    """
+    Parses the timestamps of a series' value columns into UTC epoch seconds, sorts the columns by them, and
+    drops the rows repeating the UTC time and method of an earlier row, keeping the first. Columns that are
+    already sorted and unique are returned as they are.
+
+    Arguments:      [values]
+    Returns:        [values, epochs]
+    Referenced By:  [utilities.write_odm2_series, utilities.update_ts_resource, reconcile.merge_series]
+    References:     [get_utc_epochs]
+    Libraries:      [numpy]
+    """
+
+    epochs = get_utc_epochs(values["date_time"], values["utc_offset"])
+    value_count = len(epochs)
+    if value_count < 2:
+        return values, epochs
+
+    # Rows of different methods may share a time, so the method breaks ties and is part of the duplicate key.
+    method_codes = numpy.asarray(values["method_code"])
+    if (method_codes == method_codes[0]).all():
+        method_codes = numpy.zeros(value_count, dtype=numpy.int64)
+    else:
+        method_codes = numpy.unique(method_codes, return_inverse=True)[1].reshape(-1)
+    order = numpy.lexsort((method_codes, epochs))
+    sorted_epochs = epochs[order]
+    sorted_methods = method_codes[order]
+    unique_mask = numpy.ones(value_count, dtype=bool)
+    unique_mask[1:] = (sorted_epochs[1:] != sorted_epochs[:-1]) | (sorted_methods[1:] != sorted_methods[:-1])
+    order = order[unique_mask]
+    if len(order) == value_count and (order == numpy.arange(value_count)).all():
+        return values, epochs
+
+    return dict((column, numpy.asarray(values[column])[order]) for column in values), epochs[order]
+
+
+def downsample_lttb(x, y, threshold):
+    """
+    Downsamples a series to a number of points with the Largest-Triangle-Three-Buckets algorithm, which
+    keeps the points that preserve the visual shape of the series.
+
+    Arguments:      [x, y, threshold]
+    Returns:        [indices]
+    Referenced By:  [utilities.get_series_preview]
+    References:     []
+    Libraries:      [numpy]
+    """
+
+    value_count = len(x)
+    if threshold >= value_count or threshold < 3:
+        return numpy.arange(value_count)
+
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    every = (value_count - 2) / float(threshold - 2)
+    edges = (numpy.floor(numpy.arange(threshold - 1) * every) + 1).astype(numpy.int64)
+    edges[-1] = value_count - 1
+    indices = numpy.zeros(threshold, dtype=numpy.int64)
+    selected = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else value_count
+        average_x = x[end:next_end].mean()
+        average_y = y[end:next_end].mean()
+        areas = numpy.abs((x[selected] - average_x) * (y[start:end] - y[selected]) -
+                          (x[selected] - x[start:end]) * (average_y - y[selected]))
+        selected = start + int(numpy.argmax(areas))
+        indices[bucket + 1] = selected
+    indices[-1] = value_count - 1
+
+    return indices
+
+
+def downsample_min_max(y, threshold):
+    """
+    Downsamples a series by splitting it into buckets and keeping the minimum and maximum point of each.
+
+    Arguments:      [y, threshold]
+    Returns:        [indices]
+    Referenced By:  [utilities.get_series_preview]
+    References:     []
+    Libraries:      [numpy]
+    """
+
+    value_count = len(y)
+    bucket_count = threshold // 2
+    if threshold >= value_count or bucket_count < 1:
+        return numpy.arange(value_count)
+
+    y = numpy.asarray(y, dtype=numpy.float64)
+    edges = numpy.linspace(0, value_count, bucket_count + 1).astype(numpy.int64)
+    indices = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end > start:
+            bucket = y[start:end]
+            indices += sorted((start + int(numpy.argmin(bucket)), start + int(numpy.argmax(bucket))))
+
+    return numpy.unique(indices)
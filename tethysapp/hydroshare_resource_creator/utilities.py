@@ -5,31 +5,32 @@ import requests
 import sqlite3
 import uuid
 import traceback
-import random
 import time
-import xmltodict
 import itertools
 import os
-import collections
-from hs_restclient import HydroShare, HydroShareAuthOAuth2, HydroShareNotAuthorized, HydroShareNotFound
+import json
 from xml.sax._exceptions import SAXParseException
 from django.conf import settings
-from .app import HydroshareResourceCreator
-import json
 from logging import getLogger
-import zipfile, io
-import traceback
-import sys
-import pandas
-from lxml import etree
+from .app import HydroshareResourceCreator
+from .metrics import stage_timer, observe_stage, record_error, get_service_host
+from .session_store import load_session_refts, get_selected_ids, parse_spatial_query, query_session_series
+from .refts_stream import write_refts
+
+# numpy, lxml, hs_restclient, and the series store, export, and timeseries modules are imported where they
+# are used, so that loading the controllers does not pay for them until a request needs them.
+
+# Column of TimeSeriesResultValues holding the UTC epoch seconds of each value, added to the ODM2 template of
+# builds that ask for an epoch index.
+EPOCH_COLUMN = "ValueDateTimeEpoch"
 
 logger = getLogger('django')
 use_hs_client_helper = True
 try:
     from tethys_services.backends.hs_restclient_helper import get_oauth_hs
-except:
+except Exception as ex:
     use_hs_client_helper = False
-    logger.error("tethys_services.backends.hs_restclient_helper import get_oauth_hs: " + ex.message)
+    logger.error("tethys_services.backends.hs_restclient_helper import get_oauth_hs: " + str(ex))
 
 
 def get_user_workspace(request):
@@ -48,6 +49,25 @@ def get_user_workspace(request):
     return workspace
 
 
+def get_res_workspace(res_data):
+    """
+    Gets the directory resource files are written to. An explicit workspace is used if given, which lets
+    resources be built without a request, otherwise the requesting user's workspace.
+
+    Arguments:      [res_data]
+    Returns:        [workspace]
+    Referenced By:  [create_ts_resource, update_ts_resource, create_refts_resource]
+    References:     [get_user_workspace]
+    Libraries:      []
+    """
+
+    workspace = res_data.get("workspace")
+    if workspace is None:
+        workspace = get_user_workspace(res_data["request"])
+
+    return workspace
+
+
 def get_o_auth_hs(request):
     """
     Gets HydroShare Open Authorization.
@@ -59,6 +79,8 @@ def get_o_auth_hs(request):
     Libraries:      [HydroShareAuthOAuth2, HydroShare]
     """
 
+    from hs_restclient import HydroShare, HydroShareAuthOAuth2
+
     if use_hs_client_helper:
         hs = get_oauth_hs(request)
     else:
@@ -75,6 +97,54 @@ def get_o_auth_hs(request):
     return hs
 
 
+def get_request_form_body(request):
+    """
+    Gets the refts form body of a request. A posted formBody is used if present, otherwise the refts loaded
+    in the session. Posted JSON is decoded, so the form body is always a dict.
+
+    Arguments:      [request]
+    Returns:        [form_body]
+    Referenced By:  [controllers_ajax.login_test, controllers_ajax.ajax_create_resource,
+                     controllers_ajax.ajax_preview_series]
+    References:     [session_store.load_session_refts]
+    Libraries:      [json]
+    """
+
+    form_body = request.POST.get("formBody")
+    if not form_body:
+        form_body = load_session_refts(request)
+    while not isinstance(form_body, dict):
+        form_body = json.loads(form_body)
+    if not isinstance(form_body["timeSeriesReferenceFile"], dict):
+        form_body["timeSeriesReferenceFile"] = json.loads(form_body["timeSeriesReferenceFile"])
+
+    return form_body
+
+
+def get_request_checked_ids(request):
+    """
+    Gets the selected series ids of a request. Posted checkedIds are used if present, then a posted spatial
+    query, otherwise the selection kept in the session.
+
+    Arguments:      [request]
+    Returns:        [checked_ids]
+    Referenced By:  [controllers_ajax.login_test, controllers_ajax.ajax_create_resource]
+    References:     [session_store.get_selected_ids, session_store.parse_spatial_query,
+                     session_store.query_session_series]
+    Libraries:      []
+    """
+
+    checked_ids = request.POST.get("checkedIds")
+    if checked_ids:
+        return [int(checked_id) for checked_id in checked_ids.split(",")]
+
+    spatial_query = parse_spatial_query(request.POST)
+    if spatial_query is not None:
+        return query_session_series(request, spatial_query)
+
+    return get_selected_ids(request)
+
+
 def connect_wsdl_url(wsdl_url):
     """
     Handles client url errors. 
@@ -98,6 +168,85 @@ def connect_wsdl_url(wsdl_url):
     return client
 
 
+def normalize_ts(ts):
+    """
+    Fills in the missing fields of one referenced timeseries, and points its url at the service WSDL.
+
+    Arguments:      [ts]
+    Returns:        [ts]
+    Referenced By:  [process_form_data, controllers.home]
+    References:     []
+    Libraries:      []
+    """
+
+    if not 'site' in ts:
+        ts['site'] = {}
+    if not 'variable' in ts:
+        ts['variable'] = {}
+    if not 'requestInfo' in ts:
+        ts['requestInfo'] = {}
+    if not 'method' in ts:
+        ts['method'] = {}
+    if not 'siteName' in ts['site']:
+        ts['site']['siteName'] = ''
+    if not 'siteCode' in ts['site']:
+        ts['site']['siteCode'] = ''
+    if not 'variableName' in ts['variable']:
+        ts['variable']['variableName'] = ''
+    if not 'variableCode' in ts['variable']:
+        ts['variable']['variableCode'] = ''
+    if not 'networkName' in ts['requestInfo']:
+        ts['requestInfo']['networkName'] = ''
+    if not 'refType' in ts['requestInfo']:
+        ts['requestInfo']['refType'] = ''
+    if not 'serviceType' in ts['requestInfo']:
+        ts['requestInfo']['serviceType'] = ''
+    if not 'url' in ts['requestInfo']:
+        ts['requestInfo']['url'] = ''
+    if not 'returnType' in ts['requestInfo']:
+        ts['requestInfo']['returnType'] = ''
+    if not 'latitude' in ts['site']:
+        ts['site']['latitude'] = ''
+    if not 'longitude' in ts['site']:
+        ts['site']['longitude'] = ''
+    if not 'methodDescription' in ts['method']:
+        ts['method']['methodDescription'] = ''
+    if not 'methodLink' in ts['method']:
+        ts['method']['methodLink'] = ''
+    if ts['site']['siteName'] == '':
+        ts['site']['siteName'] = 'UNKNOWN'
+    if ts['site']['siteCode'] == '':
+        ts['site']['siteCode'] = 'UNKNOWN'
+    if ts['variable']['variableName'] == '':
+        ts['variable']['variableName'] = 'UNKNOWN'
+    if ts['variable']['variableCode'] == '':
+        ts['variable']['variableCode'] = 'UNKNOWN'
+    if ts['requestInfo']['networkName'] == '':
+        ts['requestInfo']['networkName'] = 'UNKNOWN'
+    if ts['requestInfo']['refType'] == '':
+        ts['requestInfo']['refType'] = 'UNKNOWN'
+    if ts['requestInfo']['serviceType'] == '':
+        ts['requestInfo']['serviceType'] = 'UNKNOWN'
+    if ts['requestInfo']['url'] == '':
+        ts['requestInfo']['url'] = 'UNKNOWN'
+    if str(ts['requestInfo']['url'][-5:]) != '?WSDL':
+        ts['requestInfo']['url'] += '?WSDL'
+    if ts['requestInfo']['returnType'] == '':
+        ts['requestInfo']['returnType'] = 'UNKNOWN'
+    if ts['site']['latitude'] == '':
+        ts['site']['latitude'] = 'UNKNOWN'
+    if ts['site']['longitude'] == '':
+        ts['site']['longitude'] = 'UNKNOWN'
+    if ts['method']['methodDescription'] == '':
+        ts['method']['methodDescription'] = 'UNKNOWN'
+    if ts['method']['methodLink'] == '':
+        ts['method']['methodLink'] = None
+    if ts['method']['methodLink'] == 'Unknown':
+        ts['method']['methodLink'] = None
+
+    return ts
+
+
 def process_form_data(form_data):
     try:
         try:
@@ -106,70 +255,7 @@ def process_form_data(form_data):
             form_data = {'timeSeriesReferenceFile': json.loads(form_data['timeSeriesReferenceFile'])}
             series_count = len(form_data['timeSeriesReferenceFile']['referencedTimeSeries'])
         for i in range(series_count):
-            if not 'site' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site'] = {}
-            if not 'variable' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['variable'] = {}
-            if not 'requestInfo' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo'] = {}
-            if not 'method' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['method'] = {}
-            if not 'siteName' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site']:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site']['siteName'] = ''
-            if not 'siteCode' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site']:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site']['siteCode'] = ''
-            if not 'variableName' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['variable']:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['variable']['variableName'] = ''
-            if not 'variableCode' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['variable']:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['variable']['variableCode'] = ''
-            if not 'networkName' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['networkName'] = ''
-            if not 'refType' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['refType'] = ''
-            if not 'serviceType' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['serviceType'] = ''
-            if not 'url' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['url'] = ''
-            if not 'returnType' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['returnType'] = ''
-            if not 'latitude' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site']:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site']['latitude'] = ''
-            if not 'longitude' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site']:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site']['longitude'] = ''
-            if not 'methodDescription' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['method']:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['method']['methodDescription'] = ''
-            if not 'methodLink' in form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['method']:
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['method']['methodLink'] = ''
-            if form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site']['siteName'] == '':
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site']['siteName'] = 'UNKNOWN'
-            if form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site']['siteCode'] == '':
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site']['siteCode'] = 'UNKNOWN'
-            if form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['variable']['variableName'] == '':
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['variable']['variableName'] = 'UNKNOWN'
-            if form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['variable']['variableCode'] == '':
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['variable']['variableCode'] = 'UNKNOWN'
-            if form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['networkName'] == '':
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['networkName'] = 'UNKNOWN'
-            if form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['refType'] == '':
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['refType'] = 'UNKNOWN'
-            if form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['serviceType'] == '':
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['serviceType'] = 'UNKNOWN'
-            if form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['url'] == '':
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['url'] = 'UNKNOWN'
-            if str(form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['url'][-5:]) != '?WSDL':
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['url'] += '?WSDL'
-            if form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['returnType'] == '':
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['requestInfo']['returnType'] = 'UNKNOWN'
-            if form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site']['latitude'] == '':
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site']['latitude'] = 'UNKNOWN'
-            if form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site']['longitude'] == '':
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['site']['longitude'] = 'UNKNOWN'
-            if form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['method']['methodDescription'] == '':
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['method']['methodDescription'] = 'UNKNOWN'
-            if form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['method']['methodLink'] == '':
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['method']['methodLink'] = None
-            if form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['method']['methodLink'] == 'Unknown':
-                form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i]['method']['methodLink'] = None
+            normalize_ts(form_data['timeSeriesReferenceFile']['referencedTimeSeries'][i])
 
         return form_data
     except:
@@ -215,574 +301,1390 @@ def search_wml(unique_code, ns, tag_names, default_value=None, attr=None, get_tr
         return default_value
 
 
-def create_ts_resource(res_data):
+def download_wml(ts):
+    """
+    Downloads WaterML values for a referenced timeseries. The WaterOneFlow version of the refts return type
+    is requested, unless the service registry knows the service serves only another version.
+
+    Arguments:      [ts]
+    Returns:        [values_result, ns]
+    Referenced By:  [parsers.download_wml1]
+    References:     [service_registry.get_wml_version, service_registry.request_service]
+    Libraries:      [requests]
+    """
 
-    refts_data = create_refts_resource(res_data)
-    refts_path = refts_data["res_filepath"]
+    from .service_registry import get_wml_version, request_service
 
-    print("Starting Transaction")
+    return_type = ts["requestInfo"]["returnType"]
+    site_code = ts["site"]["siteCode"]
+    variable_code = ts["variable"]["variableCode"]
+    start_date = ts["beginDate"]
+    end_date = ts["endDate"]
+    url = ts["requestInfo"]["url"]
+    autho_token = ""
 
-    user_workspace = get_user_workspace(res_data["request"])
-    current_path = os.path.dirname(os.path.realpath(__file__))
-    odm_master = os.path.join(current_path, "static_data/ODM2_master.sqlite")
-    res_filepath = user_workspace + '/' + res_data['res_filename'] + '.odm2.sqlite'
-    shutil.copy(odm_master, res_filepath)
-    sql_connect = sqlite3.connect(res_filepath, isolation_level=None)
-    curs = sql_connect.cursor()
-    series_count = 0
-    parse_status = []
+    if return_type == "WaterML 1.1":
+        wml_version = get_wml_version(url, "1.1")
+    elif return_type == "WaterML 1.0":
+        wml_version = get_wml_version(url, "1.0")
+    else:
+        raise Exception("Unsupported return type: " + str(return_type))
+    ns = "{http://www.cuahsi.org/waterML/" + wml_version + "/}"
+
+    response = request_service(
+        ts,
+        "POST",
+        headers={
+            "SOAPAction": "http://www.cuahsi.org/his/" + wml_version + "/ws/GetValuesObject",
+            "Content-Type": "text/xml; charset=utf-8"
+        },
+        data = '<soap-env:Envelope xmlns:soap-env="http://schemas.xmlsoap.org/soap/envelope/">' + \
+              '<soap-env:Body>' + \
+                '<ns0:GetValuesObject xmlns:ns0="http://www.cuahsi.org/his/' + wml_version + '/ws/">' + \
+                  '<ns0:location>' + site_code + '</ns0:location>' + \
+                  '<ns0:variable>' + variable_code + '</ns0:variable>' + \
+                  '<ns0:startDate>' + start_date + '</ns0:startDate>' + \
+                  '<ns0:endDate>' + end_date + '</ns0:endDate>' + \
+                  '<ns0:authToken>' + autho_token + '</ns0:authToken>' + \
+                '</ns0:GetValuesObject>' + \
+              '</soap-env:Body>' + \
+            '</soap-env:Envelope>'
+    )
+
+    values_result = response.content
+
+    return values_result, ns
+
+
+def parse_wml_series(wml_tree, ns):
+    """
+    Extracts site, variable, unit, source, method, and processing level metadata along with columnar
+    value data from a WaterML tree.
+
+    Arguments:      [wml_tree, ns]
+    Returns:        [series]
+    Referenced By:  [parsers.parse_wml1]
+    References:     [search_wml]
+    Libraries:      [numpy]
+    """
 
-    with open(refts_path, "rb") as refts_file:
-        refts_data = json.load(refts_file)
-        ts_list = refts_data["timeSeriesReferenceFile"]["referencedTimeSeries"]
-        res_title = refts_data["timeSeriesReferenceFile"]["title"]
-        res_abstract = refts_data["timeSeriesReferenceFile"]["abstract"]
-    
-    for n, ts in enumerate(ts_list):
-        error_code = False
-        print("Preparing Series " + str(n + 1), end=" ")
-        return_type = (ts["requestInfo"]["returnType"])
-        site_code = ts["site"]["siteCode"]
-        variable_code = ts["variable"]["variableCode"]
-        start_date = ts["beginDate"]
-        end_date = ts["endDate"]
-        url = ts["requestInfo"]["url"]
-        autho_token = ""
-        
-        # -------------------------- #
-        #   Downloads WaterML Data   #
-        # -------------------------- #
+    import numpy
+
+    sf_tree = search_wml(wml_tree, ns, ["sourceInfo"], get_tree=True)
+    vr_tree = search_wml(wml_tree, ns, ["variable"], get_tree=True)
+    ut_tree = search_wml(vr_tree, ns, ["unit"], get_tree=True)
+    tu_tree = search_wml(vr_tree, ns, ["timeScale"], get_tree=True)
+    sr_tree = search_wml(wml_tree, ns, ["source"], get_tree=True)
+    pl_trees = search_wml(wml_tree, ns, ["qualityControlLevel"], get_tree=True, mult=True)
+    md_trees = search_wml(wml_tree, ns, ["method"], get_tree=True, mult=True)
+
+    def parse_unit(unit_tree):
+        unit_code = search_wml(unit_tree, ns, ["unitCode", "UnitCode", "unitsCode", "UnitsCode"], default_value=9999)
+        return {
+            "unit_code": unit_code,
+            "unit_type": search_wml(unit_tree, ns, ["unitType", "unitsType", "UnitType", "UnitsType"], default_value="other") if unit_code != 9999 else "other",
+            "unit_abbreviation": search_wml(unit_tree, ns, ["unitAbbreviation", "unitsAbbreviation", "UnitAbbreviation", "UnitsAbbreviation"], default_value="unknown") if unit_code != 9999 else "unknown",
+            "unit_name": search_wml(unit_tree, ns, ["unitName", "unitsName", "UnitName", "UnitsName"], default_value="unknown") if unit_code != 9999 else "unknown",
+            "unit_link": search_wml(unit_tree, ns, ["unitLink", "unitsLink", "UnitLink", "UnitsLink"], default_value=None) if unit_code != 9999 else None,
+        }
 
-        try:
+    organization_code = search_wml(sr_tree, ns, ["sourceCode"], default_value="unknown")
+    value_elements = list(wml_tree.iter(ns + "value"))
+
+    series = {
+        "site": {
+            "site_code": search_wml(sf_tree, ns, ["siteCode"], default_value=None),
+            "site_name": search_wml(sf_tree, ns, ["siteName"], default_value=None),
+            "latitude": search_wml(sf_tree, ns, ["latitude"], default_value=None),
+            "longitude": search_wml(sf_tree, ns, ["longitude"], default_value=None),
+            "elevation_m": search_wml(sf_tree, ns, ["elevation_m"], default_value=None),
+            "vertical_datum": search_wml(sf_tree, ns, ["verticalDatum"], default_value=None),
+            "srs_code": search_wml(sf_tree, ns, ["geogLocation"], default_value="EPSG:4269", attr="srs"),
+        },
+        "variable": {
+            "variable_code": search_wml(vr_tree, ns, ["variableCode", "VariableCode"], default_value=None),
+            "variable_name": search_wml(vr_tree, ns, ["variableName", "VariableName"], default_value="Unknown"),
+            "variable_description": search_wml(vr_tree, ns, ["variableDescription", "VariableDescription"], default_value=None),
+            "speciation": search_wml(vr_tree, ns, ["speciation", "Speciation"], default_value=None),
+            "no_data_value": search_wml(vr_tree, ns, ["noDataValue", "NoDataValue"], default_value=-9999),
+            "sample_medium": search_wml(vr_tree, ns, ["sampleMedium"], default_value="unknown"),
+        },
+        "unit": parse_unit(ut_tree),
+        "time_unit": parse_unit(tu_tree),
+        "source": {
+            "contact_name": search_wml(sr_tree, ns, ["contactName"], default_value="unknown"),
+            "organization_code": organization_code,
+            "organization": search_wml(sr_tree, ns, ["organization"], default_value="unknown") if organization_code != "unknown" else "unknown",
+            "source_description": search_wml(sr_tree, ns, ["sourceDescription"], default_value=None) if organization_code != "unknown" else None,
+            "source_link": search_wml(sr_tree, ns, ["sourceLink"], default_value=None) if organization_code != "unknown" else None,
+            "phone": search_wml(sr_tree, ns, ["phone"], default_value=None),
+            "email": search_wml(sr_tree, ns, ["email"], default_value="unknown"),
+            "address": search_wml(sr_tree, ns, ["address"], default_value=None),
+        },
+        "processing_levels": [{
+            "processing_level_code": search_wml(pl_tree, ns, ["qualityControlLevelCode"], default_value=9999),
+            "definition": search_wml(pl_tree, ns, ["definition"], None),
+            "explanation": search_wml(pl_tree, ns, ["explanation"], None),
+        } for pl_tree in pl_trees] if pl_trees else [{
+            "processing_level_code": 9999,
+            "definition": None,
+            "explanation": None,
+        }],
+        "methods": [{
+            "method_code": search_wml(md_tree, ns, ["methodCode", "MethodCode"], default_value=9999),
+            "method_description": search_wml(md_tree, ns, ["methodDescription", "MethodDescription"], None),
+            "method_link": search_wml(md_tree, ns, ["methodLink", "MethodLink"], None),
+        } for md_tree in md_trees] if md_trees else [{
+            "method_code": 9999,
+            "method_description": None,
+            "method_link": None,
+        }],
+        "values": {
+            "data_value": numpy.array([value.text for value in value_elements], dtype=numpy.float64),
+            "date_time": numpy.array([value.get("dateTime") for value in value_elements], dtype="U"),
+            "utc_offset": numpy.array([value.get("timeOffset") or "+00:00" for value in value_elements], dtype="U"),
+            "censor_code": numpy.array([value.get("censorCode") or "nc" for value in value_elements], dtype="U"),
+            "method_code": numpy.array([value.get("methodCode") or "" for value in value_elements], dtype="U"),
+        }
+    }
 
-            if return_type == "WaterML 1.1":
-                wml_version = "1.1"
-                ns = "{http://www.cuahsi.org/waterML/1.1/}"
-            elif return_type == "WaterML 1.0":
-                wml_version = "1.0"
-                ns = "{http://www.cuahsi.org/waterML/1.0/}"
-
-            response = requests.post(
-                url=url,
-                headers={
-                    "SOAPAction": "http://www.cuahsi.org/his/" + wml_version + "/ws/GetValuesObject",
-                    "Content-Type": "text/xml; charset=utf-8"
-                },
-                data = '<soap-env:Envelope xmlns:soap-env="http://schemas.xmlsoap.org/soap/envelope/">' + \
-                      '<soap-env:Body>' + \
-                        '<ns0:GetValuesObject xmlns:ns0="http://www.cuahsi.org/his/' + wml_version + '/ws/">' + \
-                          '<ns0:location>' + site_code + '</ns0:location>' + \
-                          '<ns0:variable>' + variable_code + '</ns0:variable>' + \
-                          '<ns0:startDate>' + start_date + '</ns0:startDate>' + \
-                          '<ns0:endDate>' + end_date + '</ns0:endDate>' + \
-                          '<ns0:authToken>' + autho_token + '</ns0:authToken>' + \
-                        '</ns0:GetValuesObject>' + \
-                      '</soap-env:Body>' + \
-                    '</soap-env:Envelope>'
-            )
+    return series
 
-            values_result = response.content
 
-        except:
-            print("FAILED TO DOWNLOAD WML")
-            sql_connect.rollback()
+def fetch_format_series(parser, request_ts, failed_urls):
+    """
+    Downloads and parses a referenced timeseries in one format. The requested period is split into the
+    windows its service can serve, as known to the service registry, and the windows are merged. When a
+    window times out, the registry narrows the safe window of the service, and the series is requested again
+    if that splits it further. The url of a service that fails or holds no values is added to failed_urls.
+
+    Arguments:      [parser, request_ts, failed_urls]
+    Returns:        [series]
+    Referenced By:  [fetch_series]
+    References:     [service_registry.get_request_windows, reconcile.merge_series]
+    Libraries:      [requests]
+    """
+
+    from .service_registry import get_request_windows
+    from .reconcile import merge_series
+
+    request_url = request_ts["requestInfo"]["url"]
+    host = get_service_host(request_url)
+    window_series = None
+    while window_series is None:
+        window_ts_list = get_request_windows(request_ts)
+        window_series = []
+        for window_ts in window_ts_list:
+            try:
+                with stage_timer("download", host=host, format=parser["format"]) as stage_record:
+                    values_result = parser["download"](window_ts)
+                    stage_record["bytes"] = len(values_result)
+            except Exception as ex:
+                record_error("download", request_url, ex)
+                print("FAILED TO DOWNLOAD " + parser["format"])
+                if not isinstance(ex, requests.Timeout) or \
+                        len(get_request_windows(request_ts)) <= len(window_ts_list):
+                    failed_urls.add(request_url)
+                    return None
+                window_series = None
+                break
+
+            try:
+                with stage_timer("parse", host=host, format=parser["format"]) as stage_record:
+                    series = parser["parse"](values_result, window_ts)
+                    if series is not None:
+                        stage_record["rows"] = len(series["values"]["date_time"])
+                    stage_record["bytes"] = len(values_result)
+            except Exception as ex:
+                record_error("parse", request_url, ex)
+                print("Unable to validate " + parser["format"])
+                failed_urls.add(request_url)
+                return None
+            if series is not None:
+                window_series.append(series)
+
+    if not window_series:
+        print("No timeseries data found")
+        failed_urls.add(request_url)
+        return None
+    if len(window_series) == 1:
+        return window_series[0]
+
+    series = merge_series(window_series)[0]
+    for dimension, code_key in (("methods", "method_code"), ("processing_levels", "processing_level_code")):
+        codes = set()
+        series[dimension] = [item for window in window_series for item in window[dimension]
+                             if not (item[code_key] in codes or codes.add(item[code_key]))]
+
+    return series
+
+
+def fetch_series(ts, failed_urls=None):
+    """
+    Gets a parsed series from the shared series store, or downloads, validates, and parses it and saves the
+    result to the store. Formats are tried from the cheapest to the most expensive, moving on to the next
+    when a download fails or holds no values. The urls of failed requests are added to failed_urls, so that
+    a failure can be told apart from a series without values.
+
+    Arguments:      [ts, failed_urls]
+    Returns:        [series]
+    Referenced By:  [create_ts_resource, update_ts_resource, reconcile.fetch_series_group]
+    References:     [load_series, save_series, parsers.get_format_requests, fetch_format_series]
+    Libraries:      []
+    """
+
+    from .series_store import load_series, save_series
+    from .parsers import get_format_requests
+
+    # -------------------------------------------- #
+    #   Loads Series from the Shared Series Store   #
+    # -------------------------------------------- #
+
+    series = load_series(ts)
+    if series is not None:
+        return series
+
+    # ---------------------------------------------------- #
+    #   Downloads and Parses the Cheapest Format Offered   #
+    # ---------------------------------------------------- #
+
+    url = ts["requestInfo"]["url"]
+    if failed_urls is None:
+        failed_urls = set()
+    format_requests = get_format_requests(ts)
+    if not format_requests:
+        record_error("download", url, Exception("Unsupported return type: " + str(ts["requestInfo"]["returnType"])))
+        print("FAILED TO DOWNLOAD WML")
+        failed_urls.add(url)
+        return None
+
+    # A service that failed one format, or found no data for it, is not asked for its other formats.
+    series = None
+    for parser, request_ts in format_requests:
+        if request_ts["requestInfo"]["url"] in failed_urls:
             continue
-            
-        
-        # --------------------------- #
-        #   Validates WaterML files   #
-        # --------------------------- #
-        
-        try:
-            wml_tree = etree.fromstring(values_result)
-            if not list(wml_tree.iter(ns + "values")):
-                print("No timeseries data found")
-                continue
-            if len(list(list(wml_tree.iter(ns + "values"))[0].iter(ns + "value"))) == 0:
-                print("No timeseries data found")
-                continue
-        except:
-            print("Unable to validate WML")
+        series = fetch_format_series(parser, request_ts, failed_urls)
+        if series is None:
             continue
-        
-        # ------------------------------------ #
-        #   Extracts Data for Datasets Table   #
-        # ------------------------------------ #
+        elif not series["site"]["site_code"]:
+            print("SF Failed")
+            failed_urls.add(request_ts["requestInfo"]["url"])
+            series = None
+        elif not series["variable"]["variable_code"]:
+            print("VR Failed")
+            failed_urls.add(request_ts["requestInfo"]["url"])
+            series = None
+        else:
+            break
 
-        dataset_code = 1
-        curs.execute("SELECT * FROM Datasets WHERE DataSetCode = ?", (dataset_code,))
-        row = curs.fetchone()
-        if not row:
-            dataset = (
-                str(uuid.uuid4()),
-                ("singleTimeSeries" if len(ts_list) == 1 else "multiTimeSeries"),
-                1,
-                res_title,
-                res_abstract,
-            )
+    if series is None:
+        return None
 
-            curs.execute("""INSERT INTO Datasets (
-                                DataSetID, 
-                                DataSetUUID, 
-                                DataSetTypeCV, 
-                                DataSetCode,
-                                DataSetTitle, 
-                                DataSetAbstract
-                            ) VALUES (NULL, ?, ?, ?, ?, ?)""", dataset)
-            dataset_id = curs.lastrowid
-        else:
-            dataset_id = row[0]
-
-        # -------------------------------------------- #
-        #   Extracts Data for SamplingFeatures Table   #
-        # -------------------------------------------- #
-
-        sf_tree = search_wml(wml_tree, ns, ["sourceInfo"], get_tree=True)
-        sampling_feature_code = search_wml(sf_tree, ns, ["siteCode"], default_value=None)
-        if sampling_feature_code:
-            curs.execute("SELECT * FROM SamplingFeatures WHERE SamplingFeatureCode = ?", (sampling_feature_code,))
-            row = curs.fetchone()
-            if not row:
-                sampling_feature = (
-                    str(uuid.uuid4()),
-                    "site",
-                    sampling_feature_code,
-                    search_wml(sf_tree, ns, ["siteName"], default_value=None),
-                    None,
-                    "point",
-                    None,
-                    'POINT ("' + search_wml(sf_tree, ns, ["latitude"], default_value=None) + '" "' + search_wml(sf_tree, ns, ["longitude"], default_value=None) + '")',
-                    search_wml(sf_tree, ns, ["elevation_m"], default_value=None),
-                    search_wml(sf_tree, ns, ["verticalDatum"], default_value=None),
-                )
-                curs.execute("""INSERT INTO SamplingFeatures (
-                                    SamplingFeatureID, 
-                                    SamplingFeatureUUID,
-                                    SamplingFeatureTypeCV, 
-                                    SamplingFeatureCode, 
-                                    SamplingFeatureName,
-                                    SamplingFeatureDescription, 
-                                    SamplingFeatureGeotypeCV, 
-                                    FeatureGeometry,
-                                    FeatureGeometryWKT, 
-                                    Elevation_m, 
-                                    ElevationDatumCV
-                                ) VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", sampling_feature)
-                sampling_feature_id = curs.lastrowid
-            else:
-                sampling_feature_id = row[0]
-        else:
-            print("SF Failed")
-            sql_connect.rollback()
-            continue
+    try:
+        save_series(ts, series)
+    except:
+        logger.error("Unable to save series to the series store: " + traceback.format_exc())
 
-        # --------------------------------------------- #
-        #   Extracts Data for SpatialReferences Table   #
-        # --------------------------------------------- #
+    return series
 
-        srs_code = search_wml(sf_tree, ns, ["geogLocation"], default_value="EPSG:4269", attr="srs")
-        curs.execute("SELECT * FROM SpatialReferences WHERE SRSCode = ?", (srs_code,))
-        row = curs.fetchone()
-        if not row:
-            spatial_reference = (
-                srs_code, 
-                srs_code, 
-                None,
-                None,
-            )
-            curs.execute("""INSERT INTO SpatialReferences(
-                            SpatialReferenceID, 
-                            SRSCode, 
-                            SRSName,
-                            SRSDescription, 
-                            SRSLink
-                        ) VALUES (NULL, ?, ?, ?, ?)""", spatial_reference)
-            spatial_reference_id = curs.lastrowid
-        else:
-            spatial_reference_id = row[0]
 
-        # --------------------------------- #
-        #   Extracts Data for Sites Table   #
-        # --------------------------------- #
+def should_store_epochs(res_data):
+    """
+    Checks whether the ODM2 database of a build should hold the UTC epoch seconds of each value, indexed per
+    Result for range queries: as res_data asks, or otherwise as the HS_RESOURCE_CREATOR_EPOCH_INDEX setting,
+    off by default, allows.
 
-        curs.execute("SELECT * FROM Sites WHERE SamplingFeatureID = ?", (sampling_feature_id,))
-        row = curs.fetchone()
-        if not row:
-            site = (
-                sampling_feature_id,
-                "unknown",
-                search_wml(sf_tree, ns, ["latitude"], default_value=None),
-                search_wml(sf_tree, ns, ["longitude"], default_value=None),
-                spatial_reference_id,
-            )
-            curs.execute("""INSERT INTO Sites(
-                            SamplingFeatureID, 
-                            SiteTypeCV, 
-                            Latitude, 
-                            Longitude,
-                            SpatialReferenceID
-                        ) VALUES (?, ?, ?, ?, ?)""", site)
-            site_id = curs.lastrowid
-        else:
-            site_id = row[0]
-
-        # ------------------------------------- #
-        #   Extracts Data for Variables Table   #
-        # ------------------------------------- #
-
-        vr_tree = search_wml(wml_tree, ns, ["variable"], get_tree=True)
-        variable_code = search_wml(vr_tree, ns, ["variableCode", "VariableCode"], default_value=None)
-        if variable_code:
-            curs.execute("SELECT * FROM Variables WHERE VariableCode = ?", (variable_code,))
-            row = curs.fetchone()
-            if not row:
-                variable = (
-                    "Unknown", 
-                    variable_code, 
-                    search_wml(vr_tree, ns, ["variableName", "VariableName"], default_value="Unknown"),
-                    search_wml(vr_tree, ns, ["variableDescription", "VariableDescription"], default_value=None),
-                    search_wml(vr_tree, ns, ["speciation", "Speciation"], default_value=None),
-                    search_wml(vr_tree, ns, ["noDataValue", "NoDataValue"], default_value=-9999),
-                )
-                curs.execute("""INSERT INTO Variables (
-                                VariableID, 
-                                VariableTypeCV, 
-                                VariableCode, 
-                                VariableNameCV, 
-                                VariableDefinition, 
-                                SpeciationCV, 
-                                NoDataValue 
-                            ) VALUES (NULL, ?, ?, ?, ?, ?, ?)""", variable)
-                variable_id = curs.lastrowid
-            else:
-                variable_id = row[0]
+    Arguments:      [res_data]
+    Returns:        [use_epochs]
+    Referenced By:  [create_ts_resource]
+    References:     []
+    Libraries:      []
+    """
+
+    if res_data.get("epoch_index") is not None:
+        return bool(res_data.get("epoch_index"))
+
+    return bool(getattr(settings, "HS_RESOURCE_CREATOR_EPOCH_INDEX", False))
+
+
+def add_epoch_column(res_filepath):
+    """
+    Adds the UTC epoch column, and an index on it per Result, to an empty ODM2 database. Values are written
+    in UTC order, so the index is appended to rather than rebuilt as a build goes.
+
+    Arguments:      [res_filepath]
+    Returns:        []
+    Referenced By:  [create_ts_resource]
+    References:     [has_epoch_column]
+    Libraries:      [sqlite3]
+    """
+
+    sql_connect = sqlite3.connect(res_filepath, isolation_level=None)
+    curs = sql_connect.cursor()
+    if not has_epoch_column(curs):
+        curs.execute("ALTER TABLE TimeSeriesResultValues ADD COLUMN " + EPOCH_COLUMN + " INTEGER NULL")
+    curs.execute("CREATE INDEX IF NOT EXISTS IX_TimeSeriesResultValues_ResultID_Epoch "
+                 "ON TimeSeriesResultValues (ResultID, " + EPOCH_COLUMN + ")")
+    sql_connect.close()
+
+
+def has_epoch_column(curs):
+    return EPOCH_COLUMN in [row[1] for row in curs.execute("PRAGMA table_info(TimeSeriesResultValues)").fetchall()]
+
+
+def get_value_rows(result_id, values, epochs=None):
+    """
+    Builds the TimeSeriesResultValues rows of a Result from value columns. UTC offsets and censor codes that
+    are the same for every value are repeated rather than converted to a string per value.
+
+    Arguments:      [result_id, values, epochs]
+    Returns:        [value_rows]
+    Referenced By:  [write_odm2_series, update_ts_resource]
+    References:     []
+    Libraries:      [itertools]
+    """
+
+    columns = [itertools.repeat(result_id), values["data_value"].tolist(), values["date_time"].tolist()]
+    for column in ("utc_offset", "censor_code"):
+        column_values = values[column]
+        if len(column_values) and (column_values == column_values[0]).all():
+            columns.append(itertools.repeat(str(column_values[0])))
         else:
-            print("VR Failed")
-            sql_connect.rollback()
-            continue
+            columns.append(column_values.tolist())
+    columns += [itertools.repeat("unknown"), itertools.repeat("unknown"), itertools.repeat("unknown")]
+    if epochs is not None:
+        columns.append(epochs.tolist())
+
+    return zip(*columns)
+
+
+def insert_values(curs, value_rows, store_epochs=False):
+    """
+    Inserts rows from get_value_rows into TimeSeriesResultValues, with their UTC epoch seconds if asked.
+
+    Arguments:      [curs, value_rows, store_epochs]
+    Returns:        []
+    Referenced By:  [write_odm2_series, update_ts_resource]
+    References:     []
+    Libraries:      [sqlite3]
+    """
+
+    epoch_column = ", " + EPOCH_COLUMN if store_epochs else ""
+    epoch_parameter = ", ?" if store_epochs else ""
+    curs.executemany("""INSERT INTO TimeSeriesResultValues (
+                        ValueID,
+                        ResultID,
+                        DataValue,
+                        ValueDateTime,
+                        ValueDateTimeUTCOffset,
+                        CensorCodeCV,
+                        QualityCodeCV,
+                        TimeAggregationInterval,
+                        TimeAggregationIntervalUnitsID""" + epoch_column + """
+                    ) VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?""" + epoch_parameter + ")", value_rows)
+
+
+def write_odm2_series(curs, series, dataset):
+    """
+    Writes a parsed series into an open ODM2 database, reusing existing dimension rows. Values are sorted by
+    UTC time and de-duplicated first, and written with their UTC epoch seconds when the database has the
+    column for them.
+
+    Arguments:      [curs, series, dataset]
+    Returns:        [result_ids]
+    Referenced By:  [create_ts_resource, update_ts_resource, odm2_shards.build_odm2_shard]
+    References:     [get_value_rows, insert_values, has_epoch_column, timeseries.normalize_values,
+                     metrics.stage_timer, metrics.observe_stage]
+    Libraries:      [sqlite3, itertools, time]
+    """
+
+    from .timeseries import normalize_values
+
+    site = series["site"]
+    variable = series["variable"]
+    source = series["source"]
+    with stage_timer("normalize") as stage_record:
+        values, epochs = normalize_values(series["values"])
+        stage_record["rows"] = len(epochs)
+    duplicate_count = len(series["values"]["date_time"]) - len(epochs)
+    if duplicate_count:
+        logger.info("Dropped %d duplicate values of %s" % (duplicate_count, site["site_code"]))
+    lookup_start_time = time.time()
+
+    # ------------------------------------ #
+    #   Extracts Data for Datasets Table   #
+    # ------------------------------------ #
+
+    dataset_code = 1
+    curs.execute("SELECT * FROM Datasets WHERE DataSetCode = ?", (dataset_code,))
+    row = curs.fetchone()
+    if not row:
+        curs.execute("""INSERT INTO Datasets (
+                            DataSetID,
+                            DataSetUUID,
+                            DataSetTypeCV,
+                            DataSetCode,
+                            DataSetTitle,
+                            DataSetAbstract
+                        ) VALUES (NULL, ?, ?, ?, ?, ?)""", dataset)
+        dataset_id = curs.lastrowid
+    else:
+        dataset_id = row[0]
+
+    # -------------------------------------------- #
+    #   Extracts Data for SamplingFeatures Table   #
+    # -------------------------------------------- #
+
+    curs.execute("SELECT * FROM SamplingFeatures WHERE SamplingFeatureCode = ?", (site["site_code"],))
+    row = curs.fetchone()
+    if not row:
+        sampling_feature = (
+            str(uuid.uuid4()),
+            "site",
+            site["site_code"],
+            site["site_name"],
+            None,
+            "point",
+            None,
+            'POINT ("' + site["latitude"] + '" "' + site["longitude"] + '")',
+            site["elevation_m"],
+            site["vertical_datum"],
+        )
+        curs.execute("""INSERT INTO SamplingFeatures (
+                            SamplingFeatureID,
+                            SamplingFeatureUUID,
+                            SamplingFeatureTypeCV,
+                            SamplingFeatureCode,
+                            SamplingFeatureName,
+                            SamplingFeatureDescription,
+                            SamplingFeatureGeotypeCV,
+                            FeatureGeometry,
+                            FeatureGeometryWKT,
+                            Elevation_m,
+                            ElevationDatumCV
+                        ) VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", sampling_feature)
+        sampling_feature_id = curs.lastrowid
+    else:
+        sampling_feature_id = row[0]
+
+    # --------------------------------------------- #
+    #   Extracts Data for SpatialReferences Table   #
+    # --------------------------------------------- #
+
+    srs_code = site["srs_code"]
+    curs.execute("SELECT * FROM SpatialReferences WHERE SRSCode = ?", (srs_code,))
+    row = curs.fetchone()
+    if not row:
+        spatial_reference = (
+            srs_code,
+            srs_code,
+            None,
+            None,
+        )
+        curs.execute("""INSERT INTO SpatialReferences(
+                        SpatialReferenceID,
+                        SRSCode,
+                        SRSName,
+                        SRSDescription,
+                        SRSLink
+                    ) VALUES (NULL, ?, ?, ?, ?)""", spatial_reference)
+        spatial_reference_id = curs.lastrowid
+    else:
+        spatial_reference_id = row[0]
+
+    # --------------------------------- #
+    #   Extracts Data for Sites Table   #
+    # --------------------------------- #
+
+    curs.execute("SELECT * FROM Sites WHERE SamplingFeatureID = ?", (sampling_feature_id,))
+    row = curs.fetchone()
+    if not row:
+        site_row = (
+            sampling_feature_id,
+            "unknown",
+            site["latitude"],
+            site["longitude"],
+            spatial_reference_id,
+        )
+        curs.execute("""INSERT INTO Sites(
+                        SamplingFeatureID,
+                        SiteTypeCV,
+                        Latitude,
+                        Longitude,
+                        SpatialReferenceID
+                    ) VALUES (?, ?, ?, ?, ?)""", site_row)
+
+    # ------------------------------------- #
+    #   Extracts Data for Variables Table   #
+    # ------------------------------------- #
+
+    curs.execute("SELECT * FROM Variables WHERE VariableCode = ?", (variable["variable_code"],))
+    row = curs.fetchone()
+    if not row:
+        variable_row = (
+            "Unknown",
+            variable["variable_code"],
+            variable["variable_name"],
+            variable["variable_description"],
+            variable["speciation"],
+            variable["no_data_value"],
+        )
+        curs.execute("""INSERT INTO Variables (
+                        VariableID,
+                        VariableTypeCV,
+                        VariableCode,
+                        VariableNameCV,
+                        VariableDefinition,
+                        SpeciationCV,
+                        NoDataValue
+                    ) VALUES (NULL, ?, ?, ?, ?, ?, ?)""", variable_row)
+        variable_id = curs.lastrowid
+    else:
+        variable_id = row[0]
 
-        # --------------------------------- #
-        #   Extracts Data for Units Table   #
-        # --------------------------------- #
+    # ---------------------------------------------------------- #
+    #   Extracts Data for Units Table and Time Spacing Units     #
+    # ---------------------------------------------------------- #
 
-        ut_tree = search_wml(vr_tree, ns, ["unit"], get_tree=True)
-        unit_code = search_wml(ut_tree, ns, ["unitCode", "UnitCode", "unitsCode", "UnitsCode"], default_value=9999)
-        curs.execute("SELECT * FROM Units WHERE UnitsID = ?", (unit_code,))
+    unit_ids = []
+    for unit in (series["unit"], series["time_unit"]):
+        curs.execute("SELECT * FROM Units WHERE UnitsID = ?", (unit["unit_code"],))
         row = curs.fetchone()
         if not row:
-            unit = (
-                unit_code,
-                search_wml(ut_tree, ns, ["unitType", "unitsType", "UnitType", "UnitsType"], default_value="other") if unit_code != 9999 else "other",
-                search_wml(ut_tree, ns, ["unitAbbreviation", "unitsAbbreviation", "UnitAbbreviation", "UnitsAbbreviation"], default_value="unknown") if unit_code != 9999 else "unknown",
-                search_wml(ut_tree, ns, ["unitName", "unitsName", "UnitName", "UnitsName"], default_value="unknown") if unit_code != 9999 else "unknown",
-                search_wml(ut_tree, ns, ["unitLink", "unitsLink", "UnitLink", "UnitsLink"], default_value=None) if unit_code != 9999 else None,
+            unit_row = (
+                unit["unit_code"],
+                unit["unit_type"],
+                unit["unit_abbreviation"],
+                unit["unit_name"],
+                unit["unit_link"],
             )
             curs.execute("""INSERT INTO Units (
-                            UnitsID, 
-                            UnitsTypeCV, 
-                            UnitsAbbreviation, 
+                            UnitsID,
+                            UnitsTypeCV,
+                            UnitsAbbreviation,
                             UnitsName,
                             UnitsLink
-                        ) VALUES (?, ?, ?, ?, ?)""", unit)
-            unit_id = curs.lastrowid
+                        ) VALUES (?, ?, ?, ?, ?)""", unit_row)
+            unit_ids.append(curs.lastrowid)
         else:
-            unit_id = row[0]
+            unit_ids.append(row[0])
+    unit_id = unit_ids[0]
+
+    # ------------------------------------------------------------------- #
+    #   Extracts Data for People, Organizations, and Affiliations Table   #
+    # ------------------------------------------------------------------- #
+
+    curs.execute("SELECT * FROM People WHERE PersonFirstName = ?", (source["contact_name"],))
+    row = curs.fetchone()
+    if not row:
+        person = (
+            source["contact_name"],
+            " ",
+        )
+        curs.execute("""INSERT INTO People (
+                        PersonID,
+                        PersonFirstName,
+                        PersonLastName
+                    ) VALUES (NULL, ?, ?)""", person)
+        person_id = curs.lastrowid
+    else:
+        person_id = row[0]
+    curs.execute("SELECT * FROM Organizations WHERE OrganizationCode = ?", (source["organization_code"],))
+    row = curs.fetchone()
+    if not row:
+        organization = (
+            "unknown",
+            source["organization_code"],
+            source["organization"],
+            source["source_description"],
+            source["source_link"],
+        )
+        curs.execute("""INSERT INTO Organizations (
+                        OrganizationID,
+                        OrganizationTypeCV,
+                        OrganizationCode,
+                        OrganizationName,
+                        OrganizationDescription,
+                        OrganizationLink
+                    ) VALUES (NULL, ?, ?, ?, ?, ?)""", organization)
+        organization_id = curs.lastrowid
+    else:
+        organization_id = row[0]
+    curs.execute("SELECT * FROM Affiliations WHERE PersonID = ? AND OrganizationID = ?", (person_id, organization_id,))
+    row = curs.fetchone()
+    if not row:
+        affiliation = (
+            person_id,
+            organization_id,
+            "unknown",
+            source["phone"],
+            source["email"],
+            source["address"],
+        )
+        curs.execute("""INSERT INTO Affiliations (
+                        AffiliationID,
+                        PersonID,
+                        OrganizationID,
+                        AffiliationStartDate,
+                        PrimaryPhone,
+                        PrimaryEmail,
+                        PrimaryAddress
+                    ) VALUES (NULL, ?, ?, ?, ?, ?, ?)""", affiliation)
+        affiliation_id = curs.lastrowid
+    else:
+        affiliation_id = row[0]
 
-        # ------------------------------------------ #
-        #    Extracts Data for Time Spacing Units    #
-        # ------------------------------------------ #
+    # -------------------------------------------- #
+    #   Extracts Data for ProcessingLevels Table   #
+    # -------------------------------------------- #
 
-        tu_tree = search_wml(vr_tree, ns, ["timeScale"], get_tree=True)
-        time_unit_code = search_wml(tu_tree, ns, ["unitCode", "UnitCode", "unitsCode", "UnitsCode"], default_value=9999)
-        curs.execute("SELECT * FROM Units WHERE UnitsID = ?", (time_unit_code,))
+    processing_level_ids = []
+    for processing_level_data in series["processing_levels"]:
+        processing_level_code = processing_level_data["processing_level_code"]
+        curs.execute("SELECT * FROM ProcessingLevels WHERE ProcessingLevelCode = ?", (processing_level_code,))
         row = curs.fetchone()
         if not row:
-            time_unit = (
-                time_unit_code,
-                search_wml(tu_tree, ns, ["unitType", "unitsType", "UnitType", "UnitsType"], default_value="other") if time_unit_code != 9999 else "other",
-                search_wml(tu_tree, ns, ["unitAbbreviation", "unitsAbbreviation", "UnitAbbreviation", "UnitsAbbreviation"], default_value="unknown") if time_unit_code != 9999 else "unknown",
-                search_wml(tu_tree, ns, ["unitName", "unitsName", "UnitName", "UnitsName"], default_value="unknown") if time_unit_code != 9999 else "unknown",
-                search_wml(tu_tree, ns, ["unitLink", "unitsLink", "UnitLink", "UnitsLink"], default_value=None) if time_unit_code != 9999 else None,
+            processing_level = (
+                processing_level_code,
+                processing_level_data["definition"] if processing_level_code != 9999 else None,
+                processing_level_data["explanation"] if processing_level_code != 9999 else None,
             )
-            curs.execute("""INSERT INTO Units (
-                            UnitsID, 
-                            UnitsTypeCV, 
-                            UnitsAbbreviation, 
-                            UnitsName,
-                            UnitsLink
-                        ) VALUES (?, ?, ?, ?, ?)""", time_unit)
-            time_unit_id = curs.lastrowid
+            curs.execute("""INSERT INTO ProcessingLevels (
+                            ProcessingLevelID,
+                            ProcessingLevelCode,
+                            Definition,
+                            Explanation
+                        ) VALUES (NULL, ?, ?, ?)""", processing_level)
+            processing_level_ids.append(curs.lastrowid)
         else:
-            time_unit_id = row[0]
+            processing_level_ids.append(row[0])
 
-        # ------------------------------------------------------------------- #
-        #   Extracts Data for People, Organizations, and Affiliations Table   #
-        # ------------------------------------------------------------------- #
+    # -------------------------------------------------------------------------- #
+    #   Extracts Data for Methods, Actions, ActionBy, and FeatureActions Table   #
+    # -------------------------------------------------------------------------- #
 
-        sr_tree = search_wml(wml_tree, ns, ["source"], get_tree=True)
-        person_name = search_wml(sr_tree, ns, ["contactName"], default_value="unknown")
-        curs.execute("SELECT * FROM People WHERE PersonFirstName = ?", (person_name,))
+    method_results = []
+    for method_data in series["methods"]:
+        method_code = method_data["method_code"]
+        curs.execute("SELECT * FROM Methods WHERE MethodCode = ?", (method_code,))
         row = curs.fetchone()
         if not row:
-            person = (
-                person_name,
-                " ",
+            method = (
+                "observation" if method_code != 9999 else "unknown",
+                method_code,
+                method_code if method_code != 9999 else "unknown",
+                method_data["method_description"] if method_code != 9999 else None,
+                method_data["method_link"] if method_code != 9999 else None,
             )
-            curs.execute("""INSERT INTO People (
-                            PersonID, 
-                            PersonFirstName, 
-                            PersonLastName
-                        ) VALUES (NULL, ?, ?)""", person)
-            person_id = curs.lastrowid
+            curs.execute("""INSERT INTO Methods (
+                            MethodID,
+                            MethodTypeCV,
+                            MethodCode,
+                            MethodName,
+                            MethodDescription,
+                            MethodLink
+                        ) VALUES (NULL, ?, ?, ?, ?, ?)""", method)
+            method_id = curs.lastrowid
         else:
-            person_id = row[0]
-        organization_code = search_wml(sr_tree, ns, ["sourceCode"], default_value="unknown")
-        curs.execute("SELECT * FROM Organizations WHERE OrganizationCode = ?", (organization_code,))
-        row = curs.fetchone()
-        if not row:
-            organization = (
-                "unknown",
-                organization_code,
-                search_wml(sr_tree, ns, ["organization"], default_value="unknown") if organization_code != "unknown" else "unknown",
-                search_wml(sr_tree, ns, ["sourceDescription"], default_value=None) if organization_code != "unknown" else None,
-                search_wml(sr_tree, ns, ["sourceLink"], default_value=None) if organization_code != "unknown" else None,
-            )
-            curs.execute("""INSERT INTO Organizations (
-                            OrganizationID, 
-                            OrganizationTypeCV,
-                            OrganizationCode, 
-                            OrganizationName, 
-                            OrganizationDescription, 
-                            OrganizationLink
-                        ) VALUES (NULL, ?, ?, ?, ?, ?)""", organization)
-            organization_id = curs.lastrowid
+            method_id = row[0]
+        method_mask = (values["method_code"] == str(method_code)) | (values["method_code"] == "")
+        if not method_mask.any():
+            method_mask[:] = True
+        # Values are sorted by UTC time, so the first and last of a method are its true begin and end.
+        date_times = values["date_time"][method_mask]
+        utc_offsets = values["utc_offset"][method_mask]
+        action = (
+            "observation",
+            method_id,
+            date_times[0],
+            utc_offsets[0],
+            date_times[-1],
+            utc_offsets[-1],
+            "An observation action that generated a time series result.",
+        )
+        curs.execute("""INSERT INTO Actions (
+                        ActionID,
+                        ActionTypeCV,
+                        MethodID,
+                        BeginDateTime,
+                        BeginDateTimeUTCOffset,
+                        EndDateTime,
+                        EndDateTimeUTCOffset,
+                        ActionDescription
+                    ) VALUES (NULL, ?, ?, ?, ?, ?, ?, ?)""", action)
+        action_id = curs.lastrowid
+        action_by = (
+            action_id,
+            affiliation_id,
+            1,
+        )
+        curs.execute("""INSERT INTO ActionBy (
+                        BridgeID,
+                        ActionID,
+                        AffiliationID,
+                        IsActionLead
+                    ) VALUES (NULL, ?, ?, ?)""", action_by)
+        feature_action = (
+            sampling_feature_id,
+            action_id,
+        )
+        curs.execute("""INSERT INTO FeatureActions (
+                        FeatureActionID,
+                        SamplingFeatureID,
+                        ActionID
+                    ) VALUES (NULL, ?, ?)""", feature_action)
+        method_results.append({
+            "feature_action_id": curs.lastrowid,
+            "start_date": date_times[0],
+            "start_date_offset": utc_offsets[0],
+            "value_count": len(date_times)
+        })
+
+    # ----------------------------------------------------------------------------------------------------- #
+    #    Extracts Data for Results, TimeSeriesResults, TimeSeriesResultValues, and DataSetsResults Tables   #
+    # ----------------------------------------------------------------------------------------------------- #
+
+    observe_stage("dimension_lookup", time.time() - lookup_start_time, status="success")
+    store_epochs = has_epoch_column(curs)
+    result_ids = []
+    for method_result, processing_level_id in itertools.product(method_results, processing_level_ids):
+        result = (
+            str(uuid.uuid4()),
+            method_result["feature_action_id"],
+            "timeSeriesCoverage",
+            variable_id,
+            unit_id,
+            processing_level_id,
+            method_result["start_date"],
+            method_result["start_date_offset"],
+            None,
+            variable["sample_medium"],
+            method_result["value_count"],
+        )
+        curs.execute("""INSERT INTO Results (
+                        ResultID,
+                        ResultUUID,
+                        FeatureActionID,
+                        ResultTypeCV,
+                        VariableID,
+                        UnitsID,
+                        ProcessingLevelID,
+                        ResultDateTime,
+                        ResultDateTimeUTCOffset,
+                        StatusCV,
+                        SampledMediumCV,
+                        ValueCount
+                    ) VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", result)
+        result_id = curs.lastrowid
+        timeseries_result = (
+            result_id,
+            "Unknown",
+        )
+        curs.execute("""INSERT INTO TimeSeriesResults (
+                        ResultID,
+                        AggregationStatisticCV
+                    ) VALUES (?, ?)""", timeseries_result)
+        with stage_timer("value_insert") as stage_record:
+            insert_values(curs, get_value_rows(result_id, values, epochs if store_epochs else None), store_epochs)
+            stage_record["rows"] = len(values["date_time"])
+        dataset_result = (
+            dataset_id,
+            result_id,
+        )
+        curs.execute("""INSERT INTO DataSetsResults (
+                        BridgeID,
+                        DataSetID,
+                        ResultID
+                    ) Values (NULL, ?, ?)""", dataset_result)
+        result_ids.append(result_id)
+
+    return result_ids
+
+
+def get_referenced_series(form_body, series_id):
+    """
+    Gets one referenced timeseries from a posted refts form body.
+
+    Arguments:      [form_body, series_id]
+    Returns:        [ts]
+    Referenced By:  [controllers_ajax.ajax_preview_series]
+    References:     []
+    Libraries:      [json]
+    """
+
+    json_data = form_body
+    while not isinstance(json_data, dict):
+        json_data = json.loads(json_data)
+    json_data = json_data["timeSeriesReferenceFile"]
+    if not isinstance(json_data, dict):
+        json_data = json.loads(json_data)
+    ts = json_data["referencedTimeSeries"][series_id]
+
+    return ts
+
+
+def get_series_preview(ts, max_points=1000, method="lttb"):
+    """
+    Gets a server-side downsampled preview of a referenced timeseries as columnar data. No-data values are
+    dropped, and the remaining values are reduced to at most max_points points.
+
+    Arguments:      [ts, max_points, method]
+    Returns:        [preview]
+    Referenced By:  [controllers_ajax.ajax_preview_series]
+    References:     [fetch_series, timeseries.get_utc_epochs, timeseries.downsample_lttb,
+                     timeseries.downsample_min_max]
+    Libraries:      [numpy]
+    """
+
+    import numpy
+    from .timeseries import get_utc_epochs, downsample_lttb, downsample_min_max
+
+    series = fetch_series(ts)
+    if series is None:
+        return None
+
+    values = series["values"]
+    epochs = get_utc_epochs(values["date_time"], values["utc_offset"])
+    data_values = numpy.asarray(values["data_value"], dtype=numpy.float64)
+    try:
+        no_data_value = float(series["variable"]["no_data_value"])
+    except (TypeError, ValueError):
+        no_data_value = None
+    valid = numpy.isfinite(data_values)
+    if no_data_value is not None:
+        valid &= data_values != no_data_value
+    order = numpy.argsort(epochs[valid], kind="mergesort")
+    epochs = epochs[valid][order]
+    data_values = data_values[valid][order]
+
+    if method == "minmax":
+        indices = downsample_min_max(data_values, max_points)
+    else:
+        indices = downsample_lttb(epochs, data_values, max_points)
+
+    preview = {
+        "site_name": series["site"]["site_name"],
+        "variable_name": series["variable"]["variable_name"],
+        "unit": series["unit"]["unit_abbreviation"],
+        "value_count": int(len(epochs)),
+        "t": epochs[indices].tolist(),
+        "v": data_values[indices].tolist()
+    }
+
+    return preview
+
+
+def finalize_odm2_database(res_filepath):
+    """
+    Prepares a bulk-loaded ODM2 database for upload. Builds indexes for per-Result time range queries,
+    writes per-Result, daily, and monthly summary tables, refreshes query planner statistics, and compacts
+    the file.
+
+    Arguments:      [res_filepath]
+    Returns:        []
+    Referenced By:  [create_ts_resource, update_ts_resource, partitions.build_partition]
+    References:     []
+    Libraries:      [sqlite3]
+    """
+
+    sql_connect = sqlite3.connect(res_filepath, isolation_level=None)
+    curs = sql_connect.cursor()
+
+    # --------------------- #
+    #   Creates Indexes     #
+    # --------------------- #
+
+    curs.execute("BEGIN TRANSACTION;")
+    curs.execute("""CREATE INDEX IF NOT EXISTS IX_TimeSeriesResultValues_ResultID_ValueDateTime
+                    ON TimeSeriesResultValues (ResultID, ValueDateTime, DataValue)""")
+    curs.execute("CREATE INDEX IF NOT EXISTS IX_Results_FeatureActionID ON Results (FeatureActionID)")
+    curs.execute("CREATE INDEX IF NOT EXISTS IX_Results_VariableID ON Results (VariableID)")
+    curs.execute("CREATE INDEX IF NOT EXISTS IX_FeatureActions_SamplingFeatureID ON FeatureActions (SamplingFeatureID)")
+
+    # ---------------------------- #
+    #   Creates Summary Tables     #
+    # ---------------------------- #
+
+    valid_values = """FROM TimeSeriesResultValues
+                      JOIN Results ON TimeSeriesResultValues.ResultID = Results.ResultID
+                      JOIN Variables ON Results.VariableID = Variables.VariableID
+                      WHERE TimeSeriesResultValues.DataValue != Variables.NoDataValue"""
+    curs.execute("DROP TABLE IF EXISTS ResultSummaries")
+    curs.execute("""CREATE TABLE ResultSummaries (
+                        ResultID INTEGER NOT NULL PRIMARY KEY,
+                        ValueCount INTEGER NOT NULL,
+                        MinValue FLOAT NULL,
+                        MaxValue FLOAT NULL,
+                        MeanValue FLOAT NULL,
+                        BeginDateTime DATETIME NULL,
+                        EndDateTime DATETIME NULL
+                    )""")
+    curs.execute("""INSERT INTO ResultSummaries
+                    SELECT TimeSeriesResultValues.ResultID,
+                        COUNT(*),
+                        MIN(DataValue),
+                        MAX(DataValue),
+                        AVG(DataValue),
+                        MIN(ValueDateTime),
+                        MAX(ValueDateTime)
+                    """ + valid_values + """
+                    GROUP BY TimeSeriesResultValues.ResultID""")
+    # Results without a valid value still get a summary row, with no statistics and a zero count.
+    curs.execute("""INSERT INTO ResultSummaries (ResultID, ValueCount)
+                    SELECT ResultID, 0 FROM Results
+                    WHERE ResultID NOT IN (SELECT ResultID FROM ResultSummaries)""")
+    for summary_table, period_length in (("ResultDailySummaries", 10), ("ResultMonthlySummaries", 7)):
+        curs.execute("DROP TABLE IF EXISTS " + summary_table)
+        curs.execute("""CREATE TABLE """ + summary_table + """ (
+                            ResultID INTEGER NOT NULL,
+                            Period VARCHAR (10) NOT NULL,
+                            ValueCount INTEGER NOT NULL,
+                            MinValue FLOAT NULL,
+                            MaxValue FLOAT NULL,
+                            MeanValue FLOAT NULL,
+                            PRIMARY KEY (ResultID, Period)
+                        )""")
+        curs.execute("""INSERT INTO """ + summary_table + """
+                        SELECT TimeSeriesResultValues.ResultID,
+                            SUBSTR(ValueDateTime, 1, ?) AS Period,
+                            COUNT(*),
+                            MIN(DataValue),
+                            MAX(DataValue),
+                            AVG(DataValue)
+                        """ + valid_values + """
+                        GROUP BY TimeSeriesResultValues.ResultID, Period""", (period_length,))
+    sql_connect.commit()
+
+    # ------------------------------------- #
+    #   Updates Statistics and Compacts     #
+    # ------------------------------------- #
+
+    curs.execute("ANALYZE")
+    curs.execute("VACUUM")
+    sql_connect.close()
+
+
+def create_ts_resource(res_data):
+
+    from .exports import write_exports
+    from .odm2_shards import get_shard_count, build_sharded_odm2
+    from .preflight import should_preflight, preflight_series, PRUNED_STATUSES
+    from .reconcile import should_reconcile, group_series_ids, fetch_series_group
+    from .service_registry import schedule_service_refresh
+    from .partitions import get_partition_mode, split_partitions, build_partitions, write_manifest
+    from .deferred import get_build_deadline, fetch_groups_until
+
+    build_start = time.time()
+    refts_data = create_refts_resource(res_data)
+    refts_path = refts_data["res_filepath"]
+
+    print("Starting Transaction")
+
+    user_workspace = get_res_workspace(res_data)
+    output_formats = res_data.get("output_formats") or ["odm2"]
+    write_odm2 = "odm2" in output_formats
+    export_formats = [output_format for output_format in output_formats if output_format != "odm2"]
+    current_path = os.path.dirname(os.path.realpath(__file__))
+    odm_master = os.path.join(current_path, "static_data/ODM2_master.sqlite")
+    res_filepath = user_workspace + '/' + res_data['res_filename'] + '.odm2.sqlite'
+    series_count = 0
+    series_list = []
+    parse_status = []
+
+    with open(refts_path, "rb") as refts_file:
+        refts_data = json.load(refts_file)
+        ts_list = refts_data["timeSeriesReferenceFile"]["referencedTimeSeries"]
+        res_title = refts_data["timeSeriesReferenceFile"]["title"]
+        res_abstract = refts_data["timeSeriesReferenceFile"]["abstract"]
+    schedule_service_refresh(ts_list)
+
+    # Builds that store epochs write every database, shard, and partition from a copy of the template that
+    # has the epoch column.
+    epoch_master = None
+    if write_odm2 and should_store_epochs(res_data):
+        epoch_master = user_workspace + '/' + res_data['res_filename'] + '.template.sqlite'
+        shutil.copy(odm_master, epoch_master)
+        add_epoch_column(epoch_master)
+        odm_master = epoch_master
+
+    dataset = (
+        str(uuid.uuid4()),
+        ("singleTimeSeries" if len(ts_list) == 1 else "multiTimeSeries"),
+        1,
+        res_title,
+        res_abstract,
+    )
+
+    # ------------------------------------------------------- #
+    #   Prunes Empty and Unavailable Series Before Download   #
+    # ------------------------------------------------------- #
+
+    pruned_series = []
+    if should_preflight(res_data):
+        with stage_timer("preflight") as stage_record:
+            preflight_results = preflight_series(ts_list)
+            stage_record["rows"] = len(ts_list)
+        for n, (ts, preflight_result) in enumerate(zip(ts_list, preflight_results)):
+            if preflight_result["value_count"] is not None:
+                ts["valueCount"] = preflight_result["value_count"]
+            if preflight_result["status"] in PRUNED_STATUSES:
+                pruned_series.append({
+                    "series_id": n,
+                    "site_name": ts["site"].get("siteName"),
+                    "variable_name": ts["variable"].get("variableName"),
+                    "status": preflight_result["status"],
+                    "message": preflight_result["message"]
+                })
+    pruned_ids = set(pruned["series_id"] for pruned in pruned_series)
+    kept_ids = [n for n in range(len(ts_list)) if n not in pruned_ids]
+
+    series_groups = group_series_ids(ts_list, kept_ids, should_reconcile(res_data))
+    reconciled_series = []
+    partition_mode = get_partition_mode(res_data) if write_odm2 else None
+    partition_records = []
+
+    shard_count = get_shard_count(res_data.get("shards"), len(series_groups)) if write_odm2 else 1
+    if write_odm2 and partition_mode is None:
+        shutil.copy(odm_master, res_filepath)
+
+    # Only a single ODM2 database can be returned with the series fetched by the deadline and completed later;
+    # shards, partitions, and exports are built from every series.
+    deadline = get_build_deadline(res_data)
+    if deadline is not None and (partition_mode is not None or shard_count > 1 or output_formats != ["odm2"]):
+        logger.info("Build deadline ignored: only single ODM2 database builds can be completed later")
+        deadline = None
+    fetch_state = {"pending_groups": [], "thread": None}
+
+    if partition_mode is not None:
+
+        # ----------------------------------------------- #
+        #   Writes Series to Partitioned ODM2 Databases   #
+        # ----------------------------------------------- #
+
+        partitions = split_partitions(ts_list, series_groups, partition_mode)
+        partition_records, reconciled_series = build_partitions(
+            ts_list, dataset, odm_master, user_workspace + '/' + res_data['res_filename'], partitions,
+            get_shard_count(res_data.get("shards"), len(partitions)), res_data.get("finalize"))
+        res_filepath = write_manifest(user_workspace + '/' + res_data['res_filename'] + '.manifest.json',
+                                      res_title, partition_mode, partition_records)
+        written_ids = set(index for record in partition_records for index in record["series_ids"])
+        series_count = len(written_ids)
+        if export_formats:
+            for series_group in series_groups:
+                series_group = [n for n in series_group if n in written_ids]
+                if series_group:
+                    group_series, _ = fetch_series_group([ts_list[n] for n in series_group], series_group)
+                    series_list.extend(series for _, series in group_series)
+
+    elif shard_count > 1:
+
+        # ------------------------------------------- #
+        #   Writes Series to ODM2 Shards and Merges   #
+        # ------------------------------------------- #
+
+        series_indexes, reconciled_series = build_sharded_odm2(ts_list, dataset, odm_master, res_filepath,
+                                                               shard_count, series_groups)
+        series_count = len(series_indexes)
+        if export_formats:
+            written_ids = set(series_indexes)
+            for series_group in series_groups:
+                series_group = [n for n in series_group if n in written_ids]
+                if series_group:
+                    group_series, _ = fetch_series_group([ts_list[n] for n in series_group], series_group)
+                    series_list.extend(series for _, series in group_series)
+
+    else:
+        if write_odm2:
+            sql_connect = sqlite3.connect(res_filepath, isolation_level=None)
+            curs = sql_connect.cursor()
+
+        # ----------------------------------------- #
+        #   Fetches Series and Merges Overlapping   #
+        # ----------------------------------------- #
+
+        if deadline is not None:
+            fetched_groups = fetch_groups_until(ts_list, series_groups, build_start + deadline, fetch_state)
         else:
-            organization_id = row[0]
-        curs.execute("SELECT * FROM Affiliations WHERE PersonID = ? AND OrganizationID = ?", (person_id, organization_id,))
+            fetched_groups = ((series_group,) + fetch_series_group([ts_list[n] for n in series_group], series_group)
+                              for series_group in series_groups)
+
+        for _, group_series, group_records in fetched_groups:
+            reconciled_series.extend(group_records)
+
+            for series_ids, series in group_series:
+
+                # ----------------------------------- #
+                #   Writes Series to ODM2 Database    #
+                # ----------------------------------- #
+
+                if write_odm2:
+                    try:
+                        curs.execute("BEGIN TRANSACTION;")
+                        write_odm2_series(curs, series, dataset)
+                        with stage_timer("commit"):
+                            sql_connect.commit()
+                    except:
+                        print("Unable to write series")
+                        sql_connect.rollback()
+                        continue
+                # Series are only held for the columnar exports, so ODM2 builds keep one series at a time.
+                if export_formats:
+                    series_list.append(series)
+                series_count += len(series_ids)
+
+        if write_odm2:
+            sql_connect.close()
+
+    pending_ids = [n for series_group in fetch_state["pending_groups"] for n in series_group]
+    if pending_ids:
+        logger.info("Build deadline of %s seconds reached with %d series pending" % (deadline, len(pending_ids)))
+
+    if write_odm2 and partition_mode is None:
+        if res_data.get("finalize") and series_count > 0:
+            with stage_timer("finalize"):
+                finalize_odm2_database(res_filepath)
+    if epoch_master is not None:
+        os.remove(epoch_master)
+
+    print("Database Created Successfully")
+    print(series_count)
+
+    # ---------------------------------- #
+    #   Writes Columnar Export Formats   #
+    # ---------------------------------- #
+
+    with stage_timer("export") as stage_record:
+        export_filepaths = write_exports(series_list, output_formats, user_workspace + '/' + res_data['res_filename'])
+        stage_record["bytes"] = sum(os.path.getsize(export_filepath) for export_filepath in export_filepaths)
+    file_extension = ".odm2.sqlite"
+    if partition_mode is not None:
+        export_filepaths = [record["filepath"] for record in partition_records] + export_filepaths
+        file_extension = ".manifest.json"
+    elif not write_odm2:
+        # Without an ODM2 database, the refts of the series is the main file of the resource, next to the exports.
+        res_filepath = refts_path
+        file_extension = ".refts.json"
+        if series_count > 0 and not export_filepaths:
+            parse_status.append({"res_name": "export files", "res_status": "Export failed"})
+
+    return_obj = {
+        "res_type": "CompositeResource",
+        "res_filepath": res_filepath,
+        "export_filepaths": export_filepaths,
+        "file_extension": file_extension,
+        "series_count": series_count,
+        "parse_status": parse_status,
+        "pruned_series": pruned_series,
+        "reconciled_series": reconciled_series,
+        "partitions": [dict((key, record[key]) for key in ("file_name", "key", "value_count", "size_bytes"))
+                       for record in partition_records],
+        "pending_series": [{
+            "series_id": n,
+            "site_name": ts_list[n]["site"].get("siteName"),
+            "variable_name": ts_list[n]["variable"].get("variableName")
+        } for n in pending_ids],
+        "pending_ids": pending_ids,
+        "fetch_state": fetch_state
+    }
+
+    return return_obj
+
+
+def update_ts_resource(res_data):
+    """
+    Appends new values to the ODM2 database of an existing HydroShare resource. The last ValueDateTime of
+    each Result is read from the downloaded database, and only values after that point, up to the current
+    time rather than the end of the refts window, are fetched and appended. The downloaded file is also kept
+    as backup_filepath, to restore if the upload fails. Series without a matching Result, and with new_series
+    in res_data every selected series, are fetched in full and written as new Results. New values are
+    compared and ordered by UTC time, and a series whose download fails is reported as failed.
+
+    Arguments:      [res_data]
+    Returns:        [return_obj]
+    Referenced By:  [controllers_ajax.ajax_create_resource, deferred.finish_deferred_build]
+    References:     [create_refts_resource, fetch_series, write_odm2_series, get_value_rows, insert_values,
+                     has_epoch_column, reconcile.group_series_ids, reconcile.fetch_series_group,
+                     timeseries.normalize_values, timeseries.get_utc_epochs]
+    Libraries:      [sqlite3]
+    """
+
+    from .reconcile import should_reconcile, group_series_ids, fetch_series_group
+    from .timeseries import normalize_values, get_utc_epochs
+
+    refts_data = create_refts_resource(res_data)
+    refts_path = refts_data["res_filepath"]
+
+    hs_api = res_data["hs_api"]
+    resource_id = res_data["res_id"]
+    user_workspace = get_res_workspace(res_data)
+    series_count = 0
+    parse_status = []
+
+    # --------------------------------- #
+    #   Downloads Existing ODM2 File    #
+    # --------------------------------- #
+
+    res_filename = None
+    for resource_file in hs_api.getResourceFileList(resource_id):
+        file_name = resource_file.get("file_name") or str(resource_file["url"]).split("/")[-1]
+        if file_name.endswith(".odm2.sqlite"):
+            res_filename = file_name
+            break
+    if res_filename is None:
+        raise Exception("No ODM2 database found in resource " + str(resource_id))
+    res_filepath = hs_api.getResourceFile(resource_id, res_filename, destination=user_workspace)
+
+    # The downloaded file is kept unchanged, under its own name, so that it can be restored if the upload of
+    # the updated file fails after the original was removed from the resource.
+    backup_path = os.path.join(user_workspace, "original")
+    if not os.path.isdir(backup_path):
+        os.makedirs(backup_path)
+    backup_filepath = os.path.join(backup_path, res_filename)
+    shutil.copy(res_filepath, backup_filepath)
+    sql_connect = sqlite3.connect(res_filepath, isolation_level=None)
+    curs = sql_connect.cursor()
+    store_epochs = has_epoch_column(curs)
+
+    with open(refts_path, "rb") as refts_file:
+        refts_data = json.load(refts_file)
+        ts_list = refts_data["timeSeriesReferenceFile"]["referencedTimeSeries"]
+    new_ids = []
+
+    # ------------------------------------ #
+    #   Reads Last Value of Each Result    #
+    # ------------------------------------ #
+
+    curs.execute("""SELECT Results.ResultID,
+                        SamplingFeatures.SamplingFeatureCode,
+                        Variables.VariableCode,
+                        FeatureActions.ActionID
+                    FROM Results
+                    JOIN FeatureActions ON Results.FeatureActionID = FeatureActions.FeatureActionID
+                    JOIN SamplingFeatures ON FeatureActions.SamplingFeatureID = SamplingFeatures.SamplingFeatureID
+                    JOIN Variables ON Results.VariableID = Variables.VariableID""")
+    result_list = []
+    for result_id, site_code, variable_code, action_id in curs.fetchall():
+        curs.execute("""SELECT ValueDateTime, ValueDateTimeUTCOffset
+                        FROM TimeSeriesResultValues
+                        WHERE ResultID = ?
+                        ORDER BY """ + (EPOCH_COLUMN if store_epochs else "ValueDateTime") + """ DESC LIMIT 1""",
+                     (result_id,))
         row = curs.fetchone()
-        if not row:
-            affiliation = (
-                person_id,
-                organization_id,
-                "unknown",
-                search_wml(sr_tree, ns, ["phone"], default_value=None),
-                search_wml(sr_tree, ns, ["email"], default_value="unknown"),
-                search_wml(sr_tree, ns, ["address"], default_value=None),
-            )
-            curs.execute("""INSERT INTO Affiliations (
-                            AffiliationID, 
-                            PersonID, 
-                            OrganizationID,
-                            AffiliationStartDate, 
-                            PrimaryPhone, 
-                            PrimaryEmail,
-                            PrimaryAddress
-                        ) VALUES (NULL, ?, ?, ?, ?, ?, ?)""", affiliation)
-            affiliation_id = curs.lastrowid
-        else:
-            affiliation_id = row[0]
-
-        # -------------------------------------------- #
-        #   Extracts Data for ProcessingLevels Table   #
-        # -------------------------------------------- #
-
-        pl_trees = search_wml(wml_tree, ns, ["qualityControlLevel"], get_tree=True, mult=True)
-        processing_level_data_list = [{"processing_level_code": search_wml(pl_tree, ns, ["qualityControlLevelCode"], default_value=9999), "processing_level_tree": pl_tree, "processing_level_id": None} for pl_tree in pl_trees] if pl_trees else [{"processing_level_code": 9999, "processing_level_tree": None, "processing_level_id": None}]
-        for processing_level_data in processing_level_data_list:
-            curs.execute("SELECT * FROM ProcessingLevels WHERE ProcessingLevelCode = ?", (processing_level_data["processing_level_code"],))
-            row = curs.fetchone()
-            if not row:
-                processing_level = (
-                    processing_level_data["processing_level_code"],
-                    search_wml(processing_level_data["processing_level_tree"], ns, ["definition"], None) if processing_level_data["processing_level_code"] != 9999 else None,
-                    search_wml(processing_level_data["processing_level_tree"], ns, ["explanation"], None) if processing_level_data["processing_level_code"] != 9999 else None,
-                )
-                curs.execute("""INSERT INTO ProcessingLevels (
-                                ProcessingLevelID, 
-                                ProcessingLevelCode,
-                                Definition, 
-                                Explanation
-                            ) VALUES (NULL, ?, ?, ?)""", processing_level)
-                processing_level_data["processing_level_id"] = curs.lastrowid
-            else:
-                processing_level_data["processing_level_id"] = row[0]
-
-        # -------------------------------------------------------------------------- #
-        #   Extracts Data for Methods, Actions, ActionBy, and FeatureActions Table   #
-        # -------------------------------------------------------------------------- #
-
-        md_trees = search_wml(wml_tree, ns, ["method"], get_tree=True, mult=True)
-        method_data_list = [{"method_code": search_wml(md_tree, ns, ["methodCode", "MethodCode"], default_value=9999), "method_tree": md_tree, "method_id": None, "feature_action_id": None, "start_date": None, "start_date_offset": None, "value_count": None} for md_tree in md_trees] if md_trees else [{"method_code": 9999, "method_tree": None, "method_id": None}]
-        for method_data in method_data_list:
-            curs.execute("SELECT * FROM Methods WHERE MethodCode = ?", (method_data["method_code"],))
-            row = curs.fetchone()
-            if not row:
-                method = (
-                    "observation" if method_data["method_code"] != 9999 else "unknown",
-                    method_data["method_code"],
-                    method_data["method_code"] if method_data["method_code"] != 9999 else "unknown",
-                    search_wml(method_data["method_tree"], ns, ["methodDescription", "MethodDescription"], None) if method_data["method_code"] != 9999 else None,
-                    search_wml(method_data["method_tree"], ns, ["methodLink", "MethodLink"], None) if method_data["method_code"] != 9999 else None,
-                )
-                curs.execute("""INSERT INTO Methods (
-                                MethodID, 
-                                MethodTypeCV, 
-                                MethodCode, 
-                                MethodName,
-                                MethodDescription, 
-                                MethodLink
-                            ) VALUES (NULL, ?, ?, ?, ?, ?)""", method)
-                method_data["method_id"] = curs.lastrowid
-            else:
-                method_data["method_id"] = row[0]
-            method_code_list = search_wml(wml_tree, ns, ["value"], attr="methodCode", mult=True)
-            datetime_list = [i for j, i in enumerate(search_wml(wml_tree, ns, ["value"], attr="dateTime", mult=True)) if method_code_list[j] == method_data["method_code"] or not method_code_list[j]]
-            time_offset_list = search_wml(wml_tree, ns, ["value"], attr="timeOffset", mult=True)
-            start_date = datetime_list[0]
-            value_count = len(datetime_list)
-            end_date = datetime_list[-1]
-            method_data["start_date"] = start_date[0]
-            method_data["start_date_offset"] = time_offset_list[0] if time_offset_list[0] else "+00:00"
-            method_data["value_count"] = value_count
-            action = (
-                "observation",
-                method_data["method_id"],
-                start_date,
-                time_offset_list[0] if time_offset_list[0] else "+00:00",
-                end_date,
-                time_offset_list[-1] if time_offset_list[-1] else "+00:00",
-                "An observation action that generated a time series result.",
-            )
-            curs.execute("""INSERT INTO Actions (
-                            ActionID, 
-                            ActionTypeCV, 
-                            MethodID, 
-                            BeginDateTime,
-                            BeginDateTimeUTCOffset, 
-                            EndDateTime, 
-                            EndDateTimeUTCOffset, 
-                            ActionDescription
-                        ) VALUES (NULL, ?, ?, ?, ?, ?, ?, ?)""", action)
-            action_id = curs.lastrowid
-            action_by = (
-                action_id,
-                affiliation_id,
-                1,
-            )
-            curs.execute("""INSERT INTO ActionBy (
-                            BridgeID, 
-                            ActionID, 
-                            AffiliationID, 
-                            IsActionLead
-                        ) VALUES (NULL, ?, ?, ?)""", action_by)
-            action_by_id = curs.lastrowid
-            feature_action = (
-                sampling_feature_id,
-                action_id,
-            )
-            curs.execute("""INSERT INTO FeatureActions (
-                            FeatureActionID, 
-                            SamplingFeatureID, 
-                            ActionID
-                        ) VALUES (NULL, ?, ?)""", feature_action)
-            method_data["feature_action_id"] = curs.lastrowid
-
-        # ----------------------------------------------------------------------------------------------------- #
-        #    Extracts Data for Results, TimeSeriesResults, TimeSeriesResultValues, and DataSetResults Tables    #
-        # ----------------------------------------------------------------------------------------------------- #
-
-        result_data_list = list(itertools.product(method_data_list, processing_level_data_list))
-        for result_data in result_data_list:
-            result = (
-                str(uuid.uuid4()),
-                result_data[0]["feature_action_id"],
-                "timeSeriesCoverage",
-                variable_id,
-                unit_id,
-                result_data[1]["processing_level_id"],
-                result_data[0]["start_date"],
-                result_data[0]["start_date_offset"],
-                None,
-                search_wml(vr_tree, ns, ["sampleMedium"], default_value="unknown"),
-                result_data[0]["value_count"],
-            )
-            curs.execute("""INSERT INTO Results (
-                            ResultID, 
-                            ResultUUID, 
-                            FeatureActionID, 
-                            ResultTypeCV,
-                            VariableID, 
-                            UnitsID, 
-                            ProcessingLevelID, 
-                            ResultDateTime, 
-                            ResultDateTimeUTCOffset, 
-                            StatusCV, 
-                            SampledMediumCV, 
-                            ValueCount
-                        ) VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", result)
-            result_id = curs.lastrowid
-            timeseries_result = (
-                result_id,
-                "Unknown",
-            )
-            curs.execute("""INSERT INTO TimeSeriesResults (
-                            ResultID, 
-                            AggregationStatisticCV
-                        ) VALUES (?, ?)""", timeseries_result)
-            timeseries_result_values = tuple([(
-                result_id,
-                i[0],
-                i[1],
-                i[2] if i[2] else "+00:00",
-                i[3] if i[3] else "nc",
-                "unknown",
-                "unknown",
-                "unknown",
-            ) for i in list(map(list, zip(*[
-                search_wml(wml_tree, ns, ["value"], mult=True),
-                search_wml(wml_tree, ns, ["value"], attr="dateTime", mult=True),
-                search_wml(wml_tree, ns, ["value"], default_value="+00:00", attr="timeOffset", mult=True),
-                search_wml(wml_tree, ns, ["value"], default_value="nc", attr="censorCode", mult=True)
-            ])))])
-            curs.execute("BEGIN TRANSACTION;")
-            curs.executemany("""INSERT INTO TimeSeriesResultValues ( 
-                                ValueID, 
-                                ResultID, 
-                                DataValue, 
-                                ValueDateTime,
-                                ValueDateTimeUTCOffset, 
-                                CensorCodeCV, 
-                                QualityCodeCV, 
-                                TimeAggregationInterval,
-                                TimeAggregationIntervalUnitsID
-                            ) VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?)""", timeseries_result_values)
-            dataset_result = (
-                1,
-                result_id,
-            )
-            curs.execute("""INSERT INTO DataSetsResults ( 
-                            BridgeID, 
-                            DataSetID, 
-                            ResultID
-                        ) Values (NULL, ?, ?)""", dataset_result)
+        if row:
+            result_list.append({
+                "result_id": result_id,
+                "site_code": site_code,
+                "variable_code": variable_code,
+                "action_id": action_id,
+                "last_date": str(row[0]),
+                "last_date_offset": str(row[1]),
+                "last_epoch": int(get_utc_epochs([str(row[0])], [str(row[1])])[0])
+            })
+
+    # ---------------------------------- #
+    #   Fetches and Appends New Values   #
+    # ---------------------------------- #
+
+    for n, ts in enumerate(ts_list):
+        print("Updating Series " + str(n + 1), end=" ")
+        site_code = ts["site"]["siteCode"].split(":")[-1].lower()
+        variable_code = ts["variable"]["variableCode"].split(":")[-1].lower()
+        matching_results = [result for result in result_list
+                            if str(result["site_code"]).lower() == site_code
+                            and str(result["variable_code"]).lower() == variable_code]
+        if res_data.get("new_series") or not matching_results:
+            print("Adding as new result")
+            new_ids.append(n)
+            continue
 
-        # -------------------- #
-        #    Commits Changes   #
-        # -------------------- #
+        # Results may be stored in different UTC offsets, so the window starts at the earliest last value in UTC.
+        last_epoch = min(result["last_epoch"] for result in matching_results)
+        update_ts = dict(ts)
+        update_ts["beginDate"] = datetime.utcfromtimestamp(last_epoch).strftime("%Y-%m-%dT%H:%M:%S") + "+00:00"
+        update_ts["endDate"] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+        failed_urls = set()
+        series = fetch_series(update_ts, failed_urls)
+        if series is None and failed_urls:
+            print("Unable to fetch new values")
+            parse_status.append({"res_name": ts["site"]["siteName"], "res_status": "Update failed"})
+            continue
+        if series is None:
+            print("No new values found")
+            parse_status.append({"res_name": ts["site"]["siteName"], "res_status": "Success"})
+            continue
+        values, epochs = normalize_values(series["values"])
 
         try:
-            sql_connect.commit()
+            curs.execute("BEGIN TRANSACTION;")
+            for result in matching_results:
+                new_mask = epochs > result["last_epoch"]
+                value_count = int(new_mask.sum())
+                if value_count == 0:
+                    continue
+                new_values = dict((column, values[column][new_mask]) for column in values)
+                insert_values(curs, get_value_rows(result["result_id"], new_values,
+                                                   epochs[new_mask] if store_epochs else None), store_epochs)
+                curs.execute("UPDATE Results SET ValueCount = ValueCount + ? WHERE ResultID = ?",
+                             (value_count, result["result_id"]))
+                # New values are sorted by UTC time and all follow the stored ones, so the last one ends the Action.
+                end_date, end_date_offset = new_values["date_time"][-1], new_values["utc_offset"][-1]
+                curs.execute("UPDATE Actions SET EndDateTime = ?, EndDateTimeUTCOffset = ? WHERE ActionID = ?",
+                             (end_date, end_date_offset, result["action_id"]))
+            with stage_timer("commit"):
+                sql_connect.commit()
         except:
+            print("Unable to append values")
             sql_connect.rollback()
+            parse_status.append({"res_name": ts["site"]["siteName"], "res_status": "Update failed"})
             continue
         series_count += 1
+        parse_status.append({"res_name": ts["site"]["siteName"], "res_status": "Success"})
 
-    print("Database Created Successfully")
+    if new_ids:
+
+        # ------------------------------------------ #
+        #   Writes Unmatched Series as New Results   #
+        # ------------------------------------------ #
+
+        dataset = (
+            str(uuid.uuid4()),
+            "multiTimeSeries",
+            1,
+            refts_data["timeSeriesReferenceFile"].get("title"),
+            refts_data["timeSeriesReferenceFile"].get("abstract"),
+        )
+        written_ids = set()
+        for series_group in group_series_ids(ts_list, new_ids, should_reconcile(res_data)):
+            group_series, _ = fetch_series_group([ts_list[n] for n in series_group], series_group)
+            for series_ids, series in group_series:
+                try:
+                    curs.execute("BEGIN TRANSACTION;")
+                    write_odm2_series(curs, series, dataset)
+                    with stage_timer("commit"):
+                        sql_connect.commit()
+                except:
+                    print("Unable to write series")
+                    sql_connect.rollback()
+                    continue
+                written_ids.update(series_ids)
+        for n in new_ids:
+            res_status = "Success" if n in written_ids else "Update failed"
+            parse_status.append({"res_name": ts_list[n]["site"]["siteName"], "res_status": res_status})
+        series_count += len(written_ids)
+
+    sql_connect.close()
+    if res_data.get("finalize") and series_count > 0:
+        with stage_timer("finalize"):
+            finalize_odm2_database(res_filepath)
+
+    print("Database Updated Successfully")
     print(series_count)
 
     return_obj = {
         "res_type": "CompositeResource",
         "res_filepath": res_filepath,
+        "res_filename": res_filename,
+        "backup_filepath": backup_filepath,
         "file_extension": ".odm2.sqlite",
         "series_count": series_count,
         "parse_status": parse_status
@@ -793,67 +1695,68 @@ def create_ts_resource(res_data):
 
 def create_refts_resource(res_data):
 
-    user_workspace = get_user_workspace(res_data["request"])
-    json_data = json.loads(res_data['form_body'])["timeSeriesReferenceFile"]
-    series_count = 0
-    layer = []
+    user_workspace = get_res_workspace(res_data)
+    json_data = res_data['form_body']
+    while not isinstance(json_data, dict):
+        json_data = json.loads(json_data)
+    json_data = json_data["timeSeriesReferenceFile"]
     parse_status = []
     res_filepath = user_workspace + '/' + res_data['res_filename'] + '.refts.json'
 
-    try:
-        for selected_id in res_data["selected_resources"]:
-            layer.append(json_data['referencedTimeSeries'][selected_id])
-    except:
+    if not isinstance(json_data, dict):
         json_data = json.loads(json_data)
-        for selected_id in res_data["selected_resources"]:
-            layer.append(json_data['referencedTimeSeries'][selected_id])
-
-
-    json_dict = {
-        "timeSeriesReferenceFile": {
-            "fileVersion": json_data["fileVersion"],
-            "title": res_data["res_title"],
-            "symbol": json_data["symbol"],
-            "abstract": res_data["res_abstract"],
-            "keyWords": res_data["res_keywords"],
-            "referencedTimeSeries" : []
-        }
+    layer = (json_data['referencedTimeSeries'][selected_id] for selected_id in res_data["selected_resources"])
+
+    header = {
+        "fileVersion": json_data["fileVersion"],
+        "title": res_data["res_title"],
+        "symbol": json_data["symbol"],
+        "abstract": res_data["res_abstract"],
+        "keyWords": res_data["res_keywords"]
     }
 
-    for refts in layer:
-        series_count += 1
-        sub = {
-            "requestInfo": {
-                "serviceType": refts["requestInfo"]["serviceType"],
-                "refType": refts["requestInfo"]["refType"],
-                "returnType": refts["requestInfo"]["returnType"],
-                "networkName": refts["requestInfo"]["networkName"],
-                "url": refts["requestInfo"]["url"]
-            },
-            "sampleMedium": refts["sampleMedium"],
-            "valueCount": refts["valueCount"],
-            "beginDate": refts["beginDate"],
-            "endDate": refts["endDate"],
-            "site": {
-                "siteCode": refts["site"]["siteCode"],
-                "siteName": refts["site"]["siteName"],
-                "latitude": refts["site"]["latitude"],
-                "longitude": refts["site"]["longitude"]
-            },
-            "variable": {
-                "variableCode": refts["variable"]["variableCode"],
-                "variableName": refts["variable"]["variableName"]
-            },
-            "method": {
-                "methodDescription": refts["method"]["methodDescription"],
-                "methodLink": refts["method"]["methodLink"]
+    # Series are written to the file as they are built, so only one output series is held at a time.
+    def iter_layer_series():
+        for refts in layer:
+            sub = {
+                "requestInfo": {
+                    "serviceType": refts["requestInfo"]["serviceType"],
+                    "refType": refts["requestInfo"]["refType"],
+                    "returnType": refts["requestInfo"]["returnType"],
+                    "networkName": refts["requestInfo"]["networkName"],
+                    "url": refts["requestInfo"]["url"]
+                },
+                "sampleMedium": refts["sampleMedium"],
+                "valueCount": refts["valueCount"],
+                "beginDate": refts["beginDate"],
+                "endDate": refts["endDate"],
+                "site": {
+                    "siteCode": refts["site"]["siteCode"],
+                    "siteName": refts["site"]["siteName"],
+                    "latitude": refts["site"]["latitude"],
+                    "longitude": refts["site"]["longitude"]
+                },
+                "variable": {
+                    "variableCode": refts["variable"]["variableCode"],
+                    "variableName": refts["variable"]["variableName"]
+                },
+                "method": {
+                    "methodDescription": refts["method"]["methodDescription"],
+                    "methodLink": refts["method"]["methodLink"]
+                }
             }
-        }
-        json_dict["timeSeriesReferenceFile"]["referencedTimeSeries"].append(sub)
-        parse_status.append("SUCCESS")
-
-    with open(res_filepath, 'w') as res_file:
-        json.dump(json_dict, res_file, sort_keys=True, indent=4, separators=(',', ': '))
+            parse_status.append("SUCCESS")
+            yield sub
+
+    compact = res_data.get("compact_refts")
+    if compact is None:
+        compact = getattr(settings, "HS_RESOURCE_CREATOR_COMPACT_REFTS", False)
+
+    with stage_timer("refts_write") as stage_record:
+        with open(res_filepath, 'w') as res_file:
+            series_count = write_refts(res_file, header, iter_layer_series(), compact=bool(compact))
+        stage_record["rows"] = series_count
+        stage_record["bytes"] = os.path.getsize(res_filepath)
 
     return_obj = {"res_type": "CompositeResource",
                   "res_filepath": res_filepath,